@@ -19,20 +19,62 @@ PYBIND11_MODULE(cpp_kernels, m)
 	  py::arg("lpos0"), py::arg("lpos1"), py::arg("lpos2"),
 	  py::arg("pixsize"), py::arg("periodic"));
 
+    m.def("cic_interpolate_3d_multi", cic_interpolate_3d_multi,
+	  py::arg("grids"), py::arg("points"),
+	  py::arg("lpos0"), py::arg("lpos1"), py::arg("lpos2"),
+	  py::arg("pixsize"), py::arg("periodic"));
+
+    m.def("cubic_interpolate_3d_multi", cubic_interpolate_3d_multi,
+	  py::arg("grids"), py::arg("points"),
+	  py::arg("lpos0"), py::arg("lpos1"), py::arg("lpos2"),
+	  py::arg("pixsize"), py::arg("periodic"));
+
     m.def("cic_grid_3d", cic_grid_3d,
 	  py::arg("grid"), py::arg("points"), py::arg("weights"),
 	  py::arg("wscal"), py::arg("lpos0"), py::arg("lpos1"),
-	  py::arg("lpos2"), py::arg("pixsize"), py::arg("periodic"));
+	  py::arg("lpos2"), py::arg("pixsize"), py::arg("periodic"),
+	  py::arg("nthreads"));
 
     m.def("cubic_grid_3d", cubic_grid_3d,
 	  py::arg("grid"), py::arg("points"), py::arg("weights"),
 	  py::arg("wscal"), py::arg("lpos0"), py::arg("lpos1"),
-	  py::arg("lpos2"), py::arg("pixsize"), py::arg("periodic"));
+	  py::arg("lpos2"), py::arg("pixsize"), py::arg("periodic"),
+	  py::arg("nthreads"));
+
+    m.def("cic_grid_3d_multi", cic_grid_3d_multi,
+	  py::arg("grid"), py::arg("points"), py::arg("weights"),
+	  py::arg("wscal"), py::arg("lpos0"), py::arg("lpos1"),
+	  py::arg("lpos2"), py::arg("pixsize"), py::arg("periodic"),
+	  py::arg("nthreads"));
+
+    m.def("cubic_grid_3d_multi", cubic_grid_3d_multi,
+	  py::arg("grid"), py::arg("points"), py::arg("weights"),
+	  py::arg("wscal"), py::arg("lpos0"), py::arg("lpos1"),
+	  py::arg("lpos2"), py::arg("pixsize"), py::arg("periodic"),
+	  py::arg("nthreads"));
+
+    m.def("cic_stencil_3d", cic_stencil_3d,
+	  py::arg("points"), py::arg("n0"), py::arg("n1"), py::arg("n2"),
+	  py::arg("lpos0"), py::arg("lpos1"), py::arg("lpos2"),
+	  py::arg("pixsize"), py::arg("periodic"), py::arg("single_precision"));
+
+    m.def("cubic_stencil_3d", cubic_stencil_3d,
+	  py::arg("points"), py::arg("n0"), py::arg("n1"), py::arg("n2"),
+	  py::arg("lpos0"), py::arg("lpos1"), py::arg("lpos2"),
+	  py::arg("pixsize"), py::arg("periodic"), py::arg("single_precision"));
+
+    m.def("stencil_interpolate_3d", stencil_interpolate_3d,
+	  py::arg("grid"), py::arg("indices"), py::arg("weights"));
+
+    m.def("stencil_grid_3d", stencil_grid_3d,
+	  py::arg("grid"), py::arg("indices"), py::arg("weights"),
+	  py::arg("pweights"), py::arg("coeff"), py::arg("periodic"),
+	  py::arg("nthreads"));
 
     m.def("estimate_power_spectrum", estimate_power_spectrum,
 	  py::arg("map_list"), py::arg("k_delim"),
 	  py::arg("npix"), py::arg("kf"),
-	  py::arg("box_volume"));
+	  py::arg("box_volume"), py::arg("nthreads"), py::arg("kernel"));
 
     m.def("kbin_average", kbin_average,
 	  py::arg("fk"), py::arg("k_delim"),
@@ -46,4 +88,14 @@ PYBIND11_MODULE(cpp_kernels, m)
     m.def("multiply_xli_fourier_space", multiply_xli_fourier_space,
 	  py::arg("dst"), py::arg("src"), py::arg("l"), py::arg("i"),
 	  py::arg("nz"), py::arg("coeff"), py::arg("accum"));
+
+    m.def("multiply_xli_fourier_space_slab", multiply_xli_fourier_space_slab,
+	  py::arg("dst"), py::arg("src"), py::arg("l"), py::arg("i"),
+	  py::arg("ny"), py::arg("j1"), py::arg("nz"), py::arg("coeff"), py::arg("accum"));
+
+    m.def("rfft_untangle_3d", rfft_untangle_3d,
+	  py::arg("arr"), py::arg("nz"), py::arg("forward"));
+
+    m.def("rfft_untangle_rows", rfft_untangle_rows,
+	  py::arg("arr"), py::arg("nz"), py::arg("forward"));
 }
@@ -6,6 +6,7 @@
 #include <stdexcept>
 #include <pybind11/pybind11.h>
 #include <pybind11/numpy.h>
+#include <pybind11/stl.h>
 
 // Hardware branch predictor hint.
 #ifndef _unlikely
@@ -26,17 +27,47 @@ extern py::array_t<double> cic_interpolate_3d(py::array_t<const double> &grid, p
 extern py::array_t<double> cubic_interpolate_3d(py::array_t<const double> &grid, py::array_t<const double> &points,
 						double lpos0, double lpos1, double lpos2, double pixsize, bool periodic);
 
+extern py::array_t<double> cic_interpolate_3d_multi(std::vector<py::array_t<const double>> &grids, py::array_t<const double> &points,
+						    double lpos0, double lpos1, double lpos2, double pixsize, bool periodic);
+
+extern py::array_t<double> cubic_interpolate_3d_multi(std::vector<py::array_t<const double>> &grids, py::array_t<const double> &points,
+						      double lpos0, double lpos1, double lpos2, double pixsize, bool periodic);
+
 
 extern void cic_grid_3d(py::array_t<double> &grid, py::array_t<const double> &points, py::array_t<const double> &weights,
-			double wscal, double lpos0, double lpos1, double lpos2, double pixsize, bool periodic);
+			double wscal, double lpos0, double lpos1, double lpos2, double pixsize, bool periodic,
+			int nthreads);
 
 extern void cubic_grid_3d(py::array_t<double> &grid, py::array_t<const double> &points, py::array_t<const double> &weights,
-			  double wscal, double lpos0, double lpos1, double lpos2, double pixsize, bool periodic);
+			  double wscal, double lpos0, double lpos1, double lpos2, double pixsize, bool periodic,
+			  int nthreads);
+
+extern void cic_grid_3d_multi(py::array_t<double> &grid, py::array_t<const double> &points, py::array_t<const double> &weights,
+			      double wscal, double lpos0, double lpos1, double lpos2, double pixsize, bool periodic,
+			      int nthreads);
+
+extern void cubic_grid_3d_multi(py::array_t<double> &grid, py::array_t<const double> &points, py::array_t<const double> &weights,
+				double wscal, double lpos0, double lpos1, double lpos2, double pixsize, bool periodic,
+				int nthreads);
+
 
+extern py::tuple cic_stencil_3d(py::array_t<const double> &points, long n0, long n1, long n2,
+				double lpos0, double lpos1, double lpos2, double pixsize, bool periodic,
+				bool single_precision);
+
+extern py::tuple cubic_stencil_3d(py::array_t<const double> &points, long n0, long n1, long n2,
+				  double lpos0, double lpos1, double lpos2, double pixsize, bool periodic,
+				  bool single_precision);
+
+extern py::array_t<double> stencil_interpolate_3d(py::array_t<const double> &grid, py::array_t<const int32_t> &indices,
+						  py::array &weights);
+
+extern void stencil_grid_3d(py::array_t<double> &grid, py::array_t<const int32_t> &indices, py::array &weights,
+			    py::array_t<const double> &pweights, double coeff, bool periodic, int nthreads);
 
 extern py::tuple estimate_power_spectrum(py::list map_list, py::array_t<const double> &k_delim,
 					 py::array_t<const long> &npix, py::array_t<const double> &kf,
-					 double box_volume);
+					 double box_volume, int nthreads, int kernel);
 
 extern py::tuple kbin_average(py::array_t<const double> &fk, py::array_t<const double> &k_delim,
 			      py::array_t<const long> &npix, py::array_t<const double> &kf);
@@ -51,6 +82,14 @@ extern void multiply_xli_fourier_space(py::array_t<std::complex<double>> &dst_,
 				       int l, int i, long nz, std::complex<double> coeff,
 				       bool accum);
 
+extern void multiply_xli_fourier_space_slab(py::array_t<std::complex<double>> &dst_,
+					    py::array_t<const std::complex<double>> &src_,
+					    int l, int i, long ny, long j1, long nz,
+					    std::complex<double> coeff, bool accum);
+
+extern void rfft_untangle_3d(py::array_t<std::complex<double>> &arr, long nz, bool forward);
+extern void rfft_untangle_rows(py::array_t<std::complex<double>> &arr, long nz, bool forward);
+
 
 // -------------------------------------------------------------------------------------------------
 //
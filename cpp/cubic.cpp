@@ -1,6 +1,8 @@
 #include <iostream>
 #include "cpp_kernels.hpp"
 #include "interpolation_args.hpp"
+#include "slab_partition.hpp"
+#include "stencil.hpp"
 
 using namespace std;
 
@@ -38,6 +40,14 @@ struct cubic_axis
 	this->i2 = stride * wrap_hi(i+1,n);
 	this->i3 = stride * wrap_hi(i+2,n);
     }
+
+    // Used in make_stencil_3d().
+    template<typename W>
+    inline void store(int32_t *ix, W *w) const
+    {
+	ix[0] = i0;  ix[1] = i1;  ix[2] = i2;  ix[3] = i3;
+	w[0] = w0;  w[1] = w1;  w[2] = w2;  w[3] = w3;
+    }
 };
 
 
@@ -96,6 +106,97 @@ py::array_t<double> cubic_interpolate_3d(py::array_t<const double> &grid, py::ar
 }
 
 
+// Helpers for cubic_interpolate_3d_multi(). The loops over fields are innermost (and vectorizable),
+// but the floating-point operations are the same as cubic_interp_3d(), so results are bitwise identical.
+
+static constexpr int cubic_multi_chunk = 8;   // max number of fields processed per call to cubic_interp_3d_multi()
+
+template<typename F>
+inline void cubic_interp_2d_multi(cubic_axis &ax1, cubic_axis &ax2, const F &fields, long f0, long offset, int nf, double *out)
+{
+    const double w1[4] = { ax1.w0, ax1.w1, ax1.w2, ax1.w3 };
+    const double w2[4] = { ax2.w0, ax2.w1, ax2.w2, ax2.w3 };
+    const long i1[4] = { ax1.i0, ax1.i1, ax1.i2, ax1.i3 };
+    const long i2[4] = { ax2.i0, ax2.i1, ax2.i2, ax2.i3 };
+
+    for (int b = 0; b < 4; b++) {
+	long p = offset + i1[b];
+	for (int f = 0; f < nf; f++) {
+	    const double *q = fields(f0+f) + p;
+	    double t = (w2[0] * q[i2[0]]);
+	    for (int c = 1; c < 4; c++)
+		t += (w2[c] * q[i2[c]]);
+	    out[f] = b ? (out[f] + (w1[b] * t)) : (w1[b] * t);
+	}
+    }
+}
+
+template<typename F>
+inline void cubic_interp_3d_multi(cubic_axis &ax0, cubic_axis &ax1, cubic_axis &ax2, const F &fields, long f0, int nf, double *out)
+{
+    const double w0[4] = { ax0.w0, ax0.w1, ax0.w2, ax0.w3 };
+    const long i0[4] = { ax0.i0, ax0.i1, ax0.i2, ax0.i3 };
+    double t[cubic_multi_chunk];
+
+    for (int a = 0; a < 4; a++) {
+	cubic_interp_2d_multi(ax1, ax2, fields, f0, i0[a], nf, t);
+	for (int f = 0; f < nf; f++)
+	    out[f] = a ? (out[f] + (w0[a] * t[f])) : (w0[a] * t[f]);
+    }
+}
+
+
+// Helper for cubic_interpolate_3d_multi(), templated on field addressing (strided_fields or pointer_fields).
+
+template<typename F>
+static void cubic_interpolate_3d_multi(interpolation_args<const double> &args, const F &fields, bool periodic, double *rdata)
+{
+    long npoints = args.npoints;
+
+#pragma omp parallel for schedule(guided,32)
+    for (long i = 0; i < npoints; i++) {
+	double x, y, z;
+	args.get_xyz(i, x, y, z);
+	
+	cubic_axis ax0(x, args.gn0, args.gs0, periodic);
+	cubic_axis ax1(y, args.gn1, args.gs1, periodic);
+	cubic_axis ax2(z, args.gn2, args.gs2, periodic);
+
+	for (long f0 = 0; f0 < args.nfields; f0 += cubic_multi_chunk) {
+	    int nf = std::min(args.nfields - f0, long(cubic_multi_chunk));
+	    double out[cubic_multi_chunk];
+	    
+	    cubic_interp_3d_multi(ax0, ax1, ax2, fields, f0, nf, out);
+	    for (int f = 0; f < nf; f++)
+		rdata[(f0+f)*npoints + i] = out[f];
+	}
+    }
+}
+
+
+// Interpolates 'nfields' grids at the same points, computing the stencil for each point once.
+// The 'grids' argument is a list of 3-d arrays with the same shape and strides (see interpolation_args),
+// and the returned array has shape (nfields,npoints). Fastest if the grids are interleaved in memory
+// (i.e. views of one array whose 'field' axis has the smallest stride, see core.interpolate_points_multi()).
+
+py::array_t<double> cubic_interpolate_3d_multi(std::vector<py::array_t<const double>> &grids, py::array_t<const double> &points, double lpos0, double lpos1, double lpos2, double pixsize, bool periodic)
+{
+    interpolation_args<const double> args(grids, points, lpos0, lpos1, lpos2, pixsize);
+    
+    if ((args.gn0 < 4) || (args.gn1 < 4) || (args.gn2 < 4))
+	throw runtime_error("kszx.interpolate_points_multi('cubic'): all grid dimensions must be >= 4");
+
+    py::array_t<double> ret({args.nfields, args.npoints});
+
+    if (args.gfields_strided)
+	cubic_interpolate_3d_multi(args, strided_fields{args.gdata, args.gsf}, periodic, ret.mutable_data());
+    else
+	cubic_interpolate_3d_multi(args, pointer_fields{args.gfields.data()}, periodic, ret.mutable_data());
+
+    return ret;
+}
+
+
 // -------------------------------------------------------------------------------------------------
 //
 // Cubic gridding.
@@ -126,14 +227,14 @@ inline void cubic_grid_3d(cubic_axis &ax0, cubic_axis &ax1, cubic_axis &ax2, dou
 }
 
 
-void cubic_grid_3d(py::array_t<double> &grid, py::array_t<const double> &points, py::array_t<const double> &weights, double wscal, double lpos0, double lpos1, double lpos2, double pixsize, bool periodic)
+void cubic_grid_3d(py::array_t<double> &grid, py::array_t<const double> &points, py::array_t<const double> &weights, double wscal, double lpos0, double lpos1, double lpos2, double pixsize, bool periodic, int nthreads)
 {
     interpolation_args<double> args(grid, points, weights, wscal, lpos0, lpos1, lpos2, pixsize);
     
     if ((args.gn0 < 4) || (args.gn1 < 4) || (args.gn2 < 4))
 	throw runtime_error("kszx.grid_points('cubic'): all grid dimensions must be >= 4");
 
-    for (long i = 0; i < args.npoints; i++) {
+    grid_slab_parallel(args, periodic, nthreads, [&](long i) {
 	double x, y, z, w;
 	args.get_xyzw(i, x, y, z, w);
 	
@@ -142,5 +243,48 @@ void cubic_grid_3d(py::array_t<double> &grid, py::array_t<const double> &points,
 	cubic_axis ax2(z, args.gn2, args.gs2, periodic);
 	
 	cubic_grid_3d(ax0, ax1, ax2, args.gdata, w);
-    }
+    });
+}
+
+
+// Grids 'nfields' weight vectors over the same points, computing the stencil for each point once.
+// The 'grid' array has shape (nfields,n0,n1,n2), and the 'weights' array has shape (nfields,npoints).
+
+void cubic_grid_3d_multi(py::array_t<double> &grid, py::array_t<const double> &points, py::array_t<const double> &weights, double wscal, double lpos0, double lpos1, double lpos2, double pixsize, bool periodic, int nthreads)
+{
+    interpolation_args<double> args(grid, points, weights, wscal, lpos0, lpos1, lpos2, pixsize, true);
+
+    if ((args.gn0 < 4) || (args.gn1 < 4) || (args.gn2 < 4))
+	throw runtime_error("kszx.grid_points_multi('cubic'): all grid dimensions must be >= 4");
+
+    grid_slab_parallel(args, periodic, nthreads, [&](long i) {
+	double x, y, z;
+	args.get_xyz(i, x, y, z);
+	
+	cubic_axis ax0(x, args.gn0, args.gs0, periodic);
+	cubic_axis ax1(y, args.gn1, args.gs1, periodic);
+	cubic_axis ax2(z, args.gn2, args.gs2, periodic);
+
+	for (long f = 0; f < args.nfields; f++)
+	    cubic_grid_3d(ax0, ax1, ax2, args.gdata + f*args.gsf, args.get_w(i,f));
+    });
+}
+
+
+// -------------------------------------------------------------------------------------------------
+//
+// Precomputed cubic stencils (see stencil.hpp).
+
+
+py::tuple cubic_stencil_3d(py::array_t<const double> &points, long n0, long n1, long n2, double lpos0, double lpos1, double lpos2, double pixsize, bool periodic, bool single_precision)
+{
+    interpolation_args<const double> args(points, n0, n1, n2, lpos0, lpos1, lpos2, pixsize);
+    
+    if ((args.gn0 < 4) || (args.gn1 < 4) || (args.gn2 < 4))
+	throw runtime_error("kszx.PointStencil('cubic'): all grid dimensions must be >= 4");
+
+    if (single_precision)
+	return make_stencil_3d<cubic_axis, 4, float> (args, periodic);
+    else
+	return make_stencil_3d<cubic_axis, 4, double> (args, periodic);
 }
@@ -33,46 +33,73 @@ struct interpolation_args
     double w0 = 0.0;  // overall constant (= wscal / pixel_volume)
     
 
+    // Optional: only used in "multi" gridding/interpolation kernels, where 'grid' has shape
+    // (nfields,n0,n1,n2), and 'weights' (if gridding) has shape (nfields,npoints).
+    long nfields = 1;
+    long gsf = 0;  // grid stride along 'field' axis
+    long wsf = 0;  // weights stride along 'field' axis
+
+    // Optional: only used in "multi" interpolation kernels, where the grids are a list of
+    // 3-d arrays with the same shape and strides (but arbitrary base pointers). If the base
+    // pointers are evenly spaced (e.g. if the grids are views of one 4-d array), then
+    // 'gfields_strided' is true, and 'gsf' is the spacing.
+    std::vector<T *> gfields;
+    bool gfields_strided = false;
+
+
     // This constructor does not have a 'weights' array, and is used in interpolation kernels.
     interpolation_args(py::array_t<T> &grid, py::array_t<const double> &points, double lpos0_, double lpos1_, double lpos2_, double pixsize)
     {
-	// Argument checking.
-    
 	if (grid.ndim() != 3)
 	    throw std::runtime_error("expected 'grid' to be a 3-d array");
-	if (points.ndim() != 2)
-	    throw std::runtime_error("expected 'points' to be a 2-d array");
-	if (points.shape(1) != 3)
-	    throw std::runtime_error("expected 'points' to be a shape (N,3) array");
-	if (pixsize <= 0)
-	    throw std::runtime_error("expected pixsize > 0");
 
-	// Unpack python arrays into C++ pointers/ints.
+	_init_grid(grid, 0);
+	_init_points(points, lpos0_, lpos1_, lpos2_, pixsize);
+    }
 
-	if constexpr (std::is_const<T>::value)
-            gdata = grid.data();
-        else
-            gdata = grid.mutable_data();
+    // This constructor is used in "multi" interpolation kernels. The 'grids' argument is a list of
+    // 3-d arrays with the same shape and strides, and there is no 'weights' array. (A 4-d array with
+    // shape (nfields,n0,n1,n2) can be passed from python as list(arr), without copying.)
+    interpolation_args(std::vector<py::array_t<T>> &grids, py::array_t<const double> &points, double lpos0_, double lpos1_, double lpos2_, double pixsize)
+    {
+	if (grids.size() == 0)
+	    throw std::runtime_error("expected at least one grid");
 	
-	gn0 = get_shape(grid, 0);
-	gn1 = get_shape(grid, 1);
-	gn2 = get_shape(grid, 2);
-	gs0 = get_stride(grid, 0);
-	gs1 = get_stride(grid, 1);
-	gs2 = get_stride(grid, 2);
+	for (auto &grid: grids) {
+	    if (grid.ndim() != 3)
+		throw std::runtime_error("expected each grid to be a 3-d array");
+	    for (int d = 0; d < 3; d++)
+		if ((get_shape(grid,d) != get_shape(grids[0],d)) || (get_stride(grid,d) != get_stride(grids[0],d)))
+		    throw std::runtime_error("expected all grids to have the same shape and strides");
+	}
 
-	if ((gn0 < 2) || (gn1 < 2) || (gn2 < 2))
+	_init_grid(grids[0], 0);
+	_init_points(points, lpos0_, lpos1_, lpos2_, pixsize);
+
+	nfields = grids.size();
+	for (auto &grid: grids)
+	    gfields.push_back(_grid_data(grid));
+
+	gsf = (nfields > 1) ? (gfields[1] - gfields[0]) : 0;
+	gfields_strided = true;
+	for (long f = 2; f < nfields; f++)
+	    gfields_strided = gfields_strided && (gfields[f] - gfields[0] == f*gsf);
+    }
+
+    // This constructor does not have a 'grid' array, and is used to precompute stencils (see stencil.hpp).
+    // Grid strides are set to 1, so that the cic_axis/cubic_axis structs will contain unstrided indices.
+    interpolation_args(py::array_t<const double> &points, long n0, long n1, long n2, double lpos0_, double lpos1_, double lpos2_, double pixsize)
+    {
+	if ((n0 < 2) || (n1 < 2) || (n2 < 2))
 	    throw std::runtime_error("expected all grid dimensions >= 2");
 	
-	pdata = points.data();
-	npoints = points.shape(0);
-	ps0 = get_stride(points, 0);
-	ps1 = get_stride(points, 1);
-
-	lpos0 = lpos0_;
-	lpos1 = lpos1_;
-	lpos2 = lpos2_;
-	rec_ps = 1.0 / pixsize;
+	gdata = nullptr;
+	gn0 = n0;
+	gn1 = n1;
+	gn2 = n2;
+	gs0 = gs1 = gs2 = 1;
+	
+	_init_points(points, lpos0_, lpos1_, lpos2_, pixsize);
     }
 
     // This constructor does have a 'weights' array, and is used in gridding kernels.
@@ -93,6 +120,77 @@ struct interpolation_args
 	w0 = wscal * rec_ps * rec_ps * rec_ps;	
     }
 
+    // This constructor is used in "multi" gridding kernels. The 'grid' array has shape (nfields,n0,n1,n2),
+    // and the 'weights' array has shape (nfields,npoints). (The 'multi' argument is only used to select
+    // this constructor, and must be true.)
+    interpolation_args(py::array_t<T> &grid, py::array_t<const double> &points, py::array_t<const double> &weights, double wscal, double lpos0_, double lpos1_, double lpos2_, double pixsize, bool multi)
+    {
+	if (!multi)
+	    throw std::runtime_error("interpolation_args: expected multi=true");
+	if (grid.ndim() != 4)
+	    throw std::runtime_error("expected 'grid' to be a 4-d array");
+	
+	_init_grid(grid, 1);
+	_init_points(points, lpos0_, lpos1_, lpos2_, pixsize);
+
+	nfields = get_shape(grid, 0);
+	gsf = get_stride(grid, 0);
+
+	if ((weights.ndim() != 2) || (weights.shape(0) != nfields) || (weights.shape(1) != npoints))
+	    throw std::runtime_error("expected 'weights' array to have shape (nfields,npoints)");
+
+	wdata = weights.data();
+	wsf = get_stride(weights, 0);
+	ws = get_stride(weights, 1);
+	w0 = wscal * rec_ps * rec_ps * rec_ps;
+    }
+
+
+    // Helper for constructors: unpack grid axes (a0, a0+1, a0+2).
+    void _init_grid(py::array_t<T> &grid, int a0)
+    {
+	gdata = _grid_data(grid);
+	
+	gn0 = get_shape(grid, a0);
+	gn1 = get_shape(grid, a0+1);
+	gn2 = get_shape(grid, a0+2);
+	gs0 = get_stride(grid, a0);
+	gs1 = get_stride(grid, a0+1);
+	gs2 = get_stride(grid, a0+2);
+
+	if ((gn0 < 2) || (gn1 < 2) || (gn2 < 2))
+	    throw std::runtime_error("expected all grid dimensions >= 2");
+    }
+
+    static T *_grid_data(py::array_t<T> &grid)
+    {
+	if constexpr (std::is_const<T>::value)
+            return grid.data();
+        else
+            return grid.mutable_data();
+    }
+
+    // Helper for constructors: unpack 'points' array, and (lpos, pixsize).
+    void _init_points(py::array_t<const double> &points, double lpos0_, double lpos1_, double lpos2_, double pixsize)
+    {
+	if (points.ndim() != 2)
+	    throw std::runtime_error("expected 'points' to be a 2-d array");
+	if (points.shape(1) != 3)
+	    throw std::runtime_error("expected 'points' to be a shape (N,3) array");
+	if (pixsize <= 0)
+	    throw std::runtime_error("expected pixsize > 0");
+	
+	pdata = points.data();
+	npoints = points.shape(0);
+	ps0 = get_stride(points, 0);
+	ps1 = get_stride(points, 1);
+
+	lpos0 = lpos0_;
+	lpos1 = lpos1_;
+	lpos2 = lpos2_;
+	rec_ps = 1.0 / pixsize;
+    }
+
     
     // Get (x,y,z) in "grid coordinates".
     inline void get_xyz(long i, double &x, double &y, double &z)
@@ -108,6 +206,30 @@ struct interpolation_args
 	get_xyz(i, x, y, z);
 	w = w0 * wdata[i*ws];  // note factor w0 = wscal / (pixel volume)
     }
+
+    // Get gridding weight for the i-th point and f-th field (in "multi" gridding kernels).
+    inline double get_w(long i, long f)
+    {
+	return w0 * wdata[f*wsf + i*ws];
+    }
+};
+
+
+// Field addressing in "multi" interpolation kernels: fields(f) returns the base pointer of the f-th
+// grid. The kernels are templated on the addressing, so that the common case of evenly spaced grids
+// (strided_fields) compiles to the same code as indexing a 4-d array.
+
+struct strided_fields
+{
+    const double *base;
+    long stride;
+    inline const double *operator()(long f) const { return base + f*stride; }
+};
+
+struct pointer_fields
+{
+    const double *const *ptrs;
+    inline const double *operator()(long f) const { return ptrs[f]; }
 };
 
 
@@ -21,6 +21,7 @@
 
 #include <omp.h>
 #include <cmath>
+#include <vector>
 #include "cpp_kernels.hpp"
 
 using namespace std;
@@ -111,6 +112,56 @@ struct xlm_helper
 
 	return xli;
     }
+
+    // Vectorizable version of get(), for a row of points (x, y, z[j]) where 0 <= j < n.
+    // Writes x_{li} to out[j]. The 'tmp' array must have length 4*n. (Same floating-point
+    // operations as get(), but reordered so that the inner loops are over j.)
+    inline void get_row(double x, double y, const double *z, long n, double *out, double *tmp) const
+    {
+	double *xt = tmp;
+	double *yt = tmp + n;
+	double *zt = tmp + 2*n;
+	double *prev = tmp + 3*n;
+
+	for (long j = 0; j < n; j++) {
+	    double t = 1.0 / sqrt(x*x + y*y + z[j]*z[j]);
+	    xt[j] = x * t;
+	    yt[j] = y * t;
+	    zt[j] = z[j] * t;
+	}
+
+	// (out + i*prev) = (x+iy)^m
+	
+	for (long j = 0; j < n; j++) {
+	    out[j] = 1.0;
+	    prev[j] = 0.0;
+	}
+
+	for (int mm = 0; mm < m; mm++) {
+	    for (long j = 0; j < n; j++) {
+		double new_ere = out[j]*xt[j] - prev[j]*yt[j];
+		double new_eim = out[j]*yt[j] + prev[j]*xt[j];
+		out[j] = new_ere;
+		prev[j] = new_eim;
+	    }
+	}
+
+	for (long j = 0; j < n; j++) {
+	    out[j] = C * (reim ? prev[j] : out[j]);
+	    prev[j] = 0.0;
+	}
+
+	for (int ll = m; ll < l; ll++) {
+	    double a = eps_rec[ll+1];
+	    double b = eps_rat[ll+1];
+	    
+	    for (long j = 0; j < n; j++) {
+		double xli_next = (a * zt[j] * out[j]) - (b * prev[j]);
+		prev[j] = out[j];
+		out[j] = xli_next;
+	    }
+	}
+    }
 };
 
 
@@ -180,23 +231,35 @@ inline void _multiply_xli_real_space(grid_helper<double> &dst, grid_helper<const
 	return;
     }
 	
-#pragma omp parallel for
-    for (long i0 = 0; i0 < dst.n0; i0++) {
-	double x = lpos0 + (i0 * pixsize);
-	for (long i1 = 0; i1 < dst.n1; i1++) {
-	    double y = lpos1 + (i1 * pixsize);
-	    double *dp = dst.data + (i0 * dst.s0) + (i1 * dst.s1);
-	    const double *sp = src.data + (i0 * src.s0) + (i1 * src.s1);
-	    
-	    for (long i2 = 0; i2 < dst.n2; i2++) {
-		double z = lpos2 + (i2 * pixsize);
-		double xli = h.get(x, y, z);
-		double v = coeff * xli * sp[i2 * src.s2];
-
-		if constexpr (Accum)
-		    dp[i2 * dst.s2] += v;
-		else
-		    dp[i2 * dst.s2] = v;
+    long n2 = dst.n2;
+    vector<double> zvec(n2);
+    
+    for (long i2 = 0; i2 < n2; i2++)
+	zvec[i2] = lpos2 + (i2 * pixsize);
+    
+#pragma omp parallel
+    {
+	vector<double> xli(n2);
+	vector<double> tmp(4*n2);
+	
+#pragma omp for
+	for (long i0 = 0; i0 < dst.n0; i0++) {
+	    double x = lpos0 + (i0 * pixsize);
+	    for (long i1 = 0; i1 < dst.n1; i1++) {
+		double y = lpos1 + (i1 * pixsize);
+		double *dp = dst.data + (i0 * dst.s0) + (i1 * dst.s1);
+		const double *sp = src.data + (i0 * src.s0) + (i1 * src.s1);
+
+		h.get_row(x, y, &zvec[0], n2, &xli[0], &tmp[0]);
+		
+		for (long i2 = 0; i2 < n2; i2++) {
+		    double v = coeff * xli[i2] * sp[i2 * src.s2];
+
+		    if constexpr (Accum)
+			dp[i2 * dst.s2] += v;
+		    else
+			dp[i2 * dst.s2] = v;
+		}
 	    }
 	}
     }
@@ -221,8 +284,12 @@ void multiply_xli_real_space(py::array_t<double> &dst_, py::array_t<const double
 }
 
 
+// The (ny, j1) arguments are used when 'dst' and 'src' are slabs along axis 1 (see
+// multiply_xli_fourier_space_slab()): the full array has length 'ny' along axis 1,
+// and the slab starts at index 'j1'.
+
 template<bool Accum>
-inline void _multiply_xli_fourier_space(grid_helper<complex<double>> &dst, grid_helper<const complex<double>> &src, xlm_helper &h, long nz, complex<double> coeff)
+inline void _multiply_xli_fourier_space(grid_helper<complex<double>> &dst, grid_helper<const complex<double>> &src, xlm_helper &h, long nz, complex<double> coeff, long ny, long j1)
 {
     if (h.l == 0) {
 	// Note that for l=0, we don't zero the DC/nyquist modes.
@@ -231,37 +298,60 @@ inline void _multiply_xli_fourier_space(grid_helper<complex<double>> &dst, grid_
     }
 
     double rec_nz = 1.0 / nz;
-    
-#pragma omp parallel for
-    for (long i0 = 0; i0 < dst.n0; i0++) {
-	double x = (2*i0 > dst.n0) ? (i0 - dst.n0) : (i0);
-	x /= dst.n0;
+    long n2 = dst.n2;
+    vector<double> zvec(n2);
 
-	for (long i1 = 0; i1 < dst.n1; i1++) {
-	    complex<double> *dp = dst.data + (i0 * dst.s0) + (i1 * dst.s1);
-	    const complex<double> *sp = src.data + (i0 * src.s0) + (i1 * src.s1);
-	    double y = (2*i1 > dst.n1) ? (i1 - dst.n1) : (i1);
-	    y /= dst.n1;
+    for (long i2 = 0; i2 < n2; i2++)
+	zvec[i2] = rec_nz * i2;
+    
+#pragma omp parallel
+    {
+	vector<double> xli(n2);
+	vector<double> tmp(4*n2);
+	
+#pragma omp for
+	for (long i0 = 0; i0 < dst.n0; i0++) {
+	    double x = (2*i0 > dst.n0) ? (i0 - dst.n0) : (i0);
+	    x /= dst.n0;
+
+	    for (long i1 = 0; i1 < dst.n1; i1++) {
+		complex<double> *dp = dst.data + (i0 * dst.s0) + (i1 * dst.s1);
+		const complex<double> *sp = src.data + (i0 * src.s0) + (i1 * src.s1);
+		long k1 = i1 + j1;
+		double y = (2*k1 > ny) ? (k1 - ny) : (k1);
+		y /= ny;
+
+		if ((2*i0 == dst.n0) || (2*k1 == ny)) {
+		    // Nyquist row.
+		    for (long i2 = 0; i2 < n2; i2++)
+			xli[i2] = 0.0;
+		}
+		else {
+		    h.get_row(x, y, &zvec[0], n2, &xli[0], &tmp[0]);
+		    if (i0 + k1 == 0)
+			xli[0] = 0.0;   // DC mode
+		    if (2*(n2-1) == nz)
+			xli[n2-1] = 0.0;  // Nyquist mode along last axis
+		}
 	    
-	    for (long i2 = 0; i2 < dst.n2; i2++) {
-		double z = rec_nz * i2;
-		bool dc = (i0+i1+i2) == 0;
-		bool nyq = (2*i0 == dst.n0) || (2*i1 == dst.n1) || (2*i2 == nz);
-		
-		double xli = (nyq || dc) ? 0.0 : h.get(x, y, z);
-		complex<double> v = coeff * xli * sp[i2 * src.s2];
-
-		if constexpr (Accum)
-		    dp[i2 * dst.s2] += v;
-		else
-		    dp[i2 * dst.s2] = v;
+		for (long i2 = 0; i2 < n2; i2++) {
+		    // Equivalent to v = coeff * xli * sp[i2*s2], but avoids slow complex multiplication.
+		    complex<double> w = coeff * xli[i2];
+		    complex<double> z = sp[i2 * src.s2];
+		    complex<double> v(w.real()*z.real() - w.imag()*z.imag(), w.real()*z.imag() + w.imag()*z.real());
+
+		    if constexpr (Accum)
+			dp[i2 * dst.s2] += v;
+		    else
+			dp[i2 * dst.s2] = v;
+		}
 	    }
 	}
-    }    
+    }
 }
 
 
-void multiply_xli_fourier_space(py::array_t<complex<double>> &dst_, py::array_t<const complex<double>> &src_, int l, int i, long nz, complex<double> coeff, bool accum)
+static void _multiply_xli_fourier_space(py::array_t<complex<double>> &dst_, py::array_t<const complex<double>> &src_, int l, int i, long nz, complex<double> coeff, bool accum, long ny, long j1)
 {
     grid_helper<complex<double>> dst(dst_);
     grid_helper<const complex<double>> src(src_);
@@ -271,6 +361,8 @@ void multiply_xli_fourier_space(py::array_t<complex<double>> &dst_, py::array_t<
 	throw std::runtime_error("expected dst/src maps to have the same shapes");
     if (dst.n2 != (nz/2)+1)
 	throw std::runtime_error("dst/src map shape is inconsistent with 'nz' argument");
+    if ((j1 < 0) || (j1 + dst.n1 > ny))
+	throw std::runtime_error("slab is inconsistent with 'ny' argument");
 
     double x = (l & 1) ? coeff.real() : coeff.imag();
     
@@ -283,7 +375,22 @@ void multiply_xli_fourier_space(py::array_t<complex<double>> &dst_, py::array_t<
     }
 
     if (accum)
-	_multiply_xli_fourier_space<true> (dst, src, h, nz, coeff);
+	_multiply_xli_fourier_space<true> (dst, src, h, nz, coeff, ny, j1);
     else
-	_multiply_xli_fourier_space<false> (dst, src, h, nz, coeff);
+	_multiply_xli_fourier_space<false> (dst, src, h, nz, coeff, ny, j1);
+}
+
+
+void multiply_xli_fourier_space(py::array_t<complex<double>> &dst_, py::array_t<const complex<double>> &src_, int l, int i, long nz, complex<double> coeff, bool accum)
+{
+    long ny = (dst_.ndim() == 3) ? get_shape(dst_,1) : 0;   // if ndim != 3, exception is thrown later
+    _multiply_xli_fourier_space(dst_, src_, l, i, nz, coeff, accum, ny, 0);
+}
+
+
+// Version of multiply_xli_fourier_space() which operates on a slab [j1,j1+n1) along axis 1,
+// where (dst, src) are the slabs, and 'ny' is the length of axis 1 in the full array.
+void multiply_xli_fourier_space_slab(py::array_t<complex<double>> &dst_, py::array_t<const complex<double>> &src_, int l, int i, long ny, long j1, long nz, complex<double> coeff, bool accum)
+{
+    _multiply_xli_fourier_space(dst_, src_, l, i, nz, coeff, accum, ny, j1);
 }
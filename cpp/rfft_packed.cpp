@@ -0,0 +1,197 @@
+// In-place real <-> complex FFTs, using the "packed" trick: a real array of length nz (nz even)
+// is reinterpreted as a complex array of length (nz/2), and transformed with a complex FFT. The
+// output of the complex FFT is then "untangled" to obtain the real FFT (or the reverse, for the
+// inverse transform).
+//
+// Here, we implement the untangling step for 3-d arrays. The complex FFTs are done in python
+// (kszx.core._rfft_packed_3d() and kszx.core._irfft_packed_3d()), with scipy.fft.fftn(..., overwrite_x=True).
+//
+// The array 'arr' has shape (n0, n1, h+1), where h = nz/2. In the "packed" representation, only
+// the first h elements along the last axis are used. In the "unpacked" representation, all (h+1)
+// elements are used, and the array is the output of rfftn() on a real array of shape (n0, n1, nz).
+// The real array is stored in the same memory, with padding (same layout as in-place FFTW).
+//
+// Notation: let Y = fftn(packed array), and let X = rfftn(real array). Let E and O be the FFTs of
+// the even and odd samples (along the last axis) of the real array. Then:
+//
+//   Y[k] = E[k] + i O[k]
+//   X[k] = E[k] + w^k O[k]         where w = exp(-2 pi i / nz)
+//
+//   E[k] = (Y[k] + Y[-k]^*) / 2    where -k = (-k0, -k1, h-k), with the last index mod h
+//   O[k] = (Y[k] - Y[-k]^*) / (2i)
+//
+// Each output row (k0,k1) depends on input rows (k0,k1) and (-k0,-k1), so we process pairs of rows.
+
+#include <omp.h>
+#include <cmath>
+#include <vector>
+#include <string>
+#include "cpp_kernels.hpp"
+
+using namespace std;
+
+using cplx = std::complex<double>;
+
+
+// Twiddle factors: the forward transform is X[k] = (a+b)/2 + c[k] (a-b), where a = Y[k],
+// b = Y[-k]^*, and c[k] = -(i/2) w^k. The inverse transform is Y[k] = (a+b)/2 + c[k]^* (a-b),
+// where a = X[k] and b = X[-k]^*.
+
+static void untangle_twiddles(long nz, vector<double> &cre, vector<double> &cim)
+{
+    long h = nz/2;
+    cre.resize(h+1);
+    cim.resize(h+1);
+    
+    for (long k = 0; k <= h; k++) {
+	double theta = -2*M_PI*k / double(nz);
+	cre[k] = 0.5 * sin(theta);
+	cim[k] = -0.5 * cos(theta);
+    }
+}
+
+
+// Returns (a+b)/2 + (cr + i ci) * (a-b). (We avoid std::complex multiplication, which is slow
+// without -ffast-math, due to inf/nan handling.)
+inline cplx untangle(cplx a, cplx b, double cr, double ci)
+{
+    double sr = a.real() + b.real();
+    double si = a.imag() + b.imag();
+    double dr = a.real() - b.real();
+    double di = a.imag() - b.imag();
+    return cplx(0.5*sr + cr*dr - ci*di, 0.5*si + cr*di + ci*dr);
+}
+
+
+static void check_untangle_args(py::array_t<cplx> &arr, long nz, const char *caller)
+{
+    if (arr.ndim() != 3)
+	throw runtime_error(string(caller) + ": expected 'arr' to be a 3-d array");
+    if ((nz < 2) || (nz & 1))
+	throw runtime_error(string(caller) + ": expected 'nz' to be even");
+    if (get_shape(arr,2) != (nz/2)+1)
+	throw runtime_error(string(caller) + ": expected arr.shape[2] == nz/2+1");
+}
+
+
+void rfft_untangle_3d(py::array_t<cplx> &arr, long nz, bool forward)
+{
+    check_untangle_args(arr, nz, "kszx.cpp_kernels.rfft_untangle_3d()");
+
+    cplx *data = arr.mutable_data();
+    long n0 = get_shape(arr, 0);
+    long n1 = get_shape(arr, 1);
+    long s0 = get_stride(arr, 0);
+    long s1 = get_stride(arr, 1);
+    long s2 = get_stride(arr, 2);
+    long h = nz/2;
+
+    vector<double> cre, cim;
+    untangle_twiddles(nz, cre, cim);
+
+#pragma omp parallel
+    {
+	vector<cplx> a(h+1);
+	vector<cplx> b(h+1);
+
+#pragma omp for schedule(static)
+	for (long r = 0; r < n0*n1; r++) {
+	    long k0 = r / n1;
+	    long k1 = r % n1;
+	    long k0p = (k0 > 0) ? (n0-k0) : 0;
+	    long k1p = (k1 > 0) ? (n1-k1) : 0;
+	    long rp = k0p*n1 + k1p;
+
+	    // Each pair of rows (r, rp) is processed once, by the thread with r <= rp.
+	    if (r > rp)
+		continue;
+
+	    cplx *pa = data + k0*s0 + k1*s1;
+	    cplx *pb = data + k0p*s0 + k1p*s1;
+
+	    for (long k = 0; k <= h; k++) {
+		a[k] = pa[k*s2];
+		b[k] = pb[k*s2];
+	    }
+
+	    if (forward) {
+		// Packed -> unpacked (slots [0,h) -> slots [0,h]).
+		for (long k = 0; k <= h; k++) {
+		    long j = (k < h) ? k : 0;
+		    long jp = (k > 0) ? (h-k) : 0;
+		    pa[k*s2] = untangle(a[j], conj(b[jp]), cre[k], cim[k]);
+		    pb[k*s2] = untangle(b[j], conj(a[jp]), cre[k], cim[k]);
+		}
+	    }
+	    else {
+		// Unpacked -> packed (slots [0,h] -> slots [0,h)). We first project slots 0 and h onto
+		// Hermitian-symmetric values (equivalent to irfftn(), which ignores the imaginary part
+		// of the DC and Nyquist frequencies along the last axis, after transforming the first
+		// two axes).
+		cplx a0 = 0.5 * (a[0] + conj(b[0]));
+		cplx ah = 0.5 * (a[h] + conj(b[h]));
+		a[0] = a0;  b[0] = conj(a0);
+		a[h] = ah;  b[h] = conj(ah);
+
+		for (long k = 0; k < h; k++) {
+		    pa[k*s2] = untangle(a[k], conj(b[h-k]), cre[k], -cim[k]);
+		    pb[k*s2] = untangle(b[k], conj(a[h-k]), cre[k], -cim[k]);
+		}
+	    }
+	}
+    }
+}
+
+
+// Version of rfft_untangle_3d() which untangles each row (along the last axis) independently.
+// This is the 1-d real FFT along the last axis (rather than the 3-d real FFT), i.e. the caller
+// is responsible for the complex FFTs along axes 0 and 1 (before the inverse untangling step, or
+// after the forward untangling step). Used in the "fused" spin-l FFTs (see kszx.core._fft_r2c_fused()).
+
+void rfft_untangle_rows(py::array_t<cplx> &arr, long nz, bool forward)
+{
+    check_untangle_args(arr, nz, "kszx.cpp_kernels.rfft_untangle_rows()");
+
+    cplx *data = arr.mutable_data();
+    long n0 = get_shape(arr, 0);
+    long n1 = get_shape(arr, 1);
+    long s0 = get_stride(arr, 0);
+    long s1 = get_stride(arr, 1);
+    long s2 = get_stride(arr, 2);
+    long h = nz/2;
+
+    vector<double> cre, cim;
+    untangle_twiddles(nz, cre, cim);
+
+#pragma omp parallel for schedule(static)
+    for (long r = 0; r < n0*n1; r++) {
+	cplx *p = data + (r/n1)*s0 + (r%n1)*s1;
+
+	if (forward) {
+	    // Slots [0,h) -> slots [0,h]. Slots k and (h-k) are computed together.
+	    cplx y0 = p[0];
+	    p[0] = untangle(y0, conj(y0), cre[0], cim[0]);
+	    p[h*s2] = untangle(y0, conj(y0), cre[h], cim[h]);
+
+	    for (long k = 1; 2*k <= h; k++) {
+		cplx a = p[k*s2];
+		cplx b = p[(h-k)*s2];
+		p[k*s2] = untangle(a, conj(b), cre[k], cim[k]);
+		p[(h-k)*s2] = untangle(b, conj(a), cre[h-k], cim[h-k]);
+	    }
+	}
+	else {
+	    // Slots [0,h] -> slots [0,h). The imaginary parts of slots 0 and h are ignored (as in irfft()).
+	    cplx x0 = p[0].real();
+	    cplx xh = p[h*s2].real();
+	    p[0] = untangle(x0, xh, cre[0], -cim[0]);
+
+	    for (long k = 1; 2*k <= h; k++) {
+		cplx a = p[k*s2];
+		cplx b = p[(h-k)*s2];
+		p[k*s2] = untangle(a, conj(b), cre[k], -cim[k]);
+		p[(h-k)*s2] = untangle(b, conj(a), cre[h-k], -cim[h-k]);
+	    }
+	}
+    }
+}
@@ -0,0 +1,136 @@
+#ifndef _KSZX_SLAB_PARTITION_HPP
+#define _KSZX_SLAB_PARTITION_HPP
+
+#include <omp.h>
+#include <string>
+#include <vector>
+#include "cpp_kernels.hpp"
+#include "interpolation_args.hpp"
+
+
+// -------------------------------------------------------------------------------------------------
+//
+// grid_slab_parallel(): helper for multithreaded gridding kernels (cic_grid_3d(), cubic_grid_3d()).
+//
+// Gridding is a "scatter" operation, so we can't just put '#pragma omp parallel for' in front of
+// the loop over points (as we do for interpolation). Instead, we divide the grid into slabs along
+// axis 0, and assign each point to the slab containing the base pixel of its kernel. Each slab is
+// at least 4 pixels wide, so a gridding kernel whose footprint is at most [i-1,i+2] (true for both
+// CIC and cubic) only writes to the slab containing the point, and its two neighbors. Therefore,
+// all even slabs can be processed in parallel (without races), followed by all odd slabs. (In the
+// periodic case, the number of slabs is even, so that the first and last slabs have opposite parity.)
+//
+// Within each slab, points are processed in their original order, so the output is deterministic
+// (for fixed 'nthreads'), but summation order differs from the serial kernel.
+//
+// The 'plane' argument is a callable with signature plane(long i), which returns the base pixel of
+// the i-th point along axis 0. The 'deposit' argument is a callable with signature deposit(long i),
+// which grids the i-th point. If 'nthreads <= 1' (or the grid is too small to partition), we fall
+// back to a serial loop.
+//
+// Memory overhead is 12 bytes/point (for the counting sort by slab).
+
+
+template<typename P, typename F>
+inline void grid_slab_parallel(long n0, long npoints, bool periodic, int nthreads, P plane, F deposit)
+{
+    long nslabs = std::min(4L * long(nthreads), n0/4);
+
+    if (periodic && (nslabs & 1))
+	nslabs--;
+
+    if ((nthreads <= 1) || (nslabs < 2)) {
+	for (long i = 0; i < npoints; i++)
+	    deposit(i);
+	return;
+    }
+
+    // Slab 's' consists of pixels [(s*n0)/nslabs, ((s+1)*n0)/nslabs) along axis 0.
+    std::vector<int> plane_slab(n0);
+    for (long s = 0; s < nslabs; s++)
+	for (long p = (s*n0)/nslabs; p < ((s+1)*n0)/nslabs; p++)
+	    plane_slab[p] = s;
+
+    // Stable counting sort of points by slab, parallelized over 'nthreads' contiguous blocks of points.
+    std::vector<int> point_slab(npoints);
+    std::vector<long> counts(nthreads * nslabs, 0);   // counts[b*nslabs + s]
+    std::vector<long> slab_offsets(nslabs+1, 0);
+    std::vector<long> perm(npoints);
+
+#pragma omp parallel for num_threads(nthreads) schedule(static,1)
+    for (int b = 0; b < nthreads; b++) {
+	long *bcounts = &counts[b*nslabs];
+	for (long i = (b*npoints)/nthreads; i < ((b+1)*npoints)/nthreads; i++) {
+	    long p = std::max(std::min(plane(i), n0-1), 0L);
+	    point_slab[i] = plane_slab[p];
+	    bcounts[plane_slab[p]]++;
+	}
+    }
+
+    // Convert counts to offsets (in-place), ordered by (slab, block).
+    long pos = 0;
+    for (long s = 0; s < nslabs; s++) {
+	slab_offsets[s] = pos;
+	for (int b = 0; b < nthreads; b++) {
+	    long c = counts[b*nslabs + s];
+	    counts[b*nslabs + s] = pos;
+	    pos += c;
+	}
+    }
+    slab_offsets[nslabs] = pos;
+
+#pragma omp parallel for num_threads(nthreads) schedule(static,1)
+    for (int b = 0; b < nthreads; b++) {
+	long *boffsets = &counts[b*nslabs];
+	for (long i = (b*npoints)/nthreads; i < ((b+1)*npoints)/nthreads; i++)
+	    perm[boffsets[point_slab[i]]++] = i;
+    }
+
+    // Two passes (even slabs, then odd slabs). Exceptions can't propagate out of an
+    // OpenMP parallel region, so we save the error message and rethrow afterwards.
+    std::string errmsg;
+    bool failed = false;
+
+    for (long parity = 0; parity < 2; parity++) {
+#pragma omp parallel for num_threads(nthreads) schedule(dynamic,1)
+	for (long s = parity; s < nslabs; s += 2) {
+	    try {
+		for (long j = slab_offsets[s]; j < slab_offsets[s+1]; j++)
+		    deposit(perm[j]);
+	    }
+	    catch (const std::exception &e) {
+#pragma omp critical (kszx_grid_slab_parallel)
+		{
+		    failed = true;
+		    errmsg = e.what();
+		}
+	    }
+	}
+
+	if (failed)
+	    throw std::runtime_error(errmsg);
+    }
+}
+
+
+// Version of grid_slab_parallel() for kernels which compute stencils on-the-fly from an
+// interpolation_args (i.e. 'points' array).
+
+template<typename T, typename F>
+inline void grid_slab_parallel(interpolation_args<T> &args, bool periodic, int nthreads, F deposit)
+{
+    long n0 = args.gn0;
+    
+    auto plane = [&](long i) -> long
+    {
+	double x = args.rec_ps * (args.pdata[i*args.ps0] - args.lpos0);
+	x = periodic ? xfmod(x,n0) : x;
+	// Out-of-bounds points are detected later, in deposit().
+	return (x >= 0.0) ? long(std::min(x, double(n0-1))) : 0L;
+    };
+
+    grid_slab_parallel(n0, args.npoints, periodic, nthreads, plane, deposit);
+}
+
+
+#endif  // _KSZX_SLAB_PARTITION_HPP
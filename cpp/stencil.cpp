@@ -0,0 +1,193 @@
+#include <iostream>
+#include "cpp_kernels.hpp"
+#include "slab_partition.hpp"
+
+using namespace std;
+
+
+// -------------------------------------------------------------------------------------------------
+//
+// Interpolation and gridding kernels which use precomputed stencils (see stencil.hpp).
+//
+// The order of floating-point operations is the same as cic_interp_3d() (or cubic_interp_3d()),
+// and cic_grid_3d() (or cubic_grid_3d()), so results are bitwise identical to the non-stencil
+// kernels (with float64 stencil weights, and in the single-threaded case for gridding).
+
+
+struct stencil_args
+{
+    long npoints = 0;
+    long K = 0;
+    const int32_t *ix = nullptr;
+
+    stencil_args(const py::array_t<const int32_t> &indices, const py::array &weights)
+    {
+	if (indices.ndim() != 3)
+	    throw runtime_error("kszx.cpp_kernels: expected stencil 'indices' to be a 3-d array");
+	if (indices.shape(1) != 3)
+	    throw runtime_error("kszx.cpp_kernels: expected stencil 'indices' to have shape (npoints,3,K)");
+	if ((indices.shape(2) != 2) && (indices.shape(2) != 4))
+	    throw runtime_error("kszx.cpp_kernels: expected stencil 'indices' to have shape (npoints,3,K), where K=2 or K=4");
+	if ((weights.ndim() != 3) || (weights.shape(0) != indices.shape(0)) || (weights.shape(1) != 3) || (weights.shape(2) != indices.shape(2)))
+	    throw runtime_error("kszx.cpp_kernels: stencil 'indices' and 'weights' arrays have inconsistent shapes");
+	if (!(indices.flags() & py::array::c_style) || !(weights.flags() & py::array::c_style))
+	    throw runtime_error("kszx.cpp_kernels: expected stencil arrays to be contiguous");
+
+	npoints = indices.shape(0);
+	K = indices.shape(2);
+	ix = indices.data();
+    }
+};
+
+
+template<int K, typename W>
+static void _stencil_interpolate(const double *g, long s0, long s1, long s2, const int32_t *ix, const W *wt, long npoints, double *out)
+{
+#pragma omp parallel for schedule(guided,32)
+    for (long i = 0; i < npoints; i++) {
+	const int32_t *ix0 = ix + 3*K*i;
+	const int32_t *ix1 = ix0 + K;
+	const int32_t *ix2 = ix0 + 2*K;
+	const W *w0 = wt + 3*K*i;
+	const W *w1 = w0 + K;
+	const W *w2 = w0 + 2*K;
+	double ret = 0.0;
+
+	for (int a = 0; a < K; a++) {
+	    const double *ga = g + ix0[a]*s0;
+	    double fa = 0.0;
+
+	    for (int b = 0; b < K; b++) {
+		const double *gb = ga + ix1[b]*s1;
+		double fb = 0.0;
+
+		for (int c = 0; c < K; c++)
+		    fb += double(w2[c]) * gb[ix2[c]*s2];
+
+		fa += double(w1[b]) * fb;
+	    }
+
+	    ret += double(w0[a]) * fa;
+	}
+
+	out[i] = ret;
+    }
+}
+
+
+template<int K, typename W>
+static void _stencil_grid(double *g, long sf, long s0, long s1, long s2, long nfields, long n0,
+			  const int32_t *ix, const W *wt, const double *pw, long pwf, long pws,
+			  long npoints, double coeff, bool periodic, int nthreads)
+{
+    // Base pixel along axis 0 (see grid_slab_parallel()).
+    auto plane = [&](long i) -> long { return ix[3*K*i + (K/2-1)]; };
+
+    auto deposit = [&](long i)
+    {
+	const int32_t *ix0 = ix + 3*K*i;
+	const int32_t *ix1 = ix0 + K;
+	const int32_t *ix2 = ix0 + 2*K;
+	const W *w0 = wt + 3*K*i;
+	const W *w1 = w0 + K;
+	const W *w2 = w0 + 2*K;
+
+	for (long f = 0; f < nfields; f++) {
+	    double *gf = g + f*sf;
+	    double val = coeff * pw[f*pwf + i*pws];
+
+	    for (int a = 0; a < K; a++) {
+		double *ga = gf + ix0[a]*s0;
+		double va = double(w0[a]) * val;
+
+		for (int b = 0; b < K; b++) {
+		    double *gb = ga + ix1[b]*s1;
+		    double vb = double(w1[b]) * va;
+
+		    for (int c = 0; c < K; c++)
+			gb[ix2[c]*s2] += double(w2[c]) * vb;
+		}
+	    }
+	}
+    };
+
+    grid_slab_parallel(n0, npoints, periodic, nthreads, plane, deposit);
+}
+
+
+py::array_t<double> stencil_interpolate_3d(py::array_t<const double> &grid, py::array_t<const int32_t> &indices, py::array &weights)
+{
+    stencil_args args(indices, weights);
+
+    if (grid.ndim() != 3)
+	throw runtime_error("kszx.cpp_kernels.stencil_interpolate_3d(): expected 'grid' to be a 3-d array");
+
+    const double *g = grid.data();
+    long s0 = get_stride(grid, 0);
+    long s1 = get_stride(grid, 1);
+    long s2 = get_stride(grid, 2);
+
+    py::array_t<double> ret({args.npoints});
+    double *out = ret.mutable_data();
+
+    if (py::isinstance<py::array_t<double>>(weights)) {
+	const double *wt = weights.cast<py::array_t<double>>().data();
+	if (args.K == 2)
+	    _stencil_interpolate<2> (g, s0, s1, s2, args.ix, wt, args.npoints, out);
+	else
+	    _stencil_interpolate<4> (g, s0, s1, s2, args.ix, wt, args.npoints, out);
+    }
+    else if (py::isinstance<py::array_t<float>>(weights)) {
+	const float *wt = weights.cast<py::array_t<float>>().data();
+	if (args.K == 2)
+	    _stencil_interpolate<2> (g, s0, s1, s2, args.ix, wt, args.npoints, out);
+	else
+	    _stencil_interpolate<4> (g, s0, s1, s2, args.ix, wt, args.npoints, out);
+    }
+    else
+	throw runtime_error("kszx.cpp_kernels.stencil_interpolate_3d(): expected stencil weights to have dtype float32 or float64");
+
+    return ret;
+}
+
+
+void stencil_grid_3d(py::array_t<double> &grid, py::array_t<const int32_t> &indices, py::array &weights,
+		     py::array_t<const double> &pweights, double coeff, bool periodic, int nthreads)
+{
+    stencil_args args(indices, weights);
+
+    if (grid.ndim() != 4)
+	throw runtime_error("kszx.cpp_kernels.stencil_grid_3d(): expected 'grid' to be a 4-d array");
+
+    long nfields = get_shape(grid, 0);
+
+    if ((pweights.ndim() != 2) || (pweights.shape(0) != nfields) || (pweights.shape(1) != args.npoints))
+	throw runtime_error("kszx.cpp_kernels.stencil_grid_3d(): expected 'pweights' array to have shape (nfields,npoints)");
+
+    double *g = grid.mutable_data();
+    long sf = get_stride(grid, 0);
+    long n0 = get_shape(grid, 1);
+    long s0 = get_stride(grid, 1);
+    long s1 = get_stride(grid, 2);
+    long s2 = get_stride(grid, 3);
+    const double *pw = pweights.data();
+    long pwf = get_stride(pweights, 0);
+    long pws = get_stride(pweights, 1);
+
+    if (py::isinstance<py::array_t<double>>(weights)) {
+	const double *wt = weights.cast<py::array_t<double>>().data();
+	if (args.K == 2)
+	    _stencil_grid<2> (g, sf, s0, s1, s2, nfields, n0, args.ix, wt, pw, pwf, pws, args.npoints, coeff, periodic, nthreads);
+	else
+	    _stencil_grid<4> (g, sf, s0, s1, s2, nfields, n0, args.ix, wt, pw, pwf, pws, args.npoints, coeff, periodic, nthreads);
+    }
+    else if (py::isinstance<py::array_t<float>>(weights)) {
+	const float *wt = weights.cast<py::array_t<float>>().data();
+	if (args.K == 2)
+	    _stencil_grid<2> (g, sf, s0, s1, s2, nfields, n0, args.ix, wt, pw, pwf, pws, args.npoints, coeff, periodic, nthreads);
+	else
+	    _stencil_grid<4> (g, sf, s0, s1, s2, nfields, n0, args.ix, wt, pw, pwf, pws, args.npoints, coeff, periodic, nthreads);
+    }
+    else
+	throw runtime_error("kszx.cpp_kernels.stencil_grid_3d(): expected stencil weights to have dtype float32 or float64");
+}
@@ -0,0 +1,69 @@
+#ifndef _KSZX_STENCIL_HPP
+#define _KSZX_STENCIL_HPP
+
+#include <omp.h>
+#include <string>
+#include "cpp_kernels.hpp"
+#include "interpolation_args.hpp"
+
+
+// -------------------------------------------------------------------------------------------------
+//
+// Precomputed stencils (see kszx.PointStencil). A stencil for 'npoints' points is represented by
+// a pair of arrays (indices, weights), both with shape (npoints, 3, K), where K=2 for CIC and K=4
+// for cubic interpolation. The pixel indices are unstrided, and have dtype int32. The weights have
+// dtype float32 or float64.
+//
+// This header defines make_stencil_3d(), which is used in cic.cpp and cubic.cpp. (The kernels
+// which use stencils are in stencil.cpp.)
+
+
+// The 'Axis' template parameter is either cic_axis or cubic_axis, and must define a member
+// function store(int32_t *ix, W *w), which writes K indices and K weights.
+
+template<typename Axis, int K, typename W>
+py::tuple make_stencil_3d(interpolation_args<const double> &args, bool periodic)
+{
+    long npoints = args.npoints;
+    py::array_t<int32_t> ret_indices({npoints, 3L, long(K)});
+    py::array_t<W> ret_weights({npoints, 3L, long(K)});
+
+    int32_t *ix = ret_indices.mutable_data();
+    W *wt = ret_weights.mutable_data();
+
+    // Exceptions can't propagate out of an OpenMP parallel region, so we save the
+    // error message and rethrow afterwards.
+    std::string errmsg;
+    bool failed = false;
+
+#pragma omp parallel for schedule(guided,32)
+    for (long i = 0; i < npoints; i++) {
+	try {
+	    double x, y, z;
+	    args.get_xyz(i, x, y, z);
+
+	    Axis ax0(x, args.gn0, 1, periodic);
+	    Axis ax1(y, args.gn1, 1, periodic);
+	    Axis ax2(z, args.gn2, 1, periodic);
+
+	    ax0.store(ix + 3*K*i, wt + 3*K*i);
+	    ax1.store(ix + 3*K*i + K, wt + 3*K*i + K);
+	    ax2.store(ix + 3*K*i + 2*K, wt + 3*K*i + 2*K);
+	}
+	catch (const std::exception &e) {
+#pragma omp critical (kszx_make_stencil_3d)
+	    {
+		failed = true;
+		errmsg = e.what();
+	    }
+	}
+    }
+
+    if (failed)
+	throw std::runtime_error(errmsg);
+
+    return py::make_tuple(ret_indices, ret_weights);
+}
+
+
+#endif  // _KSZX_STENCIL_HPP
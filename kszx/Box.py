@@ -1,5 +1,6 @@
 import io    # StringIO
 import functools
+import collections
 import numpy as np
 
 
@@ -60,6 +61,22 @@ class Box:
            - knyq (float): Nyquist frequency (equal to pi/pixsize)
            - box_volume (float): Box volume (equal to prod(boxsize))
            - pixel_volume (float): Pixel volume (equal to pixsize^N)
+           - cache_limit (integer): memory limit (in bytes) for cached Fourier-space arrays, see below.
+
+        Cached Fourier-space arrays:
+
+             Each Box has a cache of derived Fourier-space arrays, such as $|k|$, compensation kernels
+             (see :func:`~kszx.apply_kernel_compensation()`), or $\sqrt{P(k)}$ (see
+             :func:`~kszx.simulate_gaussian_field()` with ``cache=True``). Cached arrays are read-only.
+             The cache is limited to ``cache_limit`` bytes, and least-recently-used arrays are evicted
+             when the limit is exceeded. Arrays larger than ``cache_limit`` are never cached (in this case,
+             they are recomputed on every call). The cache is not pickled.
+
+             Caching is opt-in: the default ``cache_limit`` is ``Box.default_cache_limit = 0`` (no caching).
+             To enable it, call :meth:`~kszx.Box.set_cache_limit()`. Each cached array is real-valued with
+             shape ``fourier_space_shape``, i.e. half the size of a Fourier-space map (e.g. 4.3 GB for a
+             1024^3 box), and cached arrays are kept until evicted, or until :meth:`~kszx.Box.clear_cache()`
+             is called, so the memory cost can be significant.
 
         Fourier conventions:
 
@@ -116,6 +133,79 @@ class Box:
         self._ix_smallest_r = np.minimum(self._ix_smallest_r, self.npix-1)
         self._ix_smallest_r = tuple(self._ix_smallest_r)
 
+        self.cache_limit = Box.default_cache_limit
+        self._init_cache()
+
+        
+    default_cache_limit = 0   # bytes (caching is opt-in, see "Cached Fourier-space arrays" in docstring)
+
+
+    def _init_cache(self):
+        self._cache = collections.OrderedDict()   # key -> read-only array, in LRU order
+        self._cache_nbytes = 0
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['_cache'], state['_cache_nbytes']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__dict__.setdefault('cache_limit', Box.default_cache_limit)   # e.g. Box pickled by older kszx version
+        self._init_cache()
+
+        
+    def get_cached(self, key, compute):
+        """Returns the cached array with the specified key, calling ``compute()`` (with no args) if not in cache.
+
+        The key should be hashable, and should identify the array (e.g. ``('k', exponent, regulate)``).
+        The returned array is read-only. If the array is larger than ``self.cache_limit`` bytes, then
+        it is returned without being cached. Otherwise, it is added to the cache, and least-recently-used
+        arrays are evicted until the cache size is at most ``self.cache_limit``.
+        """
+
+        arr = self._cache.get(key, None)
+        
+        if arr is not None:
+            self._cache.move_to_end(key)
+            return arr
+
+        arr = compute()
+        arr.flags.writeable = False
+
+        if arr.nbytes > self.cache_limit:
+            return arr
+
+        self._cache[key] = arr
+        self._cache_nbytes += arr.nbytes
+        self._evict()
+        return arr
+
+    def cache_fits(self, nbytes):
+        """Returns True if an array of size ``nbytes`` would be cached by :meth:`~kszx.Box.get_cached()`."""
+        return nbytes <= self.cache_limit
+
+    def set_cache_limit(self, nbytes):
+        """Sets the memory limit (in bytes) for cached Fourier-space arrays, evicting arrays if necessary."""
+        
+        assert nbytes >= 0
+        self.cache_limit = int(nbytes)
+        self._evict()
+
+    def clear_cache(self):
+        """Removes all cached Fourier-space arrays."""
+        self._init_cache()
+
+    @property
+    def cache_nbytes(self):
+        """Total size (in bytes) of cached Fourier-space arrays."""
+        return self._cache_nbytes
+
+    def _evict(self):
+        while self._cache_nbytes > self.cache_limit:
+            _, arr = self._cache.popitem(last=False)
+            self._cache_nbytes -= arr.nbytes
+
         
     def is_real_space_map(self, arr):
         """Returns True if array 'arr' has the right shape/dtype for real-space map."""
@@ -168,16 +258,22 @@ class Box:
         return ret
 
 
-    def get_k(self, exponent=1, regulate=False):
+    def get_k(self, exponent=1, regulate=False, cached=False):
         """Returns an N-dimensional array containing |k|^exponent values.
 
         Args:
             exponent (float): return |k|^exponent. If k<0, then regulate=True is implied.
             regulate (boolean): if True, then replace k=0 by k=(2pi/boxsize).
+            cached (boolean): if True, then a read-only array from the Box cache is returned
+               (see "Cached Fourier-space arrays" in the Box docstring).
 
         Returns: real-valued array with shape (self.fourier_space_shape).
         """
 
+        if cached:
+            regulate = regulate or (exponent < 0)
+            return self.get_cached(('k', exponent, regulate), lambda: self.get_k(exponent, regulate))
+
         k2 = [ self.get_k_component(axis, zero_nyquist=False)**2 for axis in range(self.ndim) ]
         ret = functools.reduce(np.add, k2)
             
@@ -29,6 +29,9 @@ class Catalog:
           - ``self.col_names`` (list of strings): List of user-defined columns.
           - ``self.name`` (string or None): Catalog name (optional).
           - ``self.filename`` (string or None): Filename, if Catalog is stored on disk (optional).
+          - ``self.sort_permutation`` (1-d array or None): If the Catalog has been reordered with
+            :meth:`~kszx.Catalog.sort_spatially()`, then this is the permutation which was applied
+            (i.e. ``new_col = original_col[self.sort_permutation]``). Otherwise None.
 
         Additionally, for each column name (in ``self.col_names``), the Catalog contains 
         a member with the corresponding name, whose value is a 1-d array of length self.size.
@@ -61,6 +64,7 @@ class Catalog:
         self.name = name
         self.col_names = []
         self.filename = filename
+        self.sort_permutation = None
 
         if cols is not None:
             for (col_name, col_data) in cols.items():
@@ -77,7 +81,7 @@ class Catalog:
         assert isinstance(col_name, str)
         assert len(col_name) > 0
         assert not col_name.startswith('_')
-        assert col_name not in [ 'size', 'name', 'filename', 'col_names' ]
+        assert col_name not in [ 'size', 'name', 'filename', 'col_names', 'sort_permutation' ]
         assert col_name not in self.col_names
 
         col_data = np.asarray(col_data)
@@ -104,7 +108,7 @@ class Catalog:
         assert isinstance(col_name, str)
         assert len(col_name) > 0
         assert not col_name.startswith('_')
-        assert col_name not in [ 'size', 'name', 'filename', 'col_names' ]
+        assert col_name not in [ 'size', 'name', 'filename', 'col_names', 'sort_permutation' ]
         assert col_name in self.col_names
 
         self.col_names.remove(col_name)
@@ -204,6 +208,33 @@ class Catalog:
         return xyz
     
 
+    def sort_spatially(self, box, cosmo, zcol_name='z'):
+        r"""Reorders the Catalog in-place, so that nearby galaxies (in 3-d space) are nearby in memory.
+
+        Galaxies are sorted along a Morton (Z-order) curve, at the resolution of the pixels in
+        ``box`` (see :func:`kszx.utils.spatial_sort_indices()`). All columns are permuted
+        consistently. This makes :func:`~kszx.grid_points()` and :func:`~kszx.interpolate_points()`
+        faster on large grids, since consecutive galaxies access nearby grid locations.
+
+           - box (:class:`~kszx.Box`). Pixelization used for sorting.
+           - cosmo (:class:`~kszx.Cosmology`). Used to convert redshifts to distances.
+           - zcol_name (string). Name of redshift column (see :meth:`~kszx.Catalog.get_xyz()`).
+
+        Returns the permutation which was applied (i.e. ``new_col = old_col[perm]``). The permutation
+        (relative to the original Catalog, if ``sort_spatially()`` is called more than once) is also
+        saved in ``self.sort_permutation``.
+        """
+
+        perm = utils.spatial_sort_indices(box, self.get_xyz(cosmo, zcol_name))
+
+        for col_name in self.col_names:
+            col = getattr(self, col_name)
+            setattr(self, col_name, col[perm])
+
+        self.sort_permutation = perm if (self.sort_permutation is None) else self.sort_permutation[perm]
+        return perm
+
+
     def generate_batches(self, batchsize, verbose=True):
         r"""Splits catalog into subcatalogs no larger than 'batchsize'.
 
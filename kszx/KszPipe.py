@@ -1,7 +1,12 @@
 import os
+import h5py
+import time
 import yaml
+import queue
 import shutil
+import inspect
 import functools
+import collections
 import numpy as np
 
 from . import core
@@ -12,6 +17,7 @@ from . import wfunc_utils
 from .Catalog import Catalog
 from .Cosmology import Cosmology
 from .SurrogateFactory import SurrogateFactory
+from .SurrogateStore import SurrogateStore
 
 
 class KszPipe:
@@ -84,11 +90,15 @@ class KszPipe:
             self.spin_vr = params['estimate_spin_vr']
 
             self.nsurr = params['nsurr']
+            self.seed = params.get('seed', None)   # optional master seed for surrogates
             self.surr_bg = params['surr_bg']
             self.sim_surr_fg = params['simulate_surrogate_foregrounds']
             self.nzbins_gal = params['nzbins_gal']
             self.nzbins_vr = params['nzbins_vr']
 
+            # Optional: reorder random catalog for cache-friendly gridding (see Catalog.sort_spatially()).
+            self.sort_randoms = params.get('sort_randoms', False)
+
             kmin, kmax, kstep = params['kmin'], params['kmax'], params['kstep']
             self.kbin_edges = [np.arange(kmin[i], kmax[i], kstep[i]) for i in range(len(kmin))]
 
@@ -100,6 +110,28 @@ class KszPipe:
         self.pk_surr_filename = [f'{output_dir}/pk_surrogates_binning{i}.npy' for i in range(len(self.kbin_edges))]
         self.pk_single_surr_filenames = [[f'{output_dir}/tmp/pk_surr_{j}_binning{i}.npy' for i in range(len(self.kbin_edges))] for j in range(self.nsurr)]
 
+        # Per-surrogate power spectra are written to an append-only SurrogateStore, with one
+        # row per surrogate. (The 'tmp/pk_surr_*.npy' files above are only read, for backwards
+        # compatibility with pipelines started before the SurrogateStore existed.) The store is
+        # created on disk when the pipeline runs, see _get_surrogate_store().
+        nterms = 3 if self.sim_surr_fg else 2
+        self.nsurr_fields = 4*len(self.spin_gal) + nterms*len(self.spin_vr)*len(self.cmb_fields)
+        self.surr_shapes = [ (self.nsurr_fields, self.nsurr_fields, len(k)-1) for k in self.kbin_edges ]
+        self.surrogate_store_dirname = f'{output_dir}/pk_surr_store'
+        self._surrogate_store = None
+
+    def _get_surrogate_store(self, create=False):
+        """Returns the SurrogateStore in ``{output_dir}/pk_surr_store``, creating it if ``create=True``.
+
+        If the store does not exist on disk and ``create=False``, then None is returned (so that
+        read-only methods, and ``run(dry_run=True)``, don't write to the output directory).
+        """
+
+        if self._surrogate_store is None:
+            if create or os.path.exists(f'{self.surrogate_store_dirname}/store.yml'):
+                self._surrogate_store = SurrogateStore(self.surrogate_store_dirname, self.surr_shapes, seed=self.seed)
+        return self._surrogate_store
+
     @functools.cached_property
     def cosmo(self):
         return Cosmology('planck18+bao')
@@ -110,7 +142,10 @@ class KszPipe:
 
     @functools.cached_property
     def rcat(self):
-        return Catalog.from_h5(f'{self.input_dir}/randoms.h5')
+        rcat = Catalog.from_h5(f'{self.input_dir}/randoms.h5')
+        if self.sort_randoms:
+            rcat.sort_spatially(self.box, self.cosmo, 'zobs')
+        return rcat
 
     @functools.cached_property
     def rcat_xyz_obs(self):
@@ -235,10 +270,12 @@ class KszPipe:
         print('WARNING It lacks here the term in (2l+1) for p_gv(ell=1) !!!!! (no problem because it is the same between data and surrogate !!)')
         print('WARNING FOR NOW WE JUST MULITPLY by (2l+1) inside the plotting function --> CHANGE THIS ONCE YOU MODIFY the PK ESTUMATION CODE !!!')
         
+        # Estimate power spectra (all binnings in one pass over the maps).
+        pk_list = core.estimate_power_spectrum(self.box, fourier_space_maps, self.kbin_edges)
+
         pks = []
-        for i, kbin_edges in enumerate(self.kbin_edges):
-            # Estimate power spectra. and normalize by dividing by window function.
-            pk = core.estimate_power_spectrum(self.box, fourier_space_maps, kbin_edges)
+        for i, pk in enumerate(pk_list):
+            # Normalize by dividing by window function.
             pk /= self.wf[:, :, None]
             # Save 'pk_data.npy' to disk. Note that the file format is specified here:
             # https://kszx.readthedocs.io/en/latest/kszpipe.html#kszpipe-details
@@ -248,8 +285,15 @@ class KszPipe:
         if len(self.pk_data_filename): pks = pks[0]
         return pks
 
+    def _fft_and_compensate(self, real_space_map, spin):
+        """Helper for get_pk_surrogate(): equivalent to the 'fft=True, compensate=True' flags in core.grid_points()."""
+        
+        ret = core.fft_r2c(self.box, real_space_map, spin=spin)
+        core.apply_kernel_compensation(self.box, ret, self.kernel)
+        return ret
+
     def get_pk_surrogate(self, isurr, run=False, force=False):
-        r"""Returns a shape (A,A,nkbins) array, and saves it in ``pipeline_outdir/tmp/pk_surr_{isurr}.npy``,
+        r"""Returns a shape (A,A,nkbins) array, and saves it as row ``isurr`` of the :class:`~kszx.SurrogateStore` in ``pipeline_outdir/pk_surr_store``,
         where A = #spin_gal * 3 + #spin_vr * #term * #cmb_fields and # term = 2 if no forgeround and 3 if foregrounds are simulated.
         
         The returned array contains auto and cross power spectra of the following fields, for a single surrogate:
@@ -265,6 +309,13 @@ class KszPipe:
           - If ``force=True``, then this function recomputes $P(k)$, even if it is on disk from a previous pipeline run.
         """
 
+        store = self._get_surrogate_store(create = (run or force))
+
+        if (not force) and (store is not None) and store.is_done(isurr):
+            pks = store.read(isurr)
+            if len(pks) == 1: pks = pks[0]
+            return pks
+
         fname = self.pk_single_surr_filenames[isurr]
         if (not force) and all([os.path.exists(fn) for fn in fname]):
             pks = [io_utils.read_npy(fn) for fn in fname]
@@ -272,27 +323,30 @@ class KszPipe:
             return pks
 
         if not (run or force):
-            raise RuntimeError(f'KszPipe.get_pk_surrogate(): run=False was specified, and file {fname} not found')
+            raise RuntimeError(f'KszPipe.get_pk_surrogate(): run=False was specified, and surrogate {isurr} not found in {self.surrogate_store_dirname}')
 
-        import time 
         start = time.time()
 
         print(f'[{isurr=}] get_pk_surrogate(): start')
 
+        # Each surrogate has its own RNG stream (derived from the SurrogateStore master seed and isurr),
+        # so that surrogates don't depend on which worker process (or node) computes them.
+        rng = np.random.default_rng(store.seed_sequence(isurr))
+
         zobs = self.rcat.zobs
         nrand = self.rcat.size
         rweights = getattr(self.rcat, 'weight_gal', np.ones(nrand))
         vweights = getattr(self.rcat, 'weight_vr', np.ones(nrand))
 
         # The SurrogateFactory simulates LSS fields (delta, phi, vr, rsd) sampled at random catalog locations.
-        self.surrogate_factory.simulate_surrogate()
+        self.surrogate_factory.simulate_surrogate(rng=rng)
         ngal = self.surrogate_factory.ngal
 
         # Noise realization for Sg (see overleaf).
         eta_rms = np.sqrt((nrand/ngal) - (self.surr_bg**2 * self.surrogate_factory.sigma2) * self.surrogate_factory.D**2)
         if np.min(eta_rms) < 0:
             raise RuntimeError('Noise RMS went negative! This is probably a symptom of not enough randoms (note {(ngal/nrand)=})')
-        eta = np.random.normal(scale=eta_rms)
+        eta = rng.normal(scale=eta_rms)
 
         print(f'[{isurr=}] simulate_surrogate done', time.time() - start)
 
@@ -329,38 +383,58 @@ class KszPipe:
                     Sv_fg[freq] = utils.subtract_binned_means(Sv_fg[freq], zobs, self.nzbins_vr)
 
         # (Coefficient arrays) -> (Fourier-space fields).
-        fourier_space_maps, idx = [], []
-        for spin in self.spin_gal:
-            for term in [Sg_noise, dSg_db1, dSg_df, dSg_dfnl]:
-                fourier_space_maps += [core.grid_points(self.box, self.rcat_xyz_obs, term, kernel=self.kernel, fft=True, spin=spin, compensate=True)]
-                idx += [0]
-
-            print(f'[{isurr=}] Galaxy {spin=} fields done', time.time() - start)
-        
-        for spin in self.spin_vr:
-            for i, freq in enumerate(self.cmb_fields): 
-                terms = [Sv_noise, Sv_signal, Sv_fg] if self.sim_surr_fg else [Sv_noise, Sv_signal]
-                for term in terms:
-                    fourier_space_maps += [core.grid_points(self.box, self.rcat_xyz_obs, term[freq], kernel=self.kernel, fft=True, spin=spin, compensate=True)]
-                    idx += [i + 1]
-
-            print(f'[{isurr=}] Velocity {spin=} fields done', time.time() - start)
+        # Coefficient arrays are gridded in batches with core.grid_points_multi(), so that the gridding
+        # stencil is computed once per batch (rather than once per coefficient array): first the 4 galaxy
+        # terms, then one batch of 'nterms' velocity terms per frequency. Each batch is gridded once
+        # (independently of the number of spins), and its real-space maps are consumed (one FFT per spin)
+        # before the next batch is gridded, so that at most max(4,nterms) real-space maps are live at a time.
+        gterms = [Sg_noise, dSg_db1, dSg_df, dSg_dfnl]
+        gal_maps = [ [None] * len(gterms) for spin in self.spin_gal ]
+
+        grids = core.grid_points_multi(self.box, self.rcat_xyz_obs, gterms, kernel=self.kernel)
+        for j in range(len(gterms)):
+            for s, spin in enumerate(self.spin_gal):
+                gal_maps[s][j] = self._fft_and_compensate(grids[j], spin)
+        del grids
+
+        print(f'[{isurr=}] Galaxy fields done', time.time() - start)
+
+        vterms = [Sv_noise, Sv_signal, Sv_fg] if self.sim_surr_fg else [Sv_noise, Sv_signal]
+        vel_maps = [ [None] * (len(self.cmb_fields) * len(vterms)) for spin in self.spin_vr ]
+
+        for i, freq in enumerate(self.cmb_fields):
+            grids = core.grid_points_multi(self.box, self.rcat_xyz_obs, [ term[freq] for term in vterms ], kernel=self.kernel)
+            for j in range(len(vterms)):
+                for s, spin in enumerate(self.spin_vr):
+                    vel_maps[s][i*len(vterms) + j] = self._fft_and_compensate(grids[j], spin)
+            del grids
+
+        print(f'[{isurr=}] Velocity fields done', time.time() - start)
+
+        # Maps are ordered by (spin, freq, term), as in previous versions of the pipeline.
+        fourier_space_maps = [ m for maps in gal_maps for m in maps ] + [ m for maps in vel_maps for m in maps ]
+        idx = [0] * (len(self.spin_gal) * len(gterms)) + [ i+1 for spin in self.spin_vr for i in range(len(self.cmb_fields)) for j in vterms ]
+        del gal_maps, vel_maps
 
         # Rescale window function, by a factor (ngal/nrand) in each footprint.
         wf = (ngal/nrand)**2 * self.window_function
         # Expand window function from shape (3,3) to shape (15,15).
         wf = wf[idx,:][:,idx]
 
+        # Estimate power spectra (all binnings in one pass over the maps).
+        pk_list = core.estimate_power_spectrum(self.box, fourier_space_maps, self.kbin_edges)
+
         pks = []
-        for i, kbin_edges in enumerate(self.kbin_edges):
-            # Estimate power spectra. and normalize by dividing by window function.
-            pk = core.estimate_power_spectrum(self.box, fourier_space_maps, kbin_edges)
+        for i, pk in enumerate(pk_list):
+            # Normalize by dividing by window function.
             pk /= wf[:,:,None]
-            # save pk:
-            io_utils.write_npy(fname[i], pk)
             pks += [pk]
 
-        if len(fname): pks = pks[0]
+        # Save pks (all binnings are written together, and marked complete after the data is on disk).
+        store.write(isurr, pks)
+        print(f'[{isurr=}] Wrote surrogate to {store.dirname}')
+
+        if len(pks) == 1: pks = pks[0]
         return pks
 
     def get_pk_surrogates(self):
@@ -370,25 +444,164 @@ class KszPipe:
         To run the pipeline, use :meth:`~kszx.KszPipe.run()`.
         """
 
-        if all([os.path.exists(fn) for fn in self.pk_surr_filename]):
+        if self._have_pk_surrogates():
             pks = [io_utils.read_npy(fn) for fn in self.pk_surr_filename]
             if len(self.pk_surr_filename) == 1: pks = pks[0]
             return pks
 
-        if not all([all([os.path.exists(ff) for ff in fn_single_surr]) for fn_single_surr in self.pk_single_surr_filenames]):
-            raise RuntimeError(f'KszPipe.read_pk_surrogates(): necessary files do not exist; you need to call KszPipe.run()')
+        if len(self._missing_surrogates()) > 0:
+            raise RuntimeError(f'KszPipe.get_pk_surrogates(): necessary files do not exist; you need to call KszPipe.run()')
 
-        pks = []
-        for i, fn_surr in enumerate(self.pk_surr_filename):
-            pk = np.array([io_utils.read_npy(f[i]) for f in self.pk_single_surr_filenames])
+        pks = _read_surrogates(self.output_dir, self.nsurr, self.surr_shapes, self._get_surrogate_store())
+        
+        for fn_surr, pk in zip(self.pk_surr_filename, pks):
             # Save 'pk_surrogates.npy' to disk. Note that the file format is specified here:
             # https://kszx.readthedocs.io/en/latest/kszpipe.html#kszpipe-details
-            io_utils.write_npy(fn_surr, pk)
-            pks += [pk]
+            # (Written atomically, since several processes may consolidate concurrently in run_distributed().)
+            tmp_filename = f'{fn_surr[:-4]}.tmp{os.getpid()}.npy'
+            io_utils.write_npy(tmp_filename, pk)
+            os.replace(tmp_filename, fn_surr)
+            
         if len(self.pk_surr_filename) == 1: pks = pks[0]
         return pks
 
-    def run(self, processes):
+    def _have_pk_surrogates(self):
+        """Returns True if the consolidated 'pk_surrogates_binning*.npy' files exist, and contain self.nsurr surrogates.
+
+        (If nsurr has been increased since the files were written, then they are out of date.)
+        """
+        
+        for fn in self.pk_surr_filename:
+            if not os.path.exists(fn):
+                return False
+            if np.load(fn, mmap_mode='r').shape[0] != self.nsurr:
+                return False
+        return True
+
+    def _missing_surrogates(self):
+        """Returns list of surrogate indices which have not been computed (in either the SurrogateStore or legacy 'tmp' files)."""
+        
+        store = self._get_surrogate_store()
+        missing = store.missing(self.nsurr) if (store is not None) else range(self.nsurr)
+        return [ i for i in missing if not all(os.path.exists(fn) for fn in self.pk_single_surr_filenames[i]) ]
+
+    def estimate_memory(self):
+        """Returns a dict containing rough estimates of pipeline memory usage (in bytes).
+
+        The estimates are computed from ``box.real_space_shape``, the number of surrogate fields
+        (``estimate_spin_gal``, ``estimate_spin_vr``, ``cmb_fields``, ``simulate_surrogate_foregrounds``),
+        and the random catalog size (read from the HDF5 header, without reading the catalog).
+        Dict keys are:
+
+          - ``'worker'``: peak memory per worker process (the larger of the two phases of
+            :meth:`~kszx.KszPipe.get_pk_surrogate()`, plus the Box cache and per-random arrays).
+
+          - ``'phase1'``, ``'phase2'``: peak memory in maps (excluding per-random arrays and the Box
+            cache) in the two phases: simulating/interpolating LSS fields, and gridding/FFT-ing/estimating
+            power spectra of the surrogate fields. (These estimates are derived from the code path, and
+            checked against ``tracemalloc`` in ``kszx.tests.test_kszpipe``.)
+
+          - ``'shared'``: memory used once, in the parent process (catalogs, SurrogateFactory,
+            window function), which is shared with workers (by fork, or with ``shared_inputs=True``).
+
+          - ``'nrand'``, ``'real_map'``, ``'fourier_map'``: sizes used in the estimates.
+        """
+
+        nrand = self.rcat.size if ('rcat' in self.__dict__) else self._read_h5_size(f'{self.input_dir}/randoms.h5')
+        ngal = self.gcat.size if ('gcat' in self.__dict__) else self._read_h5_size(f'{self.input_dir}/galaxies.h5')
+        
+        R = 8 * np.prod(self.box.real_space_shape)       # real-space map
+        F = 16 * np.prod(self.box.fourier_space_shape)   # Fourier-space map
+        ncmb = len(self.cmb_fields)
+        nterms = 3 if self.sim_surr_fg else 2
+        nv = ncmb * nterms
+        nfourier = 4 * len(self.spin_gal) + nv * len(self.spin_vr)
+
+        # Phase 1: SurrogateFactory.simulate_surrogate(). The peak is in interpolate_derived_fields(),
+        # which keeps the Gaussian field, FFT workspace and Fourier-space buffer (3 F), plus 4 interpolated
+        # maps and a real-space buffer (5 R), and evaluates the phi/vr k-filters on the fly (|k| and f(k),
+        # two real-valued Fourier-space arrays, i.e. F).
+        phase1 = 4*F + 5*R
+
+        # Phase 2: gridding the surrogate fields (in batches, see get_pk_surrogate()). All Fourier-space
+        # surrogate fields are kept for estimate_power_spectrum(), plus the real-space maps of the current
+        # batch, and the workspace of a spin > 0 FFT (F). The peak is either in the galaxy batch (4 maps),
+        # or in the last velocity batch (nterms maps).
+        phase2 = max(4*R + (4*len(self.spin_gal)+1)*F, nterms*R + (nfourier+1)*F)
+
+        # Box cache (see kszx.Box docstring, disabled by default): up to 3 real-valued Fourier-space arrays
+        # (|k| with and without regularization, kernel compensation).
+        cache = min(self.box.cache_limit, 3*F//2)
+
+        # Per-random arrays in get_pk_surrogate(): SurrogateFactory outputs, coefficient arrays
+        # (Sg, Sv) and copies made by subtract_binned_means(), noise realization, and the stacked
+        # weights of a grid_points_multi() batch.
+        per_random = 8 * (12 + 3*nv + max(4,nterms))
+        
+        # Catalog columns (assumed to be 8 bytes/column), xyz arrays, SurrogateFactory arrays.
+        shared = 8 * (nrand * self._read_h5_ncols(f'{self.input_dir}/randoms.h5') + ngal * self._read_h5_ncols(f'{self.input_dir}/galaxies.h5'))
+        shared += 8 * nrand * (3 + 3 + 3)   # rcat_xyz_obs, SurrogateFactory.xyz_true, (D, f, faH)
+        shared += F // 2                    # SurrogateFactory.delta_kfilter
+
+        return { 'worker': int(max(phase1, phase2) + cache + per_random * nrand),
+                 'phase1': int(phase1),
+                 'phase2': int(phase2),
+                 'shared': int(shared),
+                 'nrand': int(nrand),
+                 'real_map': int(R),
+                 'fourier_map': int(F) }
+
+    def plan_processes(self, processes='auto', nsurr=None, verbose=True):
+        """Returns (processes, worker_nthreads) for run(), based on available memory and CPUs.
+
+        If ``processes`` is an integer, then it is returned unmodified (and threads are divided
+        evenly between workers). If ``processes='auto'``, then the number of processes is the
+        largest number whose estimated memory usage (see :meth:`~kszx.KszPipe.estimate_memory()`)
+        fits in 90% of available memory (see :func:`~kszx.utils.get_available_memory()`), but no
+        larger than the number of CPUs (see :func:`~kszx.utils.get_available_cpus()`), or the
+        number of surrogates ``nsurr`` (defaults to ``self.nsurr``).
+        """
+
+        ncpus = utils.get_available_cpus()
+        nsurr = self.nsurr if (nsurr is None) else nsurr
+        mem = self.estimate_memory()
+        avail = utils.get_available_memory()
+        
+        if processes == 'auto':
+            nmax = int((0.9 * avail - mem['shared']) // mem['worker'])
+            processes = max(min(nmax, ncpus, max(nsurr,1)), 1)
+            
+            if nmax < 1:
+                print(f'KszPipe: warning: estimated memory usage ({(mem["shared"] + mem["worker"])/1.0e9:.2f} GB)'
+                      + f' exceeds available memory ({avail/1.0e9:.2f} GB), running with 1 process anyway')
+        elif (processes != int(processes)) or (processes <= 0):
+            raise RuntimeError(f"KszPipe: expected 'processes' to be a positive integer or 'auto', got {processes=}")
+
+        processes = int(processes)
+        worker_nthreads = max(ncpus // processes, 1)
+
+        if verbose:
+            print(f'KszPipe: box shape {tuple(int(n) for n in self.box.real_space_shape)}, {mem["nrand"]} randoms')
+            print(f'KszPipe: estimated memory: {mem["shared"]/1.0e9:.2f} GB shared + {mem["worker"]/1.0e9:.2f} GB/worker'
+                  + f' (available: {avail/1.0e9:.2f} GB)')
+            print(f'KszPipe: {ncpus} CPUs available, plan is {processes} processes x {worker_nthreads} threads/process'
+                  + f' (estimated peak memory {(mem["shared"] + processes*mem["worker"])/1.0e9:.2f} GB)')
+
+        return processes, worker_nthreads
+
+    @staticmethod
+    def _read_h5_size(filename):
+        """Helper for estimate_memory(): returns catalog size from HDF5 header (see Catalog.write_h5())."""
+        with h5py.File(filename, 'r') as f:
+            return int(f.attrs['size'])
+
+    @staticmethod
+    def _read_h5_ncols(filename):
+        """Helper for estimate_memory(): returns number of catalog columns in HDF5 file."""
+        with h5py.File(filename, 'r') as f:
+            return len(f.keys())
+
+    def run(self, processes, shared_inputs=False, start_method=None, dry_run=False, max_retries=2):
         """Runs pipeline and saves results to disk, skipping results already on disk from previous runs.
 
         Implementation: creates a multiprocessing Pool, and calls :meth:`~kszx.KszPipe.get_pk_data()`
@@ -396,18 +609,168 @@ class KszPipe:
 
         Can be run from the command line with::
         
-           python -m kszx kszpipe_run [-p NUM_PROCESSES] <input_dir> <output_dir>
+           python -m kszx kszpipe_run [-p NUM_PROCESSES|auto] [--dry-run] [--shared-inputs] [--start-method METHOD] <input_dir> <output_dir>
+
+        The ``processes`` argument is the number of worker processes, or ``'auto'`` to choose the number
+        of processes (and threads per process) from the available memory and CPUs, using a rough estimate
+        of memory usage (see :meth:`~kszx.KszPipe.plan_processes()`). If ``dry_run=True``, then the plan
+        (number of processes, memory estimates, and missing outputs) is printed, and nothing is computed.
+
+        Surrogates are scheduled dynamically (a new surrogate starts as soon as a worker is free), and
+        a surrogate which raises an exception is retried up to ``max_retries`` times. (If a worker process
+        dies, e.g. out of memory, then an exception is raised within a minute, rather than waiting forever
+        for its task.) Each surrogate is
+        written to an append-only :class:`~kszx.SurrogateStore` as soon as it completes, so an interrupted
+        run can be resumed, and ``nsurr`` (in ``params.yml``) can be increased later without recomputing
+        existing surrogates.
+
+        If ``shared_inputs=True``, then the large read-only arrays (catalog columns, random catalog
+        xyz coordinates, and SurrogateFactory arrays) are moved into a :class:`~kszx.utils.SharedArrayDir`
+        before creating the Pool. Worker processes then attach to these arrays without copying, so
+        that catalog memory is not duplicated per worker (or per task -- note that each task pickles
+        the KszPipe), and the pipeline can use any multiprocessing ``start_method``, including
+        ``'spawn'``. (If ``start_method`` is None, then the multiprocessing default is used.)
+        """
+        
+        have_data = all([os.path.exists(fn) for fn in self.pk_data_filename])
+        have_surr = self._have_pk_surrogates()
+        missing_surrs = [] if have_surr else self._missing_surrogates()
+
+        if dry_run:
+            print(f'KszPipe.run(dry_run=True): {have_data=}, {len(missing_surrs)} missing surrogates')
+            self.plan_processes(processes, nsurr=len(missing_surrs))
+            return
+
+        self._write_output_params()
+        self._get_surrogate_store(create=True)   # before creating the Pool, so that workers agree on the master seed
+
+        if (not have_surr) and (len(missing_surrs) == 0):
+            self.get_pk_surrogates()   # creates "top-level" file
+            have_surr = True
+            
+        if have_data and have_surr:
+            print(f'KszPipe.run(): pipeline has already been run, exiting early')
+            return
+        
+        # Note: plan_processes() is called before reading catalogs, since its estimate of
+        # available memory should include memory which will be used by the parent process.
+        processes, worker_nthreads = self.plan_processes(processes, nsurr=len(missing_surrs))
+        
+        # Initialize window function and SurrogateFactory before creating multiprocessing Pool.
+        self.window_function
+        self.surrogate_factory
+
+        sdir, shared = self._share_inputs() if shared_inputs else (None, [])
+        
+        try:
+            self._run_pool(processes, worker_nthreads, start_method, have_data, missing_surrs, max_retries)
+        finally:
+            self._unshare_inputs(shared)
+            if sdir is not None:
+                sdir.close()
+
+        if not have_surr:
+            # Consolidates all surrogates into one file
+            self.get_pk_surrogates()
+
+    def run_distributed(self, nthreads=None, claim_timeout=None):
+        """Runs pipeline as one of several independent worker processes, which may be on different nodes.
+
+        Each worker process claims tasks (:meth:`~kszx.KszPipe.get_pk_data()`, or one surrogate
+        index) from the :class:`~kszx.SurrogateStore` in ``{output_dir}/pk_surr_store``, using
+        atomic file creation on the shared filesystem (see :meth:`~kszx.SurrogateStore.claim()`).
+        There is no coordinating process: workers can be started (or restarted) at any time, on any
+        node which sees ``output_dir``, and exit when no unclaimed tasks remain. The last worker to
+        finish writes the consolidated ``pk_surrogates.npy`` file. Each surrogate uses its own RNG
+        stream (derived from a master seed and the surrogate index, see
+        :meth:`~kszx.SurrogateStore.seed_sequence()`), so results do not depend on which worker
+        computes which surrogate.
+
+        Can be run from the command line with::
+
+           python -m kszx kszpipe_worker [-t NTHREADS] [--claim-timeout SECONDS] <input_dir> <output_dir>
+
+        For example, to run with 4 workers on one machine (e.g. for testing)::
+
+           for i in 1 2 3 4; do python -m kszx kszpipe_worker -t 4 input_dir output_dir & done; wait
+
+        Args:
+
+          - ``nthreads`` (int or None): number of threads in this worker (see :func:`~kszx.utils.get_nthreads()`).
+
+          - ``claim_timeout`` (float or None): if specified, then claims older than this many
+            seconds are assumed to belong to workers which died, and are taken over. Should be
+            comfortably larger than the time to compute one surrogate. If None, then stale claims
+            must be removed by hand (from ``{output_dir}/pk_surr_store/claims``).
 
-        The ``processes`` argument is the number of worker processes. Currently I don't have a good way
-        of setting this automatically -- the caller must adjust the number of processes, based on the
-        size of the datasets, and amount of memory available.
+        If a surrogate raises an exception, its claim is released (so that another worker can retry
+        it), this worker moves on to other surrogates, and an exception is raised when it exits.
         """
+
+        if nthreads is not None:
+            utils.set_nthreads(nthreads)
+        
+        self._write_output_params()
+        store = self._get_surrogate_store(create=True)
+        failed = [ ]
+        ndone = 0
+        t0 = time.time()
+
+        if not all(os.path.exists(fn) for fn in self.pk_data_filename):
+            if store.claim('data', timeout=claim_timeout):
+                try:
+                    self.get_pk_data(run=True)
+                except Exception as e:
+                    store.release('data')
+                    print(f'KszPipe.run_distributed(): get_pk_data() failed ({e!r})')
+                    failed.append(('get_pk_data()', e))
+
+        while True:
+            failed_isurr = [ label for (label,_) in failed ]
+            missing = [ i for i in self._missing_surrogates() if i not in failed_isurr ]
+            claimed = store.claimed()
+            candidates = [ i for i in missing if f'surr_{i}' not in claimed ]
+            if claim_timeout is not None:
+                candidates += [ i for i in missing if f'surr_{i}' in claimed ]   # stale claims can be taken over
+            
+            isurr = next((i for i in candidates if store.claim(f'surr_{i}', timeout=claim_timeout)), None)
+            
+            if isurr is None:
+                break
+
+            try:
+                self.get_pk_surrogate(isurr, run=True)
+            except Exception as e:
+                store.release(f'surr_{isurr}')
+                print(f'KszPipe.run_distributed(): surrogate {isurr} failed ({e!r})')
+                failed.append((isurr, e))
+                continue
+
+            ndone += 1
+            print(f'KszPipe.run_distributed(): surrogate {isurr} done ({ndone} in this worker,'
+                  + f' {3600*ndone/(time.time()-t0):.1f} surrogates/hour)')
+
+        # Every worker checks for completion after its last write, so the last worker to finish sees all surrogates.
+        nmissing = len(self._missing_surrogates())
         
+        if (nmissing == 0) and not self._have_pk_surrogates():
+            self.get_pk_surrogates()   # creates "top-level" file
+        elif nmissing > 0:
+            print(f'KszPipe.run_distributed(): no unclaimed tasks, exiting ({nmissing} surrogates in progress in other workers)')
+
+        if len(failed) > 0:
+            raise RuntimeError(f'KszPipe.run_distributed(): {len(failed)} task(s) failed: '
+                               + ', '.join(str(label) for (label,_) in failed)) from failed[0][1]
+
+    def _write_output_params(self):
+        """Helper for run() and run_distributed(): writes output_dir/params.yml (atomically, since several processes may call this concurrently)."""
+
         # Copy yaml file from input to output dir.
-        shutil.copyfile(f'{self.input_dir}/params.yml', f'{self.output_dir}/params.yml')
+        tmp_filename = f'{self.output_dir}/params.yml.tmp{os.getpid()}'
+        shutil.copyfile(f'{self.input_dir}/params.yml', tmp_filename)
 
         # Add information into the output_dir/params.yml 
-        with open(f'{self.output_dir}/params.yml', 'a') as f:
+        with open(tmp_filename, 'a') as f:
             print(file=f)
             print('# structure of pk_data.npy', file=f)
             print("data_fields:", file=f)
@@ -442,44 +805,168 @@ class KszPipe:
                         print(f"  {freq}-{spin}-bfg: {idx}  # derivative (dSv_freq/dbfg) with spin={spin}", file=f)
                         idx += 1
 
-        have_data = all([os.path.exists(fn) for fn in self.pk_data_filename])
-        have_surr = all([os.path.exists(fn) for fn in self.pk_surr_filename])
-        missing_surrs = [] if have_surr else [i for (i,f) in enumerate(self.pk_single_surr_filenames) if not all([os.path.exists(fn) for fn in f])]
+        os.replace(tmp_filename, f'{self.output_dir}/params.yml')
 
-        if (not have_surr) and (len(missing_surrs) == 0):
-            self.get_pk_surrogates()   # creates "top-level" file
-            have_surr = True
-            
-        if have_data and have_surr:
-            print(f'KszPipe.run(): pipeline has already been run, exiting early')
-            return
+    def _share_inputs(self):
+        """Helper for run(): moves large read-only arrays into a SharedArrayDir (see run() docstring).
+
+        Returns (sdir, shared), where 'shared' is a list of (object, attribute_name) pairs which
+        have been replaced by memory-mapped arrays, to be passed to _unshare_inputs(). If an exception
+        is raised (e.g. if the SharedArrayDir runs out of space), then arrays which have already been
+        replaced are restored, and the SharedArrayDir is closed, before the exception is re-raised.
+        """
+
+        sf = self.surrogate_factory
+        catalogs = [ self.gcat, self.rcat ]
+        sf_members = [ 'xyz_true', 'D', 'f', 'faH', 'delta_kfilter' ]
         
-        # Initialize window function and SurrogateFactory before creating multiprocessing Pool.
-        self.window_function
-        self.surrogate_factory
+        nbytes = self.rcat_xyz_obs.nbytes
+        nbytes += sum(getattr(cat, col).nbytes for cat in catalogs for col in cat.col_names)
+        nbytes += sum(getattr(sf, m).nbytes for m in sf_members)
+        
+        sdir = utils.SharedArrayDir(min_free_bytes = 2*nbytes)
+        print(f'KszPipe: moving {nbytes/1.0e9:.3f} GB of read-only arrays to {sdir.dirname}')
+        
+        todo = [ (cat, col) for cat in catalogs for col in (cat.col_names + ['sort_permutation']) ]
+        todo += [ (sf, m) for m in sf_members ]
+        todo += [ (self, 'rcat_xyz_obs') ]   # overrides cached_property
+        shared = [ ]
+
+        try:
+            for (obj, attr) in todo:
+                setattr(obj, attr, sdir.share(getattr(obj, attr)))
+                shared.append((obj, attr))
+        except:
+            self._unshare_inputs(shared)
+            sdir.close()
+            raise
+
+        return sdir, shared
+
+    @staticmethod
+    def _unshare_inputs(shared):
+        """Helper for run(): copies arrays moved by _share_inputs() back into ordinary (writeable) memory, before the SharedArrayDir is closed."""
+
+        for (obj, attr) in shared:
+            arr = getattr(obj, attr)
+            if arr is not None:
+                setattr(obj, attr, np.array(arr))
+
+    def _run_pool(self, processes, worker_nthreads, start_method, have_data, missing_surrs, max_retries=2, poll_interval=60.0):
+        """Helper for run(): runs get_pk_data() and get_pk_surrogate() in a multiprocessing Pool.
+
+        Tasks are scheduled dynamically: at most ``processes`` tasks are in flight at a time (so that
+        pickled tasks don't pile up in the Pool's queue), and a new task is submitted as soon as any
+        task finishes. Failed tasks are resubmitted up to ``max_retries`` times, and an exception is
+        raised at the end if any task still failed. Progress (surrogates/hour and ETA) is printed
+        after each surrogate.
+
+        If a worker process dies (e.g. killed by the OOM killer), then multiprocessing.Pool replaces
+        it, but the task it was running never completes. Therefore, we wait for results with a timeout
+        (``poll_interval`` seconds), and check that no workers have died after each timeout. Since there
+        is no way to tell which task was lost, an exception is raised. (Completed surrogates are in the
+        SurrogateStore, so the pipeline can be resumed by calling run() again.)
+        """
 
-        # FIXME currently I don't have a good way of setting the number of processes automatically --
-        # caller must adjust the number of processes to the amount of memory in the node.
+        tasks = collections.deque()     # (isurr, func, args), where isurr=None for get_pk_data()
         
-        with utils.Pool(processes) as pool:
-            # before going to the surrogate do the data and wait that they finish:
-            if not have_data:
-                x = pool.apply_async(self.get_pk_data, (True, False))   # (run,force)=(True,False)
-                x.get()
-
-            # to avoid the pool launch new surrogate on the same process before the completion of the previous one, we need to make batch and wait that all the job in the batch are done:
-            # I'm surprised that there is no function in multiporcess to do this ... 
-            nbatchs = len(missing_surrs) // processes
-            for nn in range(nbatchs):
-                print(f'Start batch {nn}/{nbatchs}')
-                l = [pool.apply_async(self.get_pk_surrogate, (i, True)) for i in missing_surrs[nn*processes: (nn+1)*processes]]  # (run,force)=(True,False)
-                # .get() block the code until receveing the answer of the pool.apply_async job:
-                for x in l: x.get()
-                print(f'Batch {nn} done!')
+        if not have_data:
+            tasks.append((None, self.get_pk_data, (True, False)))   # (run,force)=(True,False)
+        for i in missing_surrs:
+            tasks.append((i, self.get_pk_surrogate, (i, True)))     # (run,force)=(True,False)
+
+        results = queue.Queue()   # (task, exception or None), populated by apply_async() callbacks
+        attempts = collections.Counter()
+        ninflight = nsurr_done = 0
+        failed = [ ]
+        t0 = time.time()
+        
+        with utils.Pool(processes, start_method=start_method, worker_nthreads=worker_nthreads) as pool:
+            worker_pids = self._pool_worker_pids(pool)
+            
+            while (len(tasks) > 0) or (ninflight > 0):
+                while (len(tasks) > 0) and (ninflight < processes):
+                    task = tasks.popleft()
+                    attempts[task[0]] += 1
+                    ninflight += 1
+                    pool.apply_async(task[1], task[2],
+                                     callback = functools.partial(lambda t,_: results.put((t,None)), task),
+                                     error_callback = functools.partial(lambda t,e: results.put((t,e)), task))
+
+                try:
+                    task, exc = results.get(timeout=poll_interval)
+                except queue.Empty:
+                    self._check_pool_workers(pool, worker_pids, ninflight)
+                    continue
+                
+                ninflight -= 1
+                label = 'get_pk_data()' if (task[0] is None) else f'surrogate {task[0]}'
+
+                if exc is not None:
+                    if attempts[task[0]] <= max_retries:
+                        print(f'KszPipe: {label} failed ({exc!r}), retrying (attempt {attempts[task[0]]+1}/{max_retries+1})')
+                        tasks.append(task)
+                    else:
+                        print(f'KszPipe: {label} failed ({exc!r}), giving up after {max_retries+1} attempts')
+                        failed.append((label, exc))
+                    continue
+
+                if task[0] is None:
+                    print(f'KszPipe: get_pk_data() done')
+                    continue
+
+                nsurr_done += 1
+                dt = time.time() - t0
+                rate = nsurr_done / dt   # surrogates/second (includes get_pk_data() time, if any)
+                nleft = len(missing_surrs) - nsurr_done - sum(1 for (label,_) in failed if label.startswith('surrogate'))
+                print(f'KszPipe: surrogate {task[0]} done ({nsurr_done}/{len(missing_surrs)}),'
+                      + f' {3600*rate:.1f} surrogates/hour, ETA {nleft/rate/60:.1f} minutes')
+
+        if len(failed) > 0:
+            raise RuntimeError(f'KszPipe.run(): {len(failed)} task(s) failed after {max_retries+1} attempts: '
+                               + ', '.join(label for (label,_) in failed)) from failed[0][1]
+
+    @staticmethod
+    def _pool_worker_pids(pool):
+        """Helper for _run_pool(). Returns the set of worker pids (uses the private member multiprocessing.Pool._pool)."""
+        return set(p.pid for p in pool._pool)
+
+    @staticmethod
+    def _check_pool_workers(pool, worker_pids, ninflight):
+        """Helper for _run_pool(): raises an exception if any process in 'worker_pids' has died (see _run_pool() docstring)."""
+
+        alive = set(p.pid for p in pool._pool if p.is_alive())
+        dead = worker_pids - alive
+
+        if len(dead) > 0:
+            raise RuntimeError(f'KszPipe.run(): {len(dead)} worker process(es) died unexpectedly (maybe out of memory?),'
+                               + f' with {ninflight} task(s) in flight. Completed surrogates have been saved, and'
+                               + ' the pipeline can be resumed by calling run() again (maybe with fewer processes).')
 
-        if not have_surr:
-            # Consolidates all surrogates into one file
-            self.get_pk_surrogates()
+
+def _read_surrogates(dirname, nsurr, shapes, store):
+    """Helper for KszPipe.get_pk_surrogates() and KszPipeOutdir: reads surrogates 0 <= isurr < nsurr.
+
+    Surrogates are read from the SurrogateStore if present there (store may be None), or from
+    legacy 'tmp/pk_surr_{isurr}_binning{i}.npy' files otherwise. Returns a list of arrays of shape
+    (nsurr,)+shapes[i], one per binning.
+    """
+
+    done = store.done_mask(nsurr) if (store is not None) else np.zeros(nsurr, dtype=bool)
+    pks = [ np.zeros((nsurr,) + tuple(s)) for s in shapes ]
+
+    if np.any(done):
+        for pk, pk_store in zip(pks, store.read(nsurr=nsurr)):
+            pk[done] = pk_store
+
+    for isurr in np.flatnonzero(~done):
+        for i, pk in enumerate(pks):
+            pk_legacy = io_utils.read_npy(f'{dirname}/tmp/pk_surr_{isurr}_binning{i}.npy', verbose=False)
+            if pk_legacy.shape != pk.shape[1:]:
+                raise RuntimeError(f'Got {pk_legacy.shape=}, expected {pk.shape[1:]} (surrogate {isurr}, binning {i})')
+            pk[isurr] = pk_legacy
+
+    return pks
 
 
 ####################################################################################################
@@ -501,9 +988,11 @@ class KszPipeOutdir:
 
           - ``dirname`` (string): name of pipeline output directory.
          
-          - ``nsurr`` (integer or None): this is a hack for running on an incomplete
-            pipeline. If specified, then ``{dirname}/pk_surr.npy`` is not read.
-            Instead we read files of the form ``{dirname}/tmp/pk_surr_{i}.npy``.
+          - ``nsurr`` (integer or None): if None, then all available surrogates are used. For
+            an incomplete pipeline (or a pipeline whose ``nsurr`` has been increased), this means
+            all surrogates which have been written to ``{dirname}/pk_surr_store`` so far (see
+            :class:`~kszx.SurrogateStore`). If specified, then only the first ``nsurr``
+            surrogates are used (and all of them must be present).
 
         - ``p`` (float): value used to describe b_phi (p=1 for LRG, 1.4/1.6 for QSO)
 
@@ -512,6 +1001,15 @@ class KszPipeOutdir:
         - ``binning`` (dict): the binning scheme to load for the different power spectra. It does not allow different binning for the same type of power spectrum for now.
 
         - ``spin`` (dict): the spin components to load for galaxies (key 'g') and velocity (key 'v'). Useful to reduce the size of the covariance matrix pre-loaded if you want to ignore some spin components.
+
+        The model parameters (``b1``, ``fnl``, ``bv``, ...) of the ``p*_mean()`` and ``p*x*_cov()`` methods can be
+        either scalars, or 1-d arrays of length ``n`` (to evaluate ``n`` parameter points at once). In the second case,
+        the returned arrays have an extra leading axis of length ``n``.
+
+        If ``return_grad=True`` is specified, then these methods return a pair ``(mean, grad)`` (or ``(cov, grad)``),
+        where ``grad`` is a dict containing the exact derivatives with respect to the model parameters, keyed by
+        argument name (e.g. ``grad['b1']`` or ``grad['snv2']``). This is used for gradient-based inference in
+        :class:`~kszx.Likelihood`.
         """
 
         filename = f'{dirname}/params.yml'
@@ -532,24 +1030,24 @@ class KszPipeOutdir:
                 raise RuntimeError(f'Got {pk_d.shape=}, expected ({len(data_fields)},{len(data_fields)},nkbins) where {nkbins[i]=}')
 
         surr_fields = params['surrogate_fields']
-        if nsurr is None:
-            pk_surr = [io_utils.read_npy(f'{dirname}/pk_surrogates_binning{i}.npy') for i in range(len(kbin_edges))]
+        surr_shapes = [ (len(surr_fields), len(surr_fields), nkbins[i]) for i in range(len(kbin_edges)) ]
+        store = SurrogateStore(f'{dirname}/pk_surr_store', surr_shapes) if os.path.exists(f'{dirname}/pk_surr_store/store.yml') else None
+        pk_surr_filenames = [ f'{dirname}/pk_surrogates_binning{i}.npy' for i in range(len(kbin_edges)) ]
+
+        if nsurr is not None:
+            print(f'Reading {nsurr} surrogates from {dirname}/pk_surr_store (or {dirname}/tmp/pk_surr_*_binning*.npy)')
+            pk_surr = _read_surrogates(dirname, nsurr, surr_shapes, store)
+        elif all(os.path.exists(fn) for fn in pk_surr_filenames) and ((store is None) or (np.load(pk_surr_filenames[0], mmap_mode='r').shape[0] >= store.num_done)):
+            pk_surr = [io_utils.read_npy(fn) for fn in pk_surr_filenames]
             for i, pk_s in enumerate(pk_surr):
-                if (pk_s.ndim != 4) or (pk_s.shape[1:] != (len(surr_fields),len(surr_fields),nkbins[i])):
+                if (pk_s.ndim != 4) or (pk_s.shape[1:] != surr_shapes[i]):
                     raise RuntimeError(f'Got {pk_s.shape=}, expected (nsurr,{len(surr_fields)},{len(surr_fields)},nkbins) where {nkbins[i]=}')
+        elif store is not None:
+            # Incomplete pipeline: use all surrogates which have been written so far.
+            pk_surr = store.read()
+            print(f'Read {pk_surr[0].shape[0]} completed surrogates from {store.dirname} (params.yml has nsurr={params["nsurr"]})')
         else:
-            pk_surr = []
-            print(f'Reading {nsurr} surrogate files from {dirname}/tmp/pk_surr_*_binning*.npy')
-            for j in range(len(kbin_edges)):
-                pk_surr_tmp = []
-                for i in range(nsurr):
-                    pk_surrogate = io_utils.read_npy(f'{dirname}/tmp/pk_surr_{i}_binning{j}.npy', verbose=False)
-                    if pk_surrogate.shape != (len(surr_fields), len(surr_fields), nkbins[j]):
-                        raise RuntimeError(f'Got {pk_surrogate.shape=}, expected ({len(surr_fields)},{len(surr_fields)},nkbins) where {nkbins[j]=}')
-                    pk_surr_tmp += [pk_surrogate]
-                pk_surr_tmp = np.array(pk_surr_tmp)
-                pk_surr_tmp = np.reshape(pk_surr_tmp, (nsurr, len(surr_fields), len(surr_fields), nkbins[j]))   # needed if nsurr==0
-                pk_surr += [pk_surr_tmp]
+            raise RuntimeError(f'KszPipeOutdir: neither {pk_surr_filenames[0]} nor {dirname}/pk_surr_store was found')
         
         self.binning = binning 
         self.k = {key: kbin_centers[val] for key, val in binning.items()}
@@ -621,6 +1119,32 @@ class KszPipeOutdir:
                 cov[f'{i}-{j}'] = np.ascontiguousarray(cov_tmp)  # make contiguous
         self.surr_cov = cov
 
+        # Compiled model plans (see _spectrum_plan() and _cov_template()), built lazily from surr_mean/surr_cov.
+        self._model_plans = {}
+
+    def _share_arrays(self, sdir):
+        """Replaces large read-only arrays (surrogates, their mean/covariance, and compiled covariance templates)
+        by copies in a utils.SharedArrayDir, so that pickling this object (e.g. to send to worker processes) is cheap.
+
+        Returns the original arrays, to be passed to _unshare_arrays() before the SharedArrayDir is closed.
+        Model plans which are built after this call are not shared, so callers should build them first
+        (e.g. by evaluating the likelihood once)."""
+
+        saved = { attr: getattr(self, attr) for attr in [ 'pk_data', 'pk_surr', 'surr_mean', 'surr_cov', '_model_plans' ] }
+        
+        self.pk_data = [ sdir.share(x) for x in self.pk_data ]
+        self.pk_surr = [ sdir.share(x) for x in self.pk_surr ]
+        self.surr_mean = [ sdir.share(x) for x in self.surr_mean ]
+        self.surr_cov = { key: sdir.share(x) for key, x in self.surr_cov.items() }
+        self._model_plans = { key: (sdir.share(x) if isinstance(x, np.ndarray) else x) for key, x in self._model_plans.items() }
+        return saved
+
+    def _unshare_arrays(self, saved):
+        """Restores the original arrays (returned by _share_arrays())."""
+
+        for attr, x in saved.items():
+            setattr(self, attr, x)
+
     @functools.cached_property
     def cosmo(self):
         return Cosmology('planck18+bao')
@@ -694,22 +1218,232 @@ class KszPipeOutdir:
         t = field[0][0]*self.pk_data[self.binning['vv']][idx_vr_11,:] + field[0][1]*self.pk_data[self.binning['vv']][idx_vr_12,:]
         return field[1][0]*t[idx_vr_21] + field[1][1]*t[idx_vr_22]
 
-    def pgg_mean(self, b1=1, fnl=0, sn=1, sigmag=0, ell=[0,0]):
-        r"""Returns shape ``(nkbins,)`` array, containing $\langle P_{gg}^{surr}(k) \rangle$."""
-        assert ell[0] in self.spin_gal
-        assert ell[1] in self.spin_gal
+    def _gal_scalars(self, b1, fnl, sn):
+        """Returns shape (..., 4) array of parameter-dependent factors (sn, b1, f, fnl*(b1-p)) of the galaxy coefficients (see _gal_coeffs())."""
+        b1, fnl, sn = [ np.asarray(x, dtype=float) for x in (b1, fnl, sn) ]
+        ret = np.empty(np.broadcast_shapes(b1.shape, fnl.shape, sn.shape) + (4,))
+        ret[...,0] = sn
+        ret[...,1] = b1
+        ret[...,2] = self.f
+        ret[...,3] = fnl * (b1 - self.p)
+        return ret
+
+    def _gal_profiles(self, k, sigmag):
+        """Returns shape (..., 4, nkbins) array of k-dependent factors (1, D_g, D_g, D_g) of the galaxy coefficients (see _gal_coeffs())."""
+        dg = self.D_g(k, np.asarray(sigmag, dtype=float)[...,None])
+        ret = np.empty(dg.shape[:-1] + (4, len(k)))
+        ret[...,0,:] = 1.0
+        ret[...,1:,:] = dg[...,None,:]
+        return ret
+
+    def _vel_scalars(self, bv, snv, bfg):
+        """Returns shape (..., 2 or 3) array of parameter-dependent factors (snv, bv, bfg) of the velocity coefficients (see _vel_coeffs())."""
+        bv, snv, bfg = [ np.asarray(x, dtype=float) for x in (bv, snv, bfg) ]
+        shape = (bv.shape, snv.shape, bfg.shape) if self.sim_surr_fg else (bv.shape, snv.shape)
+        ret = np.empty(np.broadcast_shapes(*shape) + (len(self.suff_vel_list),))
+        ret[...,0] = snv
+        ret[...,1] = bv
+        if self.sim_surr_fg:
+            ret[...,2] = bfg
+        return ret
+
+    def _vel_profiles(self, k, sigmav):
+        """Returns shape (..., 2 or 3, nkbins) array of k-dependent factors (1, D_v, 1) of the velocity coefficients (see _vel_coeffs())."""
+        dv = self.D_v(k, np.asarray(sigmav, dtype=float)[...,None])
+        ret = np.ones(dv.shape[:-1] + (len(self.suff_vel_list), len(k)))
+        ret[...,1,:] = dv
+        return ret
+
+    def _gal_coeffs(self, k, b1, fnl, sn, sigmag):
+        """Returns shape (..., 4, nkbins) array of coefficients of the galaxy surrogate terms ('null', 'b1', 'f', 'fnl').
+
+        The RSD damping factor D_g(k) is applied to the b1/f/fnl terms, but not to the shotnoise term.
+        The parameters can be scalars or arrays (the leading axes of the returned array are the broadcast shape)."""
+        return self._gal_scalars(b1, fnl, sn)[...,None] * self._gal_profiles(k, sigmag)
+
+    def _vel_coeffs(self, k, bv, snv, bfg, sigmav):
+        """Returns shape (..., 2 or 3, nkbins) array of coefficients of the velocity surrogate terms ('null', 'bv', 'bfg').
+
+        The RSD damping factor D_v(k) is only applied to the bv term.
+        The parameters can be scalars or arrays (the leading axes of the returned array are the broadcast shape)."""
+        return self._vel_scalars(bv, snv, bfg)[...,None] * self._vel_profiles(k, sigmav)
+
+    def _gal_leg(self, k, suffix, return_grad, b1, fnl, sn, sigmag):
+        r"""Returns pair (c, dc), where c = _gal_coeffs(k, b1, fnl, sn, sigmag).
+
+        If return_grad=True, then dc is a dict containing the derivatives of c with respect to the parameters, with keys
+        'b1'+suffix, 'fnl'+suffix, 'sn'+suffix, 'sigmag'+suffix (i.e. the argument names in the calling method).
+        If return_grad=False, then dc is None."""
+        c = self._gal_coeffs(k, b1, fnl, sn, sigmag)
+        if not return_grad:
+            return c, None
+
+        b1, fnl, sigmag = [ np.asarray(x, dtype=float)[...,None] for x in (b1, fnl, sigmag) ]
+        dg = self.D_g(k, sigmag)
+        d_b1, d_fnl, d_sn = np.zeros_like(c), np.zeros_like(c), np.zeros_like(c)
+        d_b1[...,1,:] = dg
+        d_b1[...,3,:] = fnl * dg
+        d_fnl[...,3,:] = (b1 - self.p) * dg
+        d_sn[...,0,:] = 1.0
+
+        # Derivative of D_g(k,sigmag) = 1/(1+k^2 sigmag^2/2) is -k^2 sigmag D_g^2.
+        d_sigmag = c * (-k**2 * sigmag * dg)[...,None,:]
+        d_sigmag[...,0,:] = 0.0
+
+        return c, { 'b1'+suffix: d_b1, 'fnl'+suffix: d_fnl, 'sn'+suffix: d_sn, 'sigmag'+suffix: d_sigmag }
+
+    def _vel_leg(self, k, suffix, return_grad, bv, snv, bfg, sigmav):
+        r"""Returns pair (c, dc), where c = _vel_coeffs(k, bv, snv, bfg, sigmav).
+
+        If return_grad=True, then dc is a dict containing the derivatives of c with respect to the parameters, with keys
+        'bv'+suffix, 'snv'+suffix, 'sigmav'+suffix, and 'bfg'+suffix if foregrounds were simulated.
+        If return_grad=False, then dc is None."""
+        c = self._vel_coeffs(k, bv, snv, bfg, sigmav)
+        if not return_grad:
+            return c, None
+
+        bv, sigmav = [ np.asarray(x, dtype=float)[...,None] for x in (bv, sigmav) ]
+        d_bv, d_snv, d_sigmav = np.zeros_like(c), np.zeros_like(c), np.zeros_like(c)
+        d_bv[...,1,:] = self.D_v(k, sigmav)
+        d_snv[...,0,:] = 1.0
+
+        # Derivative of D_v(k,sigmav) = sinc(k sigmav) = sin(pi x)/(pi x) is k (cos(pi x) - sinc(x)) / x, where x = k sigmav.
+        x = k * sigmav
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dsinc = np.where(x != 0, (np.cos(np.pi*x) - np.sinc(x)) / x, 0.0)
+        d_sigmav[...,1,:] = bv * k * dsinc
+
+        dc = { 'bv'+suffix: d_bv, 'snv'+suffix: d_snv, 'sigmav'+suffix: d_sigmav }
+        if self.sim_surr_fg:
+            d_bfg = np.zeros_like(c)
+            d_bfg[...,2,:] = 1.0
+            dc['bfg'+suffix] = d_bfg
+        return c, dc
 
-        params_gal = np.array([sn, b1, self.f, fnl*(b1 - self.p)])
-        # Add RSD damping factor term (Warning: shotnoise is not damped !!) --> params_gal will be (4, nkbins)
-        params_gal = params_gal[:,None] * [np.ones_like(self.k['gg']), self.D_g(self.k['gg'], sigmag), self.D_g(self.k['gg'], sigmag), self.D_g(self.k['gg'], sigmag)]
-        idx_gal_1 = [self.surr_fields[f'gal-{ell[0]}-{suff}'] for suff in self.suff_gal_list]
-        idx_gal_2 = [self.surr_fields[f'gal-{ell[1]}-{suff}'] for suff in self.suff_gal_list]
+    def _spectrum_plan(self, kind, freq=None, field=None, ell=None):
+        """Returns the _SpectrumPlan for the power spectrum selection (kind, freq, field, ell), building it on first use."""
+        key = (kind, _freeze(freq), _freeze(field), _freeze(ell))
+        plan = self._model_plans.get(key)
+        if plan is None:
+            plan = self._model_plans[key] = _SpectrumPlan(self, key, kind, freq, field, ell)
+        return plan
 
-        pgg = self.surr_mean[self.binning['gg']][idx_gal_1, :, :]       # shape (2, #fields, nkbins)
-        pgg = np.sum(params_gal[:, None, :] * pgg, axis=0)  # shape (nsurr,  #fields, nkbins)
-        return np.sum(params_gal[:, :] * pgg[idx_gal_2, :], axis=0)     # shape (nsurr, nkbins)
+    def _cov_template(self, plan1, plan2):
+        r"""Returns shape (n1, n2, nkbins1, nkbins2) array T, where n1 (resp. n2) is the number of terms in plan1 (resp. plan2).
 
-    def pgv_mean(self, b1=1, fnl=0, sn=1, bv=1, snv=1, bfg=0, sigmag=0, sigmav=0, freq=['90','150'], field=[1,0], ell=[0, 1]):
+        The covariance between the two power spectra is then given by::
+
+           Cov(k,k') = sum_{ij} C1_i(k) C2_j(k') T_{ij}(k,k')
+
+        where C1, C2 are the coefficient arrays returned by _SpectrumPlan.coeffs(). Built on first use, and cached.
+        """
+        key = (plan1.key, plan2.key)
+        t = self._model_plans.get(key)
+        if t is not None:
+            return t
+
+        t = self._model_plans.get((plan2.key, plan1.key))
+        if t is not None:
+            return t.transpose(1, 0, 3, 2)
+
+        surr_cov = self.surr_cov[f'{plan1.binning}-{plan2.binning}']  # select the covariance for the right binning
+        t = surr_cov[plan1.columns][:, plan2.columns]                  # shape (ncol1, ncol2, nkbins1, nkbins2)
+        t = np.tensordot(plan1.weights, t, axes=(1,0))                  # shape (n1, ncol2, nkbins1, nkbins2)
+        t = np.tensordot(plan2.weights, t, axes=(1,1))                  # shape (n2, n1, nkbins1, nkbins2)
+        t = np.ascontiguousarray(t.transpose(1, 0, 2, 3))
+        self._model_plans[key] = t
+        return t
+
+    def _model_mean(self, plan, leg1, leg2):
+        """Returns shape (..., nkbins) mean, given per-leg (c, dc) pairs (see _gal_leg()). If dc is not None, returns (mean, grad) pair."""
+        (c1, dc1), (c2, dc2) = leg1, leg2
+        mean = plan.mean(c1, c2)
+        if dc1 is None:
+            return mean
+
+        # Note that keys can appear in both legs (e.g. in pgg_mean()), in which case the derivatives are summed.
+        grad = { }
+        for name, d in dc1.items():
+            grad[name] = plan.mean(d, c2)
+        for name, d in dc2.items():
+            grad[name] = grad.get(name, 0) + plan.mean(c1, d)
+        return mean, grad
+
+    def _model_cov(self, plan1, leg11, leg12, plan2, leg21, leg22):
+        """Returns shape (..., nkbins1, nkbins2) covariance, given per-leg (c, dc) pairs for both power spectra.
+        If dc is not None, returns (cov, grad) pair (see _model_mean())."""
+        t = self._cov_template(plan1, plan2)
+        (c11, dc11), (c12, dc12), (c21, dc21), (c22, dc22) = leg11, leg12, leg21, leg22
+        C1, C2 = plan1.coeffs(c11, c12), plan2.coeffs(c21, c22)
+        
+        if dc11 is None:
+            return np.einsum('...ik,ijkl,...jl->...kl', C1, t, C2)
+
+        t2 = np.einsum('ijkl,...jl->...ikl', t, C2)
+        t1 = np.einsum('...ik,ijkl->...jkl', C1, t)
+        cov = np.einsum('...ik,...ikl->...kl', C1, t2)
+
+        grad = { }
+        for dc, dC1 in [ (dc11, lambda d: plan1.coeffs(d,c12)), (dc12, lambda d: plan1.coeffs(c11,d)) ]:
+            for name, d in dc.items():
+                grad[name] = grad.get(name, 0) + np.einsum('...ik,...ikl->...kl', dC1(d), t2)
+        for dc, dC2 in [ (dc21, lambda d: plan2.coeffs(d,c22)), (dc22, lambda d: plan2.coeffs(c21,d)) ]:
+            for name, d in dc.items():
+                grad[name] = grad.get(name, 0) + np.einsum('...jkl,...jl->...kl', t1, dC2(d))
+
+        return cov, grad
+
+    def _mean_terms(self, kind, return_templates=True, **kwargs):
+        r"""Returns pair (s, t), such that ``p{kind}_mean(**kwargs) = sum_a s[...,a] t[a,:]``.
+
+        The shape (..., nterms) array 's' contains products of model parameters (e.g. b1*bv), and does not depend
+        on sigmag/sigmav. The shape (nterms, nkbins) array 't' contains the corresponding mean surrogate power spectra,
+        including the RSD damping factors, and only depends on sigmag/sigmav (which must be scalars). This is used
+        in Likelihood to precompute whitened templates when the covariance is fixed. If return_templates=False,
+        then only 's' is returned."""
+
+        kw = dict(self._mean_defaults(kind))
+        kw.update(kwargs)
+        
+        if kind == 'gg':
+            legs = [ ('gal','') ] * 2
+        elif kind == 'gv':
+            legs = [ ('gal',''), ('vel','') ]
+        elif kind == 'vv':
+            legs = [ ('vel','1'), ('vel','2') ]
+        else:
+            raise RuntimeError(f"KszPipeOutdir._mean_terms(): expected kind to be 'gg', 'gv', or 'vv' (got {kind=})")
+
+        s = [ self._gal_scalars(kw['b1'+x], kw['fnl'+x], kw['sn'+x]) if (leg == 'gal') else self._vel_scalars(kw['bv'+x], kw['snv'+x], kw['bfg'+x]) for (leg,x) in legs ]
+        s = s[0][...,:,None] * s[1][...,None,:]
+        s = s.reshape(s.shape[:-2] + (-1,))
+
+        if not return_templates:
+            return s
+
+        sigma = [ kw['sigmag'+x] if (leg == 'gal') else kw['sigmav'+x] for (leg,x) in legs ]
+        if any(np.ndim(x) != 0 for x in sigma):
+            raise RuntimeError('KszPipeOutdir._mean_terms(): sigmag/sigmav must be scalars')
+
+        k = self.k[kind]
+        plan = self._spectrum_plan(kind, freq=kw.get('freq'), field=kw.get('field'), ell=kw['ell'])
+        t = [ self._gal_profiles(k,x) if (leg == 'gal') else self._vel_profiles(k,x) for ((leg,_),x) in zip(legs,sigma) ]
+        t = (t[0][:,None,:] * t[1][None,:,:]).reshape(-1, len(k)) * plan.mean_template
+        return s, t
+
+    @classmethod
+    @functools.cache
+    def _mean_defaults(cls, kind):
+        """Helper for _mean_terms(): returns dict containing default arguments of p{kind}_mean()."""
+        return { key: p.default for key, p in inspect.signature(getattr(cls, f'p{kind}_mean')).parameters.items() if key != 'self' }
+
+    def pgg_mean(self, b1=1, fnl=0, sn=1, sigmag=0, ell=[0,0], return_grad=False):
+        r"""Returns shape ``(nkbins,)`` array, containing $\langle P_{gg}^{surr}(k) \rangle$."""
+        plan = self._spectrum_plan('gg', ell=ell)
+        leg = self._gal_leg(self.k['gg'], '', return_grad, b1, fnl, sn, sigmag)
+        return self._model_mean(plan, leg, leg)
+
+    def pgv_mean(self, b1=1, fnl=0, sn=1, bv=1, snv=1, bfg=0, sigmag=0, sigmav=0, freq=['90','150'], field=[1,0], ell=[0, 1], return_grad=False):
         r"""Returns shape ``(nkbins,)`` array containing $\langle P_{gv}^{surr}(k) \rangle$.
 
         The ``field`` argument is a length-2 vector, selecting a linear combination
@@ -720,30 +1454,11 @@ class KszPipeOutdir:
            - ``field=[0.5,0.5]`` for mean (90+150) GHz reconstruction **not optimal**.
            - ``field=[1,-1]`` for null (90-150) GHz reconstruction.
         """
-        field = self._check_field(field)
-        assert ell[0] in self.spin_gal
-        assert ell[1] in self.spin_vr
-
-        params_gal = np.array([sn, b1, self.f, fnl*(b1 - self.p)])
-        # Add RSD damping factor term: (Warning: only b1 / fnl terms are damped, not the shotnoise term) --> params_gal will be (4, nkbins)
-        params_gal = params_gal[:,None] * [np.ones_like(self.k['gv']), self.D_g(self.k['gv'], sigmag), self.D_g(self.k['gv'], sigmag), self.D_g(self.k['gv'], sigmag)]
-        idx_gal = [self.surr_fields[f'gal-{ell[0]}-{suff}'] for suff in self.suff_gal_list]
-
-        if self.sim_surr_fg:
-            params_vel = np.array([snv, bv, bfg])[:,None] * [np.ones_like(self.k['gv']), self.D_v(self.k['gv'], sigmav), np.ones_like(self.k['gv'])]  # Add RSD damping factor term --> shape (3, nkbins)
-        else:
-            params_vel = np.array([snv, bv])[:,None] * [np.ones_like(self.k['gv']), self.D_v(self.k['gv'], sigmav)]  # Add RSD damping factor term --> shape (2, nkbins)
-        idx_vr_1 = [self.surr_fields[f'{freq[0]}-{ell[1]}-{suff}'] for suff in self.suff_vel_list]
-        idx_vr_2 = [self.surr_fields[f'{freq[1]}-{ell[1]}-{suff}'] for suff in self.suff_vel_list]
-
-        pgv = self.surr_mean[self.binning['gv']][idx_gal,:,:] # shape (2, #fields, nkbins)
-        # this is the g term:
-        pgv = np.sum(params_gal[:, None, :] * pgv, axis=0) # shape (#fields, nkbins)
-        # combine or not the different frequency fields:
-        pgv = field[0] * pgv[idx_vr_1,:] + field[1] * pgv[idx_vr_2,:]      # shape (2 or 3, nkbins)
-        return np.sum(params_vel[:, :] * pgv, axis=0) # shape (nkbins)
+        plan = self._spectrum_plan('gv', freq=freq, field=field, ell=ell)
+        k = self.k['gv']
+        return self._model_mean(plan, self._gal_leg(k, '', return_grad, b1, fnl, sn, sigmag), self._vel_leg(k, '', return_grad, bv, snv, bfg, sigmav))
 
-    def pvv_mean(self, bv1=1, snv1=1, bfg1=0, sigmav1=0, bv2=1, snv2=1, bfg2=0, sigmav2=0, freq=[['90','150'], ['90','150']], field=[[1,0], [1,0]], ell=[1,1]):
+    def pvv_mean(self, bv1=1, snv1=1, bfg1=0, sigmav1=0, bv2=1, snv2=1, bfg2=0, sigmav2=0, freq=[['90','150'], ['90','150']], field=[[1,0], [1,0]], ell=[1,1], return_grad=False):
         r"""Returns shape ``(nkbins,)`` array containing $\langle P_{vv}^{data}(k) \rangle$.
 
         The ``field`` argument is a length-2 vector, selecting a linear combination
@@ -754,70 +1469,22 @@ class KszPipeOutdir:
            - ``field=[0.5,0.5]`` for mean (90+150) GHz reconstruction **not optimal**.
            - ``field=[1,-1]`` for null (90-150) GHz reconstruction.
         """
-        assert ell[0] in self.spin_vr
-        assert ell[1] in self.spin_vr
-
-        if self.sim_surr_fg:
-            # Add RSD damping factor term --> shape (3, nkbins)
-            params_vel1 = np.array([snv1, bv1, bfg1])[:,None] * [np.ones_like(self.k['vv']), self.D_v(self.k['vv'], sigmav1), np.ones_like(self.k['vv'])]
-            params_vel2 = np.array([snv2, bv2, bfg2])[:,None] * [np.ones_like(self.k['vv']), self.D_v(self.k['vv'], sigmav2), np.ones_like(self.k['vv'])] 
-        else:
-            # Add RSD damping factor term --> shape (2, nkbins)
-            params_vel1 = np.array([snv1, bv1])[:,None] * [np.ones_like(self.k['vv']), self.D_v(self.k['vv'], sigmav1)]  
-            params_vel2 = np.array([snv2, bv2])[:,None] * [np.ones_like(self.k['vv']), self.D_v(self.k['vv'], sigmav2)]
-
-        idx_vr_11 = [self.surr_fields[f'{freq[0][0]}-{ell[0]}-{suff}'] for suff in self.suff_vel_list]
-        idx_vr_12 = [self.surr_fields[f'{freq[0][1]}-{ell[0]}-{suff}'] for suff in self.suff_vel_list]
-        idx_vr_21 = [self.surr_fields[f'{freq[1][0]}-{ell[1]}-{suff}'] for suff in self.suff_vel_list]
-        idx_vr_22 = [self.surr_fields[f'{freq[1][1]}-{ell[1]}-{suff}'] for suff in self.suff_vel_list]
-
-        pvv = field[0][0] * self.surr_mean[self.binning['vv']][idx_vr_11,:,:] + field[0][1] * self.surr_mean[self.binning['vv']][idx_vr_12,:,:] # shape (#params_vel, #fields, nkbins)
-        pvv = np.sum(params_vel1[:, None, :] * pvv, axis=0) # shape (#fields, nkbins)
-        pvv = field[1][0] * pvv[idx_vr_21,:] + field[1][1] * pvv[idx_vr_22,:]      # shape (#params_vel, nkbins)
-        return np.sum(params_vel2[:, :] * pvv, axis=0) # shape (nkbins)
+        plan = self._spectrum_plan('vv', freq=freq, field=field, ell=ell)
+        k = self.k['vv']
+        return self._model_mean(plan, self._vel_leg(k, '1', return_grad, bv1, snv1, bfg1, sigmav1), self._vel_leg(k, '2', return_grad, bv2, snv2, bfg2, sigmav2))
 
     def pggxpgg_cov(self, b11=1, fnl1=0, sn1=1, sigmag1=0, b12=1, fnl2=0, sn2=1, sigmag2=0,
-                    ell1=[0, 0], ell2=[0, 0]):
+                    ell1=[0, 0], ell2=[0, 0], return_grad=False):
         r"""Returns shape ``(nkbins, nkbins)`` covariance matrix of $P_{gg}^{surr}(k) x P_{gg}^{surr}(k)$."""
-        idx_gal_11 = [self.surr_fields[f'gal-{ell1[0]}-{suff}'] for suff in self.suff_gal_list]
-        idx_gal_12 = [self.surr_fields[f'gal-{ell1[1]}-{suff}'] for suff in self.suff_gal_list]
-        idx_gal_21 = [self.surr_fields[f'gal-{ell2[0]}-{suff}'] for suff in self.suff_gal_list]
-        idx_gal_22 = [self.surr_fields[f'gal-{ell2[1]}-{suff}'] for suff in self.suff_gal_list]
-
-        ## TODO: write a function to compute these coeffs to avoid code duplication in pggxpgg, pggxpgv, pgvxpgv, pgvxpvv, pvvxpvv!!!
-        coeffs1 = np.array([sn1, b11, self.f, fnl1*(b11 - self.p)])
-        coeffs1 = np.ravel(coeffs1[:,None]*coeffs1[None,:]) # shape (6, ) ie (len(idx_gal_11)*len(idx_gal_12), )
-        # Add RSD damping factor term: (Warning: only b1 / fnl terms are damped, not the shotnoise term) --> shape (6, nkbins)
-        rsd1 = np.array([np.ones_like(self.k['gg']), self.D_g(self.k['gg'], sigmag1), self.D_g(self.k['gg'], sigmag1), self.D_g(self.k['gg'], sigmag1)])
-        rsd1 = rsd1[:,None] * rsd1[None,:]
-        rsd1 = rsd1.reshape(rsd1.shape[0]*rsd1.shape[1], rsd1.shape[2])
-        coeffs1 = coeffs1[:,None] * rsd1 # shape (6, nkbins)
-
-        coeffs2 = np.array([1, b12, self.f, fnl2*(b12 - self.p)])
-        coeffs2 = np.ravel(coeffs2[:,None]*coeffs2[None,:])
-        # Add RSD damping factor term:
-        rsd2 = np.array([np.ones_like(self.k['gg']), self.D_g(self.k['gg'], sigmag2), self.D_g(self.k['gg'], sigmag2), self.D_g(self.k['gg'], sigmag2)])
-        rsd2 = rsd2[:,None] * rsd2[None,:]
-        rsd2 = rsd2.reshape(rsd2.shape[0]*rsd2.shape[1], rsd2.shape[2])
-        coeffs2 = coeffs2[:,None] * rsd2 # shape (6, nkbins)
-
-        # array with all the coefficiens !
-        # shape (len(idx_gal_21)*len(idx_gal_22)**2, nkbins, nkbins)
-        coeff_cov = (coeffs1[:,None,:,None] * coeffs2[None,:,None,:]).reshape(coeffs1.shape[0]*coeffs2.shape[0], coeffs1.shape[1], coeffs2.shape[1])
-
-        # keep only the indices that are needed for the covariance matrix:
-        # shape (len(idx_gal_11)*len(idx_gal_12), )
-        idx1 = np.array([i*self.nsurr_fields + j for i in idx_gal_11 for j in idx_gal_12])  
-        idx2 = np.array([ii*self.nsurr_fields + jj for ii in idx_gal_21 for jj in idx_gal_22]) 
-
-        surr_cov = self.surr_cov[f"{self.binning['gg']}-{self.binning['gg']}"]  # select the covariance for the right binning
-        cov = coeff_cov * surr_cov[idx1][:, idx2, :, :].reshape(len(idx1)*len(idx2), self.nkbins[self.binning['gg']], self.nkbins[self.binning['gg']])  
-
-        return np.sum(cov, axis=0)  # shape (nkbins, nkbins)
+        plan1 = self._spectrum_plan('gg', ell=ell1)
+        plan2 = self._spectrum_plan('gg', ell=ell2)
+        leg1 = self._gal_leg(self.k['gg'], '1', return_grad, b11, fnl1, sn1, sigmag1)
+        leg2 = self._gal_leg(self.k['gg'], '2', return_grad, b12, fnl2, sn2, sigmag2)
+        return self._model_cov(plan1, leg1, leg1, plan2, leg2, leg2)
 
     def pgvxpgv_cov(self, b11=1, fnl1=0, sn1=1, bv1=1, snv1=1, bfg1=0, b12=1, sigmag1=0, sigmav1=0, fnl2=0, sn2=1, bv2=1, snv2=1, bfg2=0, sigmag2=0, sigmav2=0,
                     freq1=['90','150'], field1=[1,0], ell1=[0, 1],
-                    freq2=['90','150'], field2=[1,0], ell2=[0, 1]):
+                    freq2=['90','150'], field2=[1,0], ell2=[0, 1], return_grad=False):
         r"""Returns shape ``(nkbins, nkbins)`` covariance matrix of $P_{gv}^{surr}(k) x P_{gv}^{surr}(k)$.
         The ``field`` argument is a length-2 vector, selecting a linear combination
         of the 90+150 GHz velocity reconstructions. For example:
@@ -826,275 +1493,87 @@ class KszPipeOutdir:
            - ``field=[0.5,0.5]`` for mean (90+150) GHz reconstruction **not optimal**.
            - ``field=[1,-1]`` for null (90-150) GHz reconstruction.
         """
-        field1, field2 = self._check_field(field1), self._check_field(field2)
-
-        idx_gal1 = [self.surr_fields[f'gal-{ell1[0]}-{suff}'] for suff in self.suff_gal_list]
-        idx_gal2 = [self.surr_fields[f'gal-{ell2[0]}-{suff}'] for suff in self.suff_gal_list]
-
-        idx_vr1_1 = [self.surr_fields[f'{freq1[0]}-{ell1[1]}-{suff}'] for suff in self.suff_vel_list]
-        idx_vr1_2 = [self.surr_fields[f'{freq1[1]}-{ell1[1]}-{suff}'] for suff in self.suff_vel_list]
-        idx_vr2_1 = [self.surr_fields[f'{freq2[0]}-{ell2[1]}-{suff}'] for suff in self.suff_vel_list]
-        idx_vr2_2 = [self.surr_fields[f'{freq2[1]}-{ell2[1]}-{suff}'] for suff in self.suff_vel_list]       
-
-        coeffs1 = np.ravel(np.array([sn1, b11, self.f, fnl1*(b11 - self.p)])[:,None] * (np.array([snv1, bv1, bfg1]) if self.sim_surr_fg else np.array([snv2, bv1]))[None,:])
-        rsd11 = np.array([np.ones_like(self.k['gv']), self.D_g(self.k['gv'], sigmag1), self.D_g(self.k['gv'], sigmag1), self.D_g(self.k['gv'], sigmag1)])
-        rsd12 = np.array([np.ones_like(self.k['gv']), self.D_v(self.k['gv'], sigmav1), np.ones_like(self.k['gv'])]) if self.sim_surr_fg else np.array([np.ones_like(self.k['gv']), self.D_v(self.k['gv'], sigmav1)])
-        rsd1 = rsd11[:,None] * rsd12[None,:]
-        rsd1 = rsd1.reshape(rsd1.shape[0]*rsd1.shape[1], rsd1.shape[2])
-        coeffs1 = coeffs1[:,None] * rsd1 
-
-        coeffs2 = np.ravel(np.array([sn2, b12, self.f, fnl2*(b12 - self.p)])[:,None] * (np.array([snv2, bv2, bfg2]) if self.sim_surr_fg else np.array([snv2, bv2]))[None,:])
-        rsd21 = np.array([np.ones_like(self.k['gv']), self.D_g(self.k['gv'], sigmag2), self.D_g(self.k['gv'], sigmag2), self.D_g(self.k['gv'], sigmag2)])
-        rsd22 = np.array([np.ones_like(self.k['gv']), self.D_v(self.k['gv'], sigmav2), np.ones_like(self.k['gv'])]) if self.sim_surr_fg else np.array([np.ones_like(self.k['gv']), self.D_v(self.k['gv'], sigmav2)])
-        rsd2 = rsd21[:,None] * rsd22[None,:]
-        rsd2 = rsd2.reshape(rsd2.shape[0]*rsd2.shape[1], rsd2.shape[2])
-        coeffs2 = coeffs2[:,None] * rsd2 
-
-        # shape (..., nkbins, nkbins)
-        coeff_cov = (coeffs1[:,None,:,None] * coeffs2[None,:,None,:]).reshape(coeffs1.shape[0]*coeffs2.shape[0], coeffs1.shape[1], coeffs2.shape[1])
-
-        cov = []
-        # for speed up reason, we do not want to compute covariance matrices that are not needed (for instance if fields=[1,0]) 
-        for i, idx_vr1 in enumerate([idx_vr1_1, idx_vr1_2]):
-            for j, idx_vr2 in enumerate([idx_vr2_1, idx_vr2_2]):
-                if field1[i] == 0 or field2[j] == 0:
-                    cov_tmp = np.zeros((self.nkbins[self.binning['gv']], self.nkbins[self.binning['gv']]))  # shape (nkbins, nkbins)
-                else:
-                    idx1 = np.array([ii*self.nsurr_fields + jj for ii in idx_gal1 for jj in idx_vr1])  # shape (len(idx_gal_1)*len(idx_vr1), ) 
-                    idx2 = np.array([ii*self.nsurr_fields + jj for ii in idx_gal2 for jj in idx_vr2])  # shape (len(idx_gal_2)*len(idx_vr2), )
-                    surr_cov = self.surr_cov[f"{self.binning['gv']}-{self.binning['gv']}"] # select the covariance for the right binning
-                    cov_tmp = np.sum(coeff_cov * surr_cov[idx1][:, idx2, :, :].reshape(len(idx1)*len(idx2), self.nkbins[self.binning['gv']], self.nkbins[self.binning['gv']]), axis=0)  # shape (nkbins, nkbins)
-                cov += [cov_tmp]
-
-        field = np.ravel(field1[:, None] * field2[None, :])
-        return np.sum(field[:, None, None] * cov, axis=0)  # shape (nkbins, nkbins)
+        plan1 = self._spectrum_plan('gv', freq=freq1, field=field1, ell=ell1)
+        plan2 = self._spectrum_plan('gv', freq=freq2, field=field2, ell=ell2)
+        k = self.k['gv']
+        return self._model_cov(plan1, self._gal_leg(k, '1', return_grad, b11, fnl1, sn1, sigmag1), self._vel_leg(k, '1', return_grad, bv1, snv1, bfg1, sigmav1),
+                               plan2, self._gal_leg(k, '2', return_grad, b12, fnl2, sn2, sigmag2), self._vel_leg(k, '2', return_grad, bv2, snv2, bfg2, sigmav2))
 
     def pvvxpvv_cov(self, 
                     bv11=1, snv11=1, bfg11=0, sigmav11=0, bv21=1, snv21=1, bfg21=0, sigmav21=0, 
                     bv12=1, snv12=1, bfg12=0, sigmav12=0, bv22=1, snv22=1, bfg22=0, sigmav22=0,
                     freq1=[['90','150'], ['90','150']], field1=[[1,0], [1,0]], ell1=[1,1], 
-                    freq2=[['90','150'], ['90','150']], field2=[[1,0], [1,0]], ell2=[1,1]):
+                    freq2=[['90','150'], ['90','150']], field2=[[1,0], [1,0]], ell2=[1,1], return_grad=False):
         r"""Returns shape ``(nkbins, nkbins)`` covariance matrix of $P_{vv}^{surr}(k)$."""
-
-        idx_vr1_1_1 = [self.surr_fields[f'{freq1[0][0]}-{ell1[0]}-{suff}'] for suff in self.suff_vel_list]
-        idx_vr1_1_2 = [self.surr_fields[f'{freq1[0][1]}-{ell1[0]}-{suff}'] for suff in self.suff_vel_list]
-        idx_vr1_2_1 = [self.surr_fields[f'{freq1[1][0]}-{ell1[1]}-{suff}'] for suff in self.suff_vel_list]
-        idx_vr1_2_2 = [self.surr_fields[f'{freq1[1][1]}-{ell1[1]}-{suff}'] for suff in self.suff_vel_list]    
-
-        idx_vr2_1_1 = [self.surr_fields[f'{freq2[0][0]}-{ell2[0]}-{suff}'] for suff in self.suff_vel_list]
-        idx_vr2_1_2 = [self.surr_fields[f'{freq2[0][1]}-{ell2[0]}-{suff}'] for suff in self.suff_vel_list]
-        idx_vr2_2_1 = [self.surr_fields[f'{freq2[1][0]}-{ell2[1]}-{suff}'] for suff in self.suff_vel_list]
-        idx_vr2_2_2 = [self.surr_fields[f'{freq2[1][1]}-{ell2[1]}-{suff}'] for suff in self.suff_vel_list]       
-
-        coeffs11 = np.array([snv11, bv11, bfg11]) if self.sim_surr_fg else np.array([snv11, bv11])
-        coeffs21 = np.array([snv21, bv21, bfg21]) if self.sim_surr_fg else np.array([snv21, bv21])
-        coeffs1 = np.ravel(coeffs11[:,None] * coeffs21[None,:])
-        # Add RSD damping factor term:
-        rsd11 = np.array([np.ones_like(self.k['vv']), self.D_v(self.k['vv'], sigmav11), np.ones_like(self.k['vv'])]) if self.sim_surr_fg else np.array([np.ones_like(self.k['vv']), self.D_v(self.k['vv'], sigmav11)])
-        rsd21 = np.array([np.ones_like(self.k['vv']), self.D_v(self.k['vv'], sigmav21), np.ones_like(self.k['vv'])]) if self.sim_surr_fg else np.array([np.ones_like(self.k['vv']), self.D_v(self.k['vv'], sigmav21)])
-        rsd1 = rsd11[:,None] * rsd21[None,:]
-        rsd1 = rsd1.reshape(rsd1.shape[0]*rsd1.shape[1], rsd1.shape[2])
-        coeffs1 = coeffs1[:,None] * rsd1
-
-        coeffs12 = np.array([snv12, bv12, bfg12]) if self.sim_surr_fg else np.array([snv12, bv12])
-        coeffs22 = np.array([snv22, bv22, bfg22]) if self.sim_surr_fg else np.array([snv22, bv22])
-        coeffs2 = np.ravel(coeffs12[:,None]*coeffs22[None,:])
-        # Add RSD damping factor term:
-        rsd12 = np.array([np.ones_like(self.k['vv']), self.D_v(self.k['vv'], sigmav12), np.ones_like(self.k['vv'])]) if self.sim_surr_fg else np.array([np.ones_like(self.k['vv']), self.D_v(self.k['vv'], sigmav12)])
-        rsd22 = np.array([np.ones_like(self.k['vv']), self.D_v(self.k['vv'], sigmav22), np.ones_like(self.k['vv'])]) if self.sim_surr_fg else np.array([np.ones_like(self.k['vv']), self.D_v(self.k['vv'], sigmav22)])
-        rsd2 = rsd12[:,None] * rsd22[None,:]
-        rsd2 = rsd2.reshape(rsd2.shape[0]*rsd2.shape[1], rsd2.shape[2])
-        coeffs2 = coeffs2[:,None] * rsd2
-
-        # shape (..., nkbins, nkbins)
-        coeff_cov = (coeffs1[:,None,:,None] * coeffs2[None,:,None,:]).reshape(coeffs1.shape[0]*coeffs2.shape[0], coeffs1.shape[1], coeffs2.shape[1])
-
-        cov = []  # it will be a 16 x nkbins x nkbins array to cover any possible combination of fields1 / fields2.
-        # for speed up reason, we do not want to compute covariance matrices that are not needed (for instance if fields=[1,0]) 
-        for i, idx_vr1_1 in enumerate([idx_vr1_1_1, idx_vr1_1_2]):
-            for j, idx_vr1_2 in enumerate([idx_vr1_2_1, idx_vr1_2_2]):
-                for k, idx_vr2_1 in enumerate([idx_vr2_1_1, idx_vr2_1_2]):
-                    for l, idx_vr2_2 in enumerate([idx_vr2_2_1, idx_vr2_2_2]):
-                        if field1[0][i] == 0 or field1[1][j] == 0 or field2[0][k] == 0 or field2[1][l] == 0:
-                            cov_tmp = np.zeros((self.nkbins[self.binning['vv']], self.nkbins[self.binning['vv']]))  # shape (nkbins, nkbins)
-                        else:
-                            idx1 = np.array([ii*self.nsurr_fields + jj for ii in idx_vr1_1 for jj in idx_vr1_2])  # shape (len(idx_gal_1)*len(idx_vr1), ) 
-                            idx2 = np.array([ii*self.nsurr_fields + jj for ii in idx_vr2_1 for jj in idx_vr2_2])  # shape (len(idx_gal_2)*len(idx_vr2), )
-                            surr_cov = self.surr_cov[f"{self.binning['vv']}-{self.binning['vv']}"] # select the covariance for the right binning
-                            cov_tmp = np.sum(coeff_cov * surr_cov[idx1][:, idx2, :, :].reshape(len(idx1)*len(idx2), self.nkbins[self.binning['vv']], self.nkbins[self.binning['vv']]), axis=0)  # shape (nkbins, nkbins)
-                        cov += [cov_tmp]
-
-        field = np.ravel(np.ravel(np.array(field1[0])[:, None] * np.array(field1[1])[None, :])[:, None] * np.ravel(np.array(field2[0])[:, None] * np.array(field2[1])[None, :])[None, :])
-        return np.sum(field[:, None, None] * cov, axis=0)  # shape (nkbins, nkbins)
+        plan1 = self._spectrum_plan('vv', freq=freq1, field=field1, ell=ell1)
+        plan2 = self._spectrum_plan('vv', freq=freq2, field=field2, ell=ell2)
+        k = self.k['vv']
+        return self._model_cov(plan1, self._vel_leg(k, '11', return_grad, bv11, snv11, bfg11, sigmav11), self._vel_leg(k, '21', return_grad, bv21, snv21, bfg21, sigmav21),
+                               plan2, self._vel_leg(k, '12', return_grad, bv12, snv12, bfg12, sigmav12), self._vel_leg(k, '22', return_grad, bv22, snv22, bfg22, sigmav22))
 
     def pggxpgv_cov(self, b11=1, fnl1=0, sn1=1, sigmag1=0, b12=1, fnl2=0, sn2=1, bv2=1, snv2=1, bfg2=0, sigmag2=0, sigmav2=0,
                     ell1=[0, 0], 
-                    freq2=['90','150'], field2=[1,0], ell2=[0, 1]):
+                    freq2=['90','150'], field2=[1,0], ell2=[0, 1], return_grad=False):
         r"""Returns shape ``(nkbins, nkbins)`` cross-covariance matrix of $P_{gg}^{surr}(k) \times P_{gv}^{surr}(k)$."""
-        
-        field2 = self._check_field(field2)
-
-        idx_gal1 = [self.surr_fields[f'gal-{ell1[0]}-{suff}'] for suff in self.suff_gal_list]
-        idx_gal2 = [self.surr_fields[f'gal-{ell1[1]}-{suff}'] for suff in self.suff_gal_list]
-        idx_gal3 = [self.surr_fields[f'gal-{ell2[0]}-{suff}'] for suff in self.suff_gal_list]
-
-        idx_vr1_1 = [self.surr_fields[f'{freq2[0]}-{ell2[1]}-{suff}'] for suff in self.suff_vel_list]
-        idx_vr1_2 = [self.surr_fields[f'{freq2[1]}-{ell2[1]}-{suff}'] for suff in self.suff_vel_list]
-
-        coeffs1 = np.array([sn1, b11, self.f, fnl1*(b11 - self.p)])
-        coeffs1 = np.ravel(coeffs1[:,None]*coeffs1[None,:]) # shape (6, ) ie (len(idx_gal_11)*len(idx_gal_12), )
-        # Add RSD damping factor term: (Warning: only b1 / fnl terms are damped, not the shotnoise term) --> shape (6, nkbins)
-        rsd1 = np.array([np.ones_like(self.k['gg']), self.D_g(self.k['gg'], sigmag1), self.D_g(self.k['gg'], sigmag1), self.D_g(self.k['gg'], sigmag1)])
-        rsd1 = rsd1[:,None] * rsd1[None,:]
-        rsd1 = rsd1.reshape(rsd1.shape[0]*rsd1.shape[1], rsd1.shape[2])
-        coeffs1 = coeffs1[:,None] * rsd1 # shape (6, nkbins)
-
-        coeffs2 = np.ravel(np.array([sn2, b12, self.f, fnl2*(b12 - self.p)])[:,None] * (np.array([snv2, bv2, bfg2]) if self.sim_surr_fg else np.array([snv2, bv2]))[None,:])
-        rsd21 = np.array([np.ones_like(self.k['gv']), self.D_g(self.k['gv'], sigmag2), self.D_g(self.k['gv'], sigmag2), self.D_g(self.k['gv'], sigmag2)])
-        rsd22 = np.array([np.ones_like(self.k['gv']), self.D_v(self.k['gv'], sigmav2), np.ones_like(self.k['gv'])]) if self.sim_surr_fg else np.array([np.ones_like(self.k['gv']), self.D_v(self.k['gv'], sigmav2)])
-        rsd2 = rsd21[:,None] * rsd22[None,:]
-        rsd2 = rsd2.reshape(rsd2.shape[0]*rsd2.shape[1], rsd2.shape[2])
-        coeffs2 = coeffs2[:,None] * rsd2 
-
-        # shape (..., nkbins, nkbins)
-        coeff_cov = (coeffs1[:,None,:,None] * coeffs2[None,:,None,:]).reshape(coeffs1.shape[0]*coeffs2.shape[0], coeffs1.shape[1], coeffs2.shape[1])
-        
-        cov = []
-        # for speed up reason, we do not want to compute covariance matrices that are not needed (for instance if fields=[1,0]) 
-        for i, idx_vr in enumerate([idx_vr1_1, idx_vr1_2]):
-            if field2[i] == 0:
-                cov_tmp = np.zeros((self.nkbins[self.binning['gg']], self.nkbins[self.binning['gv']]))  # shape (nkbins, nkbins)
-            else:
-                idx1 = np.array([ii*self.nsurr_fields + jj for ii in idx_gal1 for jj in idx_gal2]) 
-                idx2 = np.array([ii*self.nsurr_fields + jj for ii in idx_gal3 for jj in idx_vr]) 
-                surr_cov = self.surr_cov[f"{self.binning['gg']}-{self.binning['gv']}"] # select the covariance for the right binning
-                cov_tmp = np.sum(coeff_cov * surr_cov[idx1][:, idx2, :, :].reshape(len(idx1)*len(idx2), self.nkbins[self.binning['gg']], self.nkbins[self.binning['gv']]), axis=0)  # shape (nkbins, nkbins)
-            cov += [cov_tmp]
-
-        return np.sum(field2[:, None, None] * cov, axis=0)  # shape (nkbins, nkbins)
+        plan1 = self._spectrum_plan('gg', ell=ell1)
+        plan2 = self._spectrum_plan('gv', freq=freq2, field=field2, ell=ell2)
+        leg1 = self._gal_leg(self.k['gg'], '1', return_grad, b11, fnl1, sn1, sigmag1)
+        k = self.k['gv']
+        return self._model_cov(plan1, leg1, leg1, plan2, self._gal_leg(k, '2', return_grad, b12, fnl2, sn2, sigmag2), self._vel_leg(k, '2', return_grad, bv2, snv2, bfg2, sigmav2))
 
     def pgvxpgg_cov(self, b11=1, fnl1=0, bv1=1, sn1=1, snv1=1, bfg1=0, sigmag1=0, sigmav1=0, b12=1, fnl2=0, sn2=1, sigmag2=0,
                     freq1=['90','150'], field1=[1,0], ell1=[0, 0], 
-                    ell2=[0, 1]):
+                    ell2=[0, 1], return_grad=False):
         r"""Returns shape ``(nkbins, nkbins)`` cross-covariance matrix of $P_{gv}^{surr}(k) \times P_{gg}^{surr}(k)$."""
-        
-        return self.pggxpgv_cov(b11=b12, fnl1=fnl2, sn1=sn2, sigmag1=sigmag2, b12=b11, fnl2=fnl1, bv2=bv1, sn2=sn1, snv2=snv1, bfg2=bfg1, sigmag2=sigmag1, sigmav2=sigmav1, ell1=ell2, freq2=freq1, field2=field1, ell2=ell1).T
+        plan1 = self._spectrum_plan('gv', freq=freq1, field=field1, ell=ell1)
+        plan2 = self._spectrum_plan('gg', ell=ell2)
+        k = self.k['gv']
+        leg2 = self._gal_leg(self.k['gg'], '2', return_grad, b12, fnl2, sn2, sigmag2)
+        return self._model_cov(plan1, self._gal_leg(k, '1', return_grad, b11, fnl1, sn1, sigmag1), self._vel_leg(k, '1', return_grad, bv1, snv1, bfg1, sigmav1), plan2, leg2, leg2)
 
     def pgvxpvv_cov(self, b11=1, fnl1=0, sn1=1, bv1=1, snv1=1, bfg1=0, sigmag1=0, sigmav1=0, 
                     bv12=1, snv12=1, bfg12=0, sigmav12=0, bv22=1, snv22=1, bfg22=0, sigmav22=0,
                     freq1=['90','150'], field1=[1,0], ell1=[0,1], 
-                    freq2=[['90','150'], ['90','150']], field2=[[1,0], [1,0]], ell2=[1,1]):
+                    freq2=[['90','150'], ['90','150']], field2=[[1,0], [1,0]], ell2=[1,1], return_grad=False):
         r"""Returns shape ``(nkbins, nkbins)`` cross-covariance matrix of $P_{gv}^{surr}(k) \times P_{vv}^{surr}(k)$."""
-        idx_gal1 = [self.surr_fields[f'gal-{ell1[0]}-{suff}'] for suff in self.suff_gal_list]
-
-        idx_vr1_1 = [self.surr_fields[f'{freq1[0]}-{ell1[1]}-{suff}'] for suff in self.suff_vel_list]
-        idx_vr1_2 = [self.surr_fields[f'{freq1[1]}-{ell1[1]}-{suff}'] for suff in self.suff_vel_list]
-        idx_vr2_1_1 = [self.surr_fields[f'{freq2[0][0]}-{ell2[0]}-{suff}'] for suff in self.suff_vel_list]
-        idx_vr2_1_2 = [self.surr_fields[f'{freq2[0][1]}-{ell2[0]}-{suff}'] for suff in self.suff_vel_list]
-        idx_vr2_2_1 = [self.surr_fields[f'{freq2[1][0]}-{ell2[1]}-{suff}'] for suff in self.suff_vel_list]
-        idx_vr2_2_2 = [self.surr_fields[f'{freq2[1][1]}-{ell2[1]}-{suff}'] for suff in self.suff_vel_list]       
-
-        coeffs1 = np.ravel(np.array([sn1, b11, self.f, fnl1*(b11 - self.p)])[:,None] * (np.array([snv1, bv1, bfg1]) if self.sim_surr_fg else np.array([snv2, bv1]))[None,:])
-        rsd11 = np.array([np.ones_like(self.k['gv']), self.D_g(self.k['gv'], sigmag1), self.D_g(self.k['gv'], sigmag1), self.D_g(self.k['gv'], sigmag1)])
-        rsd12 = np.array([np.ones_like(self.k['gv']), self.D_v(self.k['gv'], sigmav1), np.ones_like(self.k['gv'])]) if self.sim_surr_fg else np.array([np.ones_like(self.k['gv']), self.D_v(self.k['gv'], sigmav1)])
-        rsd1 = rsd11[:,None] * rsd12[None,:]
-        rsd1 = rsd1.reshape(rsd1.shape[0]*rsd1.shape[1], rsd1.shape[2])
-        coeffs1 = coeffs1[:,None] * rsd1 
-
-        coeffs12 = np.array([snv12, bv12, bfg12]) if self.sim_surr_fg else np.array([snv12, bv12])
-        coeffs22 = np.array([snv22, bv22, bfg22]) if self.sim_surr_fg else np.array([snv22, bv22])
-        coeffs2 = np.ravel(coeffs12[:,None]*coeffs22[None,:])
-        # Add RSD damping factor term:
-        rsd12 = np.array([np.ones_like(self.k['vv']), self.D_v(self.k['vv'], sigmav12), np.ones_like(self.k['vv'])]) if self.sim_surr_fg else np.array([np.ones_like(self.k['vv']), self.D_v(self.k['vv'], sigmav12)])
-        rsd22 = np.array([np.ones_like(self.k['vv']), self.D_v(self.k['vv'], sigmav22), np.ones_like(self.k['vv'])]) if self.sim_surr_fg else np.array([np.ones_like(self.k['vv']), self.D_v(self.k['vv'], sigmav22)])
-        rsd2 = rsd12[:,None] * rsd22[None,:]
-        rsd2 = rsd2.reshape(rsd2.shape[0]*rsd2.shape[1], rsd2.shape[2])
-        coeffs2 = coeffs2[:,None] * rsd2
-
-        # shape (..., nkbins, nkbins)
-        coeff_cov = (coeffs1[:,None,:,None] * coeffs2[None,:,None,:]).reshape(coeffs1.shape[0]*coeffs2.shape[0], coeffs1.shape[1], coeffs2.shape[1])
-
-        cov = []
-        # for speed up reason, we do not want to compute covariance matrices that are not needed (for instance if fields=[1,0]) 
-        for i, idx_vr1 in enumerate([idx_vr1_1, idx_vr1_2]):
-            for j, idx_vr2_1 in enumerate([idx_vr2_1_1, idx_vr2_1_2]):
-                for k, idx_vr2_2 in enumerate([idx_vr2_2_1, idx_vr2_2_2]):
-                    if field1[i] == 0 or field2[0][j] == 0 or field2[1][k] == 0:
-                        cov_tmp = np.zeros((self.nkbins[self.binning['gv']], self.nkbins[self.binning['vv']]))  # shape (nkbins, nkbins)
-                    else:
-                        idx1 = np.array([ii*self.nsurr_fields + jj for ii in idx_gal1 for jj in idx_vr1]) 
-                        idx2 = np.array([ii*self.nsurr_fields + jj for ii in idx_vr2_1 for jj in idx_vr2_2]) 
-                        surr_cov = self.surr_cov[f"{self.binning['gv']}-{self.binning['vv']}"] # select the covariance for the right binning
-                        cov_tmp = np.sum(coeff_cov * surr_cov[idx1][:, idx2, :, :].reshape(len(idx1)*len(idx2), self.nkbins[self.binning['gv']], self.nkbins[self.binning['vv']]), axis=0)  # shape (nkbins, nkbins)
-                    cov += [cov_tmp]
-
-        field = np.ravel(np.array(field1)[:, None] * np.ravel(np.array(field2[0])[:, None] * np.array(field2[1])[None, :])[None, :])
-        return np.sum(field[:, None, None] * cov, axis=0)  # shape (nkbins, nkbins)
+        plan1 = self._spectrum_plan('gv', freq=freq1, field=field1, ell=ell1)
+        plan2 = self._spectrum_plan('vv', freq=freq2, field=field2, ell=ell2)
+        k1, k2 = self.k['gv'], self.k['vv']
+        return self._model_cov(plan1, self._gal_leg(k1, '1', return_grad, b11, fnl1, sn1, sigmag1), self._vel_leg(k1, '1', return_grad, bv1, snv1, bfg1, sigmav1),
+                               plan2, self._vel_leg(k2, '12', return_grad, bv12, snv12, bfg12, sigmav12), self._vel_leg(k2, '22', return_grad, bv22, snv22, bfg22, sigmav22))
 
     def pvvxpgv_cov(self, bv11=11, snv11=1, bfg11=0, sigmav11=0, bv21=11, snv21=1, bfg21=0, sigmav21=0,
                     b12=1, fnl2=0, sn2=1, bv2=1, snv2=1, bfg2=0, sigmag2=0, sigmav2=0,
                     freq1=[['90','150'], ['90','150']], field1=[[1,0], [1,0]], ell1=[1,1],
-                    freq2=['90','150'], field2=[1,0], ell2=[0,1]):
+                    freq2=['90','150'], field2=[1,0], ell2=[0,1], return_grad=False):
         r"""Returns shape ``(nkbins, nkbins)`` cross-covariance matrix of $P_{vv}^{surr}(k) \times P_{gv}^{surr}(k)$."""
-
-        return self.pgvxpvv_cov(b11=b12, fnl1=fnl2, sn1=sn2, bv1=bv2, snv1=snv2, bfg1=bfg2, sigmag1=sigmag2, sigmav1=sigmav2, bv12=bv11, snv12=snv11, bfg12=bfg11, sigmav12=sigmav11, bv22=bv21, snv22=snv21, bfg22=bfg21, sigmav22=sigmav21, freq1=freq2, field1=field2, ell1=ell2, freq2=freq1, field2=field1, ell2=ell1).T
+        plan1 = self._spectrum_plan('vv', freq=freq1, field=field1, ell=ell1)
+        plan2 = self._spectrum_plan('gv', freq=freq2, field=field2, ell=ell2)
+        k1, k2 = self.k['vv'], self.k['gv']
+        return self._model_cov(plan1, self._vel_leg(k1, '11', return_grad, bv11, snv11, bfg11, sigmav11), self._vel_leg(k1, '21', return_grad, bv21, snv21, bfg21, sigmav21),
+                               plan2, self._gal_leg(k2, '2', return_grad, b12, fnl2, sn2, sigmag2), self._vel_leg(k2, '2', return_grad, bv2, snv2, bfg2, sigmav2))
 
     def pggxpvv_cov(self, b11=1, fnl1=0, sn1=1, sigmag1=0, 
                     bv12=1, snv12=1, bfg12=0, sigmav12=0, bv22=1, snv22=1, bfg22=0, sigmav22=0,
                     ell1=[0,0], 
-                    ell2=[1,1], freq2=[['90','150'], ['90','150']], field2=[[1,0], [1,0]]):
+                    ell2=[1,1], freq2=[['90','150'], ['90','150']], field2=[[1,0], [1,0]], return_grad=False):
         r"""Returns shape ``(nkbins, nkbins)`` cross-covariance matrix of $P_{gg}^{surr}(k) \times P_{vv}^{surr}(k)$."""
-        idx_gal1 = [self.surr_fields[f'gal-{ell1[0]}-{suff}'] for suff in self.suff_gal_list]
-        idx_gal2 = [self.surr_fields[f'gal-{ell1[1]}-{suff}'] for suff in self.suff_gal_list]
-
-        idx_vr2_1_1 = [self.surr_fields[f'{freq2[0][0]}-{ell2[0]}-{suff}'] for suff in self.suff_vel_list]
-        idx_vr2_1_2 = [self.surr_fields[f'{freq2[0][1]}-{ell2[0]}-{suff}'] for suff in self.suff_vel_list]
-        idx_vr2_2_1 = [self.surr_fields[f'{freq2[1][0]}-{ell2[1]}-{suff}'] for suff in self.suff_vel_list]
-        idx_vr2_2_2 = [self.surr_fields[f'{freq2[1][1]}-{ell2[1]}-{suff}'] for suff in self.suff_vel_list]       
-
-        coeffs1 = np.array([sn1, b11, self.f, fnl1*(b11 - self.p)])
-        coeffs1 = np.ravel(coeffs1[:,None]*coeffs1[None,:]) # shape (6, ) ie (len(idx_gal_11)*len(idx_gal_12), )
-        # Add RSD damping factor term: (Warning: only b1 / fnl terms are damped, not the shotnoise term) --> shape (6, nkbins)
-        rsd1 = np.array([np.ones_like(self.k['gg']), self.D_g(self.k['gg'], sigmag1), self.D_g(self.k['gg'], sigmag1), self.D_g(self.k['gg'], sigmag1)])
-        rsd1 = rsd1[:,None] * rsd1[None,:]
-        rsd1 = rsd1.reshape(rsd1.shape[0]*rsd1.shape[1], rsd1.shape[2])
-        coeffs1 = coeffs1[:,None] * rsd1 # shape (6, nkbins)
-
-        coeffs21 = np.array([snv12, bv12, bfg12]) if self.sim_surr_fg else np.array([snv12, bv12])
-        coeffs22 = np.array([snv22, bv22, bfg22]) if self.sim_surr_fg else np.array([snv22, bv22])
-        coeffs2 = np.ravel(coeffs21[:,None]*coeffs22[None,:])
-        # Add RSD damping factor term:
-        rsd21 = np.array([np.ones_like(self.k['vv']), self.D_v(self.k['vv'], sigmav12), np.ones_like(self.k['vv'])]) if self.sim_surr_fg else np.array([np.ones_like(self.k['vv']), self.D_v(self.k['vv'], sigmav12)])
-        rsd22 = np.array([np.ones_like(self.k['vv']), self.D_v(self.k['vv'], sigmav22), np.ones_like(self.k['vv'])]) if self.sim_surr_fg else np.array([np.ones_like(self.k['vv']), self.D_v(self.k['vv'], sigmav22)])
-        rsd2 = rsd21[:,None] * rsd22[None,:]
-        rsd2 = rsd2.reshape(rsd2.shape[0]*rsd2.shape[1], rsd2.shape[2])
-        coeffs2 = coeffs2[:,None] * rsd2
-
-        # shape (..., nkbins, nkbins)
-        coeff_cov = (coeffs1[:,None,:,None] * coeffs2[None,:,None,:]).reshape(coeffs1.shape[0]*coeffs2.shape[0], coeffs1.shape[1], coeffs2.shape[1])
-
-        cov = []
-        # for speed up reason, we do not want to compute covariance matrices that are not needed (for instance if fields2=[1,0]) 
-        for i, idx_vr1 in enumerate([idx_vr2_1_1, idx_vr2_1_2]):
-            for j, idx_vr2 in enumerate([idx_vr2_2_1, idx_vr2_2_2]):
-                if field2[0][i] == 0 or field2[1][j] == 0:
-                    cov_tmp = np.zeros((self.nkbins[self.binning['gg']], self.nkbins[self.binning['vv']]))  # shape (nkbins, nkbins)
-                else:
-                    idx1 = np.array([ii*self.nsurr_fields + jj for ii in idx_gal1 for jj in idx_gal2]) 
-                    idx2 = np.array([ii*self.nsurr_fields + jj for ii in idx_vr1 for jj in idx_vr2]) 
-                    surr_cov = self.surr_cov[f"{self.binning['gg']}-{self.binning['vv']}"] # select the covariance for the right binning
-                    cov_tmp = np.sum(coeff_cov * surr_cov[idx1][:, idx2, :, :].reshape(len(idx1)*len(idx2), self.nkbins[self.binning['gg']], self.nkbins[self.binning['vv']]), axis=0)  # shape (nkbins, nkbins)
-                cov += [cov_tmp]
-
-        field = np.ravel(np.array(field2[0])[:, None] * np.array(field2[1])[None, :])
-        return np.sum(field[:, None, None] * cov, axis=0)  # shape (nkbins, nkbins)
+        plan1 = self._spectrum_plan('gg', ell=ell1)
+        plan2 = self._spectrum_plan('vv', freq=freq2, field=field2, ell=ell2)
+        leg1 = self._gal_leg(self.k['gg'], '1', return_grad, b11, fnl1, sn1, sigmag1)
+        k = self.k['vv']
+        return self._model_cov(plan1, leg1, leg1, plan2, self._vel_leg(k, '12', return_grad, bv12, snv12, bfg12, sigmav12), self._vel_leg(k, '22', return_grad, bv22, snv22, bfg22, sigmav22))
 
     def pvvxpgg_cov(self, bv11=1, snv11=1, bfg11=0, sigmav11=0, bv21=1, snv21=1, bfg21=0, sigmav21=0, 
                     b12=1, fnl2=0, sn2=1, sigmag2=0, 
                     ell1=[1,1], freq1=[['90','150'], ['90','150']], field1=[[1,0], [1,0]],
-                    ell2=[0,0]):
+                    ell2=[0,0], return_grad=False):
         r"""Returns shape ``(nkbins, nkbins)`` cross-covariance matrix of $P_{vv}^{surr}(k) \times P_{gg}^{surr}(k)$."""
-        return self.pggxpvv_cov(b11=b12, fnl1=fnl2, sn1=sn2, sigmag1=sigmag2, bv12=bv11, snv12=snv11, bfg12=bfg11, sigmav12=sigmav11, bv22=bv21, snv22=snv21, bfg22=bfg21, sigmav22=sigmav21, ell1=ell2, ell2=ell1, freq2=freq1, field2=field1).T
+        plan1 = self._spectrum_plan('vv', freq=freq1, field=field1, ell=ell1)
+        plan2 = self._spectrum_plan('gg', ell=ell2)
+        k = self.k['vv']
+        leg2 = self._gal_leg(self.k['gg'], '2', return_grad, b12, fnl2, sn2, sigmag2)
+        return self._model_cov(plan1, self._vel_leg(k, '11', return_grad, bv11, snv11, bfg11, sigmav11), self._vel_leg(k, '21', return_grad, bv21, snv21, bfg21, sigmav21), plan2, leg2, leg2)
 
     def _pgg_rms(self, b1=1, fnl=0, sn=1, sigmag=0, ell=[0, 0]):
         r"""For plotting purpose, returns shape ``(nkbins,)`` array, containing sqrt(Var($P_{gg}^{surr}(k)$))."""
@@ -1207,4 +1686,98 @@ class CombineKszPipeOutdir(KszPipeOutdir):
 
         # Compute the mean and the covariances for the combination !
         self._precompute_mean_and_cov()
-        print('CombineKszPipeOutdir initialized.')
\ No newline at end of file
+        print('CombineKszPipeOutdir initialized.')
+
+####################################################################################################
+
+
+def _freeze(x):
+    """Helper for KszPipeOutdir._spectrum_plan(): converts nested lists/arrays (e.g. 'field' or 'freq') to hashable tuples."""
+    if isinstance(x, (list, tuple, np.ndarray)):
+        return tuple(_freeze(y) for y in x)
+    return x
+
+
+class _SpectrumPlan:
+    def __init__(self, pout, key, kind, freq, field, ell):
+        r"""Compiled form of a power spectrum selection (kind, freq, field, ell) in KszPipeOutdir.
+
+        The surrogate power spectrum is bilinear in the coefficients of its two legs::
+
+           P(k) = sum_{ab} c1_a(k) c2_b(k) P_{ab}(k)
+
+        where c1_a (resp. c2_b) are the coefficients of the galaxy surrogate terms ('null', 'b1', 'f', 'fnl')
+        or velocity surrogate terms ('null', 'bv', 'bfg'), see KszPipeOutdir._gal_coeffs() and _vel_coeffs().
+        Each P_{ab} is a fixed linear combination (over 'freq' and 'field') of surrogate power spectra.
+
+        The plan stores the weights of these linear combinations, and the contracted surrogate mean <P_{ab}(k)>,
+        so that evaluating the mean (or covariance, see KszPipeOutdir._cov_template()) for a new set of
+        parameters is a small tensor contraction, with no string lookups or large gathers.
+
+        Members:
+
+          - ``key``: hashable (kind, freq, field, ell) tuple.
+          - ``binning``: index of the k-binning used for this power spectrum.
+          - ``n1``, ``n2``: number of terms in each leg.
+          - ``columns``: indices ``i*A+j`` of the (flattened) pairs of surrogate fields which contribute.
+          - ``weights``: shape ``(n1*n2, len(columns))`` array, ``P_{ab} = sum_p weights[a*n2+b,p] P_{columns[p]}``.
+          - ``mean_template``: shape ``(n1*n2, nkbins)`` array containing <P_{ab}(k)>.
+        """
+
+        gal = lambda ell: [ pout.surr_fields[f'gal-{ell}-{suff}'] for suff in pout.suff_gal_list ]
+        vel = lambda freq, ell: [ pout.surr_fields[f'{freq}-{ell}-{suff}'] for suff in pout.suff_vel_list ]
+
+        # Each leg is a list of (weight, surrogate field indices) pairs.
+        if kind == 'gg':
+            assert ell[0] in pout.spin_gal
+            assert ell[1] in pout.spin_gal
+            legs1 = [ (1.0, gal(ell[0])) ]
+            legs2 = [ (1.0, gal(ell[1])) ]
+        elif kind == 'gv':
+            field = pout._check_field(field)
+            assert ell[0] in pout.spin_gal
+            assert ell[1] in pout.spin_vr
+            legs1 = [ (1.0, gal(ell[0])) ]
+            legs2 = [ (field[0], vel(freq[0],ell[1])), (field[1], vel(freq[1],ell[1])) ]
+        elif kind == 'vv':
+            field = np.array(field, dtype=float)
+            if field.shape != (2,2):
+                raise RuntimeError(f"Expected 'field' argument to be a 2-by-2 array, got {field.shape=}")
+            assert ell[0] in pout.spin_vr
+            assert ell[1] in pout.spin_vr
+            legs1 = [ (field[0,0], vel(freq[0][0],ell[0])), (field[0,1], vel(freq[0][1],ell[0])) ]
+            legs2 = [ (field[1,0], vel(freq[1][0],ell[1])), (field[1,1], vel(freq[1][1],ell[1])) ]
+        else:
+            raise RuntimeError(f"KszPipeOutdir: expected kind to be 'gg', 'gv', or 'vv' (got {kind=})")
+
+        A = pout.nsurr_fields
+        n1, n2 = len(legs1[0][1]), len(legs2[0][1])
+        weights = np.zeros((n1*n2, A*A))
+
+        # Terms with zero weight (e.g. field=[1,0]) are dropped, so that they don't contribute to 'columns'.
+        for (w1, idx1) in legs1:
+            for (w2, idx2) in legs2:
+                if (w1 == 0) or (w2 == 0):
+                    continue
+                for a, i in enumerate(idx1):
+                    for b, j in enumerate(idx2):
+                        weights[a*n2+b, i*A+j] += w1*w2
+
+        self.key = key
+        self.kind = kind
+        self.binning = pout.binning[kind]
+        self.n1, self.n2 = n1, n2
+        self.columns = np.flatnonzero(np.any(weights != 0, axis=0))
+        self.weights = np.ascontiguousarray(weights[:,self.columns])
+
+        surr_mean = pout.surr_mean[self.binning].reshape(A*A, -1)
+        self.mean_template = np.dot(self.weights, surr_mean[self.columns])   # shape (n1*n2, nkbins)
+
+    def coeffs(self, c1, c2):
+        """Given per-leg coefficients c1, c2 with shapes (..., n1, nkbins), (..., n2, nkbins), returns shape (..., n1*n2, nkbins) array."""
+        c = c1[...,:,None,:] * c2[...,None,:,:]
+        return c.reshape(c.shape[:-3] + (self.n1 * self.n2, c.shape[-1]))
+
+    def mean(self, c1, c2):
+        """Returns shape (..., nkbins) array <P(k)>, given per-leg coefficients c1, c2 with shapes (..., n1, nkbins), (..., n2, nkbins)."""
+        return np.einsum('...ak,...bk,abk->...k', c1, c2, self.mean_template.reshape(self.n1, self.n2, -1))
@@ -1,4 +1,7 @@
 import sys
+import time
+import multiprocessing
+import concurrent.futures
 
 import numpy as np
 import scipy.linalg
@@ -10,6 +13,9 @@ from .KszPipe import KszPipeOutdir
 
 
 class BaseLikelihood:
+    # Set by subclasses if _fixed_cov_chi2() is available (see Likelihood._precompute_chi2_form()).
+    _fast_chi2 = False
+
     def __init__(self):
         r""" Base class for likelihoods. 
         Todo: Add all the self.attributes that are required ! """
@@ -19,9 +25,19 @@ class BaseLikelihood:
         r""" Computes the mean and covariance matrix for the given parameters. 
             If return_grad is True, it also returns the gradients of the mean and covariance with respect to the parameters.
             If return_cov is False, only the mean is returned.
+            The parameters can be either scalars or 1-d arrays of length n (see log_likelihood_batch()), in which case
+            the mean and covariance have an extra leading axis of length n.
         """
         raise NotImplementedError("This method should be implemented in subclasses.")
 
+    def __getstate__(self):
+        # The emcee sampler (which contains the chain, and refers back to the likelihood) is not
+        # pickled, so that worker processes (see LikelihoodEvaluator) only receive the model.
+        state = self.__dict__.copy()
+        state.pop('sampler', None)
+        state.pop('_mcmc_evaluator', None)
+        return state
+
     @staticmethod
     def compute_derived_params(derived_params, params):
         """ Compute derived parameters from a dictionary of formulas and a dictionary of parameters."""
@@ -42,6 +58,10 @@ class BaseLikelihood:
         r""" """
         params = {key: params[i] for i, key in enumerate(self.params)}
 
+        if self._fast_chi2 and not self.jeffreys_prior:
+            # Fixed covariance: chi^2 is a quadratic form in the mean coefficients (see Likelihood._precompute_chi2_form()).
+            return -(0.5 * self._fixed_cov_chi2(params) + self.logdet_cov) + self.uniform_log_prior(**params)
+
         return_cov = not (self.cov_fix_params or self.cov_interp)
         return_grad = self.jeffreys_prior
 
@@ -51,6 +71,9 @@ class BaseLikelihood:
                 mean, cov, grad_mean, grad_cov = to_unpack
             else:
                 mean, cov = to_unpack
+        elif return_grad:
+            mean, grad_mean = to_unpack
+            grad_cov = None
         else: 
             mean = to_unpack
 
@@ -78,27 +101,112 @@ class BaseLikelihood:
         # Add uniform prior: 
         logL += self.uniform_log_prior(**params)
 
-        # if self.jeffreys_prior:
-        #     B, D = (self.B, self.D)
-        #     linv_dmu = scipy.linalg.solve_triangular(l, grad_mean.T, lower=True)  # shape (D,2)
-        #     f = np.dot(linv_dmu.T, linv_dmu)   # first term in 2-by-2 Fisher matrix
+        if self.jeffreys_prior:
+            logL += _jeffreys_log_prior(cov_cholesky, grad_mean, grad_cov)
 
-        #     # Second term in 2-by-2 Fisher matrix
-        #     # F_{ij} = (1/2) Tr(C^{-1} dC_i C^{-1} dC_j)
-        #     #        = (1/2) Tr(S_i S_j)  where S_i = L^{-1} dC_i L^{-T}
-            
-        #     t = grad_cov.reshape(((B+1)*D, D))
-        #     u = scipy.linalg.solve_triangular(l, t.T, lower=True)  # shape (D, (B+1)*D)
-        #     u = u.reshape((D*(B+1), D))
-        #     v = scipy.linalg.solve_triangular(l, u.T, lower=True)  # shape (D,D*(B+1))
-        #     v = v.reshape((D*D, B+1))
-        #     f += 0.5 * np.dot(v.T, v)
-
-        #     # Jeffreys prior is equivalent to including sqrt(det(F)) in the likelihood.
-        #     sign, logabsdet_F = np.linalg.slogdet(f)
-        #     logL += 0.5 * logabsdet_F
-        #     assert sign == 1
+        return logL
+
+    def log_likelihood_and_grad(self, *params):
+        r"""Returns pair ``(logL, grad)``, where ``logL = log_likelihood(*params)``, and ``grad`` is the shape ``(nparams,)``
+        gradient of the log-likelihood with respect to ``self.params``.
+
+        The gradient is computed analytically from the derivatives of the mean and covariance (see
+        ``mean_and_cov(return_grad=True)``, which are exact unless ``derived_params`` are used)::
+
+           d(logL)/dθ = (C^{-1} x).(dμ/dθ) + (1/2) (C^{-1} x).(dC/dθ).(C^{-1} x) - Tr(C^{-1} dC/dθ)     where x = data - μ
+
+        (The last term corresponds to the ``logdet(C)`` term in log_likelihood(), and vanishes if ``cov_fix_params=True``.)
+        Outside the prior, returns ``(-inf, nan)``. Not implemented for ``cov_interp=True``, or ``jeffreys_prior=True``.
+        """
+        if self.cov_interp or self.jeffreys_prior:
+            raise RuntimeError('BaseLikelihood.log_likelihood_and_grad(): not implemented for cov_interp=True or jeffreys_prior=True')
+
+        params = {key: params[i] for i, key in enumerate(self.params)}
+        log_prior = self.uniform_log_prior(**params)
+        if log_prior == -np.inf:
+            return -np.inf, np.full(len(self.params), np.nan)
+
+        if self.cov_fix_params:
+            mean, grad_mean = self.mean_and_cov(**params, return_cov=False, return_grad=True)
+            cov_cholesky, logdet_cov, grad_cov = self.cov_cholesky, self.logdet_cov, None
+        else:
+            mean, cov, grad_mean, grad_cov = self.mean_and_cov(**params, return_grad=True)
+            cov_cholesky = np.linalg.cholesky(cov)
+            logdet_cov = 2 * np.sum(np.log(np.diag(cov_cholesky)))
+
+        linv_x = scipy.linalg.solve_triangular(cov_cholesky, self.data - mean, lower=True)
+        linv_dmu, s = _whitened_grads(cov_cholesky, grad_mean, grad_cov)
+
+        logL = -(0.5 * np.dot(linv_x, linv_x) + logdet_cov) + log_prior
+        grad = np.dot(linv_dmu, linv_x)
 
+        if s is not None:
+            grad += 0.5 * np.einsum('i,aij,j->a', linv_x, s, linv_x) - np.trace(s, axis1=1, axis2=2)
+
+        return logL, grad
+
+    def log_likelihood_batch(self, theta, batch_size=256):
+        r"""Vectorized version of log_likelihood(): returns shape ``(n,)`` array of log-likelihoods.
+
+        ``theta`` is a shape ``(n, nparams)`` array, whose columns are ordered as in ``self.params``.
+        Means and covariances for all points are computed at once (see mean_and_cov()), followed by a
+        batched Cholesky decomposition and triangular solve. Points are processed in chunks of ``batch_size``
+        to bound memory usage (there is one ``(ndata, ndata)`` covariance per point). Points outside the prior
+        are not evaluated, and have log-likelihood ``-inf``.
+
+        Can be passed directly to emcee with ``vectorize=True`` (see run_mcmc()).
+        """
+        theta = np.asarray(theta, dtype=float)
+        if (theta.ndim != 2) or (theta.shape[1] != len(self.params)):
+            raise RuntimeError(f"BaseLikelihood.log_likelihood_batch(): expected theta to have shape (n, {len(self.params)}), got {theta.shape=}")
+
+        prior = np.array([self.params[key]['prior'] for key in self.params], dtype=float).reshape(-1, 2)
+        in_prior = np.all((prior[:,0] < theta) & (theta < prior[:,1]), axis=1)
+
+        logL = np.full(theta.shape[0], -np.inf)
+        ix = np.flatnonzero(in_prior)
+
+        for i in range(0, len(ix), batch_size):
+            logL[ix[i:i+batch_size]] = self._log_likelihood_batch(theta[ix[i:i+batch_size]])
+
+        return logL
+
+    def _log_likelihood_batch(self, theta):
+        """Helper for log_likelihood_batch(): all points in 'theta' are assumed to be inside the prior."""
+        params = {key: theta[:,i] for i, key in enumerate(self.params)}
+        if self._fast_chi2 and not self.jeffreys_prior:
+            return -(0.5 * self._fixed_cov_chi2(params) + self.logdet_cov)
+
+        return_cov = not (self.cov_fix_params or self.cov_interp)
+        return_grad = self.jeffreys_prior
+
+        to_unpack = self.mean_and_cov(**params, return_cov=return_cov, return_grad=return_grad)
+        mean = to_unpack[0] if (return_cov or return_grad) else to_unpack
+        x = self.data - mean   # shape (n, ndata)
+
+        if self.cov_fix_params:
+            linv_x = scipy.linalg.solve_triangular(self.cov_cholesky, x.T, lower=True).T
+            logL = -(0.5 * np.sum(linv_x**2, axis=1) + self.logdet_cov)
+            if self.jeffreys_prior:
+                logL += _jeffreys_log_prior(self.cov_cholesky, to_unpack[1])
+            return logL
+
+        if self.cov_interp:
+            cov_cholesky = self.cov_cholesky_interp(theta)
+            logdet_cov = self.logdet_interp(theta)
+            # See log_likelihood() for the treatment of points outside the interpolation range.
+            bad = np.isnan(cov_cholesky).any(axis=(1,2))
+            cov_cholesky[bad] = np.eye(cov_cholesky.shape[-1])
+            logdet_cov[bad] = 0
+        else: 
+            cov_cholesky = np.linalg.cholesky(to_unpack[1])
+            logdet_cov = 2 * np.sum(np.log(np.diagonal(cov_cholesky, axis1=1, axis2=2)), axis=1)
+
+        # Note: batched (3-d) cov_cholesky requires scipy >= 1.15.
+        linv_x = scipy.linalg.solve_triangular(cov_cholesky, x[:,:,None], lower=True)[:,:,0]
+        logL = -(0.5 * np.sum(linv_x**2, axis=1) + logdet_cov)
+        if self.jeffreys_prior:
+            logL += _jeffreys_log_prior(cov_cholesky, to_unpack[2], to_unpack[3])
         return logL
 
     def interpolate_cholesky(self, method='linear'):
@@ -158,18 +266,39 @@ class BaseLikelihood:
             if fn_fig is not None: plt.savefig(fn_fig)
             plt.show()
 
-    def run_profiling(self, nprofiles=5, fn_profile=None, maxiter=None, verbose=True):
-        r"""Returns bestfit value for self.params after nprofiles different profiling with scipy.optimize.minimize.  """
+    def run_profiling(self, nprofiles=5, fn_profile=None, maxiter=None, verbose=True, nstart=16):
+        r"""Returns bestfit value for self.params after nprofiles different profiling with scipy.optimize.minimize.
 
-        x0 = np.zeros((nprofiles, len(self.params)))
+        The starting points are chosen by drawing ``nstart * nprofiles`` random points from the prior, evaluating
+        them in one call to log_likelihood_batch(), and keeping the ``nprofiles`` points with highest likelihood.
+
+        The likelihood is maximized with L-BFGS-B, with bounds given by the priors, using the analytic
+        gradient from log_likelihood_and_grad(). (If ``cov_interp=True`` or ``jeffreys_prior=True``, then
+        the gradient is estimated by finite differences.)
+        """
+
+        x0 = np.zeros((nstart * nprofiles, len(self.params)))
         for i, key in enumerate(self.params):
-            x0[:, i] = np.random.uniform(self.params[key]['prior'][0], self.params[key]['prior'][1], size=nprofiles)
+            x0[:, i] = np.random.uniform(self.params[key]['prior'][0], self.params[key]['prior'][1], size=nstart*nprofiles)
 
-        f = lambda x: - self.log_likelihood(*x)  # note minus sign
+        logL0 = self.log_likelihood_batch(x0)
+        x0 = x0[np.argsort(np.where(np.isnan(logL0), np.inf, -logL0))[:nprofiles]]
+
+        if self.cov_interp or self.jeffreys_prior:
+            f, jac = (lambda x: - self.log_likelihood(*x)), None  # note minus sign
+        else:
+            f, jac = (lambda x: tuple(-y for y in self.log_likelihood_and_grad(*x))), True
+
+        # The uniform prior is an open interval (see uniform_log_prior()), so the bounds are shrunk slightly.
+        prior = np.array([self.params[key]['prior'] for key in self.params], dtype=float)
+        eps = 1.0e-10 * (prior[:,1] - prior[:,0])
+        bounds = list(zip(prior[:,0] + eps, prior[:,1] - eps))
+
+        options = {'maxiter': maxiter} if (maxiter is not None) else {}
 
         results = []
         for i in range(nprofiles):
-            results += [scipy.optimize.minimize(f, x0[i,:], method='Nelder-Mead', options={'maxiter': maxiter})]
+            results += [scipy.optimize.minimize(f, x0[i,:], method='L-BFGS-B', jac=jac, bounds=bounds, options=options)]
         
         # select the bestfit with the lowest log_likelihood:
         sel_min = np.argmin([result.fun for result in results])
@@ -180,11 +309,12 @@ class BaseLikelihood:
 
         return self.bestfit      
 
-    def run_mcmc(self, ncpu=1, nwalkers=8, nsamples=10000, discard=1000, thin=5, progress='notebook', extend_chain=False, fn_chain=None):
+    def run_mcmc(self, ncpu=1, nwalkers=8, nsamples=10000, discard=1000, thin=5, progress='notebook', extend_chain=False, fn_chain=None, vectorize=True, parallel='process'):
         r""" 
         Run mcmc with emcee. 
 
         Parameters:
+        - ncpu: number of worker processes (or threads) which evaluate the walkers concurrently in each step (see LikelihoodEvaluator).
         - nwalkers: number of walkers
         - nsamples: number of samples to draw
         - discard: number of samples to discard at the beginning of the chain (burnin phase)
@@ -192,36 +322,43 @@ class BaseLikelihood:
         - progress: 'notebook' or 'text' to show the progress bar of emcee (requires tqdm), False to disable it.
         - extend_chain: if True, use the previous chain as a starting point for the new chain. If False, start from a random uniform distribution.
         - fn_chain: if not None, save the chain to this file.
-        
+        - vectorize: if True, all walkers in an emcee step are evaluated in one call to log_likelihood_batch().
+          If False, walkers are evaluated one at a time with log_likelihood(). Must be True if ncpu > 1.
+        - parallel: either 'process' or 'thread' (only used if ncpu > 1, see LikelihoodEvaluator).
+
+        The wall-clock time of each step is saved in self.mcmc_step_times, and summarized when the chain is done.
         """
         import emcee
-        print(f'MCMC start: {nwalkers=}, {nsamples=}, {discard=}, {thin=}')
+        print(f'MCMC start: {nwalkers=}, {nsamples=}, {discard=}, {thin=}, {ncpu=}')
 
         if extend_chain:
-            x0 = None
+            x0 = self.sampler.get_last_sample()
         else:
             x0 = np.zeros((nwalkers, len(self.params)))
             for i, key in enumerate(self.params):
                 x0[:, i] = np.random.uniform(self.params[key]['prior'][0], self.params[key]['prior'][1], size=nwalkers)
 
-        logL = lambda x: self.log_likelihood(*x)
-
-        # It is super slow ... in the notebook at NERSC for some reason...:
-        # First need to write a wrapper function to use the logL method (OUTSIDE the class):
-        # def logL(self, x):
-        #     print(x)
-        #     return self.log_likelihood(*x)
-        #from multiprocessing import Pool
-        #import kszx.utils as utils
-        #with utils.Pool(ncpu) as pool:
-        #from multiprocessing import Pool
-        #with Pool(ncpu) as pool:
-        #    sampler = emcee.EnsembleSampler(nwalkers, len(self.params), self.logL, pool=pool)
-        #    sampler.run_mcmc(x0, nsamples, progress=progress)
-
-        if not extend_chain: self.sampler = emcee.EnsembleSampler(nwalkers, len(self.params), logL)
+            self._mcmc_evaluator = LikelihoodEvaluator(self)
+            self.sampler = emcee.EnsembleSampler(nwalkers, len(self.params), self._mcmc_evaluator, vectorize=vectorize)
+
         sampler = self.sampler
-        sampler.run_mcmc(x0, nsamples, progress=progress)
+        if (ncpu > 1) and not sampler.vectorize:
+            raise RuntimeError('Likelihood.run_mcmc(): ncpu > 1 requires vectorize=True (when the chain is started)')
+
+        evaluator = self._mcmc_evaluator
+        evaluator.nworkers, evaluator.mode = ncpu, parallel
+        step_times = np.zeros(nsamples)
+
+        with evaluator:
+            t0 = time.perf_counter()
+            for i, _ in enumerate(sampler.sample(x0, iterations=nsamples, progress=progress)):
+                t1 = time.perf_counter()
+                step_times[i] = t1 - t0
+                t0 = t1
+
+        self.mcmc_step_times = step_times
+        dt = np.median(step_times)
+        print(f'MCMC step timings ({ncpu=}, {parallel=}): median {1.0e3*dt:.3f} ms/step, {nwalkers/dt:.1f} likelihood evaluations/s, total {np.sum(step_times):.1f} s')
 
         self.samples = sampler.get_chain(discard=discard, thin=thin, flat=True)
         print('MCMC done. To see the results, call the show_mcmc() method.')
@@ -367,10 +504,13 @@ class Likelihood(BaseLikelihood):
         fields: dictionary of fields to include in the likelihood ('gg', 'gv', 'vv'). For each field you need to provide a dictionary with the entries to call  
                 pout.pgg_mean() / pout.pgv_mean() ... ('gv': 'freq', 'field', 'ell') and all field have 'name_params'. name_params should be a dictionary with the mapping between the parameter names used in the KszPipeOutdir methods and the parameter names used in the inference (i.e. in params). If you want to fix some parameters to a given value, you can provide a 'fix_params' entry with a dictionary of the parameters to fix and their values. For example, 'fix_params': {'bv': 1.0} will fix bv to 1.0 in the likelihood evaluation.
         first_kbin, last_kbin: dictionary with the same key entries than fields.
-        jeffreys_prior: if True, include the Jeffreys prior in the likelihood. Not ready yet.
+        jeffreys_prior: if True, include the Jeffreys prior (1/2) log det(F) in the likelihood, where F is the Fisher matrix
+                        computed from the exact derivatives of the mean and covariance (see mean_and_cov(return_grad=True)).
 
         cov_fix_params: if True, compute the covariance matrix only once at the fiducial value of the parameters (given in params_cov) and use it for all  
                         likelihood evaluations. This speeds up the inference but ignores the parameter dependence of the covariance matrix.
+                        The chi^2 is then evaluated from precomputed whitened mean templates, in O(ntemplates^2) operations
+                        (unless the damping parameters sigmag/sigmav are varied, see _precompute_chi2_form()).
         params_cov: dictionary of parameter values at which to compute the covariance matrix if cov_fix_params is True.
         rescale_cross_cov: dictionary to use different parameters value for the cross-covariance terms between different fields.
                            example: {'gv_1_90-gv_1_150': {'snv1': snv90x150, 'snv2': snv90x150}, 'gv}
@@ -407,9 +547,8 @@ class Likelihood(BaseLikelihood):
                 assert name in params
 
         self.jeffreys_prior = jeffreys_prior
-        if jeffreys_prior:
-            print('ERROR: jeffreys_prior is not ready yet')
-            sys.exit(8)
+        if jeffreys_prior and cov_interp and not cov_fix_params:
+            raise RuntimeError('Likelihood: jeffreys_prior=True is not supported with cov_interp=True')
 
         data = []
         for i, field in enumerate(self.fields): 
@@ -461,6 +600,8 @@ class Likelihood(BaseLikelihood):
             self.logdet_cov = np.linalg.slogdet(cov)[1]
             # cholesky decomposition is faster (for large matrix) than linalg.inv !
             self.cov_cholesky = np.linalg.cholesky(cov)
+            self._chi2_form = self._precompute_chi2_form(params_cov)
+            self._fast_chi2 = (self._chi2_form is not None)
         
         if not cov_fix_params and cov_interp: 
             print(f'Interpolate the Cholesky decomposition of the covariance matrix with RegularGridInterpolator and method={interp_method}')
@@ -474,155 +615,224 @@ class Likelihood(BaseLikelihood):
             self.logdet_interp = logdet_interp
             self.cov_cholesky_interp = lambda pp: utils.unflatten_cholesky(cov_choleskk_interp(pp), dim=self.k.size)
 
+    def _precompute_chi2_form(self, params):
+        r"""Helper for constructor (if cov_fix_params=True): precomputes the chi^2 as a quadratic form in the mean coefficients.
+
+        The mean is a linear combination mu = sum_a phi_a(params) T_a of fixed templates T_a (see KszPipeOutdir._mean_terms()),
+        so with whitened templates W_a = L^{-1} T_a and whitened data y = L^{-1} d (where C = L L^T), the chi^2 is::
+
+           chi^2 = |y - sum_a phi_a W_a|^2 = y.y - 2 sum_a phi_a (W_a.y) + sum_{ab} phi_a phi_b (W_a.W_b)
+
+        Returns tuple (y.y, W.y, W.W), or None if the templates depend on the parameters (i.e. if sigmag or sigmav is
+        varied in the likelihood), in which case the mean is computed with mean_and_cov() in each likelihood evaluation.
+        """
+
+        templates = []
+        for i, field in enumerate(self.fields):
+            ff, jac = self._pout_kwargs(field, params, return_jac=True)
+            if any(key.startswith('sigma') and (len(dparams) > 0) for key, dparams in jac.items()):
+                print(f'Mean depends on {field} damping parameters, whitened mean templates will not be used')
+                return None
+            
+            _, t = self.pout._mean_terms(field.split('_')[0], **ff)
+            kk = self.k_norebin[int(np.sum(self.nk_norebin[:i])):int(np.sum(self.nk_norebin[:i+1]))]
+            templates += [self._rebin_vector(t[:, self.first_kbin[field]:self.last_kbin[field]], kk, k_rebin=self.k_rebin[field])]
+
+        t = scipy.linalg.block_diag(*templates)   # shape (ntemplates, ndata)
+        w = scipy.linalg.solve_triangular(self.cov_cholesky, t.T, lower=True)
+        y = scipy.linalg.solve_triangular(self.cov_cholesky, self.data, lower=True)
+        print(f'Precompute {t.shape[0]} whitened mean templates for the fixed-covariance chi2')
+        
+        return np.dot(y,y), np.dot(w.T,y), np.dot(w.T,w)
+
+    def _fixed_cov_chi2(self, params):
+        r"""Returns chi^2 = (d-mu)^T C^{-1} (d-mu) with the fixed covariance, in O(ntemplates^2) operations (see _precompute_chi2_form()).
+        The params can be scalars or 1-d arrays (see log_likelihood_batch())."""
+
+        phi = [ self.pout._mean_terms(field.split('_')[0], return_templates=False, **self._pout_kwargs(field, params)) for field in self.fields ]
+        batch_shape = np.broadcast_shapes(*[p.shape[:-1] for p in phi])
+        phi = np.concatenate([np.broadcast_to(p, batch_shape + p.shape[-1:]) for p in phi], axis=-1)
+
+        yy, wy, ww = self._chi2_form
+        return yy + np.sum(phi * (np.dot(phi, ww) - 2*wy), axis=-1)
+
     def _rebin_vector(self, vect, k, k_rebin=1):
         " We take the average of every two points above k_rebin. k are assumed to be increasing ... "
 
-        non_rebin_vect = vect[k < k_rebin]
-        rebin_vect = vect[k >= k_rebin]
+        non_rebin_vect = vect[..., k < k_rebin]
+        rebin_vect = vect[..., k >= k_rebin]
         
-        if rebin_vect.size % 2 != 0:
+        if rebin_vect.shape[-1] % 2 != 0:
             # we drop the last element, bye bye:
-            rebin_vect = rebin_vect[:-1]
+            rebin_vect = rebin_vect[..., :-1]
         
-        rebin_vect = rebin_vect.reshape(-1, 2).mean(axis=1)
+        rebin_vect = rebin_vect.reshape(rebin_vect.shape[:-1] + (-1, 2)).mean(axis=-1)
 
-        return np.concatenate([non_rebin_vect, rebin_vect])
+        return np.concatenate([non_rebin_vect, rebin_vect], axis=-1)
 
     def _rebin_cov(self, cov, k1, k2, k_rebin1=1, k_rebin2=1):
         """ We rebin the covariance matrix.."""
-        A = cov[np.ix_(k1 < k_rebin1, k2 < k_rebin2)]
-        B = cov[np.ix_(k1 < k_rebin1, k2 >= k_rebin2)]
-        C = cov[np.ix_(k1 >= k_rebin1, k2 < k_rebin2)]
-        D = cov[np.ix_(k1 >= k_rebin1, k2 >= k_rebin2)]
+        A = cov[(...,) + np.ix_(k1 < k_rebin1, k2 < k_rebin2)]
+        B = cov[(...,) + np.ix_(k1 < k_rebin1, k2 >= k_rebin2)]
+        C = cov[(...,) + np.ix_(k1 >= k_rebin1, k2 < k_rebin2)]
+        D = cov[(...,) + np.ix_(k1 >= k_rebin1, k2 >= k_rebin2)]
         
         if np.sum(k1>=k_rebin1) % 2 != 0:
-            C = C[:-1, :]
-            D = D[:-1, :]
+            C = C[..., :-1, :]
+            D = D[..., :-1, :]
         
         if np.sum(k2 >= k_rebin2) % 2 != 0:
-            B = B[:, :-1]
-            D = D[:, :-1]
+            B = B[..., :, :-1]
+            D = D[..., :, :-1]
 
-        D = 1/4 * D.reshape(D.shape[0]//2, 2, D.shape[1]//2, 2).sum(axis=(1,3))
-        B = 1/4 * B.reshape(B.shape[0], B.shape[1]//2, 2).sum(axis=2)
-        C = 1/4 * C.reshape(C.shape[0]//2, 2, C.shape[1]).sum(axis=1)
+        n = cov.shape[:-2]
+        D = 1/4 * D.reshape(n + (D.shape[-2]//2, 2, D.shape[-1]//2, 2)).sum(axis=(-3,-1))
+        B = 1/4 * B.reshape(n + (B.shape[-2], B.shape[-1]//2, 2)).sum(axis=-1)
+        C = 1/4 * C.reshape(n + (C.shape[-2]//2, 2, C.shape[-1])).sum(axis=-2)
 
         return np.block([[A, B], [C, D]]) 
 
+    def _pout_kwargs(self, field, params, suffix='', return_jac=False):
+        r"""Helper for mean_and_cov(): returns kwargs for the KszPipeOutdir method (e.g. pgv_mean()) corresponding to 'field'.
+
+        The suffix is appended to all keys (e.g. 'b1' -> 'b11' for the first power spectrum in the p*x*_cov() methods).
+        If return_jac=True, also returns a dict {kwarg: {param: derivative}}, containing the nonzero derivatives of the
+        kwargs with respect to the parameters in self.params. Derivatives of 'derived_params' are approximated by central
+        finite differences of the formulas, with step size 1e-6 times the parameter scale max(|x|, prior width). This
+        is exact for linear formulas (up to roundoff), and accurate to O(step^2) otherwise."""
+
+        ff = self.fields[field].copy()
+        name_params = ff.pop('name_params')
+        fix_params = ff.pop('fix_params', {})
+        derived_params = ff.pop('derived_params', {})
+
+        # use the value of the params to evaluate the theory:
+        ff.update({nn: params[name_params[nn]] for nn in name_params})
+        # add chosen default value for some parameters
+        ff.update(fix_params)
+        # add params that are derived from others:
+        ff.update(self.compute_derived_params(derived_params, params))
+        ff = {key+suffix: value for key, value in ff.items()}
+
+        if not return_jac:
+            return ff
+
+        jac = {nn: {name_params[nn]: 1.0} for nn in name_params if nn not in fix_params}
+        
+        for key in (self.params if derived_params else []):
+            x = np.asarray(params[key], dtype=float)
+            prior = self.params[key]['prior']
+            h = 1.0e-6 * np.maximum(np.abs(x), prior[1] - prior[0])
+            derived_p = self.compute_derived_params(derived_params, {**params, key: x+h})
+            derived_m = self.compute_derived_params(derived_params, {**params, key: x-h})
+            for nn in derived_params:
+                d = (np.asarray(derived_p[nn]) - np.asarray(derived_m[nn])) / (2*h)
+                jac.setdefault(nn, {})
+                if np.any(d != 0):
+                    jac[nn][key] = d
+
+        return ff, {key+suffix: value for key, value in jac.items()}
+
+    def _chain_rule(self, value, grad, jac, nextra):
+        r"""Helper for mean_and_cov(): converts derivatives with respect to KszPipeOutdir kwargs (dict 'grad', see
+        KszPipeOutdir.pgv_mean()) to derivatives with respect to self.params, using 'jac' from _pout_kwargs().
+
+        The 'value' argument is the mean (nextra=1) or covariance (nextra=2). Returns array with shape
+        value.shape[:-nextra] + (nparams,) + value.shape[-nextra:]."""
+
+        batch_shape, tail = value.shape[:-nextra], value.shape[-nextra:]
+        ret = np.zeros(batch_shape + (len(self.params),) + tail)
+        index = {key: i for i, key in enumerate(self.params)}
+
+        for name, dparams in jac.items():
+            if name not in grad:
+                continue   # e.g. 'bfg' if foregrounds were not simulated
+            for key, d in dparams.items():
+                d = np.reshape(d, np.shape(d) + (1,)*nextra)
+                ret[(..., index[key]) + (slice(None),)*nextra] += d * grad[name]
+        
+        return ret
+
     def mean_and_cov(self, force_compute_cov=False, return_cov=True, return_grad=False, **params):
-        r""" Computes the model prediction and covariance matrix for the given parameters from the surrogates."""
+        r""" Computes the model prediction and covariance matrix for the given parameters from the surrogates.
 
-        mu = []
-        for i, field in enumerate(self.fields):
-            field_split = field.split('_')
-            ff = self.fields[field].copy()
+        If return_grad=True, the derivatives of the mean and covariance with respect to self.params are also returned,
+        as arrays with shapes (..., nparams, ndata) and (..., nparams, ndata, ndata). The derivatives are exact, except
+        that derivatives of 'derived_params' formulas are approximated by finite differences (see _pout_kwargs()).
+        The return value is:
 
-            # use the value of the params to evaluate the theory:
-            name_params = ff.pop('name_params')
-            ff.update({nn: params[name_params[nn]] for nn in name_params})
-            # add chosen default value for some parameters
-            if 'fix_params' in ff:
-                fix_params = ff.pop('fix_params')
-                ff.update(fix_params)
-            # add params that are derived from others:
-            if 'derived_params' in ff:
-                derived_params = ff.pop('derived_params')
-                derived = self.compute_derived_params(derived_params, params)
-                ff.update(derived)
-
-            mu_tmp = None
-            if field_split[0] == 'gg':
-                mu_tmp = self.pout.pgg_mean(**ff)[self.first_kbin[field]:self.last_kbin[field]]
-            elif field_split[0] == 'gv':
-                mu_tmp = self.pout.pgv_mean(**ff)[self.first_kbin[field]:self.last_kbin[field]]
-            elif field_split[0] == 'vv':
-                mu_tmp = self.pout.pvv_mean(**ff)[self.first_kbin[field]:self.last_kbin[field]]
+          - (mean, cov, grad_mean, grad_cov) if return_cov=True (grad_cov is zero if the covariance is fixed, see cov_fix_params).
+          - (mean, grad_mean) if return_cov=False.
+        """
+
+        mu, grad_mu = [], []
+        for i, field in enumerate(self.fields):
+            kind = field.split('_')[0]
             kk = self.k_norebin[int(np.sum(self.nk_norebin[:i])):int(np.sum(self.nk_norebin[:i+1]))]
-            mu += [self._rebin_vector(mu_tmp, kk, k_rebin=self.k_rebin[field])]
+            kslice = slice(self.first_kbin[field], self.last_kbin[field])
 
-        mu = np.concatenate(mu)
+            if not return_grad:
+                mu_tmp = getattr(self.pout, f'p{kind}_mean')(**self._pout_kwargs(field, params))
+                mu += [self._rebin_vector(mu_tmp[..., kslice], kk, k_rebin=self.k_rebin[field])]
+                continue
+
+            ff, jac = self._pout_kwargs(field, params, return_jac=True)
+            mu_tmp, grad_tmp = getattr(self.pout, f'p{kind}_mean')(**ff, return_grad=True)
+            grad_tmp = self._chain_rule(mu_tmp, grad_tmp, jac, nextra=1)
+            mu += [self._rebin_vector(mu_tmp[..., kslice], kk, k_rebin=self.k_rebin[field])]
+            grad_mu += [self._rebin_vector(grad_tmp[..., kslice], kk, k_rebin=self.k_rebin[field])]
+
+        mu = np.concatenate(mu, axis=-1)
+        grad_mu = np.concatenate(grad_mu, axis=-1) if return_grad else None
 
         if not return_cov:
-            return mu
+            return (mu, grad_mu) if return_grad else mu
+
+        if self.cov_fix_params and not force_compute_cov:
+            cov = self.cov   # correction factor has already been applied
+            grad_cov = np.zeros(mu.shape[:-1] + (len(self.params),) + cov.shape) if return_grad else None
         else:
-            if self.cov_fix_params and not force_compute_cov:
-                cov = self.cov
-            else:
-                cov = []
-                for i, field1 in enumerate(self.fields): 
-                    field1_split = field1.split('_')
-                    for j, field2 in enumerate(self.fields): 
-                        field2_split = field2.split('_')
-
-                        ff = {f"{key}1": value for key, value in self.fields[field1].items()}
-                        ff.update({f"{key}2": value for key, value in self.fields[field2].items()})
-
-                        # use the value of the params to evaluate the covariance:
-                        name_params1 = ff.pop('name_params1')
-                        ff.update({nn+'1': params[name_params1[nn]] for nn in name_params1})
-                        name_params2 = ff.pop('name_params2')
-                        ff.update({nn+'2': params[name_params2[nn]] for nn in name_params2})
-                        # add chosen default value for some parameters
-                        if 'fix_params1' in ff:
-                            fix_params = ff.pop('fix_params1')
-                            ff.update({nn+'1': fix_params[nn]for nn in fix_params})
-                        if 'fix_params2' in ff:
-                            fix_params = ff.pop('fix_params2')
-                            ff.update({nn+'2': fix_params[nn] for nn in fix_params})
-                        if 'derived_params1' in ff:
-                            derived_params = ff.pop('derived_params1')
-                            derived = self.compute_derived_params(derived_params, params)
-                            ff.update({nn+'1': derived[nn]for nn in derived_params})
-                        if 'derived_params2' in ff:
-                            derived_params = ff.pop('derived_params2')
-                            derived = self.compute_derived_params(derived_params, params)
-                            ff.update({nn+'2': derived[nn]for nn in derived_params})
-
-                        if self.rescale_cross_cov is not None:
-                            update_params = self.rescale_cross_cov.get(f"{field1}-{field2}", None)
-                            if update_params is not None: ff.update(update_params)
-
-                        # not super elegant... 
-                        cov_tmp = None
-                        if field1_split[0] == 'gg':
-                            if field2_split[0] == 'gg':
-                                cov_tmp = self.pout.pggxpgg_cov(**ff)[self.first_kbin[field1]:self.last_kbin[field1], self.first_kbin[field2]:self.last_kbin[field2]]
-                            elif field2_split[0] == 'gv':
-                                cov_tmp = self.pout.pggxpgv_cov(**ff)[self.first_kbin[field1]:self.last_kbin[field1], self.first_kbin[field2]:self.last_kbin[field2]]
-                            elif field2_split[0] == 'vv':
-                                cov_tmp = self.pout.pggxpvv_cov(**ff)[self.first_kbin[field1]:self.last_kbin[field1], self.first_kbin[field2]:self.last_kbin[field2]]
-                        elif field1_split[0] == 'gv':
-                            if field2_split[0] == 'gg':
-                                cov_tmp = self.pout.pgvxpgg_cov(**ff)[self.first_kbin[field1]:self.last_kbin[field1], self.first_kbin[field2]:self.last_kbin[field2]]
-                            elif field2_split[0] == 'gv':
-                                cov_tmp = self.pout.pgvxpgv_cov(**ff)[self.first_kbin[field1]:self.last_kbin[field1], self.first_kbin[field2]:self.last_kbin[field2]]
-                            elif field2_split[0] == 'vv':
-                                cov_tmp = self.pout.pgvxpvv_cov(**ff)[self.first_kbin[field1]:self.last_kbin[field1], self.first_kbin[field2]:self.last_kbin[field2]]
-                        elif field1_split[0] == 'vv':
-                            if field2_split[0] == 'gg':
-                                cov_tmp = self.pout.pvvxpgg_cov(**ff)[self.first_kbin[field1]:self.last_kbin[field1], self.first_kbin[field2]:self.last_kbin[field2]]
-                            elif field2_split[0] == 'gv':
-                                cov_tmp = self.pout.pvvxpgv_cov(**ff)[self.first_kbin[field1]:self.last_kbin[field1], self.first_kbin[field2]:self.last_kbin[field2]]
-                            elif field2_split[0] == 'vv':
-                                cov_tmp = self.pout.pvvxpvv_cov(**ff)[self.first_kbin[field1]:self.last_kbin[field1], self.first_kbin[field2]:self.last_kbin[field2]]
-    
-                        kk1 = self.k_norebin[int(np.sum(self.nk_norebin[:i])):int(np.sum(self.nk_norebin[:i+1]))]
-                        kk2 = self.k_norebin[int(np.sum(self.nk_norebin[:j])):int(np.sum(self.nk_norebin[:j+1]))]
+            cov, grad_cov = [], []
+            for i, field1 in enumerate(self.fields): 
+                kind1 = field1.split('_')[0]
+                kk1 = self.k_norebin[int(np.sum(self.nk_norebin[:i])):int(np.sum(self.nk_norebin[:i+1]))]
+
+                for j, field2 in enumerate(self.fields): 
+                    kind2 = field2.split('_')[0]
+                    kk2 = self.k_norebin[int(np.sum(self.nk_norebin[:j])):int(np.sum(self.nk_norebin[:j+1]))]
+                    kslice = (slice(self.first_kbin[field1], self.last_kbin[field1]), slice(self.first_kbin[field2], self.last_kbin[field2]))
+                    
+                    ff1 = self._pout_kwargs(field1, params, suffix='1', return_jac=return_grad)
+                    ff2 = self._pout_kwargs(field2, params, suffix='2', return_jac=return_grad)
+                    ff = {**ff1[0], **ff2[0]} if return_grad else {**ff1, **ff2}
+                    jac = {**ff1[1], **ff2[1]} if return_grad else None
+
+                    if self.rescale_cross_cov is not None:
+                        update_params = self.rescale_cross_cov.get(f"{field1}-{field2}", None)
+                        if update_params is not None: 
+                            ff.update(update_params)
+                            if return_grad:
+                                jac = {key: value for key, value in jac.items() if key not in update_params}
+
+                    cov_fn = getattr(self.pout, f'p{kind1}xp{kind2}_cov')
+                    
+                    if not return_grad:
+                        cov_tmp = cov_fn(**ff)[(...,) + kslice]
                         cov += [self._rebin_cov(cov_tmp, kk1, kk2, k_rebin1=self.k_rebin[field1], k_rebin2=self.k_rebin[field2])]
-                        
-                cov = np.block([[cov[i*len(self.fields) + j] for j in range(len(self.fields))] for i in range(len(self.fields))])
-            
-            cov = self.factor_cov_correction * cov  # apply the correction factor to the covariance matrix
+                        continue
 
-            if not return_grad:
-                return mu, cov
+                    cov_tmp, grad_tmp = cov_fn(**ff, return_grad=True)
+                    grad_tmp = self._chain_rule(cov_tmp, grad_tmp, jac, nextra=2)
+                    cov += [self._rebin_cov(cov_tmp[(...,) + kslice], kk1, kk2, k_rebin1=self.k_rebin[field1], k_rebin2=self.k_rebin[field2])]
+                    grad_cov += [self._rebin_cov(grad_tmp[(...,) + kslice], kk1, kk2, k_rebin1=self.k_rebin[field1], k_rebin2=self.k_rebin[field2])]
 
-            else:
-                print('NOT READY FOR NOW --> need to add dmu and dcov in KszPipeOutDir !')
-                sys.exit(3)
-                mu_grad = None
-                cov_grad = None
-                return mu, cov, mu_grad, cov_grad
+            # apply the correction factor to the covariance matrix
+            nf = len(self.fields)
+            cov = self.factor_cov_correction * np.block([[cov[i*nf + j] for j in range(nf)] for i in range(nf)])
+            if return_grad:
+                grad_cov = self.factor_cov_correction * np.block([[grad_cov[i*nf + j] for j in range(nf)] for i in range(nf)])
+
+        return (mu, cov, grad_mu, grad_cov) if return_grad else (mu, cov)
 
     def snr_wo_noise(self, remove_foregrounds=False):
         """ Compute the SNR without noise. Useful to check if the non-noise signal is detected or not."""
@@ -917,7 +1127,9 @@ class CombineTracerLikelihood(Likelihood):
         self.data = np.concatenate([lik.data for lik in self.likelihoods])
 
         self.cov_fix_params = all([lik.cov_fix_params for lik in self.likelihoods])
+        self.cov_interp = False
         self.jeffreys_prior = all([lik.jeffreys_prior for lik in self.likelihoods])
+        self._fast_chi2 = self.cov_fix_params and all([lik._fast_chi2 for lik in self.likelihoods])
 
         if self.cov_fix_params:
             self.cov = scipy.linalg.block_diag(*[lik.cov for lik in self.likelihoods])
@@ -925,8 +1137,12 @@ class CombineTracerLikelihood(Likelihood):
             self.logdet_cov = np.linalg.slogdet(self.cov)[1]
             self.cov_cholesky = np.linalg.cholesky(self.cov)
  
+    def _fixed_cov_chi2(self, params):
+        # The covariance is block-diagonal, so the chi^2 is the sum over likelihoods.
+        return sum(lik._fixed_cov_chi2(params) for lik in self.likelihoods)
+
     def mean_and_cov(self, force_compute_cov=False, return_cov=True, return_grad=False, **params): 
-        mean, cov, grad = [], [], []
+        mean, cov, grad_mean, grad_cov = [], [], [], []
         for lik in self.likelihoods:
             to_unpack = lik.mean_and_cov(force_compute_cov=force_compute_cov, return_cov=return_cov, return_grad=return_grad, **params)
             if not return_cov and not return_grad: 
@@ -934,16 +1150,205 @@ class CombineTracerLikelihood(Likelihood):
             else:
                 mean.append(to_unpack[0])
             if return_cov:  cov.append(to_unpack[1])
-            if return_grad: grad.append(to_unpack[2])
+            if return_grad: 
+                # Gradients of each likelihood are with respect to lik.params (a subset of self.params).
+                index = [list(self.params).index(key) for key in lik.params]
+                g = to_unpack[2] if return_cov else to_unpack[1]
+                grad_mean.append(np.zeros(g.shape[:-2] + (len(self.params),) + g.shape[-1:]))
+                grad_mean[-1][..., index, :] = g
+                if return_cov:
+                    g = to_unpack[3]
+                    grad_cov.append(np.zeros(g.shape[:-3] + (len(self.params),) + g.shape[-2:]))
+                    grad_cov[-1][..., index, :, :] = g
 
         if not return_cov and not return_grad:
-            return np.concatenate(mean)
+            return np.concatenate(mean, axis=-1)
         elif return_cov and not return_grad:
-            return np.concatenate(mean), scipy.linalg.block_diag(*cov)
+            return np.concatenate(mean, axis=-1), _block_diag(cov)
+        elif not return_cov:
+            return np.concatenate(mean, axis=-1), np.concatenate(grad_mean, axis=-1)
+        else:
+            return np.concatenate(mean, axis=-1), _block_diag(cov), np.concatenate(grad_mean, axis=-1), _block_diag(grad_cov)
+
+
+class LikelihoodEvaluator:
+    def __init__(self, likelihood, nworkers=1, mode='process', start_method=None):
+        r"""Picklable log-likelihood function, with optional parallel evaluation (used in BaseLikelihood.run_mcmc()).
+
+        Calling the evaluator with a shape ``(nparams,)`` array returns the log-likelihood (as a float).
+        Calling it with a shape ``(n, nparams)`` array returns ``likelihood.log_likelihood_batch(theta)``
+        (so that the evaluator can be passed to emcee with ``vectorize=True``). While the evaluator is open
+        (see :meth:`open()`, or use a ``with``-statement), the ``n`` points are split into ``nworkers`` chunks,
+        which are evaluated concurrently:
+
+          - ``mode='process'``: chunks are evaluated in a :func:`~kszx.utils.Pool()`. The likelihood is sent to
+            each worker once (when the pool is created), not with each call. If the multiprocessing start method
+            is not ``'fork'``, then large read-only arrays in the KszPipeOutdir are shared with the workers via a
+            :class:`~kszx.utils.SharedArrayDir`, so that they are stored once in memory, not once per worker.
+            (The KszPipeOutdir arrays are restored to their original values in :meth:`close()`.)
+
+          - ``mode='thread'``: chunks are evaluated in a thread pool (numpy releases the GIL in the model
+            contractions, Cholesky decompositions, and triangular solves). BLAS is limited to one thread
+            while the evaluator is open (see :func:`~kszx.utils.set_blas_nthreads()`), if the optional
+            ``threadpoolctl`` package is installed.
+
+        The evaluator can be pickled (e.g. for use with an external pool). Pickling sends the likelihood,
+        but not the worker pool (the unpickled copy evaluates serially).
+        """
+
+        if mode not in ['process', 'thread']:
+            raise RuntimeError(f"LikelihoodEvaluator: expected mode='process' or mode='thread', got {mode=}")
+
+        self.likelihood = likelihood
+        self.nworkers = nworkers
+        self.mode = mode
+        self.start_method = start_method
+        
+        self._pool = None
+        self._sdir = None
+        self._shared_pouts = []   # list of (pout, saved) pairs, see KszPipeOutdir._share_arrays()
+        self._blas_limits = None
+
+    def __call__(self, theta):
+        theta = np.asarray(theta, dtype=float)
+        
+        if theta.ndim == 1:
+            return float(self.likelihood.log_likelihood_batch(theta[None,:])[0])
+        if (self._pool is None) or (len(theta) < 2):
+            return self.likelihood.log_likelihood_batch(theta)
+        
+        chunks = np.array_split(theta, min(self.nworkers, len(theta)))
+        
+        if self.mode == 'process':
+            logL = self._pool.map(_worker_log_likelihood_batch, chunks)
         else:
-            import sys 
-            print('NOT IMPLEMENTED YET')
-            sys.exit(1)
+            logL = self._pool.map(self.likelihood.log_likelihood_batch, chunks)
+
+        return np.concatenate(list(logL))
+
+    def open(self):
+        """Starts the worker pool (if ``nworkers > 1``). Called automatically by the ``with``-statement."""
+
+        if (self._pool is not None) or (self.nworkers <= 1):
+            return self
+
+        # Build the compiled model plans (see KszPipeOutdir._spectrum_plan()) before starting the workers,
+        # so that they are computed once, and shared between workers.
+        lik = self.likelihood
+        lik.mean_and_cov(**{ key: np.mean(lik.params[key]['prior']) for key in lik.params })
+
+        if self.mode == 'thread':
+            self._blas_limits = utils.set_blas_nthreads(1)
+            if self._blas_limits is None:
+                print('LikelihoodEvaluator: threadpoolctl is not installed, BLAS threads will not be limited')
+            self._pool = concurrent.futures.ThreadPoolExecutor(self.nworkers)
+            return self
+
+        if multiprocessing.get_context(self.start_method).get_start_method() != 'fork':
+            self._sdir = utils.SharedArrayDir()
+            self._shared_pouts = [ (pout, pout._share_arrays(self._sdir)) for pout in _get_pouts(lik) ]
+
+        self._pool = utils.Pool(self.nworkers, start_method=self.start_method, initializer=_set_worker_likelihood, initargs=(lik,))
+        return self
+
+    def close(self):
+        """Stops the worker pool (after which the evaluator evaluates serially). Called automatically by the ``with``-statement."""
+
+        if self._pool is not None:
+            if self.mode == 'thread':
+                self._pool.shutdown()
+            else:
+                self._pool.close()
+                self._pool.join()
+            self._pool = None
+
+        if self._blas_limits is not None:
+            self._blas_limits.restore_original_limits()
+            self._blas_limits = None
+
+        for pout, saved in self._shared_pouts:
+            pout._unshare_arrays(saved)
+        self._shared_pouts = []
+
+        if self._sdir is not None:
+            self._sdir.close()
+            self._sdir = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(_pool=None, _sdir=None, _shared_pouts=[], _blas_limits=None)
+        return state
+
+
+def _get_pouts(likelihood):
+    """Helper for LikelihoodEvaluator: returns list of KszPipeOutdirs used by a likelihood (or CombineTracerLikelihood)."""
+    if hasattr(likelihood, 'likelihoods'):
+        return [ pout for lik in likelihood.likelihoods for pout in _get_pouts(lik) ]
+    return [ likelihood.pout ]
+
+
+_worker_likelihood = None
+
+def _set_worker_likelihood(likelihood):
+    """Helper for LikelihoodEvaluator: initializer for worker processes."""
+    global _worker_likelihood
+    _worker_likelihood = likelihood
+
+def _worker_log_likelihood_batch(theta):
+    """Helper for LikelihoodEvaluator: runs in worker processes."""
+    return _worker_likelihood.log_likelihood_batch(theta)
+
+
+def _whitened_grads(cov_cholesky, grad_mean, grad_cov=None):
+    r"""Helper for log_likelihood_and_grad() and _jeffreys_log_prior().
+
+    Given the Cholesky factor L of the covariance (shape (..., D, D)), and derivatives of the mean and covariance
+    (shapes (..., P, D) and (..., P, D, D), see mean_and_cov()), returns L^{-1} dmu_a and L^{-1} dC_a L^{-T}.
+    The second return value is None if grad_cov is None (e.g. if cov_fix_params=True)."""
+    
+    linv = scipy.linalg.solve_triangular(cov_cholesky, np.eye(cov_cholesky.shape[-1]), lower=True)   # batched: scipy >= 1.15
+    linv_dmu = np.einsum('...ij,...aj->...ai', linv, grad_mean)
+    if grad_cov is None:
+        return linv_dmu, None
+
+    s = linv[...,None,:,:] @ grad_cov @ np.swapaxes(linv, -1, -2)[...,None,:,:]
+    return linv_dmu, s
+
+
+def _jeffreys_log_prior(cov_cholesky, grad_mean, grad_cov=None):
+    r"""Returns log of the Jeffreys prior, (1/2) log det F, where F is the Fisher matrix.
+
+    F_{ab} = dmu_a^T C^{-1} dmu_b + (1/2) Tr(C^{-1} dC_a C^{-1} dC_b), where the second term is omitted if
+    grad_cov is None. Arguments are as in _whitened_grads(), and may have leading batch axes."""
+
+    linv_dmu, s = _whitened_grads(cov_cholesky, grad_mean, grad_cov)
+    f = np.einsum('...ai,...bi->...ab', linv_dmu, linv_dmu)
+    if s is not None:
+        f += 0.5 * np.einsum('...aij,...bji->...ab', s, s)
+
+    sign, logdet_f = np.linalg.slogdet(f)
+    return np.where(sign > 0, 0.5 * logdet_f, -np.inf)
+
+
+def _block_diag(blocks):
+    """Like scipy.linalg.block_diag(), but blocks may have (broadcastable) leading batch axes."""
+    if all(b.ndim == 2 for b in blocks):
+        return scipy.linalg.block_diag(*blocks)
+
+    batch_shape = np.broadcast_shapes(*[b.shape[:-2] for b in blocks])
+    n1, n2 = sum(b.shape[-2] for b in blocks), sum(b.shape[-1] for b in blocks)
+    ret = np.zeros(batch_shape + (n1, n2))
+    i = j = 0
+    for b in blocks:
+        ret[..., i:i+b.shape[-2], j:j+b.shape[-1]] = b
+        i, j = i + b.shape[-2], j + b.shape[-1]
+    return ret
 
 
 """ DEVELOPMENT ..."""
@@ -0,0 +1,170 @@
+import numpy as np
+
+from . import core
+from . import utils
+from . import cpp_kernels
+
+from .Box import Box
+
+
+class PointStencil:
+    def __init__(self, box, points, kernel, periodic=False, dtype=float):
+        r"""Precomputed interpolation/gridding stencil, for a fixed set of points.
+
+        If the same set of points is used many times (e.g. a random catalog which is
+        gridded/interpolated once per surrogate sim), then the pixel indices and kernel
+        weights can be computed once, and reused. This trades memory for speed: the stencil
+        uses $3K(4+b)$ bytes per point, where $K=2$ (CIC) or $K=4$ (cubic), and $b=4$ or $b=8$
+        is the size of the weight dtype. (For example, 144 bytes/point for a cubic stencil with
+        float64 weights, vs 24 bytes/point for the ``points`` array.) The memory footprint is
+        available as ``PointStencil.nbytes``.
+
+        Constructor args:
+
+          - ``box`` (kszx.Box): defines pixel size, bounding box size, and location of observer.
+            See :class:`~kszx.Box` for more info.
+
+          - ``points`` (2-d array): shape (npoints, 3) array, in "observer coordinates".
+            (Same meaning as in :func:`~kszx.interpolate_points()` and :func:`~kszx.grid_points()`.)
+
+          - ``kernel`` (string): either ``'cic'`` or ``'cubic'``.
+
+          - ``periodic`` (boolean): if True, then the box has periodic boundary conditions.
+
+          - ``dtype``: dtype of stencil weights, either ``np.float64`` (default) or ``np.float32``.
+            With float64 weights, results are identical to :func:`~kszx.interpolate_points()` and
+            :func:`~kszx.grid_points()`. Float32 weights save memory, at the cost of ~1e-7 roundoff.
+
+        Example usage::
+
+           stencil = kszx.PointStencil(box, rcat_xyz, kernel='cubic')
+           print(f'{stencil.nbytes/1.0e9} GB')
+
+           # Equivalent to kszx.grid_points(box, rcat_xyz, w, kernel='cubic', fft=True, compensate=True).
+           fmap = stencil.grid(w, fft=True, compensate=True)
+
+           # Equivalent to kszx.interpolate_points(box, fmap, rcat_xyz, kernel='cubic', fft=True).
+           vals = stencil.interpolate(fmap, fft=True)
+        """
+
+        if not isinstance(box, Box):
+            raise RuntimeError(f"kszx.PointStencil: expected 'box' arg to be kszx.Box object, got {box = }")
+        if box.ndim != 3:
+            raise RuntimeError('kszx.PointStencil: currently only ndim==3 is supported')
+        if kernel is None:
+            raise RuntimeError("kszx.PointStencil: 'kernel' arg must be specified")
+
+        dtype = np.dtype(dtype)
+        points = utils.asarray(points, 'kszx.PointStencil', 'points', dtype=float)
+        kernel = kernel.lower()
+
+        if (points.ndim != 2) or (points.shape[1] != 3):
+            raise RuntimeError(f"kszx.PointStencil: expected points.shape=(N,3), got shape {points.shape}")
+        if dtype not in [ np.float32, np.float64 ]:
+            raise RuntimeError(f"kszx.PointStencil: expected dtype to be float32 or float64, got {dtype=}")
+
+        if kernel == 'cic':
+            cpp_kernel = cpp_kernels.cic_stencil_3d
+        elif kernel == 'cubic':
+            cpp_kernel = cpp_kernels.cubic_stencil_3d
+        else:
+            raise RuntimeError(f'kszx.PointStencil: {kernel=} is not supported')
+
+        n0, n1, n2 = box.npix
+        single_precision = (dtype == np.float32)
+
+        self.box = box
+        self.kernel = kernel
+        self.periodic = periodic
+        self.npoints = points.shape[0]
+        self.indices, self.weights = cpp_kernel(points, n0, n1, n2, box.lpos[0], box.lpos[1], box.lpos[2], box.pixsize, periodic, single_precision)
+
+
+    @property
+    def nbytes(self):
+        """Memory footprint of the stencil, in bytes."""
+        return self.indices.nbytes + self.weights.nbytes
+
+
+    def interpolate(self, arr, fft=False, spin=0, threads=None):
+        r"""Interpolates real-space map at the stencil points. Returns 1-d array of length npoints.
+
+        Equivalent to ``kszx.interpolate_points(box, arr, points, kernel, fft, spin, periodic)``,
+        where (box, points, kernel, periodic) are the constructor args.
+
+        The ``threads`` arg is only used for the FFT (if ``fft=True``). The interpolation kernel
+        uses the OpenMP default (see :func:`~kszx.utils.set_nthreads()`), as in
+        :func:`~kszx.interpolate_points()`.
+        """
+
+        arr = utils.asarray(arr, 'kszx.PointStencil.interpolate()', 'arr')
+
+        if fft:
+            if not self.box.is_fourier_space_map(arr):
+                raise RuntimeError("kszx.PointStencil.interpolate(): expected 'arr' to be Fourier-space map (since fft=True)")
+            arr = core.fft_c2r(self.box, arr, spin=spin, threads=threads)
+        elif not self.box.is_real_space_map(arr):
+            raise RuntimeError("kszx.PointStencil.interpolate(): expected 'arr' to be real-space map (since fft=False)")
+        elif spin != 0:
+            raise RuntimeError("kszx.PointStencil.interpolate(): 'spin' argument was specified with fft=False")
+
+        return cpp_kernels.stencil_interpolate_3d(arr, self.indices, self.weights)
+
+
+    def grid(self, weights=None, fft=False, spin=0, compensate=False, wscal=1.0, threads=None):
+        r"""Grids the stencil points, with specified weights.
+
+        The ``weights`` arg is either None, a scalar, a 1-d array of length npoints, or
+        a 2-d array of shape (nfields, npoints).
+
+          - If ``weights`` is None, 0-d, or 1-d, then the return value is a single map.
+            Equivalent to ``kszx.grid_points(box, points, weights, kernel=kernel, ...)``.
+
+          - If ``weights`` is 2-d, then the return value is an array of shape ``(nfields,) + (map shape)``.
+            Equivalent to ``kszx.grid_points_multi(box, points, weights, kernel=kernel, ...)``.
+
+        The remaining args (``fft``, ``spin``, ``compensate``, ``wscal``, ``threads``) have
+        the same meaning as in :func:`~kszx.grid_points()`.
+        """
+
+        if (spin != 0) and (not fft):
+            raise RuntimeError("kszx.PointStencil.grid(): 'spin' argument was specified with fft=False")
+        if compensate and (not fft):
+            raise RuntimeError("kszx.PointStencil.grid(): 'compensate' argument was specified with fft=False")
+
+        if weights is None:
+            weights = 1.0
+
+        weights = utils.asarray(weights, 'kszx.PointStencil.grid()', 'weights', dtype=float)
+        multi = (weights.ndim == 2)
+
+        if weights.ndim == 0:
+            weights = np.broadcast_to(weights, (1, self.npoints))
+        elif weights.ndim == 1:
+            weights = np.reshape(weights, (1,-1))
+        elif weights.ndim != 2:
+            raise RuntimeError(f"kszx.PointStencil.grid(): expected 'weights' to be 0-d, 1-d, or 2-d, got shape {weights.shape}")
+
+        if weights.shape[1] != self.npoints:
+            raise RuntimeError(f"kszx.PointStencil.grid(): weights array has shape {weights.shape}; expected {self.npoints} points")
+
+        if threads is None:
+            threads = utils.get_nthreads()
+
+        # Same operation order as 'w0 = wscal * rec_ps * rec_ps * rec_ps' in interpolation_args.hpp.
+        rec_ps = 1.0 / self.box.pixsize
+        coeff = float(wscal) * rec_ps * rec_ps * rec_ps
+
+        nfields = weights.shape[0]
+        grids = np.zeros((nfields,) + self.box.real_space_shape, dtype=float)
+        cpp_kernels.stencil_grid_3d(grids, self.indices, self.weights, weights, coeff, self.periodic, threads)
+
+        if fft:
+            ret = np.empty((nfields,) + self.box.fourier_space_shape, dtype=complex)
+            for f in range(nfields):
+                ret[f] = core.fft_r2c(self.box, grids[f], spin=spin, threads=threads)
+                if compensate:
+                    core.apply_kernel_compensation(self.box, ret[f], self.kernel)
+            grids = ret
+
+        return grids if multi else grids[0]
@@ -0,0 +1,144 @@
+import numpy as np
+
+from . import core
+
+from .Box import Box
+
+
+class PowerSpectrumAccumulator:
+    def __init__(self, box, kbin_edges, *, use_dc=False, allow_empty_bins=False):
+        r"""Computes auto- and cross-power spectra of Fourier-space maps, which are added one at a time.
+
+        :func:`~kszx.estimate_power_spectrum()` requires all maps to be in memory simultaneously.
+        The PowerSpectrumAccumulator only keeps a "compressed" copy of each map, containing the
+        Fourier modes which fall into one of the k-bins. Therefore, maps can be produced, added
+        to the accumulator, and freed. When the k-bins only cover a small fraction of Fourier
+        space (typical for KSZ analyses, where $k_{\rm max} \ll k_{\rm nyq}$), peak memory
+        usage is close to one full-size map (plus the compressed maps).
+
+        Constructor args:
+
+          - ``box`` (kszx.Box): defines pixel size, bounding box size, and location of observer.
+            See :class:`~kszx.Box` for more info.
+
+          - ``kbin_edges``, ``use_dc``, ``allow_empty_bins``: same meaning as in
+            :func:`~kszx.estimate_power_spectrum()`.
+
+        Example usage::
+
+           acc = kszx.PowerSpectrumAccumulator(box, kbin_edges)
+
+           for i in range(nmaps):
+               fmap = make_fourier_space_map(i)   # user-defined
+               acc.add(fmap)
+               del fmap
+
+           # Equivalent to kszx.estimate_power_spectrum(box, fmap_list, kbin_edges).
+           pk = acc.get_pk()   # shape (nmaps, nmaps, nkbins)
+
+        Memory usage is 16 bytes per (compressed map, mode), plus 24 bytes per mode for bookkeeping.
+        The number of modes is available as ``PowerSpectrumAccumulator.nmodes``.
+        """
+
+        if not isinstance(box, Box):
+            raise RuntimeError(f"kszx.PowerSpectrumAccumulator: expected 'box' arg to be kszx.Box object, got {box = }")
+
+        kbin_edges = core._check_kbin_edges(box, kbin_edges, use_dc)
+        nkbins = len(kbin_edges) - 1
+
+        # Squared wavenumber of each Fourier mode, computed in the same order as the C++ kernel
+        # (cpp/estimate_power_spectrum.cpp), so that modes are assigned to the same k-bins.
+        k2 = np.zeros(box.fourier_space_shape)
+        for axis in range(box.ndim):
+            n = box.npix[axis]
+            ik = np.arange(box.fourier_space_shape[axis])
+            ik = np.minimum(ik, n-ik) if (axis < box.ndim-1) else ik
+            shape = (1,)*axis + (len(ik),) + (1,)*(box.ndim-axis-1)
+            k2 = k2 + np.square(ik * box.kfund[axis]).reshape(shape)
+
+        k2 = k2.reshape((-1,))
+        ibin = np.searchsorted(np.square(kbin_edges), k2, side='right') - 1
+        del k2
+
+        # Flattened indices of Fourier modes in k-bins, sorted by bin.
+        flat_index = np.nonzero((ibin >= 0) & (ibin < nkbins))[0]
+        ibin = ibin[flat_index]
+        perm = np.argsort(ibin, kind='stable')
+        flat_index = flat_index[perm]
+        ibin = ibin[perm]
+
+        # Mode counts (1 or 2), accounting for the "missing" half of Fourier space, as in the C++ kernel.
+        n = box.npix[-1]
+        ilast = flat_index % box.fourier_space_shape[-1]
+        mc = np.where((ilast == 0) | (2*ilast == n), 1.0, 2.0)
+
+        self.box = box
+        self.kbin_edges = kbin_edges
+        self.nkbins = nkbins
+        self.nmodes = len(flat_index)
+        self.bin_counts = np.bincount(ibin, weights=mc, minlength=nkbins).astype(int)
+
+        if (not allow_empty_bins) and (np.min(self.bin_counts) == 0):
+            raise RuntimeError('kszx.PowerSpectrumAccumulator: some k-bins were empty')
+
+        # Bins are contiguous ranges of modes. For use with np.add.reduceat(), we keep track of
+        # the start of each nonempty bin, in the "interleaved real/imaginary" representation.
+        bin_sizes = np.bincount(ibin, minlength=nkbins)
+        self._nonempty = (bin_sizes > 0)
+        self._bin_starts = 2 * (np.cumsum(bin_sizes) - bin_sizes)[self._nonempty]
+
+        self._flat_index = flat_index
+        self._mc = np.repeat(mc, 2)           # length (2 * nmodes)
+        self._maps = [ ]                      # list of complex 1-d arrays of length nmodes
+        self._pk = np.zeros((0, 0, nkbins))   # unnormalized
+
+
+    @property
+    def nmaps(self):
+        """Number of maps which have been added."""
+        return len(self._maps)
+
+
+    @property
+    def nbytes(self):
+        """Memory footprint of the accumulator (compressed maps and bookkeeping), in bytes."""
+        return sum(m.nbytes for m in self._maps) + self._flat_index.nbytes + self._mc.nbytes + self._pk.nbytes
+
+
+    def add(self, fmap):
+        """Adds a Fourier-space map, and computes its cross-power with all previously added maps.
+
+        Returns the index of the new map (i.e. its row/column in the array returned by ``get_pk()``).
+        After ``add()`` returns, the caller can free the map.
+        """
+
+        if not self.box.is_fourier_space_map(fmap):
+            raise RuntimeError("kszx.PowerSpectrumAccumulator.add(): expected 'fmap' to be a Fourier-space map"
+                               + f" with shape {self.box.fourier_space_shape}")
+
+        z = np.take(np.ravel(fmap), self._flat_index)   # complex, length nmodes
+        wz = self._mc * z.view(float)                   # real, length (2 * nmodes)
+
+        j = self.nmaps
+        pk = np.zeros((j+1, j+1, self.nkbins))
+        pk[:j,:j,:] = self._pk
+
+        for i, zi in enumerate(self._maps + [z]):
+            if len(self._bin_starts) > 0:
+                pk[i,j,self._nonempty] = np.add.reduceat(zi.view(float) * wz, self._bin_starts)
+            pk[j,i,:] = pk[i,j,:]
+
+        self._maps.append(z)
+        self._pk = pk
+        return j
+
+
+    def get_pk(self):
+        """Returns array of shape ``(nmaps, nmaps, nkbins)``, containing auto- and cross-power spectra of all maps added so far.
+
+        The normalization is the same as :func:`~kszx.estimate_power_spectrum()`. (The bin counts
+        are available as ``PowerSpectrumAccumulator.bin_counts``.)
+        """
+
+        norm = np.array([ (1.0 / n / self.box.box_volume) if (n > 0) else 0.0 for n in self.bin_counts ])
+        return self._pk * norm
@@ -71,12 +71,11 @@ class RegulatedDeconvolver:
         self.pobs = self.pobs / np.sum(self.pobs,axis=1).reshape((-1,1))  # normalize to PDF in z-bins (for each y-bin)
 
 
-    def _sample(self, zobs, zerr):
+    def _sample(self, zobs, zerr, rng):
         r"""Helper for sample(): Sample from conditional distribution $P(z_{true} | z_{obs},z_{err})$."""
         
         n = len(zobs)
         nb = self.nzbins
-        rng = np.random.default_rng()
 
         # iy, iz = bin indices (shape (n,))
         # Reminder: the variable y = log(zerr + zbin_width) is used to define zerr bins.
@@ -108,15 +107,16 @@ class RegulatedDeconvolver:
         return ztrue
 
         
-    def sample(self, n, zobs_min=None, zobs_max=None):
+    def sample(self, n, zobs_min=None, zobs_max=None, rng=None):
         r"""Returns ``(ztrue, zobs, zerr)``, where all 3 arrays have shape ``(n,)``.
         
+        The ``rng`` argument is an ``np.random.Generator`` (if None, then a freshly seeded Generator is used).
         If n is large, you may want to call sample_parallel() instead."""
 
         zobs_min = zobs_min if (zobs_min is not None) else (self.zmin - 0.01)
         zobs_max = zobs_max if (zobs_max is not None) else (self.zmax + 0.01)
         mask = np.logical_and(self.zobs_vec >= zobs_min, self.zobs_vec <= zobs_max)
-        rng = np.random.default_rng()
+        rng = np.random.default_rng() if (rng is None) else rng
         
         # Shape (n,)
         ix = np.nonzero(mask)[0]
@@ -129,22 +129,28 @@ class RegulatedDeconvolver:
         # Compute in batches, to keep memory usage under control.
         while pos < n:
             pos2 = min(n, pos + 10**5)
-            ztrue[pos:pos2] = self._sample(zobs[pos:pos2], zerr[pos:pos2])
+            ztrue[pos:pos2] = self._sample(zobs[pos:pos2], zerr[pos:pos2], rng)
             pos = pos2
                 
         return ztrue, zobs, zerr
 
 
-    def sample_parallel(self, n, zobs_min=None, zobs_max=None, processes=None):
+    def sample_parallel(self, n, zobs_min=None, zobs_max=None, processes=None, seed=None):
         r"""Returns ``(ztrue, zobs, zerr)``, where all 3 arrays are shape ``(n,)``.
         
         Uses a multiprocessing Pool for speed. If ``processes`` is None, then a
-        sensible default will be chosen."""
+        sensible default will be chosen.
 
+        The samples are generated in fixed-size chunks, where chunk ``i`` uses an RNG derived
+        from ``SeedSequence(seed).spawn()``. Therefore, if ``seed`` is specified, then the result
+        is reproducible, and independent of the number of processes."""
+
+        chunk_size = 10**6
+        nlist = [ min(chunk_size, n-i) for i in range(0, n, chunk_size) ] if (n > 0) else [ 0 ]
+        seeds = np.random.SeedSequence(seed).spawn(len(nlist))
+        
         with utils.Pool(processes) as pool:
-            p = pool._processes
-            nlist = [ (((i+1)*n)//p) - ((i*n)//p) for i in range(p) ]
-            m = pool.starmap_async(self.sample, [(n,zobs_min,zobs_max) for n in nlist])
+            m = pool.starmap_async(self.sample, [(nc,zobs_min,zobs_max,np.random.default_rng(ss)) for (nc,ss) in zip(nlist,seeds)])
             result = m.get()  # list of (ztrue, zobs, zerr) triples
             
         # Concatenate results from each task.
@@ -1,6 +1,7 @@
 import numpy as np
 
 from . import core
+from . import utils
 
 from .Box import Box
 from .Catalog import Catalog
@@ -46,6 +47,12 @@ class SurrogateFactory:
             evaluated on random catalog.
 
           - ``self.sigma2`` (scalar): variance of linear density field at $z=0$.
+
+          - ``self.delta_kfilter`` (real-valued array with shape ``box.fourier_space_shape``):
+            Fourier-space filter $\sqrt{P(k)}$, times the interpolation kernel compensation
+            $C(k)^{-1/2}$, used in ``simulate_surrogate()``. This is computed once, so that $P(k)$
+            is not evaluated per surrogate, but costs ``8 * prod(box.fourier_space_shape)`` bytes
+            (e.g. 4.3 GB for a 1024^3 box).
         """
         
         assert isinstance(box, Box)
@@ -71,12 +78,18 @@ class SurrogateFactory:
         self.D = cosmo.D(z=ztrue, z0norm=True)
         self.f = cosmo.frsd(z=ztrue) 
         self.faH = cosmo.frsd(z=ztrue) * cosmo.H(z=ztrue) / (1+ztrue)
-        self.sigma2 = self._integrate_kgrid(box, cosmo.Plin_z0(box.get_k()))
+        pk = cosmo.Plin_z0(box.get_k())
+        self.sigma2 = self._integrate_kgrid(box, pk)
+        self.delta_kfilter = self._delta_kfilter(pk)
 
     
-    def simulate_surrogate(self):
+    def simulate_surrogate(self, rng=None):
         r"""Simulates linear density/velocity fields on the random catalog.
 
+        The ``rng`` argument is an ``np.random.Generator`` (if None, then numpy's global RNG is used).
+        Passing a Generator derived from a master seed and surrogate index (see
+        :meth:`~kszx.SurrogateStore.seed_sequence()`) makes each surrogate reproducible.
+
         Initializes the following members:
 
           - ``self.ngal`` (integer): includes random scatter, see class docstring.
@@ -97,32 +110,33 @@ class SurrogateFactory:
         $\delta_g(x) = b_g \delta(x) + 2 f_{NL} \delta_c (b_g-1) \phi(x)$.
         """
 
-        ngal = self.ngal_mean + (self.ngal_rms * np.random.normal())
+        rng = utils._get_rng(rng)
+        ngal = self.ngal_mean + (self.ngal_rms * rng.normal())
         ngal = np.clip(ngal, self.ngal_min, self.ngal_max)
         ngal = int(ngal+0.5)  # round
         assert 0 < ngal <= self.nrand
 
-        # delta is in fourier space:
-        delta = core.simulate_gaussian_field(self.box, self.cosmo.Plin_z0)
-        core.apply_kernel_compensation(self.box, delta, self.kernel)
-
-        # Let's create the different fields in real space, so that we can interpolate them to the random catalog.
-        # Note that phi = delta/alpha is independent of z (in linear theory)
-        phi = core.multiply_kfunc(self.box, delta, lambda k: 1.0/self.cosmo.alpha_z0(k=k), dc=0)
-        phi = core.interpolate_points(self.box, phi, self.xyz_true, self.kernel, fft=True, spin=0)
+        # delta is in fourier space (equivalent to simulate_gaussian_field() + apply_kernel_compensation()).
+        delta = core.simulate_white_noise(self.box, fourier=True, rng=rng)
+        delta *= self.delta_kfilter
+
+        # Evaluate the different fields on the random catalog, in one call to interpolate_derived_fields(),
+        # so that FFT workspaces are shared between fields. Fields are:
+        #   delta (spin 0), also used as the monopole of the Kaiser term
+        #   phi = delta/alpha (spin 0), independent of z in linear theory
+        #   vr = (faHD/k) delta (spin 1)
+        #   Kaiser quadrupole (spin 2)
+        # The phi and vr filters are functions of k, which are evaluated by interpolate_derived_fields() when needed.
+        
+        phi_kfilter = lambda k: 1.0/self.cosmo.alpha_z0(k=k)
+        vr_kfilter = lambda k: 1.0/k
+        fields = [ (None, 0), (phi_kfilter, 0), (vr_kfilter, 1), (None, 2) ]
+        delta, phi, vr, rsd2 = core.interpolate_derived_fields(self.box, delta, self.xyz_true, self.kernel, fields)
         
-        # vr = (faHD/k) delta, evaluated at xyz_true.
-        vr = core.multiply_kfunc(self.box, delta, lambda k: 1.0/k, dc=0)
-        vr = core.interpolate_points(self.box, vr, self.xyz_true, self.kernel, fft=True, spin=1)
         vr *= self.faH * self.D
         
         # Add Kaiser term (L_2(mu) = 1/2(3*mu**2 -1)).
-        rsd0 = core.interpolate_points(self.box, delta, self.xyz_true, self.kernel, fft=True, spin=0)
-        rsd2 = core.interpolate_points(self.box, delta, self.xyz_true, self.kernel, fft=True, spin=2)
-        rsd = 2 / 3 * self.D * rsd2 + 1 / 3 * self.D * rsd0  # This term will be multiply by self.f 
-
-        # delta = core.interpolate_points(self.box, delta, self.xyz_true, self.kernel, fft=True)  # avoid running one more FFT.
-        delta = rsd0
+        rsd = 2 / 3 * self.D * rsd2 + 1 / 3 * self.D * delta  # This term will be multiply by self.f 
         delta *= self.D
             
         # M = random vector with (nrand-ngal) 0s and (ngal) 1s.
@@ -130,7 +144,7 @@ class SurrogateFactory:
         # it in numpy, and it's not currently a bottleneck.)
         M = np.zeros(self.nrand)
         M[:ngal] = 1.0
-        M = np.random.permutation(M)
+        M = rng.permutation(M)
 
         self.ngal = ngal
         self.delta = delta
@@ -140,6 +154,16 @@ class SurrogateFactory:
         self.M = M
 
     
+    def _delta_kfilter(self, pk):
+        """Helper for constructor. Returns sqrt(P(k)) times the interpolation kernel compensation C(k)^(-1/2) (overwrites 'pk')."""
+
+        ret = pk
+        ret **= 0.5
+        for factor in core._kernel_compensation_factors(self.box, self.kernel, -0.5):
+            ret *= factor
+        return ret
+
+    
     @staticmethod
     def _integrate_kgrid(box, kgrid):
         """Helper method for constructor. Could be moved somewhere more general (e.g. kszx.core)."""
@@ -0,0 +1,261 @@
+import os
+import time
+import zlib
+import socket
+import yaml
+import numpy as np
+
+
+class SurrogateStore:
+    def __init__(self, dirname, shapes=None, seed=None):
+        r"""Append-only on-disk store for per-surrogate power spectra (used by :class:`~kszx.KszPipe`).
+
+        Each surrogate ``isurr`` consists of one float64 array per binning, with fixed shapes
+        (for KszPipe, ``shapes[i] = (A,A,nkbins[i])``). The store is a directory containing:
+
+          - ``store.yml``: the per-binning shapes, and the master seed.
+          - ``binning{i}.dat``: raw float64 data, one fixed-size row per surrogate, at byte offset
+            ``isurr * rowbytes``.
+          - ``done.dat``: completion records, one (uint32 flag, uint32 crc32) pair per surrogate.
+          - ``claims/``: claim files for distributed execution (see :meth:`claim()`).
+
+        Writes are atomic from the reader's perspective: :meth:`write()` writes (and fsyncs) the
+        data rows before writing the completion record, so a surrogate is either complete (with a
+        crc32 that can be checked on read), or absent. Different processes can write different
+        surrogates concurrently, and the files grow on demand, so ``nsurr`` can be increased
+        later without recomputing (or copying) existing surrogates.
+
+        Constructor args:
+
+          - ``dirname`` (string): store directory (created if it does not exist).
+
+          - ``shapes`` (list of tuples, or None): per-binning row shapes. If the store already
+            exists, then ``shapes`` is checked against ``store.yml``. If ``shapes`` is None,
+            then the store must already exist.
+
+          - ``seed`` (integer or None): master seed for per-surrogate RNG streams (see
+            :meth:`seed_sequence()`), saved in ``store.yml`` when the store is created. If None,
+            then a random seed is generated when the store is created (and read from ``store.yml``
+            subsequently), so that all processes sharing the store agree on the seed.
+        """
+
+        self.dirname = dirname
+        self.yaml_filename = f'{dirname}/store.yml'
+        self.done_filename = f'{dirname}/done.dat'
+
+        if not os.path.exists(self.yaml_filename):
+            if shapes is None:
+                raise RuntimeError(f'kszx.SurrogateStore: {self.yaml_filename} does not exist, and shapes=None was specified')
+            init_seed = int(np.random.SeedSequence().entropy) if (seed is None) else int(seed)
+            self._create([ tuple(int(n) for n in s) for s in shapes ], init_seed)
+
+        with open(self.yaml_filename, 'r') as f:
+            params = yaml.safe_load(f)
+        
+        file_shapes = [ tuple(s) for s in params['shapes'] ]
+        if (shapes is not None) and ([tuple(s) for s in shapes] != file_shapes):
+            raise RuntimeError(f'kszx.SurrogateStore: {shapes=} does not match {file_shapes=} in {self.yaml_filename}')
+        if (seed is not None) and (seed != params['seed']):
+            raise RuntimeError(f'kszx.SurrogateStore: {seed=} does not match seed={params["seed"]} in {self.yaml_filename}')
+
+        shapes, seed = file_shapes, params['seed']
+        
+        self.shapes = shapes
+        self.seed = seed
+        self.claims_dirname = f'{dirname}/claims'
+        self.nbinnings = len(shapes)
+        self.data_filenames = [ f'{dirname}/binning{i}.dat' for i in range(self.nbinnings) ]
+        self.rowbytes = [ 8 * int(np.prod(s)) for s in shapes ]
+
+    _done_dtype = np.dtype([('flag','<u4'), ('crc','<u4')])
+
+    def _create(self, shapes, seed):
+        print(f'Creating surrogate store {self.dirname}')
+        os.makedirs(f'{self.dirname}/claims', exist_ok=True)
+
+        for i in range(len(shapes)):
+            open(f'{self.dirname}/binning{i}.dat', 'ab').close()
+        open(self.done_filename, 'ab').close()
+
+        # Write store.yml last (and atomically), since its existence indicates that the store is initialized.
+        tmp_filename = f'{self.yaml_filename}.tmp{os.getpid()}'
+        with open(tmp_filename, 'w') as f:
+            yaml.safe_dump({'shapes': [list(s) for s in shapes], 'seed': seed}, f)
+        
+        # If another process has created the store concurrently, then we use its store.yml (and seed).
+        try:
+            os.link(tmp_filename, self.yaml_filename)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_filename)
+
+
+    def write(self, isurr, pks):
+        """Writes surrogate ``isurr``, where ``pks`` is a list of arrays (one per binning).
+
+        The data is fsynced before the completion record is written, so that an interrupted write
+        leaves the surrogate absent (rather than corrupted). Overwriting an existing surrogate is allowed.
+        """
+
+        if len(pks) != self.nbinnings:
+            raise RuntimeError(f'SurrogateStore.write(): expected {self.nbinnings} arrays, got {len(pks)}')
+
+        crc = 0
+        for i, pk in enumerate(pks):
+            pk = np.ascontiguousarray(pk, dtype='<f8')
+            if pk.shape != self.shapes[i]:
+                raise RuntimeError(f'SurrogateStore.write(): got {pk.shape=} in binning {i}, expected {self.shapes[i]}')
+            buf = pk.tobytes()
+            crc = zlib.crc32(buf, crc)
+            self._pwrite(self.data_filenames[i], buf, isurr * self.rowbytes[i])
+
+        rec = np.array([(1,crc)], dtype=self._done_dtype)
+        self._pwrite(self.done_filename, rec.tobytes(), isurr * self._done_dtype.itemsize)
+
+
+    @staticmethod
+    def _pwrite(filename, buf, offset):
+        fd = os.open(filename, os.O_WRONLY)
+        try:
+            nbytes = os.pwrite(fd, buf, offset)
+            if nbytes != len(buf):
+                raise RuntimeError(f'SurrogateStore: short write to {filename} ({nbytes} of {len(buf)} bytes)')
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+    def _read_done(self):
+        return np.fromfile(self.done_filename, dtype=self._done_dtype)
+
+    def done_mask(self, nsurr):
+        """Returns a length-``nsurr`` boolean array, indicating which surrogates have been written."""
+
+        done = self._read_done()['flag'][:nsurr] == 1
+        return np.concatenate((done, np.zeros(nsurr - len(done), dtype=bool)))
+
+    def missing(self, nsurr):
+        """Returns a list of surrogate indices ``0 <= isurr < nsurr`` which have not been written."""
+        return [ int(i) for i in np.flatnonzero(~self.done_mask(nsurr)) ]
+
+    def is_done(self, isurr):
+        return bool(self.done_mask(isurr+1)[isurr])
+
+    @property
+    def num_done(self):
+        """Number of completed surrogates (not necessarily contiguous)."""
+        return int(np.sum(self._read_done()['flag'] == 1))
+
+
+    def read(self, isurr=None, nsurr=None, verify=True):
+        """Reads surrogates from the store, and returns a list of arrays (one per binning).
+
+        If ``isurr`` is specified, then a single surrogate is read, and the returned arrays have
+        shapes ``self.shapes[i]``. Otherwise, completed surrogates with indices ``< nsurr`` are read
+        (or all completed surrogates, if ``nsurr`` is None), and the returned arrays have shapes
+        ``(n,) + self.shapes[i]``, where ``n`` is the number of completed surrogates. Use
+        :meth:`done_mask()` to get the corresponding surrogate indices. If ``verify=True``, then
+        crc32 checksums are checked.
+        """
+
+        done = self._read_done()
+
+        if isurr is not None:
+            if (isurr >= len(done)) or (done['flag'][isurr] != 1):
+                raise RuntimeError(f'SurrogateStore.read(): surrogate {isurr} has not been written to {self.dirname}')
+            indices = np.array([isurr])
+        else:
+            n = len(done) if (nsurr is None) else min(nsurr, len(done))
+            indices = np.flatnonzero(done['flag'][:n] == 1)
+
+        ret = [ ]
+        for i, fn in enumerate(self.data_filenames):
+            if len(indices) == 0:
+                ret += [ np.zeros((0,) + self.shapes[i]) ]
+                continue
+            nrows = os.path.getsize(fn) // self.rowbytes[i]
+            rows = np.memmap(fn, dtype='<f8', mode='r', shape=(nrows,) + self.shapes[i])
+            ret += [ np.array(rows[indices]) ]
+            del rows
+
+        if verify:
+            for j, ix in enumerate(indices):
+                crc = 0
+                for arr in ret:
+                    crc = zlib.crc32(arr[j].tobytes(), crc)
+                if crc != done['crc'][ix]:
+                    raise RuntimeError(f'SurrogateStore.read(): checksum mismatch for surrogate {ix} in {self.dirname}')
+
+        if isurr is not None:
+            ret = [ arr[0] for arr in ret ]
+        return ret
+
+
+    def seed_sequence(self, isurr):
+        """Returns the np.random.SeedSequence for surrogate ``isurr``.
+
+        This is equivalent to ``np.random.SeedSequence(self.seed).spawn(isurr+1)[isurr]``, i.e. each
+        surrogate has an independent RNG stream which depends only on the master seed and ``isurr``
+        (and not on which process computes the surrogate, or in what order).
+        """
+        return np.random.SeedSequence(self.seed, spawn_key=(isurr,))
+
+
+    def claim(self, name, timeout=None):
+        """Atomically claims the task ``name`` (a string such as ``'surr_17'``), and returns True if successful.
+
+        Claims are files ``claims/{name}``, created with ``O_CREAT | O_EXCL``, so that exactly one
+        process (on any node sharing the filesystem) succeeds. The claim file contains the hostname
+        and pid of the claiming process. A claim is never released after the task succeeds (completion
+        is recorded separately, see :meth:`write()`), but can be released with :meth:`release()` if
+        the task fails.
+
+        If ``timeout`` (in seconds) is specified, then a claim older than ``timeout`` is considered
+        stale (e.g. the claiming process died) and can be taken over. This is best-effort: in rare
+        races, two processes can both take over the same stale claim, and compute the same task.
+        (For KszPipe surrogates, this is harmless, since surrogates are deterministic functions of
+        ``isurr``, see :meth:`seed_sequence()`.)
+        """
+
+        filename = f'{self.claims_dirname}/{name}'
+
+        for _ in range(2):
+            try:
+                fd = os.open(filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if (timeout is None) or not self._take_over_stale_claim(filename, timeout):
+                    return False
+                continue
+            
+            try:
+                os.write(fd, f'{socket.gethostname()} {os.getpid()} {time.time()}\n'.encode())
+            finally:
+                os.close(fd)
+            return True
+
+        return False
+
+
+    def _take_over_stale_claim(self, filename, timeout):
+        try:
+            if time.time() - os.path.getmtime(filename) < timeout:
+                return False
+            os.rename(filename, f'{filename}.stale.{socket.gethostname()}.{os.getpid()}')
+        except FileNotFoundError:
+            pass   # claim was released (or taken over by another process) concurrently
+        return True
+
+
+    def release(self, name):
+        """Releases a claim made with :meth:`claim()` (e.g. if the task failed, so that another process can retry)."""
+
+        try:
+            os.remove(f'{self.claims_dirname}/{name}')
+        except FileNotFoundError:
+            pass
+
+
+    def claimed(self):
+        """Returns the set of currently claimed task names."""
+        return set(fn for fn in os.listdir(self.claims_dirname) if '.stale.' not in fn)
@@ -5,7 +5,10 @@ from .core import \
     fft_r2c, \
     fft_c2r, \
     interpolate_points, \
+    interpolate_points_multi, \
+    interpolate_derived_fields, \
     grid_points, \
+    grid_points_multi, \
     apply_kernel_compensation, \
     multiply_rfunc, \
     multiply_kfunc, \
@@ -25,13 +28,16 @@ from .Box import Box
 from .BoundingBox import BoundingBox
 from .Catalog import Catalog
 from .Cosmology import Cosmology, CosmologicalParams
+from .PointStencil import PointStencil
+from .PowerSpectrumAccumulator import PowerSpectrumAccumulator
 
 # "High-level" classes.
 from .CmbClFitter import CmbClFitter
 from .KszPipe import KszPipe, KszPipeOutdir
-from .Likelihood import Likelihood
+from .Likelihood import Likelihood, LikelihoodEvaluator
 from .RegulatedDeconvolver import RegulatedDeconvolver
 from .SurrogateFactory import SurrogateFactory
+from .SurrogateStore import SurrogateStore
 
 # "Utility" submodules.
 from . import utils
@@ -27,7 +27,16 @@ if __name__ == '__main__':
     p = subparsers.add_parser('kszpipe_run')
     p.add_argument('input_dirname')
     p.add_argument('output_dirname')
-    p.add_argument('-p', type=int, default=4, help='number of processes for multiprocessing Pool (default 4)')
+    p.add_argument('-p', default='4', help="number of processes for multiprocessing Pool, or 'auto' to choose from available memory/CPUs (default 4)")
+    p.add_argument('--dry-run', action='store_true', help='print plan (processes, memory estimates, missing outputs) and exit')
+    p.add_argument('--shared-inputs', action='store_true', help='share read-only arrays between worker processes (see KszPipe.run() docstring)')
+    p.add_argument('--start-method', choices=['fork','spawn','forkserver'], default=None, help='multiprocessing start method (default: multiprocessing default)')
+
+    p = subparsers.add_parser('kszpipe_worker')
+    p.add_argument('input_dirname')
+    p.add_argument('output_dirname')
+    p.add_argument('-t', type=int, default=None, help='number of threads in this worker process (default: all CPUs)')
+    p.add_argument('--claim-timeout', type=float, default=None, help='take over task claims older than this many seconds (default: never)')
     
     args = parser.parse_args()
 
@@ -58,12 +67,22 @@ if __name__ == '__main__':
         from . import cpp_kernels
         print(f'{cpp_kernels.omp_get_max_threads() = }')
         timing.time_interpolation()
+        timing.time_spatial_sort()
+        timing.time_estimate_power_spectrum()
+        timing.time_pse_kernels()
         timing.time_multiply_xli_real_space()
         timing.time_multiply_xli_fourier_space()
+        timing.time_spin_fft()
+        timing.time_simulate_white_noise()
     elif args.command == 'kszpipe_run':
         from .KszPipe import KszPipe
         kszpipe = KszPipe(args.input_dirname, args.output_dirname)
-        kszpipe.run(processes=args.p)
+        processes = args.p if (args.p == 'auto') else int(args.p)
+        kszpipe.run(processes=processes, shared_inputs=args.shared_inputs, start_method=args.start_method, dry_run=args.dry_run)
+    elif args.command == 'kszpipe_worker':
+        from .KszPipe import KszPipe
+        kszpipe = KszPipe(args.input_dirname, args.output_dirname)
+        kszpipe.run_distributed(nthreads=args.t, claim_timeout=args.claim_timeout)
     else:
         parser.print_help()
         sys.exit(2)
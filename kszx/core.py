@@ -1,5 +1,7 @@
 import os
 import healpy
+import functools
+import concurrent.futures
 import scipy.fft
 import pixell.enmap
 import numpy as np
@@ -12,7 +14,7 @@ from . import utils
 ####################################################################################################
 
 
-def fft_r2c(box, arr, spin=0, threads=None):
+def fft_r2c(box, arr, spin=0, threads=None, workspace=None):
     r"""Computes the FFT of real-space map 'arr', and returns a Fourier-space map.
 
         - ``box`` (kszx.Box): defines pixel size, bounding box size, and location of observer.
@@ -25,6 +27,8 @@ def fft_r2c(box, arr, spin=0, threads=None):
         - ``threads`` (integer or None): number of parallel threads used.
           If ``threads=None``, then number of threads defaults to :func:`~kszx.utils.get_nthreads()`.
 
+        - ``workspace`` (array or None): scratch space for spin > 0, see notes below.
+
     Returns a numpy array representing a Fourier-space map (dtype=complex).
 
     The real-space and Fourier-space array shapes are given by ``box.real_space_shape``
@@ -63,6 +67,14 @@ def fft_r2c(box, arr, spin=0, threads=None):
          see the sphinx docs:
 
            https://kszx.readthedocs.io/en/latest/fft.html#ffts-with-spin
+
+       - For spin > 0, the FFT is computed as a sum of (2l+1) spin-0 FFTs, which are done in-place
+         in a workspace array (complex, contiguous, shape ``box.fourier_space_shape``). If the
+         ``workspace`` argument is None, then the workspace is allocated internally. If a workspace
+         is specified, then no memory is allocated (other than the return value), which can be
+         useful when calling the FFT many times. (This applies if the last dimension of the box
+         is even. Otherwise, the workspace is unused, and temporary arrays are allocated.)
+         The workspace must not overlap ``arr``.
     """
 
     assert isinstance(box, Box)
@@ -85,19 +97,24 @@ def fft_r2c(box, arr, spin=0, threads=None):
         raise RuntimeError('fft_r2c(): currently we only implement higher-spin FFTs in 3-d')
     
     ret = np.empty(box.fourier_space_shape, dtype=complex)
-    tmp = np.empty(box.real_space_shape, dtype=float)
     phase = (-1j) if (spin % 2) else (1+0j)   # note (-i), not (+i)
-
-    for i in range(2*spin+1):
-        # FIXME is there a way to do an in-place FFT here? (to avoid allocating tmp2)
-        cpp_kernels.multiply_xli_real_space(tmp, arr, spin, i, box.lpos[0], box.lpos[1], box.lpos[2], box.pixsize, 1.0, False);
-        tmp2 = scipy.fft.rfftn(tmp, overwrite_x=True, workers=threads)
-        cpp_kernels.multiply_xli_fourier_space(ret, tmp2, spin, i, box.npix[2], phase * box.pixel_volume, (i > 0))
-    
+    nz = box.npix[2]
+
+    if nz % 2:
+        # Odd last dimension: in-place FFT is not available (see _fft_workspace()).
+        tmp = np.empty(box.real_space_shape, dtype=float)
+        for i in range(2*spin+1):
+            cpp_kernels.multiply_xli_real_space(tmp, arr, spin, i, box.lpos[0], box.lpos[1], box.lpos[2], box.pixsize, 1.0, False);
+            tmp2 = scipy.fft.rfftn(tmp, overwrite_x=True, workers=threads)
+            cpp_kernels.multiply_xli_fourier_space(ret, tmp2, spin, i, nz, phase * box.pixel_volume, (i > 0))
+        return ret
+
+    ws = _fft_workspace(box, workspace, 'kszx.fft_r2c', arr)
+    _fft_r2c_fused(box, arr, spin, ret, ws, threads)
     return ret
     
 
-def fft_c2r(box, arr, spin=0, threads=None):
+def fft_c2r(box, arr, spin=0, threads=None, workspace=None):
     r"""Computes the FFT of Fourier-space map 'arr', and returns a real-space map.
 
         - ``box`` (kszx.Box): defines pixel size, bounding box size, and location of observer.
@@ -110,6 +127,8 @@ def fft_c2r(box, arr, spin=0, threads=None):
         - ``threads`` (integer or None): number of parallel threads used.
           If ``threads=None``, then number of threads defaults to :func:`~kszx.utils.get_nthreads()`.
 
+        - ``workspace`` (array or None): scratch space for spin > 0, see notes below.
+
     Returns a numpy array representing a real-space map (dtype=float).
 
     The real-space and Fourier-space array shapes are given by ``box.real_space_shape``
@@ -148,6 +167,14 @@ def fft_c2r(box, arr, spin=0, threads=None):
          see the sphinx docs:
 
            https://kszx.readthedocs.io/en/latest/fft.html#ffts-with-spin
+
+       - For spin > 0, the FFT is computed as a sum of (2l+1) spin-0 FFTs, which are done in-place
+         in a workspace array (complex, contiguous, shape ``box.fourier_space_shape``). If the
+         ``workspace`` argument is None, then the workspace is allocated internally. If a workspace
+         is specified, then no memory is allocated (other than the return value), which can be
+         useful when calling the FFT many times. (This applies if the last dimension of the box
+         is even. Otherwise, the workspace is unused, and temporary arrays are allocated.)
+         The workspace must not overlap ``arr``.
     """
     
     assert isinstance(box, Box)
@@ -169,18 +196,154 @@ def fft_c2r(box, arr, spin=0, threads=None):
     # Higher-spin FFT follows.
     
     ret = np.empty(box.real_space_shape, dtype=float)
-    tmp = np.empty(box.fourier_space_shape, dtype=complex)
     phase = (1j) if (spin % 2) else (1+0j)   # note (+i), not (-i)
+    nz = box.npix[2]
+
+    if nz % 2:
+        # Odd last dimension: in-place FFT is not available (see _fft_workspace()).
+        tmp = np.empty(box.fourier_space_shape, dtype=complex)
+        for i in range(2*spin+1):
+            cpp_kernels.multiply_xli_fourier_space(tmp, arr, spin, i, nz, phase / box.pixel_volume, False)
+            tmp2 = scipy.fft.irfftn(tmp, box.npix, overwrite_x=True, workers=threads)
+            cpp_kernels.multiply_xli_real_space(ret, tmp2, spin, i, box.lpos[0], box.lpos[1], box.lpos[2], box.pixsize, 1.0, (i > 0))
+        return ret
+
+    ws = _fft_workspace(box, workspace, 'kszx.fft_c2r', arr)
+    _fft_c2r_fused(box, arr, spin, ret, ws, threads)
+    return ret
+
+
+def _fft_workspace(box, workspace, caller, arr):
+    """Helper for fft_r2c() and fft_c2r(). Returns workspace array (allocating if necessary).
+
+    The workspace is a contiguous complex array with shape box.fourier_space_shape. It can also be
+    viewed as a real-space map in "padded" layout: ws.view(float)[:,:,:nz], where nz = box.npix[2].
+    This allows in-place real <-> complex FFTs (see _rfft_inplace()), if nz is even.
+
+    The workspace is overwritten while the input array 'arr' is still being read, so a caller-supplied
+    workspace must not overlap 'arr'. (The output array is always freshly allocated by the caller.)
+    """
+
+    if workspace is None:
+        return np.empty(box.fourier_space_shape, dtype=complex)
     
-    for i in range(2*spin+1):
-        # FIXME is there a way to do an in-place FFT here? (to avoid allocating tmp2)
-        cpp_kernels.multiply_xli_fourier_space(tmp, arr, spin, i, box.npix[2], phase / box.pixel_volume, False)
-        tmp2 = scipy.fft.irfftn(tmp, box.npix, overwrite_x=True, workers=threads)
-        cpp_kernels.multiply_xli_real_space(ret, tmp2, spin, i, box.lpos[0], box.lpos[1], box.lpos[2], box.pixsize, 1.0, (i > 0))
+    if not (box.is_fourier_space_map(workspace) and workspace.flags.c_contiguous):
+        raise RuntimeError(f"{caller}(): expected 'workspace' to be a contiguous complex array with shape {box.fourier_space_shape}")
+    if np.shares_memory(workspace, arr):
+        raise RuntimeError(f"{caller}(): 'workspace' must not overlap the input array")
+
+    return workspace
+
+
+def _rfft_inplace(ws, nz, threads):
+    """In-place (unnormalized) rfftn of the real array ws.view(float)[:,:,:nz], see cpp/rfft_packed.cpp."""
+    
+    packed = ws[:,:,:(nz//2)]
+    out = scipy.fft.fftn(packed, overwrite_x=True, workers=threads)
+    if not np.may_share_memory(out, ws):
+        packed[:] = out   # non-default scipy.fft backend which ignores overwrite_x
+    cpp_kernels.rfft_untangle_3d(ws, nz, True)
+
+
+def _irfft_inplace(ws, nz, threads):
+    """In-place irfftn (normalized as in scipy), writing the real array ws.view(float)[:,:,:nz]."""
+    
+    packed = ws[:,:,:(nz//2)]
+    cpp_kernels.rfft_untangle_3d(ws, nz, False)
+    out = scipy.fft.ifftn(packed, overwrite_x=True, workers=threads)
+    if not np.may_share_memory(out, ws):
+        packed[:] = out
+
+
+# The "fused" spin-l FFTs below are equivalent to the following "unfused" loops (for r2c and c2r):
+#
+#   for i in range(2*spin+1):
+#       multiply_xli_real_space(ws_real, arr, ...)    # ws_real = ws.view(float)[:,:,:nz]
+#       _rfft_inplace(ws, nz, threads)
+#       multiply_xli_fourier_space(ret, ws, ...)
+#
+#   for i in range(2*spin+1):
+#       multiply_xli_fourier_space(ws, arr, ...)
+#       _irfft_inplace(ws, nz, threads)
+#       multiply_xli_real_space(ret, ws_real, ...)
+#
+# but make fewer passes over memory. The 3-d FFT is split into 2-d FFTs on slabs along axis 0,
+# followed by 1-d FFTs along axis 0 on slabs along axis 1. The real-space x_{li} multiplication
+# is done slab-by-slab along axis 0 (so that each slab is still in cache for the 2-d FFT), and
+# the Fourier-space x_{li} multiplication is done slab-by-slab along axis 1. The real <-> complex
+# step along the last axis uses the "packed" trick (see cpp/rfft_packed.cpp).
+#
+# Note: kszx.timing.time_multiply_xli.time_spin_fft() compares fused/unfused FFTs.
+
+
+def _fft_slabs(n, slab_size):
+    """Helper for _fft_{r2c,c2r}_fused(). Returns list of (start, end) pairs, each with length >= 2."""
     
+    slab_size = max(slab_size, 2)
+    ret = [ [a, min(a+slab_size,n)] for a in range(0, n, slab_size) ]
+    
+    if (len(ret) > 1) and (ret[-1][1] - ret[-1][0] < 2):
+        ret[-2][1] = n   # merge short last slab into previous slab
+        del ret[-1]
+
     return ret
 
 
+def _fft_inplace(arr, axes, forward, threads):
+    """Helper for _fft_{r2c,c2r}_fused(). In-place complex FFT along specified axes (inverse FFT is normalized)."""
+    
+    f = scipy.fft.fftn if forward else scipy.fft.ifftn
+    out = f(arr, axes=axes, overwrite_x=True, workers=threads)
+    if not np.may_share_memory(out, arr):
+        arr[:] = out   # non-default scipy.fft backend which ignores overwrite_x
+
+
+def _fft_r2c_fused(box, arr, spin, ret, ws, threads, slab_size=8):
+    """Fused spin-l r2c FFT (see comment above), writing output to 'ret'. Assumes box.npix[2] is even."""
+    
+    n0, n1, nz = box.npix
+    h = nz // 2
+    ws_real = ws.view(float)[:,:,:nz]
+    coeff = ((-1j) if (spin % 2) else (1+0j)) * box.pixel_volume   # note (-i), not (+i)
+    slabs0 = _fft_slabs(n0, max(slab_size, threads))
+    slabs1 = _fft_slabs(n1, max(slab_size, threads))
+    
+    for i in range(2*spin+1):
+        for (a,b) in slabs0:
+            lpos0 = box.lpos[0] + a * box.pixsize
+            cpp_kernels.multiply_xli_real_space(ws_real[a:b], arr[a:b], spin, i, lpos0, box.lpos[1], box.lpos[2], box.pixsize, 1.0, False)
+            _fft_inplace(ws[a:b,:,:h], (2,), True, threads)
+            cpp_kernels.rfft_untangle_rows(ws[a:b], nz, True)
+            _fft_inplace(ws[a:b], (1,), True, threads)
+
+        for (a,b) in slabs1:
+            _fft_inplace(ws[:,a:b], (0,), True, threads)
+            cpp_kernels.multiply_xli_fourier_space_slab(ret[:,a:b], ws[:,a:b], spin, i, n1, a, nz, coeff, (i > 0))
+
+
+def _fft_c2r_fused(box, arr, spin, ret, ws, threads, slab_size=8):
+    """Fused spin-l c2r FFT (see comment above), writing output to 'ret'. Assumes box.npix[2] is even."""
+    
+    n0, n1, nz = box.npix
+    h = nz // 2
+    ws_real = ws.view(float)[:,:,:nz]
+    coeff = ((1j) if (spin % 2) else (1+0j)) / box.pixel_volume   # note (+i), not (-i)
+    slabs0 = _fft_slabs(n0, max(slab_size, threads))
+    slabs1 = _fft_slabs(n1, max(slab_size, threads))
+
+    for i in range(2*spin+1):
+        for (a,b) in slabs1:
+            cpp_kernels.multiply_xli_fourier_space_slab(ws[:,a:b], arr[:,a:b], spin, i, n1, a, nz, coeff, False)
+            _fft_inplace(ws[:,a:b], (0,), False, threads)
+
+        for (a,b) in slabs0:
+            lpos0 = box.lpos[0] + a * box.pixsize
+            _fft_inplace(ws[a:b], (1,), False, threads)
+            cpp_kernels.rfft_untangle_rows(ws[a:b], nz, False)
+            _fft_inplace(ws[a:b,:,:h], (2,), False, threads)
+            cpp_kernels.multiply_xli_real_space(ret[a:b], ws_real[a:b], spin, i, lpos0, box.lpos[1], box.lpos[2], box.pixsize, 1.0, (i > 0))
+
+
 ####################################################################################################
 
 
@@ -268,6 +431,234 @@ def interpolate_points(box, arr, points, kernel, fft=False, spin=0, periodic=Fal
         raise RuntimeError(f'kszx.interpolate_points(): {kernel=} is not supported')
 
 
+def interpolate_points_multi(box, arr, points, kernel, periodic=False):
+    r"""Interpolates several real-space maps at the same set of points.
+
+    Equivalent to calling :func:`~kszx.interpolate_points()` once for each map, but the
+    interpolation stencil (pixel indices and kernel weights) for each point is computed once,
+    and reused for all maps. This is fastest if the maps are interleaved in memory (see notes
+    below). For large maps in separate arrays, interpolation is limited by memory bandwidth,
+    and is not much faster than separate calls to ``interpolate_points()``.
+
+    Function args:
+
+        - ``box`` (kszx.Box): defines pixel size, bounding box size, and location of observer.
+          See :class:`~kszx.Box` for more info.
+
+        - ``arr``: either a list of real-space maps, or a numpy array with shape
+          ``(nfields,) + box.real_space_shape``. (If a list is specified, then the maps
+          are not copied into a single array.)
+
+        - ``points`` (numpy array): shape (npoints, 3) array, in "observer coordinates".
+          (Same meaning as in :func:`~kszx.interpolate_points()`.)
+
+        - ``kernel`` (string): either ``'cic'`` or ``'cubic'``.
+
+        - ``periodic`` (boolean): if True, then the box has periodic boundary conditions.
+
+    Return value:
+
+        - 2-d numpy array with shape ``(nfields, npoints)``.
+
+    Notes:
+
+       - The interpolation kernel is fastest if the "field" axis of ``arr`` has the smallest stride,
+         so that all fields in a pixel are adjacent in memory. An array with this memory layout can
+         be allocated with ``np.moveaxis(np.empty(box.real_space_shape + (nfields,)), -1, 0)``.
+         If ``arr`` is a list of maps with different memory layouts (e.g. a mixture of contiguous
+         and non-contiguous maps), then each map is interpolated separately with
+         :func:`~kszx.interpolate_points()`, so the stencil is not shared between maps.
+
+       - Unlike :func:`~kszx.interpolate_points()`, there is no ``fft`` argument. To interpolate
+         several spin-$l$ FFTs of the same Fourier-space map, see :func:`~kszx.interpolate_derived_fields()`.
+    """
+
+    if not isinstance(box, Box):
+        raise RuntimeError(f"kszx.interpolate_points_multi(): expected 'box' arg to be kszx.Box object, got {box = }")
+    if kernel is None:
+        raise RuntimeError("kszx.interpolate_points_multi(): 'kernel' arg must be specified")
+    if box.ndim != 3:
+        raise RuntimeError('kszx.interpolate_points_multi(): currently only ndim==3 is supported')
+
+    points = utils.asarray(points, 'kszx.interpolate_points_multi()', 'points', dtype=float)
+    kernel = kernel.lower()
+
+    if (points.ndim != 2) or (points.shape[1] != box.ndim):
+        raise RuntimeError(f"kszx.interpolate_points_multi(): expected points.shape=(N,{box.ndim}), got shape {points.shape}")
+
+    if isinstance(arr, (list, tuple)):
+        if not all(box.is_real_space_map(a) for a in arr):
+            raise RuntimeError("kszx.interpolate_points_multi(): expected each element of 'arr' to be a real-space map")
+        maps = list(arr)
+    else:
+        arr = utils.asarray(arr, 'kszx.interpolate_points_multi()', 'arr', dtype=float)
+        if arr.shape[1:] != box.real_space_shape:
+            raise RuntimeError(f"kszx.interpolate_points_multi(): expected 'arr' to have shape (nfields,)+{box.real_space_shape}, got shape {arr.shape}")
+        maps = list(arr)   # views, not copies
+
+    if kernel == 'cic':
+        cpp_kernel = cpp_kernels.cic_interpolate_3d_multi
+    elif kernel == 'cubic':
+        cpp_kernel = cpp_kernels.cubic_interpolate_3d_multi
+    else:
+        raise RuntimeError(f'kszx.interpolate_points_multi(): {kernel=} is not supported')
+
+    if len(maps) == 0:
+        return np.zeros((0, points.shape[0]), dtype=float)
+    
+    if any(m.strides != maps[0].strides for m in maps):
+        # Fallback for maps with different memory layouts (see docstring).
+        ret = np.empty((len(maps), points.shape[0]), dtype=float)
+        for i, m in enumerate(maps):
+            ret[i] = interpolate_points(box, m, points, kernel, periodic=periodic)
+        return ret
+
+    return cpp_kernel(maps, points, box.lpos[0], box.lpos[1], box.lpos[2], box.pixsize, periodic)
+
+
+def interpolate_derived_fields(box, arr, points, kernel, fields, periodic=False, threads=None, max_live_fields=None):
+    r"""Interpolates several fields derived from one Fourier-space map, at a specified set of points.
+
+    Each derived field is specified by a pair ``(kfilter, spin)``, and is defined by multiplying
+    the Fourier-space map ``arr`` by ``kfilter``, then calling ``fft_c2r(..., spin)``. Equivalent to::
+
+        np.array([ interpolate_points(box, (arr if (kfilter is None) else (arr*kfilter)),
+                                      points, kernel, fft=True, spin=spin, periodic=periodic)
+                   for (kfilter, spin) in fields ])
+
+    (if each ``kfilter`` is None or an array; callable ``kfilter`` arguments are described below.)
+
+    but faster, since the FFT workspaces are allocated once and shared between fields (and the
+    spin-0 FFTs are done in place), and the interpolation is done in one pass over the points
+    (see :func:`~kszx.interpolate_points_multi()`).
+
+    Memory usage (in addition to ``arr`` and the return value) is one real-space map per field,
+    plus up to three FFT buffers (a Fourier-space workspace, a Fourier-space buffer for filtered
+    maps, and a real-space buffer for spin > 0). If this is too large, then the ``max_live_fields``
+    argument can be used to process fields in groups, with one pass over the points per group.
+
+    Function args:
+
+        - ``box`` (kszx.Box): defines pixel size, bounding box size, and location of observer.
+          See :class:`~kszx.Box` for more info.
+
+        - ``arr`` (numpy array): Fourier-space map (not modified).
+
+        - ``points`` (numpy array): shape (npoints, 3) array, in "observer coordinates".
+          (Same meaning as in :func:`~kszx.interpolate_points()`.)
+
+        - ``kernel`` (string): either ``'cic'`` or ``'cubic'``.
+
+        - ``fields`` (list): list of ``(kfilter, spin)`` pairs, where ``spin`` is an integer, and
+          ``kfilter`` is one of the following:
+
+            - None (no filter).
+            - A real-valued array with shape ``box.fourier_space_shape``, e.g. precomputed with
+              ``f(box.get_k())`` if the same fields are evaluated many times (but note that each
+              such array is as large as a real-space map).
+            - A function $f(k)$, where $k=|k|$ is scalar wavenumber. The field is defined by
+              ``multiply_kfunc(box, arr, f, dc=0)``, i.e. ``f()`` is not evaluated at k=0. The array
+              $f(k)$ is evaluated when the field is computed, and is not kept afterwards.
+
+        - ``periodic`` (boolean): if True, then the box has periodic boundary conditions.
+
+        - ``threads`` (integer or None): number of threads used for FFTs.
+          If ``threads=None``, then number of threads defaults to :func:`~kszx.utils.get_nthreads()`.
+
+        - ``max_live_fields`` (integer or None): maximum number of real-space maps which are
+          in memory at the same time. If None, then all fields are processed in one group.
+          (If ``max_live_fields=1``, then the real-space buffer for spin > 0 is not needed.)
+
+    Return value:
+
+        - 2-d numpy array with shape ``(nfields, npoints)``.
+    """
+
+    if not isinstance(box, Box):
+        raise RuntimeError(f"kszx.interpolate_derived_fields(): expected 'box' arg to be kszx.Box object, got {box = }")
+    if box.ndim != 3:
+        raise RuntimeError('kszx.interpolate_derived_fields(): currently only ndim==3 is supported')
+    if not box.is_fourier_space_map(arr):
+        raise RuntimeError("kszx.interpolate_derived_fields(): expected 'arr' to be a Fourier-space map")
+
+    fields = [ (kfilter, int(spin)) for (kfilter, spin) in fields ]
+    points = utils.asarray(points, 'kszx.interpolate_derived_fields()', 'points', dtype=float)
+
+    for (kfilter, spin) in fields:
+        if (kfilter is None) or callable(kfilter):
+            pass
+        elif (np.shape(kfilter) != box.fourier_space_shape) or (np.asarray(kfilter).dtype != float):
+            raise RuntimeError("kszx.interpolate_derived_fields(): expected each 'kfilter' to be None, a function,"
+                               + f" or a real-valued array with shape {box.fourier_space_shape}")
+        if spin < 0:
+            raise RuntimeError(f"kszx.interpolate_derived_fields(): expected spin >= 0, got {spin=}")
+
+    if threads is None:
+        threads = utils.get_nthreads()
+
+    if max_live_fields is None:
+        max_live_fields = max(len(fields), 1)
+    if max_live_fields < 1:
+        raise RuntimeError(f"kszx.interpolate_derived_fields(): expected max_live_fields >= 1, got {max_live_fields=}")
+
+    # Odd last dimension: in-place FFT is not available (see _fft_workspace()).
+    nz = box.npix[2]
+    inplace = (nz % 2) == 0
+    ws = np.empty(box.fourier_space_shape, dtype=complex) if inplace else None
+    ws_real = ws.view(float)[:,:,:nz] if inplace else None
+    fbuf = rbuf = None
+    
+    ret = np.empty((len(fields), points.shape[0]), dtype=float)
+
+    # Fields are processed in groups of at most 'max_live_fields' (see docstring).
+    for i in range(0, len(fields), max_live_fields):
+        group = fields[i:(i+max_live_fields)]
+        rmaps = np.empty(box.real_space_shape + (len(group),), dtype=float)
+        rmaps = np.moveaxis(rmaps, -1, 0)   # memory layout for interpolate_points_multi(), see docstring
+        
+        for j, (kfilter, spin) in enumerate(group):
+            if not inplace:
+                src = _apply_kfilter(box, arr, kfilter)
+                rmaps[j] = fft_c2r(box, src, spin=spin, threads=threads)
+                del src
+            elif spin == 0:
+                _apply_kfilter(box, arr, kfilter, out=ws)
+                _irfft_inplace(ws, nz, threads)
+                np.multiply(ws_real, 1.0 / box.pixel_volume, out=rmaps[j])   # see Fourier conventions in fft_c2r() docstring
+            else:
+                if kfilter is None:
+                    src = arr
+                else:
+                    fbuf = np.empty(box.fourier_space_shape, dtype=complex) if (fbuf is None) else fbuf
+                    src = _apply_kfilter(box, arr, kfilter, out=fbuf)
+                if len(group) == 1:
+                    _fft_c2r_fused(box, src, spin, rmaps[j], ws, threads)   # rmaps[j] is contiguous
+                else:
+                    # Note: the spin-l FFT makes (2l+1) passes over its output, so it's faster to write
+                    # to a contiguous buffer, then copy to the (non-contiguous) rmaps[j] in one pass.
+                    rbuf = np.empty(box.real_space_shape, dtype=float) if (rbuf is None) else rbuf
+                    _fft_c2r_fused(box, src, spin, rbuf, ws, threads)
+                    rmaps[j] = rbuf
+
+        ret[i:(i+len(group))] = interpolate_points_multi(box, rmaps, points, kernel, periodic=periodic)
+        del rmaps
+
+    return ret
+
+
+def _apply_kfilter(box, arr, kfilter, out=None):
+    """Helper for interpolate_derived_fields(). Returns arr * kfilter, where kfilter is None, an array, or a function f(k)."""
+    
+    if (kfilter is None) and (out is None):
+        return arr
+    if kfilter is None:
+        out[:] = arr
+        return out
+    if callable(kfilter):
+        kfilter = _eval_kfunc(box, kfilter, dc=0)
+    return np.multiply(arr, kfilter, out=out)
+
+
 def _check_weights(box, points, weights, prefix=''):
     """Helper for grid_points(), used to parse (points,weights) and (rpoints,rweights) args."""
 
@@ -284,7 +675,7 @@ def _check_weights(box, points, weights, prefix=''):
     return weights
 
 
-def grid_points(box, points, weights=None, rpoints=None, rweights=None, kernel=None, fft=False, spin=0, periodic=False, compensate=False, wscal=1.0):
+def grid_points(box, points, weights=None, rpoints=None, rweights=None, kernel=None, fft=False, spin=0, periodic=False, compensate=False, wscal=1.0, threads=None):
     r"""Returns a map representing a sum of delta functions (or a "galaxies - randoms" difference map).
 
     Function args:
@@ -327,6 +718,9 @@ def grid_points(box, points, weights=None, rpoints=None, rweights=None, kernel=N
         - ``periodic`` (boolean): if True, then the box has periodic boundary conditions.
 
         - ``wscal`` (float, default 1.0): overall scaling applied to weights.
+
+        - ``threads`` (integer or None): number of parallel threads used (for both gridding and FFT).
+          If ``threads=None``, then number of threads defaults to :func:`~kszx.utils.get_nthreads()`.
     
     Return value: 
 
@@ -361,6 +755,9 @@ def grid_points(box, points, weights=None, rpoints=None, rweights=None, kernel=N
 
        - After calling ``grid_points()``, you may want to call :func:`~kszx.apply_kernel_compensation()`
          to mitigate high-$k$ biases. See :func:`~kszx.apply_kernel_compensation()` docstring for more info.
+
+       - With ``threads > 1``, the output is deterministic, but differs from the single-threaded
+         output at the level of floating-point roundoff (since the summation order is different).
     """
 
     if not isinstance(box, Box):
@@ -382,6 +779,9 @@ def grid_points(box, points, weights=None, rpoints=None, rweights=None, kernel=N
     rpoints = utils.asarray(rpoints, 'kszx.grid_points()', 'rpoints', dtype=float, allow_none=True)
     rweights = utils.asarray(rweights, 'kszx.grid_points()', 'rweights', dtype=float, allow_none=True)
     kernel = kernel.lower()
+
+    if threads is None:
+        threads = utils.get_nthreads()
     
     if kernel == 'cic':
         cpp_kernel = cpp_kernels.cic_grid_3d
@@ -392,7 +792,7 @@ def grid_points(box, points, weights=None, rpoints=None, rweights=None, kernel=N
         
     grid = np.zeros(box.real_space_shape, dtype=float)
     weights = _check_weights(box, points, weights)  # also checks 'points' arg
-    cpp_kernel(grid, points, weights, wscal, box.lpos[0], box.lpos[1], box.lpos[2], box.pixsize, periodic)
+    cpp_kernel(grid, points, weights, wscal, box.lpos[0], box.lpos[1], box.lpos[2], box.pixsize, periodic, threads)
 
     if rpoints is not None:
         rweights = _check_weights(box, rpoints, rweights, prefix='r')  # also checks 'rpoints' arg
@@ -401,16 +801,102 @@ def grid_points(box, points, weights=None, rpoints=None, rweights=None, kernel=N
         
         assert rweight_sum > 0
         rwscal = -weight_sum / rweight_sum
-        cpp_kernel(grid, rpoints, rweights, rwscal, box.lpos[0], box.lpos[1], box.lpos[2], box.pixsize, periodic)
+        cpp_kernel(grid, rpoints, rweights, rwscal, box.lpos[0], box.lpos[1], box.lpos[2], box.pixsize, periodic, threads)
 
     if fft:
-        grid = fft_r2c(box, grid, spin=spin)
+        grid = fft_r2c(box, grid, spin=spin, threads=threads)
     if compensate:
         apply_kernel_compensation(box, grid, kernel)
         
     return grid
 
 
+def grid_points_multi(box, points, weights, kernel=None, fft=False, spin=0, periodic=False, compensate=False, wscal=1.0, threads=None):
+    r"""Grids several weight vectors over the same set of points, and returns one map per weight vector.
+
+    Equivalent to calling :func:`~kszx.grid_points()` once for each row of ``weights``. The
+    gridding stencil (pixel indices and kernel weights) for each point is computed once, and
+    reused for all rows. (Note that gridding is usually limited by memory bandwidth rather than
+    stencil computation, so this is not much faster than separate calls to ``grid_points()``.)
+
+    Function args:
+
+        - ``box`` (kszx.Box): defines pixel size, bounding box size, and location of observer.
+          See :class:`~kszx.Box` for more info.
+
+        - ``points`` (2-d array): sequence of points, with shape (npoints, d).
+          (Same meaning as in :func:`~kszx.grid_points()`.)
+
+        - ``weights`` (2-d array): shape (nfields, npoints) array, where ``weights[f,:]``
+          are the weights for the f-th output map.
+
+        - ``kernel``, ``fft``, ``spin``, ``periodic``, ``compensate``, ``wscal``, ``threads``:
+          same meaning as in :func:`~kszx.grid_points()` (and apply to all output maps).
+
+    Return value: 
+
+      - A numpy array with shape ``(nfields,) + box.real_space_shape`` (if ``fft=False``),
+        or shape ``(nfields,) + box.fourier_space_shape`` (if ``fft=True``).
+
+        Note that iterating over the returned array gives a sequence of maps, so the return
+        value can be passed directly to :func:`~kszx.estimate_power_spectrum()`.
+
+    Notes:
+
+       - Unlike :func:`~kszx.grid_points()`, there are no ``rpoints``/``rweights`` args.
+
+       - Memory usage is one real-space map per field, so if the number of fields is large,
+         it may make sense to call ``grid_points_multi()`` several times, on subsets of fields.
+    """
+
+    if not isinstance(box, Box):
+        raise RuntimeError("kszx.grid_points_multi(): expected 'box' arg to be kszx.Box object, got {box = }")
+    if kernel is None:
+        raise RuntimeError("kszx.grid_points_multi(): 'kernel' arg must be specified")
+    if box.ndim != 3:
+        raise RuntimeError('kszx.grid_points_multi(): currently only ndim==3 is supported')
+    if (spin != 0) and (not fft):
+        raise RuntimeError("kszx.grid_points_multi(): 'spin' argument was specified with fft=False")
+    if compensate and (not fft):
+        raise RuntimeError("kszx.grid_points_multi(): 'compensate' argument was specified with fft=False")
+
+    wscal = float(wscal)
+    points = utils.asarray(points, 'kszx.grid_points_multi()', 'points', dtype=float)
+    weights = utils.asarray(weights, 'kszx.grid_points_multi()', 'weights', dtype=float)
+    kernel = kernel.lower()
+
+    if (points.ndim != 2) or (points.shape[1] != box.ndim):
+        raise RuntimeError(f"kszx.grid_points_multi(): expected points.shape=(N,{box.ndim}), got shape {points.shape}")
+    if (weights.ndim != 2) or (weights.shape[1] != points.shape[0]):
+        raise RuntimeError(f"kszx.grid_points_multi(): weights array has shape {weights.shape}; expected shape (nfields,{points.shape[0]})")
+
+    if threads is None:
+        threads = utils.get_nthreads()
+    
+    if kernel == 'cic':
+        cpp_kernel = cpp_kernels.cic_grid_3d_multi
+    elif kernel == 'cubic':
+        cpp_kernel = cpp_kernels.cubic_grid_3d_multi
+    else:
+        raise RuntimeError(f'kszx.grid_points_multi(): {kernel=} is not supported')
+
+    nfields = weights.shape[0]
+    grids = np.zeros((nfields,) + box.real_space_shape, dtype=float)
+    cpp_kernel(grids, points, weights, wscal, box.lpos[0], box.lpos[1], box.lpos[2], box.pixsize, periodic, threads)
+
+    if not fft:
+        return grids
+
+    ret = np.empty((nfields,) + box.fourier_space_shape, dtype=complex)
+    
+    for f in range(nfields):
+        ret[f] = fft_r2c(box, grids[f], spin=spin, threads=threads)
+        if compensate:
+            apply_kernel_compensation(box, ret[f], kernel)
+
+    return ret
+
+
 def apply_kernel_compensation(box, arr, kernel, exponent=-0.5):
     r"""Modifies Fourier-space map 'arr' in-place, to debias interpolation/gridding.
 
@@ -470,6 +956,23 @@ def apply_kernel_compensation(box, arr, kernel, exponent=-0.5):
     \end{align}$$
     """
 
+    assert isinstance(box, Box)
+    assert box.is_fourier_space_map(arr)  # check shape and type of input array
+
+    factors = _kernel_compensation_factors(box, kernel, exponent)
+
+    # If the full N-dimensional compensation array fits in the Box cache, then we multiply
+    # by the cached array (one pass over 'arr'). Otherwise, we multiply by one factor per axis.
+    if box.cache_fits(8 * np.prod(box.fourier_space_shape)):
+        arr *= box.get_cached(('compensation', kernel, exponent), lambda: functools.reduce(np.multiply, factors))
+    else:
+        for factor in factors:
+            arr *= factor
+
+
+def _kernel_compensation_factors(box, kernel, exponent):
+    """Helper for apply_kernel_compensation(). Returns list of ndim arrays, whose (broadcasted) product is C(k)**exponent."""
+    
     # See tex notes. The variable 's' is sin(k*L/2)
     if kernel == 'cic':
         f = lambda s: 1 - (2./3.)*s*s
@@ -478,15 +981,14 @@ def apply_kernel_compensation(box, arr, kernel, exponent=-0.5):
     else:
         raise RuntimeError(f'kszx.gridding_pk_multiplier(): {kernel=} is not supported')
 
-    assert isinstance(box, Box)
-    assert box.is_fourier_space_map(arr)  # check shape and type of input array
-
-    # FIXME could be optimized
+    factors = [ ]
     for d in range(box.ndim):
         nr = box.real_space_shape[d]
         nf = box.fourier_space_shape[d]
         s = np.sin(np.pi * np.arange(nf,dtype=float)/nr)
-        arr *= np.reshape(f(s)**exponent, (1,)*d + (nf,) + (1,)*(box.ndim-d-1))
+        factors += [ np.reshape(f(s)**exponent, (1,)*d + (nf,) + (1,)*(box.ndim-d-1)) ]
+
+    return factors
 
 
 ####################################################################################################
@@ -514,13 +1016,16 @@ def _multiply(src, x, dest, in_place):
         return src * x
 
 
-def _eval_kfunc(box, f, dc=None):
-    """Helper for multiply_kfunc(), kbin_average()."""
+def _eval_kfunc(box, f, dc=None, cache=False):
+    """Helper for multiply_kfunc(), kbin_average(). If cache=True, then the (read-only) result is cached in the Box."""
 
     assert callable(f)
     assert isinstance(box, Box)
 
-    k = box.get_k(regulate = (dc is not None))
+    if cache:
+        return box.get_cached(('kfunc', f, dc), lambda: _eval_kfunc(box, f, dc))
+    
+    k = _writeable_k(box, regulate = (dc is not None))
     fk = f(k)
 
     if fk.shape != box.fourier_space_shape:
@@ -534,6 +1039,18 @@ def _eval_kfunc(box, f, dc=None):
     return fk
 
 
+def _writeable_k(box, regulate):
+    """Helper for _eval_kfunc(), _sqrt_pk(). Returns a |k| array which the caller owns.
+
+    User-supplied functions f(k) may modify their argument in place, so we don't pass them a (read-only)
+    array from the Box cache. If |k| is cached, then we return a copy (which is faster than recomputing |k|).
+    """
+
+    if box.cache_fits(8 * np.prod(box.fourier_space_shape)):
+        return np.copy(box.get_k(regulate=regulate, cached=True))
+    return box.get_k(regulate=regulate)
+
+
 def multiply_rfunc(box, arr, f, dest=None, in_place=False, regulate=False, eps=1.0e-6):
     r"""Multiply real-space map 'arr' by a function f(r), where r is scalar radial coordinate.
 
@@ -587,7 +1104,7 @@ def multiply_rfunc(box, arr, f, dest=None, in_place=False, regulate=False, eps=1
     return _multiply(arr, fr, dest, in_place)
     
     
-def multiply_kfunc(box, arr, f, dest=None, in_place=False, dc=None):
+def multiply_kfunc(box, arr, f, dest=None, in_place=False, dc=None, cache=False):
     r"""Multiply Fourier-space map 'arr' by a real-valued function f(k), where k=|k| is scalar wavenumber.
     
     Function args:
@@ -608,6 +1125,11 @@ def multiply_kfunc(box, arr, f, dest=None, in_place=False, dc=None):
           $\lim_{k\rightarrow 0} f(k) = \infty$. If ``dc`` is specified, then ``f()``
           is not evaluated at k=0, and the value of ``dc`` is used instead of ``f(0)``.
 
+        - ``cache`` (boolean): if True, then the array $f(k)$ is cached in the Box (see "Cached
+          Fourier-space arrays" in the :class:`~kszx.Box` docstring), so that ``f()`` is only
+          evaluated once if ``multiply_kfunc()`` is called repeatedly with the same ``f`` object.
+          (Not useful if ``f`` is a lambda-function which is redefined on every call!)
+
 
     Return value:
 
@@ -635,7 +1157,7 @@ def multiply_kfunc(box, arr, f, dest=None, in_place=False, dc=None):
     assert isinstance(box, Box)
     assert box.is_fourier_space_map(arr)   # check shape, dtype
 
-    fk = _eval_kfunc(box, f, dc=dc)
+    fk = _eval_kfunc(box, f, dc=dc, cache=cache)
     return _multiply(arr, fk, dest, in_place)
 
 
@@ -764,11 +1286,14 @@ def _to_float(x, errmsg):
         raise RuntimeError(errmsg)
 
 
-def _sqrt_pk(box, pk, regulate):
-    """Helper for simulate_gaussian_field()."""
+def _sqrt_pk(box, pk, regulate, cache=False):
+    """Helper for simulate_gaussian_field(). If cache=True, then the (read-only) result is cached in the Box."""
 
+    if callable(pk) and cache:
+        return box.get_cached(('sqrt_pk', pk, regulate), lambda: _sqrt_pk(box, pk, regulate))
+        
     if callable(pk):
-        k = box.get_k(regulate=regulate)
+        k = _writeable_k(box, regulate)
         pk = pk(k)
         
         if pk.shape != box.fourier_space_shape:
@@ -790,7 +1315,7 @@ def _sqrt_pk(box, pk, regulate):
     return np.sqrt(pk)
 
     
-def simulate_white_noise(box, *, fourier):
+def simulate_white_noise(box, *, fourier, rng=None, method='fourier', threads=None):
     r"""Simulate white noise, in either real space or Fourier space, normalized to $P(k)=1$.
 
     Intended as a helper for ``simulate_gaussian_field()``, but may be useful on its own.
@@ -801,6 +1326,17 @@ def simulate_white_noise(box, *, fourier):
           See :class:`~kszx.Box` for more info.
 
         - ``fourier`` (boolean): determines whether output is real-space or Fourier-space.
+
+        - ``rng`` (np.random.Generator or None): random number generator. If None, then numpy's
+          global RNG is used (e.g. as seeded by ``np.random.seed()``).
+
+        - ``method`` (string): only used if ``fourier=True``. If ``'fourier'`` (the default), then
+          Fourier-space noise is simulated directly. If ``'fft'``, then real-space noise is simulated,
+          and Fourier transformed with :func:`~kszx.fft_r2c()`. (The two methods produce the same
+          statistics, but the ``'fft'`` method is slower, unless an FFT is needed anyway.)
+
+        - ``threads`` (integer or None): number of threads used to generate random numbers.
+          If None, then ``utils.get_nthreads()`` is used. The output does not depend on ``threads``.
     
     Return value: 
 
@@ -820,18 +1356,23 @@ def simulate_white_noise(box, *, fourier):
     $$\langle f(x) f(x') \rangle = V_{\rm pix}^{-1} \delta_{xx'}$$
     """
 
-    if not fourier:
+    if method not in ['fourier', 'fft']:
+        raise RuntimeError(f"kszx.simulate_white_noise(): got {method=}, expected 'fourier' or 'fft'")
+    
+    if (not fourier) or (method == 'fft'):
         rms = 1.0 / np.sqrt(box.pixel_volume)
-        return np.random.normal(size=box.real_space_shape, scale=rms)
+        ret = np.empty(box.real_space_shape, dtype=float)
+        _fill_normal(ret, rms, rng, threads)
+        return fft_r2c(box, ret, threads=threads) if fourier else ret
         
-    # Simulate white noise in Fourier space.
+    # Simulate white noise in Fourier space (real and imaginary parts are filled together, in place).
     nd = box.ndim
     rms = np.sqrt(0.5 * box.box_volume)
-    ret = np.zeros(box.fourier_space_shape, dtype=complex)        
-    ret.real = np.random.normal(size=box.fourier_space_shape, scale=rms)
-    ret.imag = np.random.normal(size=box.fourier_space_shape, scale=rms)
+    ret = np.empty(box.fourier_space_shape, dtype=complex)
+    _fill_normal(ret.view(float), rms, rng, threads)
 
     # The rest of this function imposes the reality condition f(-k) = f(k)^*.
+    # This only involves modes where k_{nd-1} is self-conjugate, i.e. one or two planes.
     
     # t = modes where k_{nd-1} is self-conjugate
     n = box.npix[nd-1]
@@ -856,7 +1397,39 @@ def simulate_white_noise(box, *, fourier):
     return ret
 
 
-def simulate_gaussian_field(box, pk, pk0=None):
+def _fill_normal(arr, scale, rng, threads, chunk_size=2**18):
+    """Helper for simulate_white_noise(): fills contiguous float64 array 'arr' with Gaussian random numbers (in place).
+
+    The array is divided into fixed-size chunks, and chunk i is filled from a PCG64 stream which is
+    jumped i times from a common seed (drawn from 'rng'). Chunks are filled in parallel by a thread
+    pool (numpy Generators release the GIL), and the output does not depend on the number of threads.
+    """
+
+    assert arr.dtype == float
+    assert arr.flags.c_contiguous
+
+    flat = arr.reshape((-1,))
+    nchunks = (flat.size + chunk_size - 1) // chunk_size
+    threads = utils.get_nthreads() if (threads is None) else threads
+    
+    seed = int.from_bytes(utils._get_rng(rng).bytes(16), 'little')
+    base = np.random.PCG64(seed)
+    
+    def fill(i):
+        chunk = flat[i*chunk_size : (i+1)*chunk_size]
+        np.random.Generator(base.jumped(i)).standard_normal(out=chunk)
+        chunk *= scale
+
+    if (threads <= 1) or (nchunks <= 1):
+        for i in range(nchunks):
+            fill(i)
+    else:
+        with concurrent.futures.ThreadPoolExecutor(min(threads, nchunks)) as pool:
+            for _ in pool.map(fill, range(nchunks)):
+                pass
+
+
+def simulate_gaussian_field(box, pk, pk0=None, rng=None, cache=False):
     r"""Simulates a Gaussian field (in Fourier space) with specified power spectrum P(k).
 
     Function args:
@@ -870,6 +1443,14 @@ def simulate_gaussian_field(box, pk, pk0=None):
         - ``pk0`` (scalar or None): This optional argument is intended to regulate cases
           where $\lim_{k\rightarrow 0} P(k) = \infty$. If ``pk0`` is specified, then ``pk()`` is
           not evaluated at k=0, and the value of ``pk0`` is used instead of ``Pk(0)``.
+
+        - ``rng`` (np.random.Generator or None): random number generator. If None, then numpy's
+          global RNG is used (e.g. as seeded by ``np.random.seed()``).
+
+        - ``cache`` (boolean): if True, then $\sqrt{P(k)}$ is cached in the Box (see "Cached
+          Fourier-space arrays" in the :class:`~kszx.Box` docstring), so that ``pk()`` is only
+          evaluated once if ``simulate_gaussian_field()`` is called repeatedly with the same
+          ``pk`` object (e.g. a bound method such as ``cosmo.Plin_z0``).
     
     Return value: 
 
@@ -901,8 +1482,8 @@ def simulate_gaussian_field(box, pk, pk0=None):
 
     assert isinstance(box, Box)
 
-    sqrt_pk = _sqrt_pk(box, pk, regulate = (pk0 is not None))
-    ret = simulate_white_noise(box, fourier=True)
+    sqrt_pk = _sqrt_pk(box, pk, regulate = (pk0 is not None), cache = cache)
+    ret = simulate_white_noise(box, fourier=True, rng=rng)
 
     dc = ret[(0,)*box.ndim]   # must precede multiplying by sqrt_pk
     ret *= sqrt_pk
@@ -957,7 +1538,7 @@ def _parse_map_or_maps(box, map_or_maps, caller):
                        + " or an iterable returning Fourier-space maps")
     
 
-def estimate_power_spectrum(box, map_or_maps, kbin_edges, *, use_dc=False, allow_empty_bins=False, return_counts=False):
+def estimate_power_spectrum(box, map_or_maps, kbin_edges, *, use_dc=False, allow_empty_bins=False, return_counts=False, threads=None):
     r"""Computes power spectrum $P(k)$ for one or more maps (including cross-spectra). The window function is not deconvolved.
 
     Function args:
@@ -978,6 +1559,8 @@ def estimate_power_spectrum(box, map_or_maps, kbin_edges, *, use_dc=False, allow
         - ``kbin_edges`` (1-d array): 1-d array of length (nkbins+1) defining bin endpoints.
           The i-th bin covers k-range ``kbin_edges[i] <= i < kbin_edges[i+1]``.
 
+          Can also be a list of 1-d arrays, representing multiple binning schemes (see below).
+
         - ``use_dc`` (boolean): if False (the default), then the k=0 mode will not be used,
           even if the lowest bin includes k=0.
 
@@ -986,6 +1569,9 @@ def estimate_power_spectrum(box, map_or_maps, kbin_edges, *, use_dc=False, allow
 
         - ``return_counts`` (boolean): See below.
 
+        - ``threads`` (integer or None): number of parallel threads used.
+          If ``threads=None``, then number of threads defaults to :func:`~kszx.utils.get_nthreads()`.
+
     Return value: 
 
        - An array ``pk`` is returned, with two cases as follows:
@@ -1004,6 +1590,14 @@ def estimate_power_spectrum(box, map_or_maps, kbin_edges, *, use_dc=False, allow
          ``bin_counts`` is a 1-d array with length ``nkbins``, containing the number of Fourier
          modes in each k-bin.
 
+       - If ``kbin_edges`` is a list of 1-d arrays, then the return value is a list (with
+         one element per binning scheme), where each element is the ``pk`` array or the
+         ``(pk, bin_counts)`` pair described above.
+
+         This is faster than calling ``estimate_power_spectrum()`` once per binning scheme,
+         since the maps are only traversed once. (Internally, the union of all bin edges
+         is used as a "fine" binning, and fine bins are summed to obtain each binning.)
+
     Notes:
 
        - Normalization: to estimate the power spectrum, we square each Fourier mode and divide by 
@@ -1028,12 +1622,47 @@ def estimate_power_spectrum(box, map_or_maps, kbin_edges, *, use_dc=False, allow
 
        - Before calling ``estimate_power_spectrum()``, you may want to call :func:`~kszx.apply_kernel_compensation()`
          to mitigate high-$k$ biases. See :func:`~kszx.apply_kernel_compensation()` docstring for more info.
+
+       - With ``threads > 1``, the outermost Fourier-space axis is divided between threads, and
+         per-thread partial sums are added at the end. The output is deterministic, but differs
+         from the single-threaded output at the level of floating-point roundoff.
     """
 
-    kbin_edges = _check_kbin_edges(box, kbin_edges, use_dc)
+    if threads is None:
+        threads = utils.get_nthreads()
+
     map_list, multi_map_flag = _parse_map_or_maps(box, map_or_maps, 'kszx.estimate_power_spectrum')
-    pk, bin_counts = cpp_kernels.estimate_power_spectrum(map_list, kbin_edges, box.npix, box.kfund, box.box_volume)
 
+    if _is_kbin_edges_list(kbin_edges):
+        edges_list = [ _check_kbin_edges(box, e, use_dc) for e in kbin_edges ]
+        fine_edges = np.unique(np.concatenate(edges_list))
+        fine_pk, fine_counts = cpp_kernels.estimate_power_spectrum(map_list, fine_edges, box.npix, box.kfund, box.box_volume, threads, 0)
+        fine_pk *= (fine_counts * box.box_volume)   # undo normalization
+
+        ret = [ ]
+        for e in edges_list:
+            # Bin i of this binning consists of fine bins ix[i] <= j < ix[i+1].
+            ix = np.searchsorted(fine_edges, e)
+            bin_counts = np.add.reduceat(fine_counts[:ix[-1]], ix[:-1])
+            pk = np.add.reduceat(fine_pk[:,:,:ix[-1]], ix[:-1], axis=2)
+            pk *= np.array([ (1.0 / n / box.box_volume) if (n > 0) else 0.0 for n in bin_counts ])
+            ret.append(_finalize_power_spectrum(pk, bin_counts, multi_map_flag, allow_empty_bins, return_counts))
+            
+        return ret
+
+    kbin_edges = _check_kbin_edges(box, kbin_edges, use_dc)
+    pk, bin_counts = cpp_kernels.estimate_power_spectrum(map_list, kbin_edges, box.npix, box.kfund, box.box_volume, threads, 0)
+    return _finalize_power_spectrum(pk, bin_counts, multi_map_flag, allow_empty_bins, return_counts)
+
+
+def _is_kbin_edges_list(kbin_edges):
+    """Helper for estimate_power_spectrum(). Returns True if 'kbin_edges' is a list of 1-d arrays (multiple binnings)."""
+    return isinstance(kbin_edges, (list,tuple)) and (len(kbin_edges) > 0) and all(np.ndim(e) == 1 for e in kbin_edges)
+
+
+def _finalize_power_spectrum(pk, bin_counts, multi_map_flag, allow_empty_bins, return_counts):
+    """Helper for estimate_power_spectrum(). Returns 'pk' or '(pk, bin_counts)'."""
+    
     if (not allow_empty_bins) and (np.min(bin_counts) == 0):
         raise RuntimeError('kszx.estimate_power_spectrum(): some k-bins were empty')
     
@@ -1,5 +1,6 @@
 from . import test_box
 from . import test_fft
+from . import test_kszpipe
 from . import test_lss
 from . import test_utils
 
@@ -8,11 +9,21 @@ def run_all_tests():
     test_box.test_k_component()
     test_box.test_r_component()
     test_box.test_smallest_r()
+    test_box.test_box_cache()
     
     test_lss.test_interpolation()
     test_lss.test_interpolation_gridding_consistency()
+    test_lss.test_threaded_gridding()
+    test_lss.test_grid_points_multi()
+    test_lss.test_interpolate_points_multi()
+    test_lss.test_point_stencil()
+    test_lss.test_interpolate_derived_fields()
     test_lss.test_simulate_gaussian()
     test_lss.test_estimate_power_spectrum()
+    test_lss.test_threaded_estimate_power_spectrum()
+    test_lss.test_pse_kernels()
+    test_lss.test_multi_binning_power_spectrum()
+    test_lss.test_power_spectrum_accumulator()
     test_lss.test_kbin_average()
 
     test_fft.test_xli()
@@ -21,8 +32,25 @@ def run_all_tests():
     test_fft.test_fft_inverses()
     test_fft.test_fft_transposes()
     test_fft.test_spin_12_ffts()
+    test_fft.test_fft_workspace()
 
     test_utils.test_contract_axis()
+    test_utils.test_spatial_sort_indices()
+    test_utils.test_shared_array_dir()
+    test_utils.test_surrogate_store()
+    test_utils.test_surrogate_store_claims()
+
+    test_kszpipe.test_kszpipe_outdir_model()
+    test_kszpipe.test_log_likelihood_batch()
+    test_kszpipe.test_likelihood_evaluator()
+    test_kszpipe.test_likelihood_grad()
+    test_kszpipe.test_fixed_cov_chi2()
+    test_kszpipe.test_kszpipe_estimate_memory()
+    test_kszpipe.test_kszpipe_dry_run()
+    test_kszpipe.test_kszpipe_share_inputs()
+    test_kszpipe.test_kszpipe_run_pool()
+    test_kszpipe.test_kszpipe_delta_kfilter()
+    test_kszpipe.test_kszpipe_run_distributed()
 
     #test_lss.monte_carlo_simulate_gaussian([4,6,1], 10.0)
     #test_lss.monte_carlo_simulate_gaussian([5,4,6], 10.0)
@@ -1,5 +1,7 @@
 from .. import Box
 
+import os
+import yaml
 import numpy as np
 
     
@@ -117,3 +119,74 @@ def map_dot_product(box, arr1, arr2, normalize=True):
         t = np.vdot(arr1, arr2)
     
     return t.real / box.box_volume
+
+
+def make_kszpipe_outdir(dirname, nsurr, sim_surr_fg, cmb_fields=['90','150'], spin_gal=[0], spin_vr=[0,1], nkbins=[6,4]):
+    """Writes a small KszPipe output directory with random data/surrogate power spectra (see KszPipe._write_output_params())."""
+
+    data_fields = [ f'gal-{s}' for s in spin_gal ] + [ f'{freq}-{s}' for s in spin_vr for freq in cmb_fields ]
+    suff_vel_list = ['null', 'bv', 'bfg'] if sim_surr_fg else ['null', 'bv']
+    surr_fields = [ f'gal-{s}-{suff}' for s in spin_gal for suff in ['null','b1','f','fnl'] ]
+    surr_fields += [ f'{freq}-{s}-{suff}' for s in spin_vr for freq in cmb_fields for suff in suff_vel_list ]
+
+    params = { 'kmin': [0.0] * len(nkbins),
+               'kmax': [ 0.01 * (n+0.5) for n in nkbins ],
+               'kstep': [0.01] * len(nkbins),
+               'nsurr': nsurr,
+               'cmb_fields': list(cmb_fields),
+               'estimate_spin_gal': list(spin_gal),
+               'estimate_spin_vr': list(spin_vr),
+               'simulate_surrogate_foregrounds': sim_surr_fg,
+               'data_fields': { f:i for i,f in enumerate(data_fields) },
+               'surrogate_fields': { f:i for i,f in enumerate(surr_fields) } }
+
+    os.makedirs(dirname, exist_ok=True)
+    with open(f'{dirname}/params.yml', 'w') as f:
+        yaml.safe_dump(params, f)
+
+    D, A = len(data_fields), len(surr_fields)
+    for i, nk in enumerate(nkbins):
+        np.save(f'{dirname}/pk_data_binning{i}.npy', np.random.normal(size=(D,D,nk)))
+        np.save(f'{dirname}/pk_surrogates_binning{i}.npy', np.random.normal(size=(A,A,nk)) + np.random.normal(size=(nsurr,A,A,nk)))
+
+
+def make_kszpipe_input_dir(dirname, ngal, nrand, npix, nsurr=1):
+    """Writes a small KszPipe input directory with random catalogs (see docs/source/kszpipe.rst), and a box with shape (npix,npix,npix)."""
+
+    from .. import Catalog, io_utils
+    
+    def make_catalog(n, zcols):
+        # 0.2 < z < 0.25 is a shell with 830 < r < 1030 (Mpc), which fits in the box below.
+        cols = { 'ra_deg': np.random.uniform(0, 20, n),
+                 'dec_deg': np.random.uniform(-10, 10, n) }
+        z = np.random.uniform(0.2, 0.25, n)
+        for col in zcols:
+            cols[col] = z
+        for col in ['bv_90', 'bv_150', 'tcmb_90', 'tcmb_150']:
+            cols[col] = np.random.uniform(0.5, 1.0, n)
+        return Catalog(cols)
+
+    params = { 'version': 2,
+               'cmb_fields': ['90', '150'],
+               'estimate_spin_gal': [0],
+               'estimate_spin_vr': [0, 1],
+               'nsurr': nsurr,
+               'seed': 1,
+               'surr_bg': 2.0,
+               'simulate_surrogate_foregrounds': False,
+               'nzbins_gal': 5,
+               'nzbins_vr': 5,
+               'zeff': 0.22,
+               'kmin': [0.02],
+               'kmax': [0.2],
+               'kstep': [0.04] }
+    
+    os.makedirs(dirname, exist_ok=True)
+    with open(f'{dirname}/params.yml', 'w') as f:
+        yaml.safe_dump(params, f)
+    
+    make_catalog(ngal, ['z']).write_h5(f'{dirname}/galaxies.h5')
+    make_catalog(nrand, ['zobs', 'ztrue']).write_h5(f'{dirname}/randoms.h5')
+
+    box = Box((npix,npix,npix), pixsize=400.0/npix, cpos=[900.0, 175.0, 0.0])
+    io_utils.write_pickle(f'{dirname}/bounding_box.pkl', box)
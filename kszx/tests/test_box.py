@@ -54,3 +54,52 @@ def test_smallest_r():
         
     print(f'test_smallest_r(): pass')
 
+
+
+def test_box_cache():
+    print(f'test_box_cache(): start')
+
+    from .. import core
+    
+    for iouter in range(20):
+        box = helpers.random_box()
+        nbytes = 8 * np.prod(box.fourier_space_shape)
+
+        # Caching is opt-in.
+        assert box.cache_limit == 0
+        assert box.get_k(cached=True) is not box.get_k(cached=True)
+        assert box.cache_nbytes == 0
+        box.set_cache_limit(10 * nbytes)
+        
+        # Cached arrays agree with uncached arrays, and are read-only.
+        k = box.get_k(cached=True)
+        assert np.array_equal(k, box.get_k()) and not k.flags.writeable
+        assert box.get_k(cached=True) is k
+
+        # User-supplied k-functions get a writeable copy of |k|, and may modify it in place.
+        arr = core.simulate_white_noise(box, fourier=True)
+        arr2 = arr * (2.0 * k)
+        arr2[(0,)*box.ndim] = 0
+        arr = core.multiply_kfunc(box, arr, lambda k: np.multiply(k, 2.0, out=k), dc=0)
+        assert np.max(np.abs(arr-arr2)) <= 1.0e-12 * np.max(np.abs(arr2))
+        assert np.array_equal(k, box.get_k())
+
+        arr = core.simulate_white_noise(box, fourier=True)
+        arr2 = np.copy(arr)
+        core.apply_kernel_compensation(box, arr, 'cubic')   # uses cached compensation array
+        box.set_cache_limit(0)
+        core.apply_kernel_compensation(box, arr2, 'cubic')  # uses per-axis factors
+        assert box.cache_nbytes == 0
+        assert np.max(np.abs(arr-arr2)) <= 1.0e-12 * np.max(np.abs(arr))
+
+        # LRU eviction: the cache holds at most 2 arrays.
+        box.set_cache_limit(2 * nbytes)
+        k1 = box.get_k(exponent=1, cached=True)
+        k2 = box.get_k(exponent=2, cached=True)
+        assert box.get_k(exponent=1, cached=True) is k1   # k1 is now most recently used
+        box.get_k(exponent=3, cached=True)                 # evicts k2
+        assert box.cache_nbytes == 2 * nbytes
+        assert box.get_k(exponent=1, cached=True) is k1
+        assert box.get_k(exponent=2, cached=True) is not k2
+        
+    print(f'test_box_cache(): pass')
@@ -276,3 +276,31 @@ def test_spin_12_ffts():
         assert eps < 1.0e-12
         
     print('test_spin_12_ffts(): pass')
+
+
+def test_fft_workspace():
+    """Checks that spin-l FFTs give the same result with a caller-supplied (reused) workspace."""
+    
+    print('test_fft_workspace(): start')
+
+    for _ in range(20):
+        box = helpers.random_box(ndim=3, nmin=3, avoid_small_r=True)
+        ws = np.zeros(box.fourier_space_shape, dtype=complex)
+        
+        for spin in [1, 2, 3]:
+            src = core.simulate_white_noise(box, fourier=False)
+            assert np.array_equal(core.fft_r2c(box, src, spin=spin, workspace=ws), core.fft_r2c(box, src, spin=spin))
+            
+            src = core.simulate_white_noise(box, fourier=True)
+            assert np.array_equal(core.fft_c2r(box, src, spin=spin, workspace=ws), core.fft_c2r(box, src, spin=spin))
+
+        # A workspace which aliases the input array is rejected (rather than silently overwriting the input).
+        if box.npix[2] % 2 == 0:
+            src = core.simulate_white_noise(box, fourier=True)
+            try:
+                core.fft_c2r(box, src, spin=1, workspace=src)
+                assert False, 'expected fft_c2r() to reject aliased workspace'
+            except RuntimeError:
+                pass
+
+    print('test_fft_workspace(): pass')
@@ -0,0 +1,481 @@
+import io
+import os
+import sys
+import time
+import pickle
+import subprocess
+import tempfile
+import functools
+import contextlib
+import tracemalloc
+import numpy as np
+import scipy.linalg
+
+from ..KszPipe import KszPipe, KszPipeOutdir
+from ..SurrogateFactory import SurrogateFactory
+from ..Cosmology import Cosmology, CosmologicalParams
+from ..Likelihood import Likelihood, LikelihoodEvaluator
+from .. import utils
+from . import helpers
+
+
+def _make_outdir(tmpdir, sim_surr_fg, nsurr=50, binning={'gg':0, 'gv':1, 'vv':0}):
+    helpers.make_kszpipe_outdir(tmpdir, nsurr, sim_surr_fg)
+    with contextlib.redirect_stdout(io.StringIO()):
+        return KszPipeOutdir(tmpdir, f=0.7, binning=binning)
+
+
+def _surr_gv(pout, b1, fnl, sn, bv, snv, bfg, sigmag, sigmav, freq, field, ell):
+    """Returns shape (nsurr, nkbins) array P_{gv}(k) for each surrogate, computed directly from pout.pk_surr."""
+    k = pout.k['gv']
+    dg, dv = pout.D_g(k,sigmag), pout.D_v(k,sigmav)
+    cg = [ sn+0*k, b1*dg, pout.f*dg, fnl*(b1-pout.p)*dg ]
+    cv = [ snv+0*k, bv*dv, bfg+0*k ]
+    pk = pout.pk_surr[pout.binning['gv']]
+
+    ret = 0
+    for a, sg in enumerate(pout.suff_gal_list):
+        for b, sv in enumerate(pout.suff_vel_list):
+            i = pout.surr_fields[f'gal-{ell[0]}-{sg}']
+            for w, fr in zip(field, freq):
+                j = pout.surr_fields[f'{fr}-{ell[1]}-{sv}']
+                ret = ret + w * cg[a] * cv[b] * pk[:,i,j,:]
+    return ret
+
+
+def _surr_vv(pout, bv1, snv1, bfg1, sigmav1, bv2, snv2, bfg2, sigmav2, freq, field, ell):
+    """Returns shape (nsurr, nkbins) array P_{vv}(k) for each surrogate, computed directly from pout.pk_surr."""
+    k = pout.k['vv']
+    cv1 = [ snv1+0*k, bv1*pout.D_v(k,sigmav1), bfg1+0*k ]
+    cv2 = [ snv2+0*k, bv2*pout.D_v(k,sigmav2), bfg2+0*k ]
+    pk = pout.pk_surr[pout.binning['vv']]
+
+    ret = 0
+    for a, s1 in enumerate(pout.suff_vel_list):
+        for b, s2 in enumerate(pout.suff_vel_list):
+            for w1, fr1 in zip(field[0], freq[0]):
+                for w2, fr2 in zip(field[1], freq[1]):
+                    i = pout.surr_fields[f'{fr1}-{ell[0]}-{s1}']
+                    j = pout.surr_fields[f'{fr2}-{ell[1]}-{s2}']
+                    ret = ret + w1 * w2 * cv1[a] * cv2[b] * pk[:,i,j,:]
+    return ret
+
+
+def test_kszpipe_outdir_model():
+    """Compares KszPipeOutdir means/covariances (computed from compiled model plans) to per-surrogate power spectra."""
+    
+    print('test_kszpipe_outdir_model(): start')
+
+    for sim_surr_fg in [ False, True ]:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            pout = _make_outdir(tmpdir, sim_surr_fg)
+
+            for _ in range(3):
+                u = lambda: np.random.uniform(0.5, 2.0)
+                pgv = dict(b1=u(), fnl=10*u(), sn=u(), bv=u(), snv=u(), bfg=(u() if sim_surr_fg else 0), sigmag=5*u(), sigmav=5*u(),
+                           freq=['90','150'], field=[u(), np.random.choice([0,-u()])], ell=[0,1])
+                pvv = dict(bv1=u(), snv1=u(), bfg1=(u() if sim_surr_fg else 0), sigmav1=5*u(), bv2=u(), snv2=u(), bfg2=(u() if sim_surr_fg else 0), sigmav2=5*u(),
+                           freq=[['90','150'],['150','90']], field=[[u(),0.0],[u(),u()]], ell=[1,0])
+
+                sgv, svv = _surr_gv(pout, **pgv), _surr_vv(pout, **pvv)
+                nk = sgv.shape[1]
+                cov = np.cov(np.concatenate((sgv,svv), axis=1), rowvar=False)
+
+                # Second pass re-uses the cached plans.
+                for _ in range(2):
+                    assert np.allclose(pout.pgv_mean(**pgv), np.mean(sgv,axis=0))
+                    assert np.allclose(pout.pvv_mean(**pvv), np.mean(svv,axis=0))
+                    
+                    cgv = { f'{key}1': val for key,val in pgv.items() }
+                    cvv = { 'bv12':pvv['bv1'], 'snv12':pvv['snv1'], 'bfg12':pvv['bfg1'], 'sigmav12':pvv['sigmav1'],
+                            'bv22':pvv['bv2'], 'snv22':pvv['snv2'], 'bfg22':pvv['bfg2'], 'sigmav22':pvv['sigmav2'],
+                            'freq2':pvv['freq'], 'field2':pvv['field'], 'ell2':pvv['ell'] }
+                    
+                    assert np.allclose(pout.pgvxpgv_cov(**cgv, **{ f'{key}2': val for key,val in pgv.items() }), cov[:nk,:nk])
+                    assert np.allclose(pout.pgvxpvv_cov(**cgv, **cvv), cov[:nk,nk:])
+        
+    print('test_kszpipe_outdir_model(): pass')
+
+
+def _make_likelihood(pout, **kwargs):
+    params = { 'fnl': {'ref': 0, 'prior': [-100,100], 'latex': 'fnl'},
+               'bv': {'ref': 1, 'prior': [0,3], 'latex': 'bv'},
+               'b1': {'ref': 2, 'prior': [0,3], 'latex': 'b1'} }
+    
+    fields = { 'gg': {'ell': [0,0], 'name_params': {'fnl':'fnl', 'b1':'b1'}},
+               'gv_90': {'freq': ['90','150'], 'field': [1,0], 'ell': [0,1], 'name_params': {'fnl':'fnl', 'bv':'bv', 'b1':'b1'}, 'fix_params': {'sigmav': 2.0}},
+               'gv_150': {'freq': ['90','150'], 'field': [0,1], 'ell': [0,1], 'name_params': {'fnl':'fnl', 'bv':'bv'}, 'derived_params': {'b1': '1.1*b1'}},
+               'vv': {'freq': [['90','150'],['90','150']], 'field': [[1,0],[1,0]], 'ell': [1,1], 'name_params': {'bv1':'bv', 'bv2':'bv'}} }
+
+    kbins = { key: None for key in fields }
+    k_rebin = { 'gg': 0.035, 'gv_90': 1, 'gv_150': 1, 'vv': 1 }
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        return Likelihood(pout, params=params, fields=fields, first_kbin=kbins, last_kbin=kbins, k_rebin=k_rebin, cov_correction='hartlap', **kwargs)
+
+
+def test_log_likelihood_batch():
+    """Compares Likelihood.log_likelihood_batch() to Likelihood.log_likelihood()."""
+
+    print('test_log_likelihood_batch(): start')
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pout = _make_outdir(tmpdir, sim_surr_fg=True, nsurr=200)
+
+        for kwargs in [ {}, {'cov_fix_params': True, 'params_cov': {'fnl':0, 'bv':1, 'b1':2}} ]:
+            lik = _make_likelihood(pout, **kwargs)
+            
+            theta = np.random.uniform([-50,0.5,1.0], [50,2.0,2.5], size=(10,3))
+            theta[3,1] = 5.0   # outside prior
+
+            logL = lik.log_likelihood_batch(theta, batch_size=4)
+            assert logL.shape == (10,)
+            assert logL[3] == -np.inf
+            
+            for i in [0,1,2,4,9]:
+                assert np.isclose(logL[i], lik.log_likelihood(*theta[i]))
+
+    print('test_log_likelihood_batch(): pass')
+
+
+def test_likelihood_evaluator():
+    """Compares parallel LikelihoodEvaluator (process and thread pools) to Likelihood.log_likelihood_batch()."""
+
+    print('test_likelihood_evaluator(): start')
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pout = _make_outdir(tmpdir, sim_surr_fg=True, nsurr=200)
+        lik = _make_likelihood(pout)
+
+        theta = np.random.uniform([-50,0.5,1.0], [50,2.0,2.5], size=(9,3))
+        theta[4,0] = 500.0   # outside prior
+        logL = lik.log_likelihood_batch(theta)
+        pk_surr = pout.pk_surr
+
+        for mode, start_method in [ ('process','fork'), ('process','spawn'), ('thread',None) ]:
+            with LikelihoodEvaluator(lik, nworkers=2, mode=mode, start_method=start_method) as evaluator:
+                assert np.allclose(evaluator(theta), logL, rtol=1.0e-10, atol=0)
+                assert np.isclose(evaluator(theta[0]), logL[0])
+
+            # The caller's KszPipeOutdir is unchanged (in particular, shared arrays are restored in close()).
+            assert pout.pk_surr is pk_surr
+            assert np.allclose(lik.log_likelihood_batch(theta), logL, rtol=1.0e-10, atol=0)
+
+        evaluator = pickle.loads(pickle.dumps(LikelihoodEvaluator(lik, nworkers=2)))
+        assert np.allclose(evaluator(theta), logL, rtol=1.0e-10, atol=0)
+
+    print('test_likelihood_evaluator(): pass')
+
+
+def test_likelihood_grad():
+    """Compares Likelihood.log_likelihood_and_grad() to finite differences, and checks the Jeffreys prior."""
+
+    print('test_likelihood_grad(): start')
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pout = _make_outdir(tmpdir, sim_surr_fg=True, nsurr=200)
+
+        for kwargs in [ {}, {'cov_fix_params': True, 'params_cov': {'fnl':0, 'bv':1, 'b1':2}} ]:
+            lik = _make_likelihood(pout, **kwargs)
+            x = np.random.uniform([-50,0.5,1.0], [50,2.0,2.5])
+            logL, grad = lik.log_likelihood_and_grad(*x)
+            assert np.isclose(logL, lik.log_likelihood(*x))
+
+            for i in range(3):
+                h = 1.0e-5 * max(abs(x[i]), 1.0)
+                dx = h * np.eye(3)[i]
+                fd = (lik.log_likelihood(*(x+dx)) - lik.log_likelihood(*(x-dx))) / (2*h)
+                assert np.isclose(grad[i], fd, rtol=1.0e-6, atol=1.0e-8)
+
+            lik = _make_likelihood(pout, jeffreys_prior=True, **kwargs)
+            theta = np.random.uniform([-50,0.5,1.0], [50,2.0,2.5], size=(4,3))
+            logL = lik.log_likelihood_batch(theta)
+            assert np.allclose(logL, [ lik.log_likelihood(*x) for x in theta ])
+
+    print('test_likelihood_grad(): pass')
+
+
+def test_fixed_cov_chi2():
+    """Compares the whitened-template chi^2 (cov_fix_params=True) to a direct computation from mean_and_cov()."""
+
+    print('test_fixed_cov_chi2(): start')
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for sim_surr_fg in [ True, False ]:
+            pout = _make_outdir(f'{tmpdir}/{sim_surr_fg}', sim_surr_fg=sim_surr_fg, nsurr=200)
+            lik = _make_likelihood(pout, cov_fix_params=True, params_cov={'fnl':0, 'bv':1, 'b1':2})
+            assert lik._fast_chi2
+
+            theta = np.random.uniform([-50,0.5,1.0], [50,2.0,2.5], size=(5,3))
+            logL = lik.log_likelihood_batch(theta)
+
+            for i, x in enumerate(theta):
+                mean = lik.mean_and_cov(**dict(zip(lik.params, x)), return_cov=False)
+                linv_x = scipy.linalg.solve_triangular(lik.cov_cholesky, lik.data - mean, lower=True)
+                assert np.isclose(logL[i], -(0.5 * np.dot(linv_x, linv_x) + lik.logdet_cov), rtol=1.0e-10)
+                assert np.isclose(logL[i], lik.log_likelihood(*x), rtol=1.0e-10)
+
+    print('test_fixed_cov_chi2(): pass')
+
+
+@functools.cache
+def _cheap_cosmology():
+    """Low-accuracy cosmology, to reduce CAMB running time (P(k) is only needed for k < knyq)."""
+    
+    params = CosmologicalParams('planck18+bao')
+    params.lmax, params.zmax, params.kmax = 100, 1.0, 10.0
+    
+    with contextlib.redirect_stdout(io.StringIO()):
+        return Cosmology(params)
+
+
+def _make_kszpipe(input_dir, output_dir):
+    """Returns KszPipe with a low-accuracy cosmology (see _cheap_cosmology())."""
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        kp = KszPipe(input_dir, output_dir)
+    
+    kp.cosmo = _cheap_cosmology()   # overrides cached_property
+    return kp
+
+
+def test_kszpipe_estimate_memory():
+    """Compares KszPipe.estimate_memory() to the peak memory of get_pk_surrogate(), measured with tracemalloc."""
+
+    print('test_kszpipe_estimate_memory(): start')
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        helpers.make_kszpipe_input_dir(f'{tmpdir}/input', ngal=500, nrand=10000, npix=64)
+        kp = _make_kszpipe(f'{tmpdir}/input', f'{tmpdir}/output')
+        
+        with contextlib.redirect_stdout(io.StringIO()):
+            kp.window_function, kp.surrogate_factory, kp.rcat_xyz_obs
+            kp.box.set_cache_limit(0)   # so that measured peaks don't depend on the contents of the Box cache
+            mem = kp.estimate_memory()
+
+            tracemalloc.start()
+            try:
+                m0 = tracemalloc.get_traced_memory()[0]
+                kp.surrogate_factory.simulate_surrogate()
+                phase1 = tracemalloc.get_traced_memory()[1] - m0
+                
+                tracemalloc.reset_peak()
+                m0 = tracemalloc.get_traced_memory()[0]
+                kp.get_pk_surrogate(0, run=True)
+                worker = tracemalloc.get_traced_memory()[1] - m0
+            finally:
+                tracemalloc.stop()
+
+    # Estimates should be upper bounds, but not too far from the measured peaks.
+    assert phase1 <= mem['phase1'] <= 1.1 * phase1
+    assert worker <= mem['worker'] <= 1.1 * worker
+    
+    print('test_kszpipe_estimate_memory(): pass')
+
+
+def test_kszpipe_dry_run():
+    """Checks that the KszPipe constructor and run(dry_run=True) don't write files to the output directory."""
+
+    print('test_kszpipe_dry_run(): start')
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        helpers.make_kszpipe_input_dir(f'{tmpdir}/input', ngal=100, nrand=2000, npix=16, nsurr=3)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            kp = KszPipe(f'{tmpdir}/input', f'{tmpdir}/output')
+            kp.run(processes=1, dry_run=True)
+            assert kp._missing_surrogates() == [0,1,2]
+        
+        files = [ f for (_,_,fs) in os.walk(f'{tmpdir}/output') for f in fs ]
+        assert files == [], files
+        assert kp._get_surrogate_store() is None
+
+    print('test_kszpipe_dry_run(): pass')
+
+
+def test_kszpipe_share_inputs():
+    """Checks that KszPipe._share_inputs() restores its inputs, and cleans up, if sharing fails partway."""
+
+    print('test_kszpipe_share_inputs(): start')
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        helpers.make_kszpipe_input_dir(f'{tmpdir}/input', ngal=500, nrand=5000, npix=16)
+        kp = _make_kszpipe(f'{tmpdir}/input', f'{tmpdir}/output')
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            kp.surrogate_factory, kp.rcat_xyz_obs
+        
+        inputs = [ (kp.rcat, 'ra_deg'), (kp.gcat, 'z'), (kp.surrogate_factory, 'xyz_true'), (kp, 'rcat_xyz_obs') ]
+        orig = [ np.copy(getattr(obj, attr)) for (obj, attr) in inputs ]
+        dirnames = [ ]
+        
+        # Simulate running out of space after 5 arrays.
+        share = utils.SharedArrayDir.share
+        def failing_share(sdir, arr):
+            dirnames.append(sdir.dirname)
+            if len(dirnames) > 5:
+                raise OSError('No space left on device')
+            return share(sdir, arr)
+
+        utils.SharedArrayDir.share = failing_share
+        
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                kp._share_inputs()
+            assert False, 'KszPipe._share_inputs() should have raised an exception'
+        except OSError:
+            pass
+        finally:
+            utils.SharedArrayDir.share = share
+
+        assert not os.path.exists(dirnames[0])
+        
+        for (obj, attr), x in zip(inputs, orig):
+            arr = getattr(obj, attr)
+            assert (type(arr) is np.ndarray) and arr.flags.writeable
+            assert np.array_equal(arr, x)
+
+    print('test_kszpipe_share_inputs(): pass')
+
+
+_get_pk_surrogate = KszPipe.get_pk_surrogate
+
+def _flaky_get_pk_surrogate(self, isurr, run=False, force=False):
+    """Replaces KszPipe.get_pk_surrogate() in test_kszpipe_run_pool(): fails the first self._test_nfail[isurr] attempts.
+
+    Attempts and successes are counted in files, since tasks run in worker processes."""
+
+    with open(f'{self.output_dir}/attempts_{isurr}', 'a') as f:
+        f.write('x')
+    if os.path.getsize(f'{self.output_dir}/attempts_{isurr}') <= self._test_nfail.get(isurr, 0):
+        raise RuntimeError(f'simulated failure (surrogate {isurr})')
+    
+    ret = _get_pk_surrogate(self, isurr, run, force)
+    
+    with open(f'{self.output_dir}/writes_{isurr}', 'a') as f:
+        f.write('x')
+    return ret
+
+_flaky_get_pk_surrogate.__name__ = 'get_pk_surrogate'   # bound methods are pickled by name
+
+
+def test_kszpipe_run_pool():
+    """Tests retries, giving up, and nsurr % processes != 0 in KszPipe._run_pool(), with a monkeypatched get_pk_surrogate()."""
+
+    print('test_kszpipe_run_pool(): start')
+
+    def count(kp, prefix, isurr):
+        fn = f'{kp.output_dir}/{prefix}_{isurr}'
+        return os.path.getsize(fn) if os.path.exists(fn) else 0
+
+    # (nsurr, nfail, max_retries, expect_failure)
+    cases = [ (5, {}, 2, False),         # 5 surrogates, 2 processes
+              (3, {1:1}, 2, False),      # surrogate 1 fails once, then succeeds
+              (3, {0:3}, 2, True) ]      # surrogate 0 fails more than max_retries times
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for icase, (nsurr, nfail, max_retries, expect_failure) in enumerate(cases):
+            helpers.make_kszpipe_input_dir(f'{tmpdir}/input{icase}', ngal=500, nrand=5000, npix=64, nsurr=nsurr)
+            kp = _make_kszpipe(f'{tmpdir}/input{icase}', f'{tmpdir}/output{icase}')
+            kp._test_nfail = nfail
+            
+            KszPipe.get_pk_surrogate = _flaky_get_pk_surrogate
+            
+            try:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    kp._get_surrogate_store(create=True)
+                    kp.window_function, kp.surrogate_factory
+                    kp._run_pool(2, 1, 'fork', have_data=True, missing_surrs=list(range(nsurr)), max_retries=max_retries)
+                assert not expect_failure, 'KszPipe._run_pool() should have raised an exception'
+            except RuntimeError:
+                assert expect_failure
+            finally:
+                KszPipe.get_pk_surrogate = _get_pk_surrogate
+
+            for isurr in range(nsurr):
+                n = nfail.get(isurr, 0)
+                assert count(kp, 'attempts', isurr) == min(n+1, max_retries+1)
+                assert count(kp, 'writes', isurr) == (1 if (n <= max_retries) else 0)
+
+            assert kp._missing_surrogates() == [ i for i in range(nsurr) if nfail.get(i,0) > max_retries ]
+
+    print('test_kszpipe_run_pool(): pass')
+
+
+def test_kszpipe_delta_kfilter():
+    """Checks that SurrogateFactory._delta_kfilter() is called once per KszPipe.run(), not once per surrogate."""
+
+    print('test_kszpipe_delta_kfilter(): start')
+
+    delta_kfilter = SurrogateFactory._delta_kfilter
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # Calls are counted in a file, in case they happen in worker processes.
+        def counting_delta_kfilter(sf, pk):
+            with open(f'{tmpdir}/ncalls', 'a') as f:
+                f.write('x')
+            return delta_kfilter(sf, pk)
+
+        SurrogateFactory._delta_kfilter = counting_delta_kfilter
+        
+        try:
+            for shared_inputs in [ False, True ]:
+                helpers.make_kszpipe_input_dir(f'{tmpdir}/input{int(shared_inputs)}', ngal=500, nrand=5000, npix=64, nsurr=3)
+                kp = _make_kszpipe(f'{tmpdir}/input{int(shared_inputs)}', f'{tmpdir}/output{int(shared_inputs)}')
+                
+                with contextlib.redirect_stdout(io.StringIO()):
+                    kp.run(processes=2, shared_inputs=shared_inputs, start_method='fork')
+                    
+                assert os.path.getsize(f'{tmpdir}/ncalls') == 1
+                assert kp._missing_surrogates() == []
+                os.remove(f'{tmpdir}/ncalls')
+        finally:
+            SurrogateFactory._delta_kfilter = delta_kfilter
+
+    print('test_kszpipe_delta_kfilter(): pass')
+
+
+def test_kszpipe_run_distributed():
+    """Runs 'python -m kszx kszpipe_worker' in 2 subprocesses, and compares to KszPipe.run(processes=1).
+
+    Covers claim contention, takeover of a stale claim, and consolidation by the last worker.
+    (Note: this test is slow, since each worker process runs CAMB.)"""
+
+    print('test_kszpipe_run_distributed(): start')
+
+    nsurr, nworkers = 6, 2
+    env = dict(os.environ, PYTHONPATH = os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # Note: nrand=10000 (rather than 5000) so that the surrogate noise RMS is real (see get_pk_surrogate()).
+        helpers.make_kszpipe_input_dir(f'{tmpdir}/input', ngal=500, nrand=10000, npix=64, nsurr=nsurr)
+
+        # Stale claim on surrogate 0 (e.g. from a worker which died an hour ago).
+        with contextlib.redirect_stdout(io.StringIO()):
+            store = KszPipe(f'{tmpdir}/input', f'{tmpdir}/dist')._get_surrogate_store(create=True)
+            assert store.claim('surr_0')
+        os.utime(f'{store.claims_dirname}/surr_0', (time.time()-3600,)*2)
+
+        workers = [ ]
+        for i in range(nworkers):
+            with open(f'{tmpdir}/worker{i}.log', 'w') as f:
+                cmd = [ sys.executable, '-m', 'kszx', 'kszpipe_worker', '-t', '1', '--claim-timeout', '600', f'{tmpdir}/input', f'{tmpdir}/dist' ]
+                workers.append(subprocess.Popen(cmd, stdout=f, stderr=subprocess.STDOUT, env=env))
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            KszPipe(f'{tmpdir}/input', f'{tmpdir}/ref').run(processes=1)
+
+        for i, w in enumerate(workers):
+            assert w.wait(timeout=1800) == 0, open(f'{tmpdir}/worker{i}.log').read()
+
+        # Every surrogate is computed exactly once (including surrogate 0, after takeover of the stale claim).
+        logs = ''.join(open(f'{tmpdir}/worker{i}.log').read() for i in range(nworkers))
+        done = [ int(line.split()[2]) for line in logs.splitlines() if line.startswith('KszPipe.run_distributed(): surrogate') and ' done ' in line ]
+        assert sorted(done) == list(range(nsurr)), done
+        assert any(fn.startswith('surr_0.stale.') for fn in os.listdir(store.claims_dirname))
+
+        # Consolidated output (written by the last worker) is bitwise identical to run(processes=1).
+        for fn in [ 'pk_data_binning0.npy', 'pk_surrogates_binning0.npy' ]:
+            assert np.array_equal(np.load(f'{tmpdir}/dist/{fn}'), np.load(f'{tmpdir}/ref/{fn}')), fn
+
+    print('test_kszpipe_run_distributed(): pass')
@@ -1,5 +1,8 @@
 from .. import Box
+from .. import PointStencil
+from .. import PowerSpectrumAccumulator
 from .. import core
+from .. import cpp_kernels
 from .. import utils
 from . import helpers
 
@@ -146,6 +149,176 @@ def test_interpolation_gridding_consistency():
     print('test_interpolation_gridding_consistency(): pass')
 
 
+def test_threaded_gridding():
+    print('test_threaded_gridding(): start')
+
+    for _ in range(20):
+        kernel, degree = ('cic',1) if (np.random.uniform() < 0.5) else ('cubic',3)
+        periodic = (np.random.uniform() < 0.5)
+        nthreads = np.random.randint(2, 9)
+
+        # Use a large-ish axis 0, so that the grid is partitioned into several slabs.
+        npix = np.array([ np.random.randint(16,65), np.random.randint(4,17), np.random.randint(4,17) ])
+        box = Box(npix, np.random.uniform(1.0, 10.0), np.random.uniform(-100.0, 100.0, size=3))
+
+        npoints = np.random.randint(1000, 5000)
+        pad = (-1000 * box.pixsize) if periodic else ((degree - 1 + 1.0e-7) * (box.pixsize/2.))
+        points = np.random.uniform(box.lpos+pad, box.rpos-pad, size=(npoints,3))
+        w = np.random.normal(size=npoints) if (np.random.uniform() < 0.5) else np.random.uniform(1.0, 2.0)
+
+        g1 = core.grid_points(box, points, weights=w, kernel=kernel, periodic=periodic, threads=1)
+        g2 = core.grid_points(box, points, weights=w, kernel=kernel, periodic=periodic, threads=nthreads)
+        g3 = core.grid_points(box, points, weights=w, kernel=kernel, periodic=periodic, threads=nthreads)
+
+        assert helpers.compare_arrays(g1, g2) < 1.0e-12
+        assert np.array_equal(g2, g3)   # deterministic for fixed nthreads
+
+    print('test_threaded_gridding(): pass')
+
+
+def test_grid_points_multi():
+    print('test_grid_points_multi(): start')
+
+    for _ in range(20):
+        kernel, degree = ('cic',1) if (np.random.uniform() < 0.5) else ('cubic',3)
+        periodic = (np.random.uniform() < 0.5)
+        threads = np.random.randint(1, 5)
+        box = helpers.random_box(ndim=3, nmin=degree+1)
+
+        nfields = np.random.randint(1, 5)
+        npoints = np.random.randint(100, 200)
+        pad = (-1000 * box.pixsize) if periodic else ((degree - 1 + 1.0e-7) * (box.pixsize/2.))
+        points = np.random.uniform(box.lpos+pad, box.rpos-pad, size=(npoints,3))
+        weights = np.random.normal(size=(nfields,npoints))
+        wscal = np.random.uniform(1.0, 2.0)
+
+        fft = (np.random.uniform() < 0.5)
+        spin = np.random.randint(0,3) if fft else 0
+        
+        kwds = dict(kernel=kernel, fft=fft, spin=spin, periodic=periodic, compensate=fft, wscal=wscal, threads=threads)
+        maps = core.grid_points_multi(box, points, weights, **kwds)
+
+        for f in range(nfields):
+            m = core.grid_points(box, points, weights[f], **kwds)
+            assert helpers.compare_arrays(maps[f], m) < 1.0e-12
+
+    print('test_grid_points_multi(): pass')
+
+
+def test_interpolate_points_multi():
+    print('test_interpolate_points_multi(): start')
+
+    for _ in range(50):
+        kernel, degree = ('cic',1) if (np.random.uniform() < 0.5) else ('cubic',3)
+        periodic = (np.random.uniform() < 0.5)
+        box = helpers.random_box(ndim=3, nmin=degree+1)
+
+        npoints = np.random.randint(100, 200)
+        pad = (-1000 * box.pixsize) if periodic else ((degree - 1 + 1.0e-7) * (box.pixsize/2.))
+        points = np.random.uniform(box.lpos+pad, box.rpos-pad, size=(npoints,3))
+        nfields = np.random.randint(1, 5)
+        grids = np.random.normal(size=(nfields,) + box.real_space_shape)
+
+        # Memory layouts: 4-d array, interleaved 4-d array, list of views, list of separate arrays,
+        # and a list containing a non-contiguous map (the only case which doesn't share the stencil).
+        interleaved = np.moveaxis(np.array(np.moveaxis(grids,0,-1)), -1, 0)
+        strided = np.zeros(box.real_space_shape + (2,))[...,0]
+        strided[:] = grids[0]
+        layouts = [ grids, interleaved, list(grids), [ np.copy(g) for g in grids ], [strided] + list(grids[1:]) ]
+        ilayout = np.random.randint(len(layouts))
+        arg = layouts[ilayout]
+
+        # Check that interpolate_points() is only called in the fallback case.
+        interpolate_points = core.interpolate_points
+        if (ilayout < 4) or (nfields == 1):
+            core.interpolate_points = None
+        
+        try:
+            vals = core.interpolate_points_multi(box, arg, points, kernel, periodic=periodic)
+        finally:
+            core.interpolate_points = interpolate_points
+
+        assert vals.shape == (nfields, npoints)
+
+        for f in range(nfields):
+            v = core.interpolate_points(box, grids[f], points, kernel, periodic=periodic)
+            assert np.array_equal(vals[f], v)
+
+    print('test_interpolate_points_multi(): pass')
+
+
+def test_point_stencil():
+    print('test_point_stencil(): start')
+
+    for _ in range(50):
+        kernel, degree = ('cic',1) if (np.random.uniform() < 0.5) else ('cubic',3)
+        periodic = (np.random.uniform() < 0.5)
+        single_precision = (np.random.uniform() < 0.3)
+        threads = np.random.randint(1, 5)
+        box = helpers.random_box(ndim=3, nmin=degree+1)
+
+        npoints = np.random.randint(100, 200)
+        pad = (-1000 * box.pixsize) if periodic else ((degree - 1 + 1.0e-7) * (box.pixsize/2.))
+        points = np.random.uniform(box.lpos+pad, box.rpos-pad, size=(npoints,3))
+        wshape = (np.random.randint(1,4), npoints) if (np.random.uniform() < 0.5) else (npoints,)
+        w = np.random.normal(size=wshape)
+        g = np.random.normal(size=box.npix)
+        
+        stencil = PointStencil(box, points, kernel, periodic=periodic, dtype=(np.float32 if single_precision else float))
+        assert stencil.nbytes == npoints * 3 * (degree+1) * (4 + (4 if single_precision else 8))
+        epsilon = 1.0e-6 if single_precision else 1.0e-15
+        
+        i1 = stencil.interpolate(g)
+        i2 = core.interpolate_points(box, g, points, kernel=kernel, periodic=periodic)
+        assert helpers.compare_arrays(i1, i2) < epsilon
+
+        g1 = stencil.grid(w, threads=threads)
+        
+        if w.ndim == 1:
+            g2 = core.grid_points(box, points, w, kernel=kernel, periodic=periodic, threads=threads)
+        else:
+            g2 = core.grid_points_multi(box, points, w, kernel=kernel, periodic=periodic, threads=threads)
+
+        assert helpers.compare_arrays(g1, g2) < epsilon
+
+    print('test_point_stencil(): pass')
+
+
+def test_interpolate_derived_fields():
+    print('test_interpolate_derived_fields(): start')
+
+    for _ in range(20):
+        kernel, degree = ('cic',1) if (np.random.uniform() < 0.5) else ('cubic',3)
+        periodic = (np.random.uniform() < 0.5)
+        box = helpers.random_box(ndim=3, nmin=degree+1, avoid_small_r=True)
+
+        npoints = np.random.randint(100, 200)
+        pad = (-1000 * box.pixsize) if periodic else ((degree - 1 + 1.0e-7) * (box.pixsize/2.))
+        points = np.random.uniform(box.lpos+pad, box.rpos-pad, size=(npoints,3))
+        fmap = core.fft_r2c(box, np.random.normal(size=box.real_space_shape))
+        fmap_copy = np.copy(fmap)
+
+        # Each kfilter is either None, an array, or a function f(k).
+        kfilters = [ None, np.random.normal(size=box.fourier_space_shape), (lambda k: 1.0/k) ]
+        nfields = np.random.randint(1, 5)
+        fields = [ (kfilters[np.random.randint(3)], np.random.randint(0, 3)) for _ in range(nfields) ]
+        
+        max_live_fields = np.random.choice([None, 1, 2])
+        ret = core.interpolate_derived_fields(box, fmap, points, kernel, fields, periodic=periodic, max_live_fields=max_live_fields)
+        assert ret.shape == (nfields, npoints)
+        assert np.array_equal(fmap, fmap_copy)
+
+        for j, (kfilter, spin) in enumerate(fields):
+            if callable(kfilter):
+                src = core.multiply_kfunc(box, fmap, kfilter, dc=0)
+            else:
+                src = fmap if (kfilter is None) else (fmap * kfilter)
+            r = core.interpolate_points(box, src, points, kernel, fft=True, spin=spin, periodic=periodic)
+            assert helpers.compare_arrays(ret[j], r) < 1.0e-10
+
+    print('test_interpolate_derived_fields(): pass')
+
+
 ####################################################################################################
 
 
@@ -160,6 +333,19 @@ def test_simulate_gaussian():
         arr2 = core.fft_r2c(box, arr2)
         eps = np.max(np.abs(arr-arr2)) *  np.sqrt(box.pixel_volume)
         assert eps < 1.0e-10
+
+        # With an explicit np.random.Generator, the simulation is reproducible.
+        ss = np.random.SeedSequence(np.random.randint(10**9), spawn_key=(5,))
+        sims = [ core.simulate_gaussian_field(box, 2.0, rng=np.random.default_rng(ss)) for _ in range(2) ]
+        assert np.array_equal(sims[0], sims[1])
+
+        # White noise does not depend on the number of threads.
+        w = [ core.simulate_white_noise(box, fourier=f, rng=np.random.default_rng(ss), threads=t) for f in [True,False] for t in [1,3] ]
+        assert np.array_equal(w[0], w[1]) and np.array_equal(w[2], w[3])
+
+        # method='fft' gives Fourier-space white noise with the same normalization.
+        arr = core.simulate_white_noise(box, fourier=True, method='fft', rng=np.random.default_rng(ss))
+        assert np.array_equal(arr, core.fft_r2c(box, w[2]))
         
     print('test_simulate_gaussian(): pass')
 
@@ -264,6 +450,98 @@ def test_estimate_power_spectrum():
     print('test_estimate_power_spectrum(): pass')
 
 
+def test_threaded_estimate_power_spectrum():
+    print('test_threaded_estimate_power_spectrum(): start')
+
+    for _ in range(50):
+        box = helpers.random_box()
+        kbin_edges = helpers.random_kbin_edges(box)
+        use_dc = (np.random.uniform() < 0.5)
+        nthreads = np.random.randint(2, 9)
+        nmaps = np.random.randint(1, 8)
+        maps = [ core.simulate_white_noise(box, fourier=True) for _ in range(nmaps) ]
+        
+        kwds = dict(use_dc=use_dc, allow_empty_bins=True, return_counts=True)
+        pk1, bc1 = core.estimate_power_spectrum(box, maps, kbin_edges, threads=1, **kwds)
+        pk2, bc2 = core.estimate_power_spectrum(box, maps, kbin_edges, threads=nthreads, **kwds)
+        pk3, bc3 = core.estimate_power_spectrum(box, maps, kbin_edges, threads=nthreads, **kwds)
+
+        assert np.array_equal(bc1, bc2)
+        assert np.max(np.abs(pk1 - pk2)) <= 1.0e-12 * np.max(np.abs(pk1))
+        assert np.array_equal(pk2, pk3)   # deterministic for fixed nthreads
+
+    print('test_threaded_estimate_power_spectrum(): pass')
+
+
+def test_pse_kernels():
+    """Compares the blocked and unblocked C++ power spectrum kernels (see cpp/estimate_power_spectrum.cpp)."""
+    
+    print('test_pse_kernels(): start')
+
+    for _ in range(50):
+        box = helpers.random_box()
+        kbin_edges = helpers.random_kbin_edges(box)
+        nmaps = np.random.randint(1, 13)
+        nthreads = np.random.randint(1, 5)
+        maps = [ core.simulate_white_noise(box, fourier=True) for _ in range(nmaps) ]
+        args = (maps, kbin_edges, box.npix, box.kfund, box.box_volume, nthreads)
+
+        pk1, bc1 = cpp_kernels.estimate_power_spectrum(*args, 1)   # unblocked
+        pk2, bc2 = cpp_kernels.estimate_power_spectrum(*args, 2)   # blocked
+        
+        assert np.array_equal(bc1, bc2)
+        assert np.max(np.abs(pk1 - pk2)) <= 1.0e-12 * np.max(np.abs(pk1))
+
+    print('test_pse_kernels(): pass')
+
+
+def test_multi_binning_power_spectrum():
+    print('test_multi_binning_power_spectrum(): start')
+
+    for _ in range(50):
+        box = helpers.random_box()
+        nbinnings = np.random.randint(1, 4)
+        edges_list = [ helpers.random_kbin_edges(box) for _ in range(nbinnings) ]
+        use_dc = (np.random.uniform() < 0.5)
+        nmaps = np.random.randint(1, 6)
+        maps = [ core.simulate_white_noise(box, fourier=True) for _ in range(nmaps) ]
+        map_arg = maps if (np.random.uniform() < 0.5) else maps[0]
+
+        kwds = dict(use_dc=use_dc, allow_empty_bins=True, return_counts=True)
+        ret = core.estimate_power_spectrum(box, map_arg, edges_list, **kwds)
+        assert len(ret) == nbinnings
+
+        for (pk, bc), kbin_edges in zip(ret, edges_list):
+            pk0, bc0 = core.estimate_power_spectrum(box, map_arg, kbin_edges, **kwds)
+            assert pk.shape == pk0.shape
+            assert np.array_equal(bc, bc0)
+            assert np.max(np.abs(pk - pk0)) <= 1.0e-12 * np.max(np.abs(pk0))
+
+    print('test_multi_binning_power_spectrum(): pass')
+
+
+def test_power_spectrum_accumulator():
+    print('test_power_spectrum_accumulator(): start')
+
+    for _ in range(50):
+        box = helpers.random_box()
+        kbin_edges = helpers.random_kbin_edges(box)
+        use_dc = (np.random.uniform() < 0.5)
+        nmaps = np.random.randint(1, 8)
+        maps = [ core.simulate_white_noise(box, fourier=True) for _ in range(nmaps) ]
+
+        acc = PowerSpectrumAccumulator(box, kbin_edges, use_dc=use_dc, allow_empty_bins=True)
+        for i,fmap in enumerate(maps):
+            assert acc.add(fmap) == i
+
+        pk, bc = core.estimate_power_spectrum(box, maps, kbin_edges, use_dc=use_dc, allow_empty_bins=True, return_counts=True)
+        
+        assert np.array_equal(acc.bin_counts, bc)
+        assert np.max(np.abs(acc.get_pk() - pk)) <= 1.0e-12 * np.max(np.abs(pk))
+
+    print('test_power_spectrum_accumulator(): pass')
+
+
 ####################################################################################################
 
 
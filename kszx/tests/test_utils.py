@@ -1,8 +1,13 @@
 """This file is currently extremely incomplete! Some day I'll test more utility functions."""
 
+import os
+import pickle
+import tempfile
 import numpy as np
 
 from .. import utils
+from ..SurrogateStore import SurrogateStore
+from . import helpers
 
 
 def test_contract_axis():
@@ -27,3 +32,126 @@ def test_contract_axis():
 
     print('test_contract_axis(): pass')
     
+
+
+def test_spatial_sort_indices():
+    print('test_spatial_sort_indices(): start')
+
+    for _ in range(20):
+        box = helpers.random_box(ndim=3)
+        npoints = np.random.randint(1000, 2000)
+        points = np.random.uniform(box.lpos - box.pixsize/2., box.rpos + box.pixsize/2., size=(npoints,3))
+        
+        perm = utils.spatial_sort_indices(box, points)
+        assert np.array_equal(np.sort(perm), np.arange(npoints))
+
+        # Sorted points in the same pixel should be contiguous, and in their original order.
+        ix = np.floor((points[perm] - box.lpos) / box.pixsize + 0.5).astype(int)
+        ix = np.clip(ix, 0, box.npix-1)
+        ipix = np.ravel_multi_index(ix.T, box.npix)
+        run_starts = np.concatenate(([True], ipix[1:] != ipix[:-1]))
+        assert len(np.unique(ipix)) == np.sum(run_starts)
+        assert all(np.all(np.diff(perm[ipix == i]) > 0) for i in np.unique(ipix))
+
+    print('test_spatial_sort_indices(): pass')
+
+
+def test_shared_array_dir():
+    print('test_shared_array_dir(): start')
+
+    with utils.SharedArrayDir() as sdir:
+        dirname = sdir.dirname
+        
+        for _ in range(10):
+            shape = helpers.random_shape()
+            arr = np.random.normal(size=shape)
+            sarr = sdir.share(arr)
+            assert np.array_equal(arr, sarr)
+            assert not sarr.flags.writeable
+            
+            # Shared arrays are pickled by filename, and unpickled as read-only memory-mapped arrays.
+            s = pickle.dumps(sarr)
+            assert len(s) < 1000
+            assert np.array_equal(pickle.loads(s), arr)
+
+            # Derived arrays are plain numpy arrays.
+            assert type(sarr + 1.0) is np.ndarray
+            assert type(np.concatenate([sarr, sarr])) is np.ndarray
+
+    assert not os.path.exists(dirname)
+    
+    # After SharedArrayDir.close(), shared arrays are pickled by value.
+    assert np.array_equal(pickle.loads(pickle.dumps(sarr)), arr)
+    
+    print('test_shared_array_dir(): pass')
+
+
+def test_surrogate_store():
+    print('test_surrogate_store(): start')
+
+    shapes = [ (3,3,5), (3,3,2) ]
+    
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store = SurrogateStore(f'{tmpdir}/store', shapes)
+        pks = { i: [np.random.normal(size=s) for s in shapes] for i in [4,1,7] }   # out of order, with gaps
+        
+        for i, pk in pks.items():
+            store.write(i, pk)
+
+        assert store.missing(10) == [0,2,3,5,6,8,9]
+        assert store.is_done(7) and not store.is_done(8)
+
+        # Reopening the store (e.g. in a different process) checks shapes, and sees all writes.
+        store2 = SurrogateStore(f'{tmpdir}/store')
+        assert store2.shapes == shapes
+        assert all(np.array_equal(a,b) for (a,b) in zip(store2.read(7), pks[7]))
+
+        # Partial read: completed surrogates in index order.
+        ret = store2.read(nsurr=5)
+        assert all(np.array_equal(r, np.array([pks[1][i], pks[4][i]])) for (i,r) in enumerate(ret))
+        assert ret[0].shape == (2,3,3,5)
+
+        # Corrupted data is detected by the checksum.
+        with open(f'{tmpdir}/store/binning1.dat', 'r+b') as f:
+            f.seek(4 * 8 * 18)
+            f.write(b'\x01' * 8)
+        try:
+            store2.read()
+            assert False, 'expected checksum error'
+        except RuntimeError:
+            pass
+
+    print('test_surrogate_store(): pass')
+
+
+def _claim_all(dirname, n):
+    store = SurrogateStore(dirname)
+    return [ i for i in range(n) if store.claim(f'surr_{i}') ]
+
+
+def test_surrogate_store_claims():
+    print('test_surrogate_store_claims(): start')
+
+    n, nproc = 200, 4
+    
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store = SurrogateStore(f'{tmpdir}/store', [(2,2,3)])
+        
+        # Several processes race to claim the same tasks: each task is claimed exactly once.
+        with utils.Pool(nproc) as pool:
+            claims = pool.starmap(_claim_all, [(store.dirname, n)] * nproc)
+        assert sorted(i for c in claims for i in c) == list(range(n))
+        assert not store.claim('surr_0')
+
+        # Released claims can be reclaimed, and stale claims can be taken over.
+        store.release('surr_0')
+        assert store.claim('surr_0')
+        assert not store.claim('surr_1', timeout=1.0e6)
+        assert store.claim('surr_1', timeout=0.0)
+
+        # Per-surrogate seeds are deterministic, and agree with SeedSequence.spawn().
+        children = np.random.SeedSequence(store.seed).spawn(3)
+        assert SurrogateStore(store.dirname).seed == store.seed
+        assert np.array_equal(store.seed_sequence(2).generate_state(4), children[2].generate_state(4))
+
+    print('test_surrogate_store_claims(): pass')
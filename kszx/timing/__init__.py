@@ -1,2 +1,5 @@
 from .time_interpolation import time_interpolation
-from .time_multiply_xli import time_multiply_xli_real_space, time_multiply_xli_fourier_space
+from .time_multiply_xli import time_multiply_xli_real_space, time_multiply_xli_fourier_space, time_spin_fft
+from .time_spatial_sort import time_spatial_sort
+from .time_estimate_power_spectrum import time_estimate_power_spectrum, time_pse_kernels
+from .time_simulate_white_noise import time_simulate_white_noise
@@ -0,0 +1,56 @@
+import time
+import numpy as np
+
+from .. import core
+from .. import utils
+from .. import cpp_kernels
+from ..Box import Box
+
+
+def time_estimate_power_spectrum(box_nside=256, nmaps_list=(1,4,16), nkbins=25):
+    """Times estimate_power_spectrum() with one thread, vs utils.get_nthreads() threads."""
+
+    print('time_estimate_power_spectrum: start')
+
+    npix = (box_nside, box_nside, box_nside)
+    box = Box(npix, pixsize=1.0)
+    kbin_edges = np.linspace(0, box.knyq, nkbins+1)
+    nmodes = np.prod(box.fourier_space_shape)
+    nthreads = utils.get_nthreads()
+
+    for nmaps in nmaps_list:
+        maps = [ core.simulate_white_noise(box, fourier=True) for _ in range(nmaps) ]
+        
+        for threads in sorted(set([1, nthreads])):
+            t0 = time.time()
+            core.estimate_power_spectrum(box, maps, kbin_edges, threads=threads)
+            dt = time.time() - t0
+            print(f'time_estimate_power_spectrum({box_nside=}, {nmaps=}, {threads=}): {dt} seconds, {1.0e9 * (dt/nmodes)} ns/mode')
+
+        del maps
+
+
+def time_pse_kernels(box_nside=256, nmaps_list=(1,4,5,6,8,16,32), nkbins=25):
+    """Times the "unblocked" C++ power spectrum kernels (M-specific for M <= 4), vs the blocked runtime-M kernel.
+
+    This timing was used to choose the threshold value of M where estimate_power_spectrum()
+    switches to the blocked kernel (see pse_dispatch() in cpp/estimate_power_spectrum.cpp).
+    """
+
+    print('time_pse_kernels: start')
+
+    npix = (box_nside, box_nside, box_nside)
+    box = Box(npix, pixsize=1.0)
+    kbin_edges = np.linspace(0, box.knyq, nkbins+1)
+    nmodes = np.prod(box.fourier_space_shape)
+
+    for nmaps in nmaps_list:
+        maps = [ core.simulate_white_noise(box, fourier=True) for _ in range(nmaps) ]
+        
+        for (kernel, label) in [ (1,'unblocked'), (2,'blocked') ]:
+            t0 = time.time()
+            cpp_kernels.estimate_power_spectrum(maps, kbin_edges, box.npix, box.kfund, box.box_volume, 1, kernel)
+            dt = time.time() - t0
+            print(f'time_pse_kernels({box_nside=}, {nmaps=}): {label} kernel: {dt} seconds, {1.0e9 * (dt/nmodes)} ns/mode')
+
+        del maps
@@ -1,6 +1,7 @@
 from .. import Box
 from .. import core
 from .. import cpp_kernels
+from .. import utils
 
 import time
 import numpy as np
@@ -36,3 +37,45 @@ def time_multiply_xli_fourier_space(box_nside=1024, niter=10, l=5, i=1):
     dt = time.time() - t0
     nbytes = 16 * niter * box_nside**3
     print(f'time_multiply_xli_fourier_space({box_nside=}, {niter=}, {l=}, {i=}): {dt} seconds, {1.0e-9 * (nbytes/dt)} GB/sec')
+
+
+def time_spin_fft(box_nside=256, spin=1, threads=None):
+    """Compares the fused spin-l FFTs in kszx.core (used by fft_r2c/fft_c2r) to the unfused loop (see comment in core.py)."""
+    
+    print('time_spin_fft: start')
+    box = Box((box_nside, box_nside, box_nside), 1.0, cpos=(3*box_nside, 3*box_nside, 3*box_nside))
+    threads = utils.get_nthreads() if (threads is None) else threads
+    nz = box_nside
+    
+    rmap = np.random.normal(size=box.real_space_shape)
+    fmap = np.zeros(box.fourier_space_shape, dtype=complex)
+    ws = np.empty(box.fourier_space_shape, dtype=complex)
+    ws_real = ws.view(float)[:,:,:nz]
+    lpos, pixsize = box.lpos, box.pixsize
+    nbytes = 16 * (2*spin+1) * box_nside**3
+
+    t0 = time.time()
+    for i in range(2*spin+1):
+        cpp_kernels.multiply_xli_real_space(ws_real, rmap, spin, i, lpos[0], lpos[1], lpos[2], pixsize, 1.0, False)
+        core._rfft_inplace(ws, nz, threads)
+        cpp_kernels.multiply_xli_fourier_space(fmap, ws, spin, i, nz, 1+0j, (i > 0))
+    dt = time.time() - t0
+    print(f'time_spin_fft({box_nside=}, {spin=}, {threads=}): unfused r2c: {dt} seconds, {1.0e-9 * (nbytes/dt)} GB/sec')
+    
+    t0 = time.time()
+    core._fft_r2c_fused(box, rmap, spin, fmap, ws, threads)
+    dt = time.time() - t0
+    print(f'time_spin_fft({box_nside=}, {spin=}, {threads=}): fused r2c: {dt} seconds, {1.0e-9 * (nbytes/dt)} GB/sec')
+
+    t0 = time.time()
+    for i in range(2*spin+1):
+        cpp_kernels.multiply_xli_fourier_space(ws, fmap, spin, i, nz, 1+0j, False)
+        core._irfft_inplace(ws, nz, threads)
+        cpp_kernels.multiply_xli_real_space(rmap, ws_real, spin, i, lpos[0], lpos[1], lpos[2], pixsize, 1.0, (i > 0))
+    dt = time.time() - t0
+    print(f'time_spin_fft({box_nside=}, {spin=}, {threads=}): unfused c2r: {dt} seconds, {1.0e-9 * (nbytes/dt)} GB/sec')
+    
+    t0 = time.time()
+    core._fft_c2r_fused(box, fmap, spin, rmap, ws, threads)
+    dt = time.time() - t0
+    print(f'time_spin_fft({box_nside=}, {spin=}, {threads=}): fused c2r: {dt} seconds, {1.0e-9 * (nbytes/dt)} GB/sec')
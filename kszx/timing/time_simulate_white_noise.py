@@ -0,0 +1,24 @@
+import time
+import numpy as np
+
+from .. import core
+from .. import utils
+from ..Box import Box
+
+
+def time_simulate_white_noise(box_nside=256):
+    """Times simulate_white_noise() with one thread, vs utils.get_nthreads() threads (and method='fft')."""
+
+    print('time_simulate_white_noise: start')
+
+    npix = (box_nside, box_nside, box_nside)
+    box = Box(npix, pixsize=1.0)
+    nthreads = utils.get_nthreads()
+    rng = np.random.default_rng()
+
+    for fourier, method in [ (False,'fourier'), (True,'fourier'), (True,'fft') ]:
+        for threads in sorted(set([1, nthreads])):
+            t0 = time.time()
+            core.simulate_white_noise(box, fourier=fourier, method=method, rng=rng, threads=threads)
+            dt = time.time() - t0
+            print(f'time_simulate_white_noise({box_nside=}, {fourier=}, {method=}, {threads=}): {dt} seconds')
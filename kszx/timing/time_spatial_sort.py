@@ -0,0 +1,33 @@
+import time
+import numpy as np
+
+from .. import core
+from .. import utils
+from ..Box import Box
+
+
+def time_spatial_sort(box_nside=1024, npoints=10**8, kernel='cubic'):
+    """Times gridding/interpolation with randomly ordered points, vs points sorted by utils.spatial_sort_indices()."""
+    
+    print('time_spatial_sort: start')
+
+    npix = (box_nside, box_nside, box_nside)
+    box = Box(npix, pixsize=1.0)
+    arr = np.ones(npix)
+    points = np.random.uniform(size=(npoints,3), low = 2.1, high = box_nside-3.1)
+
+    t0 = time.time()
+    perm = utils.spatial_sort_indices(box, points)
+    dt = time.time() - t0
+    print(f'time_spatial_sort({box_nside=}, {npoints=}): sorting: {dt} seconds, {1.0e9 * (dt/npoints)} ns/point')
+    
+    for (label, p) in [ ('unsorted', points), ('sorted', points[perm]) ]:
+        t0 = time.time()
+        core.interpolate_points(box, arr, p, kernel)
+        dt = time.time() - t0
+        print(f'time_spatial_sort({box_nside=}, {npoints=}, {kernel=}): {label} interpolation: {dt} seconds, {1.0e9 * (dt/npoints)} ns/point')
+
+        t0 = time.time()
+        core.grid_points(box, p, kernel=kernel)
+        dt = time.time() - t0
+        print(f'time_spatial_sort({box_nside=}, {npoints=}, {kernel=}): {label} gridding: {dt} seconds, {1.0e9 * (dt/npoints)} ns/point')
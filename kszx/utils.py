@@ -1,6 +1,8 @@
 """The ``kszx.utils`` module contains miscelleanous utilities, that didn't really fit in elsewhere."""
 
 import os
+import shutil
+import tempfile
 import numpy as np
 import scipy.special
 import scipy.integrate
@@ -54,7 +56,25 @@ def set_nthreads(nthreads, reseed_numpy_rng=False):
         np.random.seed(ss.generate_state(624))
 
     
-def Pool(processes=None, reseed_numpy_rng=True):
+def set_blas_nthreads(nthreads):
+    """Limits the number of BLAS/LAPACK threads (used by e.g. ``np.dot()``, ``np.linalg.cholesky()``) in the current process.
+
+    Unlike :func:`~kszx.utils.set_nthreads()`, this function must be called explicitly. Requires the
+    optional ``threadpoolctl`` package. Returns a ``threadpoolctl.threadpool_limits`` object, whose
+    ``restore_original_limits()`` method undoes the change, or None if ``threadpoolctl`` is not
+    installed (in which case the BLAS thread count is unchanged, and can only be controlled with
+    environment variables such as ``OMP_NUM_THREADS``, set before numpy is imported).
+    """
+
+    try:
+        import threadpoolctl
+    except ImportError:
+        return None
+
+    return threadpoolctl.threadpool_limits(int(nthreads), user_api='blas')
+
+
+def Pool(processes=None, reseed_numpy_rng=True, start_method=None, worker_nthreads=None, initializer=None, initargs=()):
     """Wrapper around multiprocessing.Pool(), which reseeds the numpy RNG and calls set_nthreads() in each worker.
 
     This function addresses some issues with multiprocessing.Pool:
@@ -95,6 +115,25 @@ def Pool(processes=None, reseed_numpy_rng=True):
        - ``reseed_numpy_rng`` (boolean): if True (the default), then numpy's global RNG will 
          be re-seeded in each worker thread. You should always do this, unless you're confident
          that the workers won't use the global RNG.
+
+         Note that reseeding makes the workers independent, but not reproducible (and the assignment
+         of tasks to workers is nondeterministic anyway). For reproducible results, pass each task
+         an explicit ``np.random.Generator``, derived from a master seed and the task index, e.g.
+         ``np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(i,)))`` (equivalent to
+         ``SeedSequence(seed).spawn()``). Many kszx functions take an optional ``rng`` argument
+         for this purpose (e.g. :func:`~kszx.simulate_gaussian_field()`).
+
+       - ``start_method`` (string or None): multiprocessing start method (``'fork'``, ``'spawn'``,
+         or ``'forkserver'``). If None, then the multiprocessing default is used. With ``'spawn'``,
+         task arguments are pickled, so large read-only arrays should be wrapped in a
+         :class:`~kszx.utils.SharedArrayDir` to avoid copying them to each worker.
+
+       - ``worker_nthreads`` (int or None): number of threads per worker (see
+         :func:`~kszx.utils.get_nthreads()`). If None, then ``get_nthreads() // processes``.
+
+       - ``initializer``, ``initargs``: if ``initializer`` is specified, then ``initializer(*initargs)``
+         is called in each worker (after ``set_nthreads()``), as in ``multiprocessing.Pool()``. This
+         can be used to send large read-only objects to each worker once, rather than with each task.
     """
 
     if processes is None:
@@ -105,7 +144,12 @@ def Pool(processes=None, reseed_numpy_rng=True):
         
     assert processes > 0
     assert processes == int(processes)
-    worker_nthreads = max(get_nthreads() // int(processes), 1)
+    
+    if worker_nthreads is None:
+        worker_nthreads = max(get_nthreads() // int(processes), 1)
+
+    assert 0 < worker_nthreads <= os.cpu_count()
+    worker_nthreads = int(worker_nthreads)
     
     print(f'Creating multiprocessing pool with {processes} worker processes, and {worker_nthreads} threads/worker.')
 
@@ -114,8 +158,183 @@ def Pool(processes=None, reseed_numpy_rng=True):
     else:
         print('Warning: global numpy RNG is shared between worker process! (reseed_numpy_rng=False)')
     
-    initargs = (worker_nthreads, reseed_numpy_rng)   # arguments to set_nthreads() called in each worker
-    return multiprocessing.Pool(processes, initializer=set_nthreads, initargs=initargs)
+    ctx = multiprocessing.get_context(start_method)
+    
+    if initializer is None:
+        initargs = (worker_nthreads, reseed_numpy_rng)   # arguments to set_nthreads() called in each worker
+        return ctx.Pool(processes, initializer=set_nthreads, initargs=initargs)
+
+    initargs = (worker_nthreads, reseed_numpy_rng, initializer, tuple(initargs))
+    return ctx.Pool(processes, initializer=_init_pool_worker, initargs=initargs)
+
+
+def _init_pool_worker(nthreads, reseed_numpy_rng, initializer, initargs):
+    """Helper for Pool(): worker initializer, if the caller specifies an initializer."""
+    set_nthreads(nthreads, reseed_numpy_rng)
+    initializer(*initargs)
+
+
+def _get_rng(rng):
+    """Helper for functions with an optional ``rng`` argument: returns ``rng``, or numpy's global RNG if None.
+
+    (The ``np.random`` module has the same interface as ``np.random.Generator`` for the methods we use,
+    e.g. ``normal()``, ``uniform()``, ``permutation()``, so callers don't need to distinguish the two cases.)
+    """
+    return np.random if (rng is None) else rng
+
+
+def get_available_cpus():
+    """Returns the number of CPUs (logical cores) available to the current process.
+
+    Uses ``os.sched_getaffinity()`` if available (so that e.g. slurm/taskset CPU masks are
+    respected), otherwise ``os.cpu_count()``.
+    """
+
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+
+
+def get_available_memory():
+    """Returns the amount of memory (in bytes) available for new allocations, without swapping.
+
+    On Linux, this is the 'MemAvailable' field of ``/proc/meminfo``. Otherwise (or if MemAvailable
+    is not present), falls back to (free pages) x (page size).
+    """
+
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024   # units are kB
+    except OSError:
+        pass
+
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+class SharedArrayDir:
+    def __init__(self, dirname=None, min_free_bytes=0):
+        r"""Directory of read-only, memory-mapped arrays, which can be passed to worker processes without copying.
+
+        :meth:`~kszx.utils.SharedArrayDir.share()` writes an array to a file in the directory, and returns
+        a read-only memory-mapped copy. When the returned array is pickled (e.g. as part of a task
+        submitted to a :func:`~kszx.utils.Pool()`), only the filename is pickled, and the worker
+        process attaches to the same file. Since all processes map the same file, the array is
+        stored once in memory (in the OS page cache), regardless of the number of workers. This
+        works with any multiprocessing start method, including ``'spawn'``.
+
+        Constructor args:
+
+          - ``dirname`` (string or None): parent directory. A new temporary subdirectory is created
+            in ``dirname``, and deleted by :meth:`~kszx.utils.SharedArrayDir.close()`. If None, then
+            ``/dev/shm`` is used if it exists and has at least ``min_free_bytes`` free, otherwise
+            the default temporary directory.
+
+          - ``min_free_bytes`` (integer): only used if ``dirname`` is None (see above).
+
+        Example usage::
+
+          with kszx.utils.SharedArrayDir() as sdir:
+              big_array = sdir.share(big_array)   # replace by memory-mapped version
+              with kszx.utils.Pool(start_method='spawn') as pool:
+                  f = [ pool.apply_async(np.sum, (big_array,)) for _ in range(10) ]
+                  f = [ x.get() for x in f ]
+
+        Notes:
+
+          - Views of a shared array (e.g. slices) are pickled by value, not by filename.
+
+          - If a shared array is pickled after the SharedArrayDir is closed, then it is pickled by value.
+            (On Linux, arrays in the parent process remain valid after closing, since deleted files
+            remain accessible while memory-mapped.)
+        """
+        
+        if dirname is None:
+            dirname = '/dev/shm' if os.path.isdir('/dev/shm') else None
+            if (dirname is not None) and (shutil.disk_usage(dirname).free < min_free_bytes):
+                dirname = None
+
+        self.dirname = tempfile.mkdtemp(prefix='kszx_shared_', dir=dirname)
+        self.nbytes = 0
+        self._nfiles = 0
+
+
+    def share(self, arr):
+        """Writes 'arr' to a file in the shared directory, and returns a read-only memory-mapped copy.
+
+        The returned array is pickled by filename (not by value). If ``arr`` is None, returns None.
+        """
+
+        if arr is None:
+            return None
+        if self.dirname is None:
+            raise RuntimeError('kszx.utils.SharedArrayDir.share(): directory has been closed')
+
+        arr = np.asarray(arr)
+        filename = os.path.join(self.dirname, f'{self._nfiles}.npy')
+        np.save(filename, arr, allow_pickle=False)
+        
+        self._nfiles += 1
+        self.nbytes += arr.nbytes
+        return _open_shared_array(filename)
+
+
+    def close(self):
+        """Deletes the shared directory (see notes in class docstring)."""
+        
+        if self.dirname is not None:
+            shutil.rmtree(self.dirname, ignore_errors=True)
+            self.dirname = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _SharedArray(np.ndarray):
+    """Helper for SharedArrayDir: read-only memory-mapped array, which is pickled by filename.
+
+    Arrays computed from a _SharedArray (e.g. by ufuncs or numpy functions) are plain numpy arrays.
+    """
+
+    def __array_finalize__(self, obj):
+        self._shared_filename = None   # views are not shared (pickled by value)
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        inputs = _unshare(inputs)
+        if 'out' in kwargs:
+            kwargs['out'] = _unshare(kwargs['out'])
+        return getattr(ufunc, method)(*inputs, **kwargs)
+
+    def __array_function__(self, func, types, args, kwargs):
+        return func(*_unshare(args), **{ k: _unshare(v) for (k,v) in kwargs.items() })
+
+    def __reduce__(self):
+        fn = self._shared_filename
+        if (fn is None) or (not os.path.exists(fn)):
+            return np.asarray(self).copy().__reduce__()
+        return (_open_shared_array, (fn,))
+
+
+def _unshare(x):
+    """Helper for _SharedArray: converts _SharedArrays to plain numpy arrays, in (possibly nested) tuples/lists."""
+
+    if isinstance(x, _SharedArray):
+        return x.view(np.ndarray)
+    if isinstance(x, (tuple, list)):
+        return type(x)(_unshare(y) for y in x)
+    return x
+
+
+def _open_shared_array(filename):
+    """Helper for SharedArrayDir: opens memory-mapped array (also called when unpickling in worker processes)."""
+
+    ret = np.load(filename, mmap_mode='r').view(_SharedArray)
+    ret._shared_filename = filename
+    return ret
 
 
 ####################################################################################################
@@ -539,6 +758,46 @@ def subtract_binned_means(data, x, nbins):
     return data - mean_per_bin[bin_indices]
 
 
+def _morton_spread(x):
+    """Helper for spatial_sort_indices(): spreads the low 21 bits of uint64 array 'x', so that bit i moves to bit 3i."""
+
+    x = x & np.uint64(0x1fffff)
+    x = (x | (x << np.uint64(32))) & np.uint64(0x1f00000000ffff)
+    x = (x | (x << np.uint64(16))) & np.uint64(0x1f0000ff0000ff)
+    x = (x | (x << np.uint64(8))) & np.uint64(0x100f00f00f00f00f)
+    x = (x | (x << np.uint64(4))) & np.uint64(0x10c30c30c30c30c3)
+    x = (x | (x << np.uint64(2))) & np.uint64(0x1249249249249249)
+    return x
+
+
+def spatial_sort_indices(box, points):
+    """Returns a permutation of 'points' which makes nearby points (in 3-d space) nearby in memory.
+
+    The return value is a 1-d integer array ``perm``, such that ``points[perm]`` is sorted along
+    a Morton (Z-order) curve, at the resolution of the pixels in ``box``. Sorting points this way
+    makes gridding/interpolation kernels (e.g. :func:`~kszx.grid_points()`) more cache-friendly,
+    since consecutive points access nearby grid locations.
+
+    The sort is stable, so points in the same pixel keep their original relative order.
+    Points outside the box are allowed (they are sorted as if they were on the box boundary).
+    See also :meth:`kszx.Catalog.sort_spatially()`.
+    """
+
+    points = np.asarray(points)
+    
+    if (points.ndim != 2) or (points.shape[1] != box.ndim) or (box.ndim > 3):
+        raise RuntimeError(f"kszx.utils.spatial_sort_indices(): expected points.shape=(N,{box.ndim}) with ndim <= 3, got shape {points.shape}")
+
+    code = np.zeros(points.shape[0], dtype=np.uint64)
+    
+    for axis in range(box.ndim):
+        ix = (points[:,axis] - box.lpos[axis]) / box.pixsize + 0.5
+        ix = np.clip(ix, 0, box.npix[axis]-1).astype(np.uint64)
+        code |= _morton_spread(ix) << np.uint64(box.ndim - axis - 1)
+
+    return np.argsort(code, kind='stable')
+
+
 def random_rotation_matrix(N):
     """Returns a random N-by-N rotation matrix."""
 
@@ -667,9 +926,10 @@ def flatten_cholesky(L):
 
 
 def unflatten_cholesky(vec, dim):
-    L = np.zeros((dim, dim))
-    tril_indices = np.tril_indices(dim)
-    L[tril_indices] = vec
+    vec = np.asarray(vec)
+    L = np.zeros(vec.shape[:-1] + (dim, dim))
+    i, j = np.tril_indices(dim)
+    L[..., i, j] = vec
     return L
 
 
@@ -9,7 +9,9 @@ cpp_source_files = [
     "cpp/cic.cpp",
     "cpp/cubic.cpp",
     "cpp/estimate_power_spectrum.cpp",
-    "cpp/kbin_average.cpp"
+    "cpp/kbin_average.cpp",
+    "cpp/stencil.cpp",
+    "cpp/rfft_packed.cpp"
 ]
 
 ext_module = Pybind11Extension(